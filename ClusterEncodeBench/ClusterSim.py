@@ -0,0 +1,573 @@
+#!/usr/bin/env python3
+"""
+    File: ClusterSim.py
+    Description: Run a whole cluster on this machine, for end-to-end, and scaling tests. Starts N daemons on loopback
+        ports, each with its own home, and local working directory under a temporary root, and one shared working
+        directory for them all; Node 0 is the file host. Complete split -> encode -> combine jobs are then driven
+        across them, for each cluster size asked for, and the scaling efficiency from 1 to N nodes is reported.
+        Uses the fake ffmpeg by default, see ffmpegCli/FakeFfmpeg.py, or real ffmpeg with '--real --source <file>'.
+
+    Usage: ./ClusterSim.py --nodes 4 --slots 2
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection
+from threading import Thread
+from typing import Optional, Final, Any, Callable
+
+sys.path.append('../')
+from ffmpegCli.FakeFfmpeg import make_fake_media
+from ffmpegCli.Ffmpegcli import Ffmpegcli, find_ffmpeg
+
+DAEMON_DIR: Final[str] = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                      'ClusterEncodeDaemon')
+"""The directory the daemon is run from, it imports ffmpegCli from '../'."""
+SIM_SECRET: Final[str] = 'cluster-sim-secret'
+"""The shared secret of the simulated daemons."""
+BUSY_ERROR: Final[int] = 80
+"""The error number a daemon replies with when it's too busy to accept work."""
+BUSY_MAX_RETRIES: Final[int] = 10
+"""The number of times to retry a command a daemon was too busy for."""
+BUSY_DEFAULT_RETRY_AFTER: Final[float] = 5.0
+"""Seconds to wait before retrying a busy daemon that didn't say how long to wait."""
+START_TIMEOUT: Final[float] = 30.0
+"""Seconds to wait for a daemon to start listening."""
+STOP_TIMEOUT: Final[float] = 15.0
+"""Seconds to wait for a daemon to exit after 'shutdown', before it's killed."""
+FINAL_STATUSES: Final[tuple[str, ...]] = ('split finished', 'encode chunks finished', 'combine finished', 'trace',
+                                          'error')
+"""The statuses that end a command's replies, the rest are progress reports."""
+
+
+class SimError(Exception):
+    """
+    Exception to throw when a simulated node, or a job on it, fails.
+    """
+    def __init__(self, message: str) -> None:
+        self._message: str = message
+        return
+
+    @property
+    def message(self) -> str:
+        return self._message
+
+    def __str__(self) -> str:
+        return self._message
+
+
+def find_free_port() -> int:
+    """
+    Find a free loopback port by binding to port 0. Another process could take it before the daemon binds it, but
+    nothing else on a test machine should be racing for ports.
+    :return: int: The port.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class SimNode(object):
+    """
+    A daemon running on a loopback port, with its own home, and local working directory.
+    """
+    def __init__(self, index: int, root_dir: str, shared_dir: str, slots: int, fake: bool, admission: bool,
+                 env: dict[str, str]) -> None:
+        """
+        Initialize the node, and write its config file.
+        :param index: int: The node number, 0 is the file host.
+        :param root_dir: str: The temporary root directory, the node's directory is made in it.
+        :param shared_dir: str: The shared working directory of all the nodes.
+        :param slots: int: The number of encode slots.
+        :param fake: bool: True use the fake ffmpeg.
+        :param admission: bool: True keep the default admission limits; They're turned off otherwise, every node
+        shares this machine's memory, load, and disk, so one busy node would hold back all the others.
+        :param env: dict[str, str]: Extra environment variables for the daemon, IE: FAKE_FFMPEG_SPEED.
+        """
+        self.index: int = index
+        """The node number."""
+        self.name: str = 'node%i' % index
+        """The node's name."""
+        self.port: int = find_free_port()
+        """The port the daemon listens on."""
+        self.is_file_host: bool = index == 0
+        """True this node is the file host."""
+        self.node_dir: str = os.path.join(root_dir, self.name)
+        """The node's directory, holding its home, local working directory, and config."""
+        self.home_dir: str = os.path.join(self.node_dir, 'home')
+        """The daemon's home, so each gets its own .ClusterEncodeDaemon, log, and working file manifest."""
+        self.local_dir: str = os.path.join(self.node_dir, 'local')
+        """The daemon's local working directory."""
+        self.config_path: str = os.path.join(self.node_dir, 'config.json')
+        """The daemon's config file."""
+        self.output_path: str = os.path.join(self.node_dir, 'daemon.out')
+        """Where the daemon's stdout and stderr go."""
+        self._fake: bool = fake
+        """True the daemon uses the fake ffmpeg."""
+        self._env: dict[str, str] = env
+        """Extra environment variables for the daemon."""
+        self._process: Optional[subprocess.Popen] = None
+        """The daemon process, while running."""
+        for dir_path in (self.home_dir, os.path.join(self.local_dir, 'Input'), os.path.join(self.local_dir, 'Output')):
+            os.makedirs(dir_path, exist_ok=True)
+        config: dict[str, Any] = {
+            'sharedWorkingDir': shared_dir,
+            'localWorkingDir': self.local_dir,
+            'host': '127.0.0.1',
+            'port': self.port,
+            'sharedSecret': SIM_SECRET,
+            'numChunks': slots,
+            'isFileHost': self.is_file_host,
+        }
+        if not admission:
+            config.update({'minFreeMemory': 0, 'maxLoadPercent': 0, 'minFreeDisk': 0})
+        with open(self.config_path, 'w') as file_handle:
+            json.dump(config, file_handle, indent=4)
+        return
+
+    def start(self) -> None:
+        """
+        Start the daemon, without waiting for it to listen.
+        :return: None
+        """
+        command: list[str] = [sys.executable, 'main.py', '--noFork', '--configFile', self.config_path]
+        if self._fake:
+            command.append('--fakeFfmpeg')
+        env: dict[str, str] = dict(os.environ)
+        env.update(self._env)
+        env['HOME'] = self.home_dir
+        with open(self.output_path, 'a') as output_handle:
+            self._process = subprocess.Popen(command, cwd=DAEMON_DIR, env=env, stdin=subprocess.DEVNULL,
+                                             stdout=output_handle, stderr=subprocess.STDOUT)
+        return
+
+    def wait_ready(self, timeout: float = START_TIMEOUT) -> None:
+        """
+        Wait for the daemon to accept connections. Raises SimError if it exits, or doesn't listen within the timeout.
+        :param timeout: float = START_TIMEOUT: Seconds to wait.
+        :return: None
+        """
+        deadline: float = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise SimError("%s exited with %i, see '%s'." % (self.name, self._process.returncode,
+                                                                 self.output_path))
+            try:
+                connection = self.connect()
+            except (ConnectionRefusedError, OSError):
+                time.sleep(0.1)
+                continue
+            connection.send({'version': '1.0.0', 'command': 'close'})
+            connection.close()
+            return
+        raise SimError("%s didn't start listening within %i seconds." % (self.name, int(timeout)))
+
+    def connect(self) -> Connection:
+        """
+        Connect to the daemon.
+        :return: Connection: The connection.
+        """
+        try:
+            return Client(('127.0.0.1', self.port), authkey=SIM_SECRET.encode())
+        except AuthenticationError:
+            raise SimError("%s failed authentication." % self.name)
+
+    def stop(self) -> None:
+        """
+        Shut the daemon down, killing it if it doesn't exit in time.
+        :return: None
+        """
+        if self._process is None or self._process.poll() is not None:
+            return
+        try:
+            connection = self.connect()
+            connection.send({'version': '1.0.0', 'command': 'shutdown'})
+            connection.close()
+            self._process.wait(STOP_TIMEOUT)
+        except (OSError, EOFError, SimError, subprocess.TimeoutExpired):
+            self._process.kill()
+            self._process.wait()
+        return
+
+    def request(self, command_obj: dict[str, Any], on_report: Optional[Callable[[dict[str, Any]], None]] = None
+                ) -> dict[str, Any]:
+        """
+        Send a command on a new connection, and wait for its final reply. A busy daemon (error 80) is retried after
+        the 'retryAfter' it gives, up to BUSY_MAX_RETRIES times. Raises SimError if the daemon replies with an error.
+        :param command_obj: dict[str, Any]: The command object.
+        :param on_report: Optional[Callable[[dict[str, Any]], None]] = None: Called with each progress report.
+        :return: dict[str, Any]: The final reply.
+        """
+        retries: int = 0
+        while True:
+            connection = self.connect()
+            try:
+                connection.send(command_obj)
+                while True:
+                    response_obj: dict[str, Any] = connection.recv()
+                    if response_obj.get('status') in FINAL_STATUSES:
+                        break
+                    if on_report is not None:
+                        on_report(response_obj)
+                if response_obj['status'] != 'error':
+                    connection.send({'version': '1.0.0', 'command': 'close'})
+            except EOFError:
+                raise SimError("%s closed the connection during '%s'." % (self.name, command_obj['command']))
+            finally:
+                connection.close()
+            if response_obj['status'] != 'error':
+                return response_obj
+            error: dict[str, Any] = response_obj['error']
+            if error['number'] != BUSY_ERROR or retries >= BUSY_MAX_RETRIES:
+                raise SimError("%s replied to '%s' with error %i: %s" % (self.name, command_obj['command'],
+                                                                         error['number'], error['message']))
+            retries += 1
+            time.sleep(error.get('retryAfter', BUSY_DEFAULT_RETRY_AFTER))
+
+
+class SimCluster(object):
+    """
+    A cluster of simulated nodes sharing one working directory. Use as a context manager to stop the nodes after.
+    """
+    def __init__(self, root_dir: str, num_nodes: int, slots: int, fake: bool, admission: bool,
+                 env: dict[str, str]) -> None:
+        """
+        Initialize the cluster.
+        :param root_dir: str: The directory to make the nodes' directories in, it's emptied first.
+        :param num_nodes: int: The number of nodes.
+        :param slots: int: The number of encode slots on each node.
+        :param fake: bool: True use the fake ffmpeg.
+        :param admission: bool: True keep the default admission limits, see SimNode.
+        :param env: dict[str, str]: Extra environment variables for the daemons.
+        """
+        if os.path.exists(root_dir):
+            shutil.rmtree(root_dir)
+        self.root_dir: str = root_dir
+        """The cluster's directory."""
+        self.shared_dir: str = os.path.join(root_dir, 'shared')
+        """The shared working directory."""
+        os.makedirs(self.shared_dir)
+        self.nodes: list[SimNode] = [SimNode(index, root_dir, self.shared_dir, slots, fake, admission, env)
+                                     for index in range(num_nodes)]
+        """The nodes, the file host first."""
+        return
+
+    @property
+    def file_host(self) -> SimNode:
+        return self.nodes[0]
+
+    def start(self) -> None:
+        """
+        Start the nodes, the file host first, it makes the shared 'Input' and 'Output' directories.
+        :return: None
+        """
+        self.file_host.start()
+        self.file_host.wait_ready()
+        for node in self.nodes[1:]:
+            node.start()
+        for node in self.nodes[1:]:
+            node.wait_ready()
+        return
+
+    def stop(self) -> None:
+        """
+        Stop all the nodes.
+        :return: None
+        """
+        for node in self.nodes:
+            node.stop()
+        return
+
+    def __enter__(self) -> 'SimCluster':
+        try:
+            self.start()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *_exc_info) -> None:
+        self.stop()
+        return
+
+    def shared_path(self, path: str) -> str:
+        """
+        Convert a path in the shared directory to a '%shared%/' path, so each node maps it to its own mount.
+        :param path: str: The full path.
+        :return: str: The '%shared%/' path.
+        """
+        return '%shared%/' + os.path.relpath(path, self.shared_dir)
+
+    def collect_trace(self) -> list[dict[str, Any]]:
+        """
+        Collect, and clear, the traced spans of every node. The nodes share this machine's clock, so no offsets.
+        :return: list[dict[str, Any]]: The Chrome trace events.
+        """
+        trace_events: list[dict[str, Any]] = []
+        for node in self.nodes:
+            response_obj = node.request({'version': '1.0.0', 'command': 'trace', 'clear': True})
+            trace_events.extend(response_obj['traceEvents'])
+        return trace_events
+
+
+def run_job(cluster: SimCluster, job_id: str, source_path: str, length: timedelta, chunk_size: int,
+            encode_settings: dict[str, Any], use_local_copy: bool) -> dict[str, Any]:
+    """
+    Run a complete job: Split the source on the file host, encode the chunks round robin across all the nodes at
+    once, then combine them on the file host.
+    :param cluster: SimCluster: The running cluster.
+    :param job_id: str: The job id.
+    :param source_path: str: The full path to the source, in the shared directory.
+    :param length: timedelta: The length of the source.
+    :param chunk_size: int: The length of each chunk, in seconds.
+    :param encode_settings: dict[str, Any]: The ENCODE_PARAMS of the encode command.
+    :param use_local_copy: bool: True the nodes copy the chunks to their local working directory to encode.
+    :return: dict[str, Any]: The timings in seconds: 'split', 'encode', 'combine', and 'total'; And 'numChunks'.
+    """
+    start: float = time.monotonic()
+    split_obj = cluster.file_host.request({
+        'version': '1.0.0',
+        'command': 'split',
+        'inputFile': cluster.shared_path(source_path),
+        'outputDir': '%shared%/Input',
+        'chunkSize': chunk_size,
+        'length': length,
+        'jobId': job_id,
+    })
+    if not split_obj['success']:
+        raise SimError("Split of job '%s' failed." % job_id)
+    split_time: float = time.monotonic()
+
+    # Deal the chunks out round robin, and encode on every node at once:
+    chunk_paths: list[str] = sorted(split_obj['outputFiles'], key=lambda path: Ffmpegcli.part_sort_key(
+        os.path.basename(path)))
+    node_chunks: list[list[dict[str, Any]]] = [[] for _node in cluster.nodes]
+    for index, chunk_path in enumerate(chunk_paths):
+        node_chunks[index % len(cluster.nodes)].append({
+            'inputFile': cluster.shared_path(chunk_path),
+            'outputFile': '%shared%/Output/' + os.path.basename(chunk_path),
+        })
+    results: list[Optional[dict[str, Any] | SimError]] = [None] * len(cluster.nodes)
+
+    def encode_on(node: SimNode) -> None:
+        command_obj: dict[str, Any] = {
+            'version': '1.0.0',
+            'command': 'encode_chunks',
+            'jobId': job_id,
+            'chunks': node_chunks[node.index],
+            'useLocalCopy': use_local_copy,
+        }
+        command_obj.update(encode_settings)
+        try:
+            results[node.index] = node.request(command_obj)
+        except (SimError, OSError) as e:
+            results[node.index] = SimError(str(e))
+        return
+
+    threads: list[Thread] = [Thread(target=encode_on, args=(node,), daemon=True)
+                             for node in cluster.nodes if len(node_chunks[node.index]) > 0]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    output_paths: list[str] = []
+    for result in results:
+        if isinstance(result, SimError):
+            raise result
+        if result is not None:
+            if not result['success']:
+                raise SimError("Encode of job '%s' failed." % job_id)
+            output_paths.extend(result['outputFiles'])
+    encode_time: float = time.monotonic()
+
+    output_name: str = '%s%s' % (job_id, os.path.splitext(source_path)[1])
+    cluster.file_host.request({
+        'version': '1.0.0',
+        'command': 'combine',
+        'inputFiles': [cluster.shared_path(path) for path in output_paths],
+        'outputFile': '%shared%/' + output_name,
+        'jobId': job_id,
+    })
+    end: float = time.monotonic()
+    os.remove(os.path.join(cluster.shared_dir, output_name))
+    return {
+        'numChunks': len(chunk_paths),
+        'split': split_time - start,
+        'encode': encode_time - split_time,
+        'combine': end - encode_time,
+        'total': end - start,
+    }
+
+
+def run_step(args: argparse.Namespace, num_nodes: int, env: dict[str, str]) -> dict[str, Any]:
+    """
+    Start a cluster of num_nodes nodes, run the jobs on it, and stop it.
+    :param args: argparse.Namespace: The command line arguments.
+    :param num_nodes: int: The number of nodes.
+    :param env: dict[str, str]: Extra environment variables for the daemons.
+    :return: dict[str, Any]: The number of nodes, and the mean timings of the jobs, see run_job().
+    """
+    root_dir: str = os.path.join(args.root, '%i-nodes' % num_nodes)
+    with SimCluster(root_dir, num_nodes, args.slots, not args.real, args.admission, env) as cluster:
+        if args.real:
+            source_path: str = os.path.join(cluster.shared_dir, os.path.basename(args.source))
+            shutil.copyfile(args.source, source_path)
+        else:
+            source_path = os.path.join(cluster.shared_dir, 'source.mkv')
+            make_fake_media(source_path, args.duration)
+        ffmpeg_path, ffprobe_path = find_ffmpeg(not args.real)
+        length: Optional[timedelta] = Ffmpegcli(ffmpeg_path, ffprobe_path).get_duration(source_path)
+        if length is None:
+            raise SimError("Failed to get the duration of '%s'." % source_path)
+        encode_settings: dict[str, Any] = {
+            'audioEncoder': args.audioEncoder,
+            'downMixAudio': False,
+            'boostVolume': 0,
+            'videoEncoder': args.videoEncoder,
+            'scaleVideo': None,
+        }
+        jobs: list[dict[str, Any]] = []
+        for job_number in range(args.jobs):
+            job_id = 'sim%i-%i' % (num_nodes, job_number)
+            jobs.append(run_job(cluster, job_id, source_path, length, args.chunkSize, encode_settings,
+                                not args.noLocalCopy))
+            print("  %s: %.2fs, %i chunks." % (job_id, jobs[-1]['total'], jobs[-1]['numChunks']), file=sys.stderr)
+        if args.trace is not None:
+            trace_path: str = os.path.join(args.trace, 'trace-%i-nodes.json' % num_nodes)
+            with open(trace_path, 'w') as file_handle:
+                json.dump({'traceEvents': cluster.collect_trace(), 'displayTimeUnit': 'ms'}, file_handle)
+    step: dict[str, Any] = {'nodes': num_nodes}
+    for key in ('split', 'encode', 'combine', 'total'):
+        step[key] = sum(job[key] for job in jobs) / len(jobs)
+    step['numChunks'] = jobs[0]['numChunks']
+    return step
+
+
+def add_scaling(steps: list[dict[str, Any]]) -> None:
+    """
+    Add the speedup, and efficiency of each step against the smallest cluster: Speedup is its total time over the
+    step's, and efficiency is the speedup over the growth in nodes, 1.0 is perfect scaling.
+    :param steps: list[dict[str, Any]]: The steps, from run_step(), smallest cluster first.
+    :return: None
+    """
+    base: dict[str, Any] = steps[0]
+    for step in steps:
+        step['speedup'] = base['total'] / step['total']
+        step['efficiency'] = step['speedup'] * base['nodes'] / step['nodes']
+    return
+
+
+def print_report(steps: list[dict[str, Any]]) -> None:
+    """
+    Print the scaling table.
+    :param steps: list[dict[str, Any]]: The steps, with add_scaling() done.
+    :return: None
+    """
+    print('%5s %9s %9s %9s %9s %8s %10s' % ('nodes', 'total', 'split', 'encode', 'combine', 'speedup', 'efficiency'))
+    for step in steps:
+        print('%5i %8.2fs %8.2fs %8.2fs %8.2fs %7.2fx %9.0f%%' % (step['nodes'], step['total'], step['split'],
+                                                                  step['encode'], step['combine'], step['speedup'],
+                                                                  step['efficiency'] * 100.0))
+    return
+
+
+def parse_steps(value: str) -> list[int]:
+    """
+    Parse the '--steps' argument.
+    :param value: str: The cluster sizes, IE: '1,2,4'.
+    :return: list[int]: The sizes, smallest first.
+    """
+    try:
+        steps = sorted({int(step) for step in value.split(',')})
+    except ValueError:
+        raise argparse.ArgumentTypeError("steps must be a comma separated list of integers.")
+    if len(steps) == 0 or steps[0] < 1:
+        raise argparse.ArgumentTypeError("steps must be 1 or more.")
+    return steps
+
+
+def main() -> int:
+    """
+    Run the simulation.
+    :return: int: The exit code.
+    """
+    parser = argparse.ArgumentParser(description="Run a simulated cluster of daemons on this machine, and report how "
+                                                 "the job time scales with the number of nodes.")
+    parser.add_argument('--nodes', type=int, default=4, help="The max number of nodes, default 4.")
+    parser.add_argument('--steps', type=parse_steps, default=None,
+                        help="The cluster sizes to run, IE: '1,2,4'; Default every size from 1 to --nodes.")
+    parser.add_argument('--slots', type=int, default=1, help="The encode slots on each node, default 1.")
+    parser.add_argument('--jobs', type=int, default=1, help="The jobs to run at each size, default 1.")
+    parser.add_argument('--chunkSize', type=int, default=30, help="The chunk length in seconds, default 30.")
+    parser.add_argument('--duration', type=float, default=600.0,
+                        help="The fake source's length in seconds, default 600.")
+    parser.add_argument('--speed', type=float, default=50.0,
+                        help="The fake ffmpeg's encode speed, seconds of media per second, default 50.")
+    parser.add_argument('--failRate', type=float, default=0.0,
+                        help="The chance, 0 - 1, a fake split / encode fails, default 0.")
+    parser.add_argument('--real', action='store_true', default=False,
+                        help="Use the real ffmpeg, and the --source file, instead of the fake.")
+    parser.add_argument('--source', type=str, default=None, help="The source to encode with --real.")
+    parser.add_argument('--audioEncoder', type=str, default='aac', help="The audio encoder, default aac.")
+    parser.add_argument('--videoEncoder', type=str, default='libx264', help="The video encoder, default libx264.")
+    parser.add_argument('--noLocalCopy', action='store_true', default=False,
+                        help="Encode straight from the shared directory, instead of a local copy.")
+    parser.add_argument('--admission', action='store_true', default=False,
+                        help="Keep the daemons' default admission limits.")
+    parser.add_argument('--root', type=str, default=None,
+                        help="The directory to run the nodes in, default a new temporary directory.")
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help="Keep the nodes' directories, with their logs, after the run.")
+    parser.add_argument('--trace', type=str, default=None,
+                        help="A directory to save a Chrome trace of each cluster size in.")
+    parser.add_argument('--json', type=str, default=None, help="A file to save the results in, as JSON.")
+    args = parser.parse_args()
+
+    steps: list[int] = args.steps if args.steps is not None else list(range(1, args.nodes + 1))
+    if args.real and (args.source is None or not os.path.isfile(args.source)):
+        print("--real needs a --source file.", file=sys.stderr)
+        return 2
+    if args.real and find_ffmpeg(False)[0] is None:
+        print("ffmpeg not found.", file=sys.stderr)
+        return 3
+    remove_root: bool = args.root is None and not args.keep
+    if args.root is None:
+        args.root = tempfile.mkdtemp(prefix='ClusterSim-')
+    args.root = os.path.abspath(args.root)
+    env: dict[str, str] = {
+        'FAKE_FFMPEG_SPEED': str(args.speed),
+        'FAKE_FFMPEG_FAIL_RATE': str(args.failRate),
+    }
+    if args.trace is not None:
+        os.makedirs(args.trace, exist_ok=True)
+
+    results: list[dict[str, Any]] = []
+    try:
+        for num_nodes in steps:
+            print("Running %i node%s..." % (num_nodes, 's' if num_nodes > 1 else ''), file=sys.stderr)
+            results.append(run_step(args, num_nodes, env))
+    except SimError as e:
+        print("Simulation failed: %s" % e.message, file=sys.stderr)
+        print("Node directories kept in '%s'." % args.root, file=sys.stderr)
+        return 1
+    if remove_root:
+        shutil.rmtree(args.root, ignore_errors=True)
+
+    add_scaling(results)
+    print_report(results)
+    if args.json is not None:
+        with open(args.json, 'w') as file_handle:
+            json.dump(results, file_handle, indent=4)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+    File: ProtocolBench.py
+    Description: Micro-benchmark the daemon's protocol over loopback: Messages per second, and p50 / p99 round trip
+        latency of 'status' and 'report' on an open connection, of connecting and authenticating, and of the progress
+        reports an encode streams back; With one client, and with many at once, each in its own process so the
+        clients' GIL isn't what's measured. Also times encoding and decoding the daemon's replies with each codec,
+        without the network. Transports and codecs are looked up by name, so a new wire format is benchmarked by
+        adding it to TRANSPORTS and CODECS.
+
+    Usage: ./ProtocolBench.py --clients 1,8,32
+        Starts a daemon with the fake ffmpeg in a temporary directory; Or pass --port and --secret to benchmark a
+        daemon that's already running.
+"""
+import argparse
+import json
+import math
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue, Event
+from multiprocessing.connection import Client
+from typing import Optional, Final, Any, Callable
+
+sys.path.append('../')
+from ffmpegCli.FakeFfmpeg import make_fake_media
+from ClusterSim import SimCluster, SimError, SIM_SECRET
+
+SCENARIOS: Final[tuple[str, ...]] = ('status', 'report', 'connect', 'progress')
+"""The scenarios: 'status' and 'report' round trips on an open connection; 'connect' a new connection, status, and
+close each time; 'progress' the gaps between the progress reports of back to back encodes."""
+PROGRESS_MEDIA_LENGTH: Final[float] = 20.0
+"""The length in seconds of the fake media encoded by the 'progress' scenario."""
+PROGRESS_SPEED: Final[float] = 10.0
+"""The fake ffmpeg speed of the started daemon, so each 'progress' encode lasts a couple of seconds."""
+CODEC_ROUNDS: Final[int] = 20000
+"""The number of times each reply is encoded and decoded by the codec benchmark."""
+
+
+def connect_pickle(host: str, port: int, secret: str) -> Any:
+    """
+    Connect with the daemon's current transport: multiprocessing.connection, pickled dicts, HMAC authentication.
+    :param host: str: The daemon's address.
+    :param port: int: The daemon's port.
+    :param secret: str: The shared secret.
+    :return: Any: The channel, with send(obj), recv(), and close().
+    """
+    return Client((host, port), authkey=secret.encode())
+
+
+TRANSPORTS: Final[dict[str, Callable[[str, int, str], Any]]] = {
+    'pickle': connect_pickle,
+}
+"""The transports, by name: Called with (host, port, secret), they return a channel with send(obj), recv(), and
+close()."""
+CODECS: Final[dict[str, tuple[Callable[[Any], bytes], Callable[[bytes], Any]]]] = {
+    'pickle': (lambda obj: pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), pickle.loads),
+}
+"""The wire encodings, by name: (encode, decode) functions."""
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    """
+    Get a percentile, by the nearest rank.
+    :param sorted_values: list[float]: The values, sorted.
+    :param percent: float: The percentile, 0 - 100.
+    :return: float: The value, 0.0 if there are none.
+    """
+    if len(sorted_values) == 0:
+        return 0.0
+    rank: int = max(math.ceil(percent / 100.0 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def _command(command: str, **params) -> dict[str, Any]:
+    command_obj: dict[str, Any] = {'version': '1.0.0', 'command': command}
+    command_obj.update(params)
+    return command_obj
+
+
+def _round_trips(channel: Any, command_obj: dict[str, Any], deadline: float) -> list[float]:
+    """
+    Send a command and wait for its reply, over and over on one connection.
+    :param channel: Any: The open channel.
+    :param command_obj: dict[str, Any]: The command object.
+    :param deadline: float: The time.perf_counter() to stop at.
+    :return: list[float]: The round trip times, in seconds.
+    """
+    times: list[float] = []
+    while True:
+        start: float = time.perf_counter()
+        if start >= deadline:
+            return times
+        channel.send(command_obj)
+        channel.recv()
+        times.append(time.perf_counter() - start)
+
+
+def _progress_gaps(channel: Any, command_obj: dict[str, Any], deadline: float) -> list[float]:
+    """
+    Run encodes back to back, timing the gaps between their progress reports. The daemon reports every half
+    second, so the gaps show how late reports are delivered when many streams are running.
+    :param channel: Any: The open channel.
+    :param command_obj: dict[str, Any]: The encode command object.
+    :param deadline: float: The time.perf_counter() to stop starting encodes at.
+    :return: list[float]: The gaps, in seconds.
+    """
+    gaps: list[float] = []
+    while time.perf_counter() < deadline:
+        channel.send(command_obj)
+        last: Optional[float] = None
+        while True:
+            response_obj: dict[str, Any] = channel.recv()
+            if response_obj['status'] != 'encoding report':
+                break
+            now: float = time.perf_counter()
+            if last is not None:
+                gaps.append(now - last)
+            last = now
+        if response_obj['status'] == 'error':
+            raise SimError("Encode failed: %s" % response_obj['error']['message'])
+    return gaps
+
+
+def run_client(client_index: int, args: argparse.Namespace, scenario: str, ready: Event, results: Queue) -> None:
+    """
+    Run one client of a scenario, in its own process. Waits for ready, then runs for args.duration seconds.
+    :param client_index: int: The client number.
+    :param args: argparse.Namespace: The command line arguments.
+    :param scenario: str: The scenario.
+    :param ready: Event: Set when all the clients should start.
+    :param results: Queue: The list of times, or an error message, is put on it.
+    :return: None
+    """
+    connect: Callable[[str, int, str], Any] = TRANSPORTS[args.transport]
+    try:
+        channel = connect(args.host, args.port, args.secret)
+        ready.wait()
+        deadline: float = time.perf_counter() + args.duration
+        times: list[float] = []
+        if scenario in ('status', 'report'):
+            _round_trips(channel, _command(scenario), time.perf_counter() + args.warmup)
+            times = _round_trips(channel, _command(scenario), deadline + args.warmup)
+        elif scenario == 'connect':
+            channel.close()
+            status_obj = _command('status')
+            while True:
+                start: float = time.perf_counter()
+                if start >= deadline:
+                    break
+                channel = connect(args.host, args.port, args.secret)
+                channel.send(status_obj)
+                channel.recv()
+                channel.send(_command('close'))
+                channel.close()
+                times.append(time.perf_counter() - start)
+            channel = None
+        elif scenario == 'progress':
+            encode_obj = _command('encode', inputFile=args.progressInput,
+                                  outputFile='%%local%%/Output/bench-%i-%i.mkv' % (os.getpid(), client_index),
+                                  audioEncoder='aac', downMixAudio=False, boostVolume=0, videoEncoder='libx264',
+                                  scaleVideo=None)
+            times = _progress_gaps(channel, encode_obj, deadline)
+        if channel is not None:
+            channel.send(_command('close'))
+            channel.close()
+        results.put(times)
+    except (OSError, EOFError, SimError) as e:
+        results.put('client %i: %s' % (client_index, str(e)))
+    return
+
+
+def run_scenario(args: argparse.Namespace, scenario: str, num_clients: int) -> dict[str, Any]:
+    """
+    Run a scenario with a number of clients at once.
+    :param args: argparse.Namespace: The command line arguments.
+    :param scenario: str: The scenario.
+    :param num_clients: int: The number of clients.
+    :return: dict[str, Any]: The results: 'scenario', 'clients', 'messages', 'perSecond', 'p50', 'p99', and 'max',
+    the times in milliseconds.
+    """
+    ready: Event = Event()
+    results: Queue = Queue()
+    clients: list[Process] = [Process(target=run_client, args=(index, args, scenario, ready, results), daemon=True)
+                              for index in range(num_clients)]
+    for client in clients:
+        client.start()
+    time.sleep(0.2 + num_clients * 0.01)  # Let them all connect.
+    ready.set()
+    times: list[float] = []
+    for _client in clients:
+        result = results.get()
+        if isinstance(result, str):
+            raise SimError(result)
+        times.extend(result)
+    for client in clients:
+        client.join()
+    times.sort()
+    duration: float = args.duration
+    if scenario == 'progress':
+        duration = max(sum(times) / num_clients, 0.001)
+    return {
+        'scenario': scenario,
+        'clients': num_clients,
+        'messages': len(times),
+        'perSecond': len(times) / duration,
+        'p50': percentile(times, 50.0) * 1000.0,
+        'p99': percentile(times, 99.0) * 1000.0,
+        'max': (times[-1] if len(times) > 0 else 0.0) * 1000.0,
+    }
+
+
+def run_codecs(args: argparse.Namespace) -> list[dict[str, Any]]:
+    """
+    Time encoding and decoding the daemon's 'status' and 'report' replies with each codec.
+    :param args: argparse.Namespace: The command line arguments.
+    :return: list[dict[str, Any]]: The results: 'codec', 'message', 'bytes', and 'encodeUs' / 'decodeUs', the mean
+    times in microseconds.
+    """
+    channel = TRANSPORTS[args.transport](args.host, args.port, args.secret)
+    messages: dict[str, Any] = {}
+    for command in ('status', 'report'):
+        channel.send(_command(command))
+        messages[command] = channel.recv()
+    channel.send(_command('close'))
+    channel.close()
+    results: list[dict[str, Any]] = []
+    for codec_name, (encode, decode) in CODECS.items():
+        for message_name, message in messages.items():
+            data: bytes = encode(message)
+            start: float = time.perf_counter()
+            for _round in range(CODEC_ROUNDS):
+                encode(message)
+            encode_time: float = time.perf_counter() - start
+            start = time.perf_counter()
+            for _round in range(CODEC_ROUNDS):
+                decode(data)
+            decode_time: float = time.perf_counter() - start
+            results.append({
+                'codec': codec_name,
+                'message': message_name,
+                'bytes': len(data),
+                'encodeUs': encode_time * 1000000.0 / CODEC_ROUNDS,
+                'decodeUs': decode_time * 1000000.0 / CODEC_ROUNDS,
+            })
+    return results
+
+
+def print_report(transport: str, results: list[dict[str, Any]], codec_results: list[dict[str, Any]]) -> None:
+    """
+    Print the results tables.
+    :param transport: str: The transport name.
+    :param results: list[dict[str, Any]]: The scenario results, from run_scenario().
+    :param codec_results: list[dict[str, Any]]: The codec results, from run_codecs().
+    :return: None
+    """
+    print("Transport: %s" % transport)
+    print('%-9s %7s %9s %10s %9s %9s %9s' % ('scenario', 'clients', 'messages', 'msgs/s', 'p50 ms', 'p99 ms',
+                                             'max ms'))
+    for result in results:
+        print('%-9s %7i %9i %10.1f %9.3f %9.3f %9.3f' % (result['scenario'], result['clients'], result['messages'],
+                                                         result['perSecond'], result['p50'], result['p99'],
+                                                         result['max']))
+    print()
+    print('%-9s %-9s %7s %10s %10s' % ('codec', 'message', 'bytes', 'encode us', 'decode us'))
+    for result in codec_results:
+        print('%-9s %-9s %7i %10.2f %10.2f' % (result['codec'], result['message'], result['bytes'],
+                                               result['encodeUs'], result['decodeUs']))
+    return
+
+
+def parse_clients(value: str) -> list[int]:
+    """
+    Parse the '--clients' argument.
+    :param value: str: The client counts, IE: '1,8,32'.
+    :return: list[int]: The counts, smallest first.
+    """
+    try:
+        counts = sorted({int(count) for count in value.split(',')})
+    except ValueError:
+        raise argparse.ArgumentTypeError("clients must be a comma separated list of integers.")
+    if len(counts) == 0 or counts[0] < 1:
+        raise argparse.ArgumentTypeError("clients must be 1 or more.")
+    return counts
+
+
+def main() -> int:
+    """
+    Run the benchmark.
+    :return: int: The exit code.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the daemon protocol's throughput and latency.")
+    parser.add_argument('--clients', type=parse_clients, default=[1, 8],
+                        help="The numbers of clients to run at once, IE: '1,8,32', default '1,8'.")
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS),
+                        help="The scenarios to run, default '%s'." % ','.join(SCENARIOS))
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds to run each scenario for, default 5.")
+    parser.add_argument('--warmup', type=float, default=0.5,
+                        help="Seconds of round trips before timing starts, default 0.5.")
+    parser.add_argument('--transport', type=str, default='pickle', choices=tuple(TRANSPORTS.keys()),
+                        help="The transport, default 'pickle'.")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help="The daemon's address, with --port.")
+    parser.add_argument('--port', type=int, default=None,
+                        help="Benchmark the daemon already running on this port, instead of starting one.")
+    parser.add_argument('--secret', type=str, default=None, help="The shared secret, with --port.")
+    parser.add_argument('--progressInput', type=str, default=None,
+                        help="The input the daemon encodes for the 'progress' scenario, with --port; Use a short one.")
+    parser.add_argument('--json', type=str, default=None, help="A file to save the results in, as JSON.")
+    args = parser.parse_args()
+
+    scenarios: list[str] = [scenario for scenario in args.scenarios.split(',') if scenario != '']
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            print("Unknown scenario '%s'." % scenario, file=sys.stderr)
+            return 2
+    if args.port is not None:
+        if args.secret is None:
+            print("--port needs --secret.", file=sys.stderr)
+            return 2
+        if 'progress' in scenarios and args.progressInput is None:
+            print("The 'progress' scenario needs --progressInput with --port.", file=sys.stderr)
+            return 2
+
+    cluster: Optional[SimCluster] = None
+    root_dir: Optional[str] = None
+    try:
+        if args.port is None:
+            root_dir = tempfile.mkdtemp(prefix='ProtocolBench-')
+            cluster = SimCluster(os.path.join(root_dir, 'cluster'), 1, max(args.clients), True, False,
+                                 {'FAKE_FFMPEG_SPEED': str(PROGRESS_SPEED), 'FAKE_FFMPEG_SPEED_JITTER': '0'})
+            cluster.start()
+            node = cluster.file_host
+            args.port = node.port
+            args.secret = SIM_SECRET
+            source_path: str = os.path.join(cluster.shared_dir, 'bench.mkv')
+            make_fake_media(source_path, PROGRESS_MEDIA_LENGTH)
+            args.progressInput = cluster.shared_path(source_path)
+        results: list[dict[str, Any]] = []
+        for scenario in scenarios:
+            for num_clients in args.clients:
+                print("Running '%s' with %i client%s..." % (scenario, num_clients, 's' if num_clients > 1 else ''),
+                      file=sys.stderr)
+                results.append(run_scenario(args, scenario, num_clients))
+        codec_results: list[dict[str, Any]] = run_codecs(args)
+    except (SimError, OSError) as e:
+        print("Benchmark failed: %s" % str(e), file=sys.stderr)
+        return 1
+    finally:
+        if cluster is not None:
+            cluster.stop()
+        if root_dir is not None:
+            shutil.rmtree(root_dir, ignore_errors=True)
+
+    print_report(args.transport, results, codec_results)
+    if args.json is not None:
+        with open(args.json, 'w') as file_handle:
+            json.dump({'transport': args.transport, 'scenarios': results, 'codecs': codec_results}, file_handle,
+                      indent=4)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
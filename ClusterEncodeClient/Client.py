@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+"""
+    File: Client.py
+    Description: An asyncio client for the daemon. One DaemonClient per daemon keeps a few idle connections open to
+        reuse, and has a method for each command; Long commands return a CommandStream, iterated for their progress
+        reports. Everything runs on the one event loop, so a script can drive hundreds of daemons without a thread
+        for each, see fan_out().
+"""
+import asyncio
+import random
+from datetime import timedelta
+from typing import Optional, Final, Any, Callable, Awaitable, Iterable
+
+from ClusterEncodeClient.Protocol import MessageStream, AuthenticationError
+
+BUSY_ERROR: Final[int] = 80
+"""The error number a daemon replies with when it's too busy to accept work."""
+BUSY_DEFAULT_RETRY_AFTER: Final[float] = 30.0
+"""Seconds to wait before retrying a busy daemon that didn't say how long to wait."""
+DEFAULT_CONNECT_TIMEOUT: Final[float] = 10.0
+"""Seconds to wait to connect, and authenticate."""
+DEFAULT_TIMEOUT: Final[float] = 30.0
+"""Seconds to wait for the reply to a command."""
+DEFAULT_MAX_IDLE: Final[int] = 2
+"""The number of idle connections kept open to each daemon; Each holds a thread on the daemon."""
+DEFAULT_CONCURRENCY: Final[int] = 64
+"""The default number of daemons fan_out() talks to at once."""
+FINAL_STATUSES: Final[dict[str, str]] = {
+    'split': 'split finished',
+    'encode': 'encode finished',
+    'encode_chunks': 'encode chunks finished',
+    'combine': 'combine finished',
+    'profile': 'profile finished',
+    'ingest': 'ingest',
+}
+"""The status that ends each long command's replies, the rest are progress reports."""
+
+
+class ClientError(Exception):
+    """
+    Exception to throw when a daemon can't be reached, or stops answering.
+    """
+    def __init__(self, message: str) -> None:
+        self._message: str = message
+        return
+
+    @property
+    def message(self) -> str:
+        return self._message
+
+    def __str__(self) -> str:
+        return self._message
+
+
+class CommandError(ClientError):
+    """
+    Exception to throw when a daemon replies with an error.
+    """
+    def __init__(self, name: str, command: str, error: dict[str, Any]) -> None:
+        """
+        Initialize the error.
+        :param name: str: The daemon's name.
+        :param command: str: The command that failed.
+        :param error: dict[str, Any]: The reply's error dict: 'number', 'message', and any details.
+        """
+        super().__init__("%s replied to '%s' with error %i: %s" % (name, command, error['number'], error['message']))
+        self.number: int = error['number']
+        """The error number, see devnotes.md."""
+        self.error: dict[str, Any] = error
+        """The error dict, with any details, IE: 'retryAfter'."""
+        return
+
+
+class RetryPolicy(object):
+    """
+    When to retry a command. Only what can't have run twice is retried: Failing to connect, a reused connection the
+    daemon had closed, and busy errors (80), which the daemon sends before starting anything.
+    """
+    def __init__(self, connect_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0,
+                 busy_retries: int = 10, max_retry_after: float = 300.0) -> None:
+        """
+        Initialize the policy.
+        :param connect_attempts: int = 5: The number of times to try to connect.
+        :param base_delay: float = 0.5: Seconds to wait after the first failed connect, doubled each time after.
+        :param max_delay: float = 30.0: The longest wait between connects.
+        :param busy_retries: int = 10: The number of times to retry a busy daemon, 0 to raise the busy error.
+        :param max_retry_after: float = 300.0: The longest to wait for a busy daemon, whatever it asks for.
+        """
+        self.connect_attempts: int = connect_attempts
+        """The number of times to try to connect."""
+        self.base_delay: float = base_delay
+        """Seconds to wait after the first failed connect."""
+        self.max_delay: float = max_delay
+        """The longest wait between connects."""
+        self.busy_retries: int = busy_retries
+        """The number of times to retry a busy daemon."""
+        self.max_retry_after: float = max_retry_after
+        """The longest to wait for a busy daemon."""
+        return
+
+    def connect_delay(self, attempt: int) -> float:
+        """
+        Get the time to wait before connecting again: Exponential backoff, with jitter so many clients that lost the
+        same daemon don't all come back at once.
+        :param attempt: int: The number of failed attempts so far, from 1.
+        :return: float: Seconds to wait.
+        """
+        return min(self.base_delay * 2 ** (attempt - 1), self.max_delay) * random.uniform(0.5, 1.0)
+
+    def busy_delay(self, error: dict[str, Any]) -> float:
+        """
+        Get the time to wait before retrying a busy daemon, the 'retryAfter' it asked for.
+        :param error: dict[str, Any]: The busy error dict.
+        :return: float: Seconds to wait.
+        """
+        return min(float(error.get('retryAfter', BUSY_DEFAULT_RETRY_AFTER)), self.max_retry_after)
+
+
+NO_RETRY: Final[RetryPolicy] = RetryPolicy(connect_attempts=1, busy_retries=0)
+"""A policy that never retries."""
+
+
+class CommandStream(object):
+    """
+    A long command's replies. Iterate it for the progress reports, then read 'result'; Or await wait() for the final
+    reply. Leaving it before the end, or aclose(), drops the connection, which cancels the command on the daemon.
+    """
+    def __init__(self, client: 'DaemonClient', stream: MessageStream, command: str, first_obj: dict[str, Any],
+                 idle_timeout: Optional[float]) -> None:
+        """
+        Initialize the command stream.
+        :param client: DaemonClient: The client, the connection is given back to it at the end.
+        :param stream: MessageStream: The connection the command is running on.
+        :param command: str: The command's name, IE: 'split'.
+        :param first_obj: dict[str, Any]: The first reply, already received.
+        :param idle_timeout: Optional[float]: Seconds to wait between replies, None to wait forever; Queued chunks
+        send nothing until they start.
+        """
+        self._client: DaemonClient = client
+        """The client."""
+        self._stream: Optional[MessageStream] = stream
+        """The connection, None once the command has finished, or been dropped."""
+        self._command: str = command
+        """The command's name."""
+        self._final_status: str = FINAL_STATUSES[command]
+        """The status that ends the replies."""
+        self._next_obj: Optional[dict[str, Any]] = first_obj
+        """A reply received, and not yet returned."""
+        self._idle_timeout: Optional[float] = idle_timeout
+        """Seconds to wait between replies."""
+        self.result: Optional[dict[str, Any]] = None
+        """The final reply, once it has arrived."""
+        return
+
+    def __aiter__(self) -> 'CommandStream':
+        return self
+
+    async def __anext__(self) -> dict[str, Any]:
+        """
+        Get the next progress report. Raises CommandError if the daemon replies with an error, or ClientError if the
+        connection fails, or goes quiet for longer than the idle timeout.
+        :return: dict[str, Any]: The report, IE: 'chunk finished'; Or 'cancelled', the reply to cancel().
+        """
+        if self._stream is None:
+            raise StopAsyncIteration
+        if self._next_obj is not None:
+            response_obj, self._next_obj = self._next_obj, None
+        else:
+            try:
+                response_obj = await self._stream.recv(self._idle_timeout)
+            except asyncio.TimeoutError:
+                await self.aclose()
+                raise ClientError("%s sent nothing for %i seconds during '%s'." % (self._client.name,
+                                                                                  int(self._idle_timeout),
+                                                                                  self._command))
+            except (EOFError, OSError):
+                await self.aclose()
+                raise ClientError("%s closed the connection during '%s'." % (self._client.name, self._command))
+        status: Optional[str] = response_obj.get('status')
+        if status == 'error':
+            await self.aclose()  # The daemon closes the connection after an error.
+            raise CommandError(self._client.name, self._command, response_obj['error'])
+        if status == self._final_status:
+            self.result = response_obj
+            self._client.release(self._stream)
+            self._stream = None
+            raise StopAsyncIteration
+        return response_obj
+
+    async def wait(self, on_report: Optional[Callable[[dict[str, Any]], None]] = None) -> dict[str, Any]:
+        """
+        Wait for the final reply.
+        :param on_report: Optional[Callable[[dict[str, Any]], None]] = None: Called with each report left.
+        :return: dict[str, Any]: The final reply.
+        """
+        async for report_obj in self:
+            if on_report is not None:
+                on_report(report_obj)
+        return self.result
+
+    async def cancel(self, chunk_id: Optional[int] = None) -> None:
+        """
+        Ask the daemon to cancel the command, or one of its chunks; The daemon's 'cancelled' reply comes as a report,
+        and the command still finishes with its final reply.
+        :param chunk_id: Optional[int] = None: The chunk to cancel, None for the whole command.
+        :return: None
+        """
+        if self._stream is not None:
+            await self._stream.send({'version': '1.0.0', 'command': 'cancel', 'jobId': None, 'chunkId': chunk_id})
+        return
+
+    async def aclose(self) -> None:
+        """
+        Drop the connection, the daemon cancels a command whose client goes away.
+        :return: None
+        """
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        return
+
+    async def __aenter__(self) -> 'CommandStream':
+        return self
+
+    async def __aexit__(self, *_exc_info) -> None:
+        await self.aclose()
+        return
+
+
+class DaemonClient(object):
+    """
+    A client for one daemon.
+    """
+    def __init__(self, address: str, port: int, secret: str, name: Optional[str] = None,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, timeout: float = DEFAULT_TIMEOUT,
+                 retry: Optional[RetryPolicy] = None, max_idle: int = DEFAULT_MAX_IDLE) -> None:
+        """
+        Initialize the client, it connects when it's first used.
+        :param address: str: The daemon's address.
+        :param port: int: The daemon's port.
+        :param secret: str: The shared secret.
+        :param name: Optional[str] = None: The daemon's name in errors, None for 'address:port'.
+        :param connect_timeout: float = DEFAULT_CONNECT_TIMEOUT: Seconds to wait to connect, and authenticate.
+        :param timeout: float = DEFAULT_TIMEOUT: Seconds to wait for the reply to a command with one reply.
+        :param retry: Optional[RetryPolicy] = None: When to retry, None for the default RetryPolicy().
+        :param max_idle: int = DEFAULT_MAX_IDLE: The number of idle connections to keep open.
+        """
+        self.address: str = address
+        """The daemon's address."""
+        self.port: int = port
+        """The daemon's port."""
+        self._secret: str = secret
+        """The shared secret."""
+        self.name: str = name if name is not None else '%s:%i' % (address, port)
+        """The daemon's name."""
+        self.connect_timeout: float = connect_timeout
+        """Seconds to wait to connect."""
+        self.timeout: float = timeout
+        """Seconds to wait for a reply."""
+        self.retry: RetryPolicy = retry if retry is not None else RetryPolicy()
+        """When to retry."""
+        self._max_idle: int = max_idle
+        """The number of idle connections to keep open."""
+        self._idle: list[MessageStream] = []
+        """The idle connections, most recently used last."""
+        return
+
+    async def _connect(self) -> MessageStream:
+        """
+        Open a new connection, retrying as the policy says. Raises ClientError if it can't.
+        :return: MessageStream: The connection.
+        """
+        attempt: int = 0
+        while True:
+            attempt += 1
+            try:
+                return await asyncio.wait_for(MessageStream.open(self.address, self.port, self._secret),
+                                              self.connect_timeout)
+            except AuthenticationError as e:
+                raise ClientError("%s failed authentication: %s" % (self.name, e.message))
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                if attempt >= self.retry.connect_attempts:
+                    raise ClientError("Failed to connect to %s: %s" % (self.name, str(e) or type(e).__name__))
+            await asyncio.sleep(self.retry.connect_delay(attempt))
+
+    def release(self, stream: MessageStream) -> None:
+        """
+        Give a connection back once its command has finished, to reuse; It's closed if enough are idle already.
+        :param stream: MessageStream: The connection.
+        :return: None
+        """
+        if stream.closed:
+            return
+        if len(self._idle) >= self._max_idle:
+            stream.close()
+            return
+        self._idle.append(stream)
+        return
+
+    async def _start(self, command_obj: dict[str, Any], timeout: Optional[float]
+                     ) -> tuple[MessageStream, dict[str, Any]]:
+        """
+        Send a command, and wait for its first reply, retrying as the policy says. Raises CommandError if the daemon
+        replies with an error, or ClientError if it can't be reached, or doesn't reply in time.
+        :param command_obj: dict[str, Any]: The command object.
+        :param timeout: Optional[float]: Seconds to wait for the first reply, None to wait forever.
+        :return: tuple[MessageStream, dict[str, Any]]: The connection, and the first reply.
+        """
+        busy_retries: int = 0
+        while True:
+            reused: bool = len(self._idle) > 0
+            stream: MessageStream = self._idle.pop() if reused else await self._connect()
+            try:
+                await stream.send(command_obj)
+                response_obj: dict[str, Any] = await stream.recv(timeout)
+            except (EOFError, OSError):
+                stream.close()
+                if reused:  # The daemon closed it while it was idle, it never saw the command.
+                    continue
+                raise ClientError("%s closed the connection during '%s'." % (self.name, command_obj['command']))
+            except asyncio.TimeoutError:
+                stream.close()  # A timed out read leaves the stream mid-message.
+                raise ClientError("%s didn't reply to '%s' within %i seconds." % (self.name, command_obj['command'],
+                                                                                  int(timeout)))
+            if response_obj.get('status') != 'error':
+                return stream, response_obj
+            error: dict[str, Any] = response_obj['error']
+            if error['number'] != BUSY_ERROR:
+                stream.close()  # The daemon closes the connection after an error.
+                raise CommandError(self.name, command_obj['command'], error)
+            self.release(stream)  # A busy daemon keeps the connection open.
+            if busy_retries >= self.retry.busy_retries:
+                raise CommandError(self.name, command_obj['command'], error)
+            busy_retries += 1
+            await asyncio.sleep(self.retry.busy_delay(error))
+
+    async def request(self, command_obj: dict[str, Any]) -> dict[str, Any]:
+        """
+        Send a command with a single reply.
+        :param command_obj: dict[str, Any]: The command object.
+        :return: dict[str, Any]: The reply.
+        """
+        stream, response_obj = await self._start(command_obj, self.timeout)
+        self.release(stream)
+        return response_obj
+
+    async def stream(self, command_obj: dict[str, Any], idle_timeout: Optional[float] = None) -> CommandStream:
+        """
+        Start a long command, see FINAL_STATUSES. Its first reply can be a long time coming, IE: chunks queued
+        behind other jobs; Errors come straight away.
+        :param command_obj: dict[str, Any]: The command object.
+        :param idle_timeout: Optional[float] = None: Seconds to wait for each reply, None to wait forever.
+        :return: CommandStream: The command's replies.
+        """
+        stream, first_obj = await self._start(command_obj, idle_timeout)
+        return CommandStream(self, stream, command_obj['command'], first_obj, idle_timeout)
+
+    ##############################
+    # Commands:
+    async def status(self) -> dict[str, Any]:
+        """
+        Get the daemon's status: Its scheduler, load, working directories, and command workers.
+        :return: dict[str, Any]: The status reply.
+        """
+        return await self.request({'version': '1.0.0', 'command': 'status'})
+
+    async def report(self) -> dict[str, Any]:
+        """
+        Get the daemon's report: Its versions, number of slots ('numChunks'), and whether it's the file host.
+        :return: dict[str, Any]: The report reply.
+        """
+        return await self.request({'version': '1.0.0', 'command': 'report'})
+
+    async def trace(self, job_id: Optional[str] = None, clear: bool = False) -> dict[str, Any]:
+        """
+        Get the daemon's traced spans.
+        :param job_id: Optional[str] = None: Only this job's spans, None for all of them.
+        :param clear: bool = False: True to drop the spans returned.
+        :return: dict[str, Any]: The trace reply: 'host', 'time', and 'traceEvents'.
+        """
+        return await self.request({'version': '1.0.0', 'command': 'trace', 'jobId': job_id, 'clear': clear})
+
+    async def cancel(self, job_id: str, chunk_id: Optional[int] = None) -> bool:
+        """
+        Cancel a job, or one of its chunks, IE: one queued with submit().
+        :param job_id: str: The job id.
+        :param chunk_id: Optional[int] = None: The chunk, None for the whole job.
+        :return: bool: True something was cancelled.
+        """
+        response_obj = await self.request({'version': '1.0.0', 'command': 'cancel', 'jobId': job_id,
+                                           'chunkId': chunk_id})
+        return response_obj['success']
+
+    async def split(self, input_file: str, output_dir: str, chunk_size: int, length: timedelta,
+                    job_id: Optional[str] = None) -> CommandStream:
+        """
+        Split a source into chunks, on the file host. Paths may start with '%shared%/' or '%local%/'.
+        :param input_file: str: The source.
+        :param output_dir: str: The directory to put the chunks in.
+        :param chunk_size: int: The chunk length, in seconds.
+        :param length: timedelta: The source's duration.
+        :param job_id: Optional[str] = None: The job to track the chunks under.
+        :return: CommandStream: The reports, 'splitting new file', and 'splitting report'; Then 'split finished'
+        with 'outputFiles'.
+        """
+        return await self.stream({'version': '1.0.0', 'command': 'split', 'inputFile': input_file,
+                                  'outputDir': output_dir, 'chunkSize': chunk_size, 'length': length,
+                                  'jobId': job_id})
+
+    async def encode(self, input_file: str, output_file: str, audio_encoder: str, video_encoder: str,
+                     down_mix_audio: bool = False, boost_volume: int = 0, scale_video: Optional[dict] = None,
+                     start_time: Optional[timedelta] = None, end_time: Optional[timedelta] = None,
+                     job_id: Optional[str] = None) -> CommandStream:
+        """
+        Encode one file, or a time range of it.
+        :param input_file: str: The input.
+        :param output_file: str: The output.
+        :param audio_encoder: str: The audio encoder, IE: 'aac'.
+        :param video_encoder: str: The video encoder, IE: 'libx265'.
+        :param down_mix_audio: bool = False: True down mix the audio to stereo.
+        :param boost_volume: int = 0: The volume boost.
+        :param scale_video: Optional[dict] = None: 'width', 'height', and 'direction', None to not scale.
+        :param start_time: Optional[timedelta] = None: Where to start in the input.
+        :param end_time: Optional[timedelta] = None: Where to stop in the input.
+        :param job_id: Optional[str] = None: The job to track the output under.
+        :return: CommandStream: The 'encoding report's, then 'encode finished'.
+        """
+        return await self.stream({'version': '1.0.0', 'command': 'encode', 'inputFile': input_file,
+                                  'outputFile': output_file, 'audioEncoder': audio_encoder,
+                                  'downMixAudio': down_mix_audio, 'boostVolume': boost_volume,
+                                  'videoEncoder': video_encoder, 'scaleVideo': scale_video, 'startTime': start_time,
+                                  'endTime': end_time, 'jobId': job_id})
+
+    async def encode_chunks(self, job_id: str, chunks: list[dict[str, Any]], audio_encoder: str, video_encoder: str,
+                            down_mix_audio: bool = False, boost_volume: int = 0, scale_video: Optional[dict] = None,
+                            use_local_copy: bool = True, priority: Optional[int] = None,
+                            owner: Optional[str] = None) -> CommandStream:
+        """
+        Encode a list of chunks on the daemon's slots.
+        :param job_id: str: The job id, unique on the daemon while it runs.
+        :param chunks: list[dict[str, Any]]: The chunks: 'inputFile', 'outputFile', and optionally 'startTime',
+        'endTime', and 'length'.
+        :param audio_encoder: str: The audio encoder.
+        :param video_encoder: str: The video encoder.
+        :param down_mix_audio: bool = False: True down mix the audio to stereo.
+        :param boost_volume: int = 0: The volume boost.
+        :param scale_video: Optional[dict] = None: How to scale the video, None to not scale.
+        :param use_local_copy: bool = True: True copy the chunks to the local working directory to encode.
+        :param priority: Optional[int] = None: The job's priority, higher first, None for 0.
+        :param owner: Optional[str] = None: Who the job is for, in fair sharing, None for our address.
+        :return: CommandStream: The chunk reports, IE: 'chunk finished'; Then 'encode chunks finished'.
+        """
+        return await self.stream({'version': '1.0.0', 'command': 'encode_chunks', 'jobId': job_id, 'chunks': chunks,
+                                  'audioEncoder': audio_encoder, 'downMixAudio': down_mix_audio,
+                                  'boostVolume': boost_volume, 'videoEncoder': video_encoder,
+                                  'scaleVideo': scale_video, 'useLocalCopy': use_local_copy, 'priority': priority,
+                                  'owner': owner})
+
+    async def submit(self, job_id: str, chunks: list[dict[str, Any]], audio_encoder: str, video_encoder: str,
+                     down_mix_audio: bool = False, boost_volume: int = 0, scale_video: Optional[dict] = None,
+                     use_local_copy: bool = True, priority: Optional[int] = None,
+                     owner: Optional[str] = None) -> dict[str, Any]:
+        """
+        Queue a list of chunks, without waiting on them; Their progress shows in status(). See encode_chunks().
+        :return: dict[str, Any]: The 'job submitted' reply.
+        """
+        return await self.request({'version': '1.0.0', 'command': 'submit', 'jobId': job_id, 'chunks': chunks,
+                                   'audioEncoder': audio_encoder, 'downMixAudio': down_mix_audio,
+                                   'boostVolume': boost_volume, 'videoEncoder': video_encoder,
+                                   'scaleVideo': scale_video, 'useLocalCopy': use_local_copy, 'priority': priority,
+                                   'owner': owner})
+
+    async def combine(self, input_files: list[str], output_file: str, job_id: Optional[str] = None) -> CommandStream:
+        """
+        Combine encoded chunks, on the file host; With a job id, the job's files are removed after.
+        :param input_files: list[str]: The encoded chunks, in any order.
+        :param output_file: str: The output.
+        :param job_id: Optional[str] = None: The job the chunks are tracked under.
+        :return: CommandStream: No reports, then 'combine finished'.
+        """
+        return await self.stream({'version': '1.0.0', 'command': 'combine', 'inputFiles': input_files,
+                                  'outputFile': output_file, 'jobId': job_id})
+
+    async def profile(self, duration: float, sample_interval: Optional[float] = None,
+                      trace_memory: bool = False, top: Optional[int] = None) -> dict[str, Any]:
+        """
+        Profile the daemon.
+        :param duration: float: Seconds to profile for.
+        :param sample_interval: Optional[float] = None: Seconds between stack samples, None for the daemon's default.
+        :param trace_memory: bool = False: True to trace memory allocations too.
+        :param top: Optional[int] = None: The number of functions / allocation sites, None for the default.
+        :return: dict[str, Any]: The 'profile finished' reply.
+        """
+        command_stream = await self.stream({'version': '1.0.0', 'command': 'profile', 'duration': duration,
+                                            'sampleInterval': sample_interval, 'traceMemory': trace_memory,
+                                            'top': top}, duration + self.timeout)
+        return await command_stream.wait()
+
+    async def ingest(self, wait: float = 0.0, max_files: Optional[int] = None) -> dict[str, Any]:
+        """
+        Take the files that have arrived in the file host's watch folders.
+        :param wait: float = 0.0: Seconds to wait for a file if there are none, up to 300.
+        :param max_files: Optional[int] = None: The max number of files to take, None for the daemon's default.
+        :return: dict[str, Any]: The ingest reply: 'files', each an 'inputFile', 'relativePath', and 'size'; And the
+        'preset' settings to encode them with.
+        """
+        command_stream = await self.stream({'version': '1.0.0', 'command': 'ingest', 'wait': wait, 'max': max_files},
+                                           wait + self.timeout)
+        return await command_stream.wait()
+
+    async def shutdown(self) -> None:
+        """
+        Shut the daemon down, it doesn't reply.
+        :return: None
+        """
+        stream: MessageStream = self._idle.pop() if len(self._idle) > 0 else await self._connect()
+        await stream.send({'version': '1.0.0', 'command': 'shutdown'})
+        stream.close()
+        await self.close()
+        return
+
+    async def close(self) -> None:
+        """
+        Close the idle connections.
+        :return: None
+        """
+        idle, self._idle = self._idle, []
+        for stream in idle:
+            stream.close()
+        return
+
+    async def __aenter__(self) -> 'DaemonClient':
+        return self
+
+    async def __aexit__(self, *_exc_info) -> None:
+        await self.close()
+        return
+
+
+async def fan_out(clients: Iterable[DaemonClient], function: Callable[[DaemonClient], Awaitable[Any]],
+                  concurrency: int = DEFAULT_CONCURRENCY) -> dict[str, Any]:
+    """
+    Run a function against many daemons at once, IE: fan_out(clients, DaemonClient.status).
+    :param clients: Iterable[DaemonClient]: The daemons' clients.
+    :param function: Callable[[DaemonClient], Awaitable[Any]]: Called with each client.
+    :param concurrency: int = DEFAULT_CONCURRENCY: The most daemons talked to at once, so a large cluster doesn't
+    open hundreds of connections in the same instant.
+    :return: dict[str, Any]: Each daemon's result, or the ClientError it raised, by name.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(client: DaemonClient) -> Any:
+        async with semaphore:
+            try:
+                return await function(client)
+            except ClientError as e:
+                return e
+
+    clients = list(clients)
+    results = await asyncio.gather(*(run(client) for client in clients))
+    return {client.name: result for client, result in zip(clients, results)}
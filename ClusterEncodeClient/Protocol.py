@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+    File: Protocol.py
+    Description: The daemon's wire protocol on asyncio streams. The daemon speaks multiprocessing.connection: Each
+        message is a 4 byte big endian length, then the pickled object; And a connection starts with an HMAC
+        challenge each way, keyed with the shared secret. This is that, without a thread blocked on each socket.
+"""
+import asyncio
+import hmac
+import os
+import pickle
+import struct
+from typing import Final, Any, Optional
+
+CHALLENGE: Final[bytes] = b'#CHALLENGE#'
+"""Prefixes the random message each side sends the other to sign."""
+WELCOME: Final[bytes] = b'#WELCOME#'
+"""Sent when the signature is good."""
+FAILURE: Final[bytes] = b'#FAILURE#'
+"""Sent when the signature is bad."""
+CHALLENGE_LENGTH: Final[int] = 40
+"""The number of random bytes in the challenge we send."""
+CHALLENGE_DIGEST: Final[str] = 'sha256'
+"""The digest we ask the daemon to sign with; Daemons on python before 3.12 sign with md5 whatever is asked."""
+ALLOWED_DIGESTS: Final[frozenset[str]] = frozenset(('md5', 'sha256', 'sha384', 'sha3_256', 'sha3_384'))
+"""The digests we sign with, and accept signatures in."""
+MAX_HANDSHAKE_SIZE: Final[int] = 256
+"""The max size of a handshake message."""
+MAX_MESSAGE_SIZE: Final[int] = 256 * 1024 * 1024
+"""The max size of a message, a bad length shouldn't allocate the machine's memory."""
+
+
+class AuthenticationError(Exception):
+    """
+    Exception to throw when the handshake fails, IE: the secrets don't match.
+    """
+    def __init__(self, message: str) -> None:
+        self._message: str = message
+        return
+
+    @property
+    def message(self) -> str:
+        return self._message
+
+    def __str__(self) -> str:
+        return self._message
+
+
+def _split_digest(message: bytes) -> tuple[str, bytes]:
+    """
+    Split a '{digest}payload' message; Messages without the prefix are md5, as python before 3.12 sends.
+    :param message: bytes: The message.
+    :return: tuple[str, bytes]: The digest name, and the payload.
+    """
+    if message.startswith(b'{'):
+        end: int = message.find(b'}', 1, 32)
+        if end > 0:
+            return message[1:end].decode('ascii', 'replace'), message[end + 1:]
+    return 'md5', message
+
+
+class MessageStream(object):
+    """
+    A connection to a daemon: Pickled messages over an asyncio stream.
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Initialize the stream.
+        :param reader: asyncio.StreamReader: The stream's reader.
+        :param writer: asyncio.StreamWriter: The stream's writer.
+        """
+        self._reader: asyncio.StreamReader = reader
+        """The stream's reader."""
+        self._writer: asyncio.StreamWriter = writer
+        """The stream's writer."""
+        return
+
+    @classmethod
+    async def open(cls, address: str, port: int, secret: str) -> 'MessageStream':
+        """
+        Connect, and authenticate both ways, as multiprocessing.connection.Client() does. Raises AuthenticationError
+        if the secrets don't match, or OSError if the connection fails.
+        :param address: str: The daemon's address.
+        :param port: int: The daemon's port.
+        :param secret: str: The shared secret.
+        :return: MessageStream: The authenticated connection.
+        """
+        reader, writer = await asyncio.open_connection(address, port)
+        stream = cls(reader, writer)
+        try:
+            await stream._answer_challenge(secret.encode())
+            await stream._deliver_challenge(secret.encode())
+        except BaseException:
+            stream.close()
+            raise
+        return stream
+
+    async def _answer_challenge(self, authkey: bytes) -> None:
+        """
+        Sign the daemon's challenge.
+        :param authkey: bytes: The shared secret.
+        :return: None
+        """
+        message: bytes = await self.recv_bytes(MAX_HANDSHAKE_SIZE)
+        if not message.startswith(CHALLENGE):
+            raise AuthenticationError("Expected a challenge, got: %r" % message[:32])
+        message = message[len(CHALLENGE):]
+        digest_name: str = _split_digest(message)[0]
+        if digest_name not in ALLOWED_DIGESTS:
+            raise AuthenticationError("The daemon asked for an unsupported digest: '%s'." % digest_name)
+        signature: bytes = hmac.new(authkey, message, digest_name).digest()
+        if message.startswith(b'{'):
+            signature = b'{%s}%s' % (digest_name.encode('ascii'), signature)
+        self.send_bytes(signature)
+        await self.drain()
+        if await self.recv_bytes(MAX_HANDSHAKE_SIZE) != WELCOME:
+            raise AuthenticationError("The daemon rejected the secret.")
+        return
+
+    async def _deliver_challenge(self, authkey: bytes) -> None:
+        """
+        Challenge the daemon to sign a random message, so we know it has the secret too.
+        :param authkey: bytes: The shared secret.
+        :return: None
+        """
+        message: bytes = b'{%s}%s' % (CHALLENGE_DIGEST.encode('ascii'), os.urandom(CHALLENGE_LENGTH))
+        self.send_bytes(CHALLENGE + message)
+        await self.drain()
+        digest_name, signature = _split_digest(await self.recv_bytes(MAX_HANDSHAKE_SIZE))
+        if digest_name not in ALLOWED_DIGESTS or \
+                not hmac.compare_digest(signature, hmac.new(authkey, message, digest_name).digest()):
+            self.send_bytes(FAILURE)
+            await self.drain()
+            raise AuthenticationError("The daemon failed the challenge.")
+        self.send_bytes(WELCOME)
+        await self.drain()
+        return
+
+    def send_bytes(self, data: bytes) -> None:
+        """
+        Queue a message to send, call drain() to wait for it to be sent.
+        :param data: bytes: The message.
+        :return: None
+        """
+        if len(data) > 0x7fffffff:
+            self._writer.write(struct.pack('!iQ', -1, len(data)))
+            self._writer.write(data)
+        else:
+            self._writer.write(struct.pack('!i', len(data)) + data)
+        return
+
+    async def recv_bytes(self, max_size: int = MAX_MESSAGE_SIZE) -> bytes:
+        """
+        Receive a message. Raises EOFError if the daemon closed the connection, or OSError if it's too big.
+        :param max_size: int = MAX_MESSAGE_SIZE: The max size of the message.
+        :return: bytes: The message.
+        """
+        try:
+            size: int = struct.unpack('!i', await self._reader.readexactly(4))[0]
+            if size == -1:
+                size = struct.unpack('!Q', await self._reader.readexactly(8))[0]
+            if size < 0 or size > max_size:
+                raise OSError("Message of %i bytes is too big." % size)
+            return await self._reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise EOFError("The daemon closed the connection.")
+
+    async def drain(self) -> None:
+        """
+        Wait for the queued messages to be sent.
+        :return: None
+        """
+        await self._writer.drain()
+        return
+
+    async def send(self, obj: dict[str, Any]) -> None:
+        """
+        Send an object.
+        :param obj: dict[str, Any]: The object, IE: a command object.
+        :return: None
+        """
+        self.send_bytes(pickle.dumps(obj))
+        await self._writer.drain()
+        return
+
+    async def recv(self, timeout: Optional[float] = None) -> dict[str, Any]:
+        """
+        Receive an object. Raises asyncio.TimeoutError if none arrives in time, EOFError if the daemon closed the
+        connection.
+        :param timeout: Optional[float] = None: Seconds to wait, None to wait forever.
+        :return: dict[str, Any]: The object, IE: a response object.
+        """
+        if timeout is None:
+            data: bytes = await self.recv_bytes()
+        else:
+            data = await asyncio.wait_for(self.recv_bytes(), timeout)
+        return pickle.loads(data)
+
+    @property
+    def closed(self) -> bool:
+        return self._writer.is_closing() or self._reader.at_eof()
+
+    def close(self) -> None:
+        """
+        Close the connection, without waiting.
+        :return: None
+        """
+        self._writer.close()
+        return
@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+from typing import Final
+
+from ClusterEncodeClient.Protocol import MessageStream, AuthenticationError
+from ClusterEncodeClient.Client import DaemonClient, CommandStream, RetryPolicy, NO_RETRY, ClientError, CommandError, \
+    fan_out
+__version__: Final[str] = '1.0.0'
@@ -0,0 +1,1024 @@
+#!/usr/bin/env python3
+"""
+    File: Controller.py
+    Description: Drive cluster encode jobs without the GUI. Each job is split on the file host, its chunks are handed
+        out to every daemon as they have free slots, and the parts are combined on the file host; Progress is passed
+        to a callback as event dicts. Several jobs run at once, so one job's split and combine overlap the others'
+        encodes, and the daemons' slots don't sit idle between jobs.
+"""
+import os
+import shutil
+import time
+import uuid
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection
+from concurrent.futures import ThreadPoolExecutor, Future, wait as wait_futures, FIRST_COMPLETED
+from threading import Thread, Lock, Condition, Event as ThreadEvent
+from typing import Optional, Final, Any, Callable
+
+from ffmpegCli.Ffmpegcli import Ffmpegcli
+
+BUSY_ERROR: Final[int] = 80
+"""The error number a daemon replies with when it's too busy to accept work."""
+BUSY_MAX_RETRIES: Final[int] = 10
+"""The number of times to retry a command a daemon was too busy for."""
+BUSY_DEFAULT_RETRY_AFTER: Final[float] = 30.0
+"""Seconds to wait before retrying a busy daemon that didn't say how long to wait."""
+CHUNK_MAX_ATTEMPTS: Final[int] = 3
+"""The number of times a chunk is tried, on any host, before its job fails."""
+FINAL_STATUSES: Final[tuple[str, ...]] = ('split finished', 'encode finished', 'encode chunks finished',
+                                          'combine finished', 'ingest', 'error')
+"""The statuses that end a command's replies, the rest are progress reports."""
+MEDIA_EXTENSIONS: Final[tuple[str, ...]] = ('.mkv', '.mp4', '.m4v', '.mov', '.avi', '.ts', '.m2ts', '.mpg', '.mpeg',
+                                            '.webm', '.wmv', '.flv')
+"""The extensions of the files picked up from an input directory."""
+DEFAULT_SETTINGS: Final[dict[str, Any]] = {
+    'audioEncoder': 'aac',
+    'downMixAudio': False,
+    'boostVolume': 0,
+    'videoEncoder': 'libx265',
+    'scaleVideo': None,
+    'chunkSize': 30,
+    'useLocalCopy': True,
+    'priority': 0,
+    'wholeFileDuration': 120,
+    'videoOnlyChunks': False,
+    'videoBitRate': None,
+    'twoPass': False,
+    'renditions': None,
+}
+"""The job settings used when neither the job, nor the spec's defaults set them. 'renditions' are more outputs encoded
+from the same decode of each chunk: A list of {'name', 'scaleVideo', 'bitRate'}, see Job.rendition_output_path()."""
+INGEST_WAIT: Final[int] = 60
+"""Seconds each 'ingest' command waits on the file host for files to arrive in its watch folders."""
+INGEST_RETRY_INTERVAL: Final[float] = 30.0
+"""Seconds to wait before asking the file host for files again, after it couldn't be reached."""
+
+PASS_DIR_NAME: Final[str] = 'Pass1'
+"""The directory in a two pass job's 'Output' directory for the first pass's statistics, the first pass writes no
+outputs."""
+
+Event = dict[str, Any]
+"""A progress event: 'event' the event name, 'time' when it happened, and the event's values."""
+
+
+class ControllerError(Exception):
+    """
+    Exception to throw when a host, a job spec, or a job fails.
+    """
+    def __init__(self, message: str) -> None:
+        self._message: str = message
+        return
+
+    @property
+    def message(self) -> str:
+        return self._message
+
+    def __str__(self) -> str:
+        return self._message
+
+
+JobPath = str
+"""How a job is run: 'remux' on the file host, 'whole' file on one host, or 'chunked' across the cluster."""
+
+
+class Host(object):
+    """
+    A daemon from the GUI config's host list.
+    """
+    def __init__(self, name: str, address: str, port: int, secret: str, is_file_host: bool) -> None:
+        """
+        Initialize the host.
+        :param name: str: The host's name in the config.
+        :param address: str: The host's address.
+        :param port: int: The daemon's port.
+        :param secret: str: The daemon's shared secret.
+        :param is_file_host: bool: True the daemon is the file host, splits and combines run on it.
+        """
+        self.name: str = name
+        """The host's name."""
+        self.address: str = address
+        """The host's address."""
+        self.port: int = port
+        """The daemon's port."""
+        self._secret: str = secret
+        """The daemon's shared secret."""
+        self.is_file_host: bool = is_file_host
+        """True the daemon is the file host."""
+        self.slots: int = 1
+        """The number of encode slots, set from the daemon's report by probe(); 0 for a file host that doesn't encode,
+        it's never sent chunks."""
+        self.watching: bool = False
+        """True the daemon has watch folders, set from its report by probe()."""
+        return
+
+    def connect(self) -> Connection:
+        """
+        Connect to the daemon. Raises ControllerError if the connection fails.
+        :return: Connection: The connection.
+        """
+        try:
+            return Client((self.address, self.port), authkey=self._secret.encode())
+        except AuthenticationError:
+            raise ControllerError("%s failed authentication." % self.name)
+        except OSError as e:
+            raise ControllerError("Failed to connect to %s: %s" % (self.name, e.strerror or str(e)))
+
+    def request(self, command_obj: dict[str, Any], on_report: Optional[Callable[[dict[str, Any]], None]] = None
+                ) -> dict[str, Any]:
+        """
+        Send a command on a new connection, and wait for its final reply. A busy daemon (error 80) is retried after
+        the 'retryAfter' it gives, up to BUSY_MAX_RETRIES times. Raises ControllerError if the daemon replies with an
+        error, or the connection fails.
+        :param command_obj: dict[str, Any]: The command object.
+        :param on_report: Optional[Callable[[dict[str, Any]], None]] = None: Called with each progress report.
+        :return: dict[str, Any]: The final reply.
+        """
+        retries: int = 0
+        while True:
+            connection = self.connect()
+            try:
+                connection.send(command_obj)
+                while True:
+                    response_obj: dict[str, Any] = connection.recv()
+                    if response_obj.get('status') in FINAL_STATUSES:
+                        break
+                    if on_report is not None:
+                        on_report(response_obj)
+                if response_obj['status'] != 'error':
+                    connection.send({'version': '1.0.0', 'command': 'close'})
+            except (EOFError, OSError):
+                raise ControllerError("%s closed the connection during '%s'." % (self.name, command_obj['command']))
+            finally:
+                connection.close()
+            if response_obj['status'] != 'error':
+                return response_obj
+            error: dict[str, Any] = response_obj['error']
+            if error['number'] != BUSY_ERROR or retries >= BUSY_MAX_RETRIES:
+                raise ControllerError("%s replied to '%s' with error %i: %s" % (self.name, command_obj['command'],
+                                                                                error['number'], error['message']))
+            retries += 1
+            time.sleep(error.get('retryAfter', BUSY_DEFAULT_RETRY_AFTER))
+
+    def probe(self) -> dict[str, Any]:
+        """
+        Ask the daemon for its report, and take its number of slots from it. Raises ControllerError if it fails.
+        :return: dict[str, Any]: The report.
+        """
+        connection = self.connect()
+        try:
+            connection.send({'version': '1.0.0', 'command': 'report'})
+            report_obj: dict[str, Any] = connection.recv()
+            if report_obj.get('status') != 'error':
+                connection.send({'version': '1.0.0', 'command': 'close'})
+        except (EOFError, OSError):
+            raise ControllerError("%s closed the connection during 'report'." % self.name)
+        finally:
+            connection.close()
+        if report_obj['status'] == 'error':
+            raise ControllerError("%s replied to 'report' with error %i: %s" % (self.name,
+                                                                                report_obj['error']['number'],
+                                                                                report_obj['error']['message']))
+        self.slots = max(int(report_obj.get('numChunks', 1)), 0)
+        self.watching = report_obj.get('isWatching', False)
+        return report_obj
+
+    def load(self) -> tuple[float, int]:
+        """
+        Get how loaded the daemon is, from its status. Raises ControllerError if it fails.
+        :return: tuple[float, int]: The running and pending chunks per slot, and the machine's load percent.
+        """
+        connection = self.connect()
+        try:
+            connection.send({'version': '1.0.0', 'command': 'status'})
+            status_obj: dict[str, Any] = connection.recv()
+            if status_obj.get('status') != 'error':
+                connection.send({'version': '1.0.0', 'command': 'close'})
+        except (EOFError, OSError):
+            raise ControllerError("%s closed the connection during 'status'." % self.name)
+        finally:
+            connection.close()
+        if status_obj['status'] == 'error':
+            raise ControllerError("%s replied to 'status' with error %i: %s" % (self.name,
+                                                                                status_obj['error']['number'],
+                                                                                status_obj['error']['message']))
+        scheduler_obj: dict[str, Any] = status_obj.get('scheduler', {})
+        num_chunks: int = scheduler_obj.get('pendingChunks', 0) + \
+            len([chunk for chunk in scheduler_obj.get('slots', []) if chunk is not None])
+        return num_chunks / self.slots, status_obj.get('load', {}).get('loadPercent', 0)
+
+
+def load_hosts(config: dict[str, Any], secret: Optional[str]) -> list[Host]:
+    """
+    Build the hosts from a GUI config. The GUI doesn't save secrets yet, so each host's is its 'secret' if set, then
+    the config's 'sharedSecret', then the one given. Raises ControllerError if a host has no secret, or there isn't
+    exactly one file host.
+    :param config: dict[str, Any]: The GUI config, see ClusterEncodeGUI/common.py.
+    :param secret: Optional[str]: The secret of hosts that don't set their own.
+    :return: list[Host]: The hosts, the file host first.
+    """
+    hosts: list[Host] = []
+    for name, host_obj in config.get('hosts', {}).items():
+        host_secret: Optional[str] = host_obj.get('secret', config.get('sharedSecret', secret))
+        if host_secret is None:
+            raise ControllerError("No shared secret for host '%s'." % name)
+        hosts.append(Host(name, host_obj['host'], host_obj['port'], host_secret, host_obj.get('isFileHost', False)))
+    file_hosts: list[Host] = [host for host in hosts if host.is_file_host]
+    if len(file_hosts) != 1:
+        raise ControllerError("The config must have exactly one file host, it has %i." % len(file_hosts))
+    hosts.remove(file_hosts[0])
+    return file_hosts + hosts
+
+
+class Job(object):
+    """
+    A file to encode.
+    """
+    def __init__(self, input_path: str, output_path: str, settings: dict[str, Any],
+                 job_id: Optional[str] = None) -> None:
+        """
+        Initialize the job.
+        :param input_path: str: The full path to the source, in the shared directory.
+        :param output_path: str: The full path to the final output.
+        :param settings: dict[str, Any]: The settings, see DEFAULT_SETTINGS, missing ones are defaulted.
+        :param job_id: Optional[str] = None: The job id, None to make one from the source's name.
+        """
+        self.input_path: str = os.path.abspath(input_path)
+        """The full path to the source."""
+        self.output_path: str = os.path.abspath(output_path)
+        """The full path to the final output."""
+        self.settings: dict[str, Any] = dict(DEFAULT_SETTINGS)
+        """The encode settings."""
+        self.settings.update(settings)
+        if job_id is None:
+            name: str = os.path.splitext(os.path.basename(input_path))[0]
+            job_id = '%s-%s' % (''.join(c if c.isalnum() or c in '-_' else '_' for c in name)[:48],
+                                uuid.uuid4().hex[:8])
+        self.job_id: str = job_id
+        """The job id, the daemons track the job's files under it."""
+        return
+
+    def encode_settings(self) -> dict[str, Any]:
+        """
+        Get the encoder setting parameters of the encode commands.
+        :return: dict[str, Any]
+        """
+        return {key: self.settings[key] for key in ('audioEncoder', 'downMixAudio', 'boostVolume', 'videoEncoder',
+                                                    'scaleVideo')}
+
+    def renditions(self) -> list[dict[str, Any]]:
+        """
+        Get the job's extra renditions.
+        :return: list[dict[str, Any]]: The renditions, empty for none.
+        """
+        return list(self.settings['renditions'] or [])
+
+    def rendition_output_path(self, name: str) -> str:
+        """
+        Get the final output path of a rendition, beside the job's output.
+        :param name: str: The rendition's name.
+        :return: str: The path, IE: '/out/Movie.720p.mkv' for '/out/Movie.mkv'.
+        """
+        stem, extension = os.path.splitext(self.output_path)
+        return '%s.%s%s' % (stem, name, extension)
+
+    def output_paths(self) -> list[str]:
+        """
+        Get all the job's final output paths.
+        :return: list[str]: The output path, then each rendition's.
+        """
+        return [self.output_path] + [self.rendition_output_path(rendition['name']) for rendition in self.renditions()]
+
+
+def allocate_bit_rates(bit_rate: int, durations: list[float], weights: list[float]) -> list[int]:
+    """
+    Share a job's bit budget between its chunks: The budget is the job's bit rate over the chunks' total duration,
+    and each chunk gets the part of it its first pass weight is of the total, see Ffmpegcli.read_pass_complexity().
+    So a chunk twice as hard to encode as another of the same length gets more bits, as it would in a two pass
+    encode of the whole source, and the output still comes to the target size.
+    :param bit_rate: int: The job's average video bit rate in kbit/s.
+    :param durations: list[float]: Each chunk's duration in seconds.
+    :param weights: list[float]: Each chunk's first pass weight.
+    :return: list[int]: Each chunk's video bit rate in kbit/s.
+    """
+    budget: float = bit_rate * sum(durations)
+    total_weight: float = sum(weights)
+    bit_rates: list[int] = []
+    for duration, weight in zip(durations, weights):
+        if total_weight <= 0.0 or duration <= 0.0:
+            bit_rates.append(bit_rate)
+        else:
+            bit_rates.append(max(int(round(budget * weight / total_weight / duration)), 1))
+    return bit_rates
+
+
+def _make_job(job_obj: dict[str, Any], defaults: dict[str, Any], output_dir: str) -> Job:
+    """
+    Make a job from a job spec entry. Raises ControllerError if it has no input file.
+    :param job_obj: dict[str, Any]: The entry: 'inputFile', optional 'outputFile' and 'jobId', and any settings.
+    :param defaults: dict[str, Any]: The spec's default settings.
+    :param output_dir: str: The directory outputs go in, if the entry doesn't say.
+    :return: Job: The job.
+    """
+    if not isinstance(job_obj, dict) or not isinstance(job_obj.get('inputFile'), str):
+        raise ControllerError("Every job must be an object with an 'inputFile'.")
+    settings: dict[str, Any] = dict(defaults)
+    settings.update({key: value for key, value in job_obj.items() if key in DEFAULT_SETTINGS.keys()})
+    output_path: str = job_obj.get('outputFile') or os.path.join(output_dir, os.path.basename(job_obj['inputFile']))
+    return Job(job_obj['inputFile'], output_path, settings, job_obj.get('jobId'))
+
+
+def load_spec(spec_obj: dict[str, Any] | list[Any], output_dir: str, defaults: dict[str, Any]) -> list[Job]:
+    """
+    Load the jobs from a job spec: Either a list of jobs, or an object with 'jobs', and optionally 'defaults' for
+    them, and 'outputDir'. Raises ControllerError if the spec is invalid.
+    :param spec_obj: dict[str, Any] | list[Any]: The spec, as loaded from JSON.
+    :param output_dir: str: The directory outputs go in, if the spec doesn't say.
+    :param defaults: dict[str, Any]: The default settings, the spec's defaults override them.
+    :return: list[Job]: The jobs, in order.
+    """
+    if isinstance(spec_obj, list):
+        spec_obj = {'jobs': spec_obj}
+    if not isinstance(spec_obj, dict) or not isinstance(spec_obj.get('jobs'), list):
+        raise ControllerError("The job spec must be a list of jobs, or an object with a 'jobs' list.")
+    spec_defaults: dict[str, Any] = dict(defaults)
+    spec_defaults.update(spec_obj.get('defaults', {}))
+    spec_output_dir: str = spec_obj.get('outputDir', output_dir)
+    return [_make_job(job_obj, spec_defaults, spec_output_dir) for job_obj in spec_obj['jobs']]
+
+
+def scan_input_dir(input_dir: str, output_dir: str, defaults: dict[str, Any]) -> list[Job]:
+    """
+    Make a job for each media file in a directory, and its sub-directories; Outputs keep their path relative to the
+    input directory.
+    :param input_dir: str: The directory to scan.
+    :param output_dir: str: The directory outputs go in.
+    :param defaults: dict[str, Any]: The settings of every job.
+    :return: list[Job]: The jobs, sorted by path.
+    """
+    jobs: list[Job] = []
+    for dir_path, dir_names, file_names in os.walk(input_dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].lower() not in MEDIA_EXTENSIONS:
+                continue
+            input_path: str = os.path.join(dir_path, file_name)
+            output_path: str = os.path.join(output_dir, os.path.relpath(input_path, input_dir))
+            jobs.append(Job(input_path, output_path, defaults))
+    return jobs
+
+
+class _ChunkQueue(object):
+    """
+    A job's chunks waiting to be encoded, shared by the threads sending them to each host.
+    """
+    def __init__(self, chunks: list[dict[str, Any]]) -> None:
+        """
+        Initialize the queue.
+        :param chunks: list[dict[str, Any]]: The chunks, see Controller._encode().
+        """
+        self._pending: list[dict[str, Any]] = list(chunks)
+        """The chunks waiting for a host."""
+        self._num_running: int = 0
+        """The number of chunks sent to a host, and not finished yet."""
+        self._condition: Condition = Condition()
+        """Waited on for chunks to be put back, or the last running chunk to finish."""
+        self.failed: bool = False
+        """True a chunk ran out of attempts, the rest of the job is dropped."""
+        return
+
+    def take(self, count: int) -> list[dict[str, Any]]:
+        """
+        Take chunks to send to a host; Waits while there are none pending, but some running could still fail, and
+        be put back.
+        :param count: int: The max number of chunks to take.
+        :return: list[dict[str, Any]]: The chunks, empty when there's nothing left to do.
+        """
+        with self._condition:
+            while len(self._pending) == 0 and self._num_running > 0 and not self.failed:
+                self._condition.wait()
+            if self.failed:
+                return []
+            chunks: list[dict[str, Any]] = self._pending[:count]
+            del self._pending[:count]
+            self._num_running += len(chunks)
+            return chunks
+
+    def done(self, chunks: list[dict[str, Any]], retry: list[dict[str, Any]]) -> None:
+        """
+        Return chunks taken with take().
+        :param chunks: list[dict[str, Any]]: The chunks that were taken.
+        :param retry: list[dict[str, Any]]: The ones that didn't finish, to be tried again; A chunk out of attempts
+        fails the job.
+        :return: None
+        """
+        with self._condition:
+            self._num_running -= len(chunks)
+            for chunk in retry:
+                chunk['attempts'] += 1
+                if chunk['attempts'] >= CHUNK_MAX_ATTEMPTS:
+                    self.failed = True
+                self._pending.append(chunk)
+            self._condition.notify_all()
+        return
+
+    def abandon(self) -> None:
+        """
+        Fail the job, waking any waiting threads.
+        :return: None
+        """
+        with self._condition:
+            self.failed = True
+            self._condition.notify_all()
+        return
+
+    @property
+    def remaining(self) -> int:
+        with self._condition:
+            return len(self._pending) + self._num_running
+
+
+class Controller(object):
+    """
+    Run jobs across the cluster's daemons.
+    """
+    def __init__(self, hosts: list[Host], shared_dir: str, ffmpeg_cli: Ffmpegcli, emit: Callable[[Event], None],
+                 parallel: int = 2, skip_existing: bool = False, verbose: bool = False) -> None:
+        """
+        Initialize the controller.
+        :param hosts: list[Host]: The hosts, the file host first, see load_hosts().
+        :param shared_dir: str: This machine's mount of the shared working directory.
+        :param ffmpeg_cli: Ffmpegcli: Used to get each source's duration, which the split needs.
+        :param emit: Callable[[Event], None]: Called with each event, from any thread.
+        :param parallel: int = 2: The number of jobs to run at once.
+        :param skip_existing: bool = False: True skip jobs whose output already exists.
+        :param verbose: bool = False: True emit every progress report from the daemons, not just the milestones.
+        """
+        self._hosts: list[Host] = hosts
+        """The hosts, the file host first."""
+        self._shared_dir: str = os.path.abspath(shared_dir)
+        """The shared working directory."""
+        self._ffmpeg_cli: Ffmpegcli = ffmpeg_cli
+        """Used to get the sources' durations."""
+        self._emit: Callable[[Event], None] = emit
+        """Called with each event."""
+        self._parallel: int = parallel
+        """The number of jobs to run at once."""
+        self._skip_existing: bool = skip_existing
+        """True skip jobs whose output already exists."""
+        self._verbose: bool = verbose
+        """True emit every progress report."""
+        self._split_lock: Lock = Lock()
+        """Held while splitting, the file host only splits one file at a time."""
+        return
+
+    @property
+    def file_host(self) -> Host:
+        return self._hosts[0]
+
+    def emit(self, event: str, **values) -> None:
+        """
+        Emit an event.
+        :param event: str: The event name, IE: 'job finished'.
+        :param values: The event's values.
+        :return: None
+        """
+        event_obj: Event = {'event': event, 'time': time.time()}
+        event_obj.update(values)
+        self._emit(event_obj)
+        return
+
+    def shared_path(self, path: str) -> str:
+        """
+        Convert a path in the shared directory to a '%shared%/' path, so each daemon maps it to its own mount. Raises
+        ControllerError if it isn't in the shared directory.
+        :param path: str: The full path.
+        :return: str: The '%shared%/' path.
+        """
+        relative_path: str = os.path.relpath(os.path.abspath(path), self._shared_dir)
+        if relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+            raise ControllerError("'%s' isn't in the shared directory '%s'." % (path, self._shared_dir))
+        return '%shared%/' + relative_path
+
+    def probe_hosts(self) -> int:
+        """
+        Get every host's report, dropping the ones that can't be reached. Raises ControllerError if the file host
+        can't be.
+        :return: int: The number of hosts left.
+        """
+        for host in list(self._hosts):
+            try:
+                report_obj = host.probe()
+            except ControllerError as e:
+                if host.is_file_host:
+                    raise
+                self.emit('host error', host=host.name, message=e.message)
+                self._hosts.remove(host)
+                continue
+            self.emit('host ready', host=host.name, slots=host.slots, isFileHost=host.is_file_host,
+                      daemonVersion=report_obj.get('daemonVersion'))
+        return len(self._hosts)
+
+    def run(self, jobs: list[Job]) -> int:
+        """
+        Run the jobs, parallel at a time, in order.
+        :param jobs: list[Job]: The jobs.
+        :return: int: The number of jobs that failed.
+        """
+        self.emit('batch started', numJobs=len(jobs), hosts=[host.name for host in self._hosts])
+        start: float = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self._parallel, thread_name_prefix='job') as executor:
+            results: list[Optional[bool]] = list(executor.map(self.run_job, jobs))
+        num_failed: int = results.count(False)
+        self.emit('batch finished', numJobs=len(jobs), numFinished=results.count(True), numFailed=num_failed,
+                  numSkipped=results.count(None), duration=time.monotonic() - start)
+        return num_failed
+
+    def follow(self, output_dir: str, defaults: dict[str, Any], stop_event: Optional[ThreadEvent] = None) -> int:
+        """
+        Run the files that arrive in the file host's watch folders, until stopped, or interrupted; The jobs running
+        are finished first. Files are only taken as jobs can start, so the rest wait on the file host for any
+        controller. Outputs keep their path relative to their watch folder.
+        :param output_dir: str: The directory outputs go in.
+        :param defaults: dict[str, Any]: Settings that override the file host's 'watchPreset'.
+        :param stop_event: Optional[ThreadEvent] = None: Set to stop taking files.
+        :return: int: The number of jobs that failed.
+        """
+        if stop_event is None:
+            stop_event = ThreadEvent()
+        self.emit('follow started', hosts=[host.name for host in self._hosts])
+        results: list[Optional[bool]] = []
+        start: float = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self._parallel, thread_name_prefix='job') as executor:
+            running: set[Future] = set()
+            try:
+                while not stop_event.is_set():
+                    for future in [future for future in running if future.done()]:
+                        running.remove(future)
+                        results.append(future.result())
+                    if len(running) >= self._parallel:
+                        wait_futures(running, INGEST_RETRY_INTERVAL, FIRST_COMPLETED)
+                        continue
+                    try:
+                        ingest_obj = self.file_host.request({'version': '1.0.0', 'command': 'ingest',
+                                                             'wait': INGEST_WAIT, 'max': self._parallel - len(running)})
+                    except ControllerError as e:
+                        self.emit('host error', host=self.file_host.name, message=e.message)
+                        stop_event.wait(INGEST_RETRY_INTERVAL)
+                        continue
+                    settings: dict[str, Any] = dict(ingest_obj.get('preset', {}))
+                    settings.update(defaults)
+                    for file_obj in ingest_obj['files']:
+                        input_path: str = os.path.join(self._shared_dir, file_obj['inputFile'][len('%shared%/'):])
+                        job = Job(input_path, os.path.join(output_dir, file_obj['relativePath']), settings)
+                        self.emit('job ingested', jobId=job.job_id, inputFile=job.input_path, size=file_obj['size'])
+                        running.add(executor.submit(self.run_job, job))
+            except KeyboardInterrupt:
+                self.emit('follow stopping', numRunning=len([future for future in running if not future.done()]))
+            for future in running:
+                results.append(future.result())
+        num_failed: int = results.count(False)
+        self.emit('follow finished', numJobs=len(results), numFinished=results.count(True), numFailed=num_failed,
+                  numSkipped=results.count(None), duration=time.monotonic() - start)
+        return num_failed
+
+    def run_job(self, job: Job) -> Optional[bool]:
+        """
+        Run a job: Split, encode, and combine it. Its working directories are removed after, whether it worked or not.
+        :param job: Job: The job.
+        :return: Optional[bool]: True it finished, False it failed, None it was skipped.
+        """
+        if self._skip_existing and all(os.path.exists(output_path) for output_path in job.output_paths()):
+            self.emit('job skipped', jobId=job.job_id, inputFile=job.input_path, outputFile=job.output_path)
+            return None
+        self.emit('job started', jobId=job.job_id, inputFile=job.input_path, outputFile=job.output_path)
+        split_dir: str = os.path.join(self._shared_dir, 'Input', job.job_id)
+        encode_dir: str = os.path.join(self._shared_dir, 'Output', job.job_id)
+        start: float = time.monotonic()
+        streams_thread: Optional[Thread] = None
+        streams_result: list[str | ControllerError] = []
+        try:
+            length = self._ffmpeg_cli.get_duration(job.input_path)
+            if length is None:
+                raise ControllerError("Failed to get the duration of '%s'." % job.input_path)
+            os.makedirs(split_dir, exist_ok=True)
+            os.makedirs(encode_dir, exist_ok=True)
+            job_path: JobPath = self.plan(job, length)
+            for rendition in job.renditions():  # Each rendition's parts, the names are the same in every set.
+                os.makedirs(os.path.join(encode_dir, rendition['name']), exist_ok=True)
+            if job_path == 'chunked':
+                if job.settings['videoOnlyChunks']:  # The other streams are encoded on the file host meanwhile:
+                    streams_thread = Thread(target=lambda: streams_result.append(self._encode_streams(job, encode_dir)),
+                                            daemon=True)
+                    streams_thread.start()
+                chunk_paths: list[str] = self._split(job, split_dir, length)
+                split_time: float = time.monotonic()
+                if job.settings['twoPass']:
+                    output_paths: list[str] = self._encode_two_pass(job, chunk_paths, split_dir, encode_dir)
+                else:
+                    output_paths = self._encode(job, chunk_paths, split_dir, encode_dir)
+                encode_time: float = time.monotonic()
+                streams_file: Optional[str] = None
+                if streams_thread is not None:
+                    streams_thread.join()
+                    streams_thread = None
+                    if isinstance(streams_result[0], ControllerError):
+                        raise streams_result[0]
+                    streams_file = streams_result[0]
+                self._combine(job, output_paths, streams_file)
+            else:
+                chunk_paths = [job.input_path]
+                split_time = start
+                if job_path == 'remux':
+                    self._remux(job, encode_dir)
+                else:
+                    self._encode_whole(job, encode_dir)
+                encode_time = time.monotonic()
+        except (ControllerError, OSError) as e:
+            self.emit('job failed', jobId=job.job_id, inputFile=job.input_path, message=str(e))
+            return False
+        finally:
+            if streams_thread is not None:  # Still writing to the job's directory:
+                streams_thread.join()
+            shutil.rmtree(split_dir, ignore_errors=True)
+            shutil.rmtree(encode_dir, ignore_errors=True)
+        end: float = time.monotonic()
+        self.emit('job finished', jobId=job.job_id, inputFile=job.input_path, outputFile=job.output_path,
+                  renditionFiles=job.output_paths()[1:], path=job_path, numChunks=len(chunk_paths),
+                  split=split_time - start, encode=encode_time - split_time, combine=end - encode_time,
+                  duration=end - start)
+        return True
+
+    def plan(self, job: Job, length) -> JobPath:
+        """
+        Choose how to run a job. Splitting only pays off when there's encoding to share out: A pure remux (both
+        encoders 'copy') is I/O, so it's run on the file host, next to the files; And a source no longer than its
+        'wholeFileDuration' is encoded whole on one host, the split, copies, and combine would take longer than the
+        encode they save. Two pass jobs are always chunked, their passes share the split. Raises ControllerError if
+        the job's rate control or rendition settings don't go together.
+        :param job: Job: The job.
+        :param length: timedelta: The source's duration.
+        :return: JobPath: 'remux', 'whole', or 'chunked'.
+        """
+        if job.settings['twoPass']:
+            if job.settings['videoBitRate'] is None:
+                raise ControllerError("'twoPass' needs a 'videoBitRate'.")
+            if job.settings['videoEncoder'] not in ('libx264', 'libx265'):
+                raise ControllerError("'twoPass' needs the libx264 or libx265 video encoder.")
+        names: list[Any] = [rendition.get('name') if isinstance(rendition, dict) else None
+                            for rendition in job.renditions()]
+        if len(names) > 0:
+            if job.settings['twoPass'] or job.settings['videoEncoder'] == 'copy':
+                raise ControllerError("'renditions' need a video encoder other than copy, and no 'twoPass'.")
+            if not all(isinstance(name, str) and name != '' and all(c.isalnum() or c in '-_' for c in name)
+                       for name in names) or len(set(names)) < len(names):
+                raise ControllerError("Every rendition needs a unique 'name' of letters, digits, '-', and '_'.")
+        if job.settings['audioEncoder'] == 'copy' and job.settings['videoEncoder'] == 'copy':
+            return 'remux'
+        if job.settings['twoPass']:
+            return 'chunked'
+        if length.total_seconds() <= job.settings['wholeFileDuration']:
+            return 'whole'
+        return 'chunked'
+
+    def _move_output(self, job: Job, encode_dir: str) -> None:
+        """
+        Move a job's outputs from its directory in the shared 'Output' directory to their final paths.
+        :param job: Job: The job.
+        :param encode_dir: str: The job's directory in the shared 'Output' directory.
+        :return: None
+        """
+        for output_path in job.output_paths():
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            shutil.move(os.path.join(encode_dir, os.path.basename(output_path)), output_path)
+        return
+
+    @staticmethod
+    def _rendition_params(job: Job) -> Optional[list[dict[str, Any]]]:
+        """
+        Get the 'renditions' parameter of a job's encode commands.
+        :param job: Job: The job.
+        :return: Optional[list[dict[str, Any]]]: Each rendition's 'scaleVideo' and 'bitRate', None for none.
+        """
+        renditions: list[dict[str, Any]] = job.renditions()
+        if len(renditions) == 0:
+            return None
+        return [{'scaleVideo': rendition.get('scaleVideo'), 'bitRate': rendition.get('bitRate')}
+                for rendition in renditions]
+
+    def _remux(self, job: Job, encode_dir: str) -> None:
+        """
+        Remux the source on the file host, in one pass, with no split or combine. Raises ControllerError if it fails.
+        :param job: Job: The job.
+        :param encode_dir: str: The job's directory in the shared 'Output' directory.
+        :return: None
+        """
+        def on_report(report_obj: dict[str, Any]) -> None:
+            if self._verbose:
+                self.emit('remux progress', jobId=job.job_id, report=report_obj)
+            return
+
+        self.emit('remux started', jobId=job.job_id, host=self.file_host.name)
+        command_obj: dict[str, Any] = {
+            'version': '1.0.0',
+            'command': 'encode',
+            'inputFile': self.shared_path(job.input_path),
+            'outputFile': self.shared_path(os.path.join(encode_dir, os.path.basename(job.output_path))),
+            'jobId': job.job_id,
+        }
+        command_obj.update(job.encode_settings())
+        encode_obj = self.file_host.request(command_obj, on_report)
+        if not encode_obj['success']:
+            raise ControllerError("The remux failed.")
+        self._move_output(job, encode_dir)
+        return
+
+    def _encode_whole(self, job: Job, encode_dir: str) -> None:
+        """
+        Encode the whole source, as a single chunk, on the least loaded host; Tried again on the next least loaded if
+        it fails. Raises ControllerError if it fails CHUNK_MAX_ATTEMPTS times, or no host can be reached.
+        :param job: Job: The job.
+        :param encode_dir: str: The job's directory in the shared 'Output' directory.
+        :return: None
+        """
+        output_files: list[str] = [self.shared_path(os.path.join(encode_dir, os.path.basename(output_path)))
+                                   for output_path in job.output_paths()]
+        chunk_obj: dict[str, Any] = {
+            'inputFile': self.shared_path(job.input_path),
+            'outputFile': output_files[0],
+            'renditionFiles': output_files[1:],
+        }
+        for attempt in range(CHUNK_MAX_ATTEMPTS):
+            loads: list[tuple[tuple[float, int], int, Host]] = []
+            for index, host in enumerate(list(self._hosts)):
+                if host.slots == 0:
+                    continue
+                try:
+                    loads.append((host.load(), index, host))
+                except ControllerError as e:
+                    self.emit('host error', jobId=job.job_id, host=host.name, message=e.message)
+            if len(loads) == 0:
+                raise ControllerError("No hosts left to encode on.")
+            host: Host = min(loads)[2]
+            finished: list[bool] = []
+
+            def on_report(report_obj: dict[str, Any]) -> None:
+                if report_obj['status'] == 'chunk finished':
+                    finished.append(report_obj['success'])
+                    self.emit('chunk finished', jobId=job.job_id, host=host.name, outputFile=chunk_obj['outputFile'],
+                              success=report_obj['success'], numFinished=int(report_obj['success']), numChunks=1)
+                elif self._verbose:
+                    self.emit('chunk progress', jobId=job.job_id, host=host.name, report=report_obj)
+                return
+
+            command_obj: dict[str, Any] = {
+                'version': '1.0.0',
+                'command': 'encode_chunks',
+                'jobId': job.job_id,
+                'chunks': [chunk_obj],
+                'useLocalCopy': job.settings['useLocalCopy'],
+                'priority': job.settings['priority'],
+                'bitRate': job.settings['videoBitRate'],
+                'renditions': self._rendition_params(job),
+            }
+            command_obj.update(job.encode_settings())
+            try:
+                host.request(command_obj, on_report)
+            except ControllerError as e:
+                self.emit('host error', jobId=job.job_id, host=host.name, message=e.message)
+                continue
+            if finished == [True]:
+                self._move_output(job, encode_dir)
+                return
+        raise ControllerError("The whole file encode failed %i times." % CHUNK_MAX_ATTEMPTS)
+
+    def _encode_streams(self, job: Job, encode_dir: str) -> str | ControllerError:
+        """
+        Encode every stream of the source but the video, on the file host: The audio once, instead of a slice in
+        every chunk, with no seams at the chunk boundaries; And the subtitles and attachments copied. It's muxed in
+        with the video only chunks when they're combined. Runs on its own thread, so errors are returned.
+        :param job: Job: The job.
+        :param encode_dir: str: The job's directory in the shared 'Output' directory.
+        :return: str | ControllerError: The '%shared%/' path to the streams, or the error if it failed.
+        """
+        self.emit('streams started', jobId=job.job_id, host=self.file_host.name)
+        # In the source's container, which can hold its subtitles and attachments:
+        output_file: str = self.shared_path(os.path.join(encode_dir, 'Streams.' + os.path.basename(job.input_path)))
+        command_obj: dict[str, Any] = {
+            'version': '1.0.0',
+            'command': 'encode',
+            'inputFile': self.shared_path(job.input_path),
+            'outputFile': output_file,
+            'jobId': job.job_id,
+            'noVideo': True,
+        }
+        command_obj.update(job.encode_settings())
+        try:
+            encode_obj = self.file_host.request(command_obj)
+        except ControllerError as e:
+            return e
+        if not encode_obj['success']:
+            return ControllerError("The streams encode failed.")
+        self.emit('streams finished', jobId=job.job_id)
+        return output_file
+
+    def _split(self, job: Job, split_dir: str, length) -> list[str]:
+        """
+        Split the source on the file host. Raises ControllerError if it fails.
+        :param job: Job: The job.
+        :param split_dir: str: The job's directory in the shared 'Input' directory.
+        :param length: timedelta: The source's duration.
+        :return: list[str]: The full paths to the chunks, on the file host.
+        """
+        def on_report(report_obj: dict[str, Any]) -> None:
+            if report_obj['status'] == 'splitting new file' or self._verbose:
+                self.emit('split progress', jobId=job.job_id, report=report_obj)
+            return
+
+        with self._split_lock:
+            self.emit('split started', jobId=job.job_id, host=self.file_host.name)
+            split_obj = self.file_host.request({
+                'version': '1.0.0',
+                'command': 'split',
+                'inputFile': self.shared_path(job.input_path),
+                'outputDir': self.shared_path(split_dir),
+                'chunkSize': job.settings['chunkSize'],
+                'length': length,
+                'jobId': job.job_id,
+                'videoOnly': job.settings['videoOnlyChunks'],
+            }, on_report)
+        if not split_obj['success']:
+            raise ControllerError("The split failed.")
+        self.emit('split finished', jobId=job.job_id, numChunks=len(split_obj['outputFiles']))
+        return list(split_obj['outputFiles'])
+
+    def _encode_two_pass(self, job: Job, chunk_paths: list[str], split_dir: str, encode_dir: str) -> list[str]:
+        """
+        Encode the chunks in two passes, each spread across all the hosts: The first measures how hard each chunk is
+        to encode, the job's bit budget is shared out by that, see allocate_bit_rates(), and the second encodes each
+        chunk at its share. The statistics are in the shared directory, so a chunk's second pass can run on any host.
+        Raises ControllerError if either pass fails, see _encode().
+        :param job: Job: The job.
+        :param chunk_paths: list[str]: The full paths to the chunks, on the file host.
+        :param split_dir: str: The job's directory in the shared 'Input' directory.
+        :param encode_dir: str: The job's directory in the shared 'Output' directory.
+        :return: list[str]: The '%shared%/' paths to the encoded chunks.
+        """
+        pass_dir: str = os.path.join(encode_dir, PASS_DIR_NAME)
+        os.makedirs(pass_dir, exist_ok=True)
+        names: list[str] = [os.path.basename(chunk_path) for chunk_path in chunk_paths]
+        pass_logs: dict[str, str] = {name: self.shared_path(os.path.join(pass_dir, 'Stats.' + name)) for name in names}
+        self.emit('pass started', jobId=job.job_id, ratePass=1)
+        complexities: dict[str, float] = {}
+        self._encode(job, chunk_paths, split_dir, pass_dir, 1, pass_logs, complexities=complexities)
+        durations: list[float] = []
+        for name in names:
+            duration = self._ffmpeg_cli.get_duration(os.path.join(split_dir, name))
+            if duration is None:
+                raise ControllerError("Failed to get the duration of chunk '%s'." % name)
+            durations.append(duration.total_seconds())
+        bit_rates: list[int] = allocate_bit_rates(job.settings['videoBitRate'], durations,
+                                                  [complexities[name] for name in names])
+        self.emit('pass started', jobId=job.job_id, ratePass=2, bitRates=dict(zip(names, bit_rates)))
+        return self._encode(job, chunk_paths, split_dir, encode_dir, 2, pass_logs, dict(zip(names, bit_rates)))
+
+    def _encode(self,
+                job: Job,
+                chunk_paths: list[str],
+                split_dir: str,
+                encode_dir: str,
+                rate_pass: Optional[int] = None,
+                pass_logs: Optional[dict[str, str]] = None,
+                bit_rates: Optional[dict[str, int]] = None,
+                complexities: Optional[dict[str, float]] = None,
+                ) -> list[str]:
+        """
+        Encode the chunks across all the hosts. Each host is sent as many chunks as it has slots, and more as they
+        finish, so faster hosts take more of the job; Running jobs in parallel keeps the slots busy while a host
+        waits on the last chunk of a batch. A failed chunk is tried again, on any host, and a host that fails has its
+        chunks handed to the others. Raises ControllerError if a chunk runs out of attempts, or no hosts are left.
+        :param job: Job: The job.
+        :param chunk_paths: list[str]: The full paths to the chunks, on the file host.
+        :param split_dir: str: The job's directory in the shared 'Input' directory.
+        :param encode_dir: str: The directory in the shared directory to encode the chunks to.
+        :param rate_pass: Optional[int] = None: 1 or 2 to run that pass of a two pass encode, see _encode_two_pass().
+        :param pass_logs: Optional[dict[str, str]] = None: The '%shared%/' pass statistics path prefix of each chunk
+        name, for rate_pass.
+        :param bit_rates: Optional[dict[str, int]] = None: The video bit rate of each chunk name, None for the job's
+        'videoBitRate'.
+        :param complexities: Optional[dict[str, float]] = None: Filled in with the first pass weight of each chunk
+        name, for rate_pass 1.
+        :return: list[str]: The '%shared%/' paths to the encoded chunks.
+        """
+        # The daemons reply with paths on their own mounts, so only the names are used:
+        chunks: list[dict[str, Any]] = []
+        for chunk_path in chunk_paths:
+            name: str = os.path.basename(chunk_path)
+            chunks.append({
+                'inputFile': self.shared_path(os.path.join(split_dir, name)),
+                'outputFile': self.shared_path(os.path.join(encode_dir, name)),
+                'bitRate': bit_rates[name] if bit_rates is not None else job.settings['videoBitRate'],
+                'passLogFile': pass_logs[name] if pass_logs is not None else None,
+                'renditionFiles': [self.shared_path(os.path.join(encode_dir, rendition['name'], name))
+                                   for rendition in job.renditions()],
+                'attempts': 0,
+            })
+        queue = _ChunkQueue(chunks)
+        output_files: list[str] = []
+        output_lock: Lock = Lock()
+
+        def encode_on(host: Host) -> None:
+            while True:
+                batch: list[dict[str, Any]] = queue.take(host.slots)
+                if len(batch) == 0:
+                    return
+                finished: set[int] = set()
+
+                def on_report(report_obj: dict[str, Any]) -> None:
+                    if report_obj['status'] == 'chunk finished':
+                        output_file: str = self.shared_path(os.path.join(encode_dir,
+                                                                         os.path.basename(report_obj['outputFile'])))
+                        with output_lock:
+                            if report_obj['success']:
+                                finished.add(report_obj['chunkId'])
+                                output_files.append(output_file)
+                                if complexities is not None:
+                                    complexities[os.path.basename(output_file)] = report_obj['passComplexity']
+                            num_finished: int = len(output_files)
+                        self.emit('chunk finished', jobId=job.job_id, host=host.name, outputFile=output_file,
+                                  success=report_obj['success'], numFinished=num_finished, numChunks=len(chunks))
+                    elif self._verbose:
+                        self.emit('chunk progress', jobId=job.job_id, host=host.name, report=report_obj)
+                    return
+
+                command_obj: dict[str, Any] = {
+                    'version': '1.0.0',
+                    'command': 'encode_chunks',
+                    'jobId': job.job_id,
+                    'chunks': [{key: value for key, value in chunk.items() if key != 'attempts'} for chunk in batch],
+                    'useLocalCopy': job.settings['useLocalCopy'],
+                    'priority': job.settings['priority'],
+                    'ratePass': rate_pass,
+                    'renditions': self._rendition_params(job),
+                }
+                command_obj.update(job.encode_settings())
+                try:
+                    host.request(command_obj, on_report)
+                except ControllerError as e:
+                    self.emit('host error', jobId=job.job_id, host=host.name, message=e.message)
+                    queue.done(batch, [chunk for index, chunk in enumerate(batch) if index not in finished])
+                    return  # Leave this job's remaining chunks to the other hosts.
+                queue.done(batch, [chunk for index, chunk in enumerate(batch) if index not in finished])
+
+        threads: list[Thread] = [Thread(target=encode_on, args=(host,), daemon=True) for host in self._hosts
+                                 if host.slots > 0]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if queue.failed:
+            raise ControllerError("A chunk failed %i times." % CHUNK_MAX_ATTEMPTS)
+        if queue.remaining > 0:
+            queue.abandon()
+            raise ControllerError("No hosts left to encode on.")
+        return output_files
+
+    def _combine(self, job: Job, output_paths: list[str], streams_file: Optional[str] = None) -> None:
+        """
+        Combine the encoded chunks on the file host. An output outside the shared directory is combined in it, then
+        moved. A job with renditions has a set of parts for each, in a directory named after it, combined one after
+        the other; The file host keeps the job's files until the last. Raises ControllerError if it fails.
+        :param job: Job: The job.
+        :param output_paths: list[str]: The '%shared%/' paths to the encoded chunks.
+        :param streams_file: Optional[str] = None: The '%shared%/' path to the other streams, for video only chunks.
+        :return: None
+        """
+        self.emit('combine started', jobId=job.job_id, host=self.file_host.name)
+        encode_dir: str = os.path.join(self._shared_dir, 'Output', job.job_id)
+        part_sets: list[tuple[str, list[str]]] = [(job.output_path, output_paths)]
+        for rendition in job.renditions():
+            part_sets.append((job.rendition_output_path(rendition['name']),
+                              [self.shared_path(os.path.join(encode_dir, rendition['name'], os.path.basename(path)))
+                               for path in output_paths]))
+        for index, (final_path, part_paths) in enumerate(part_sets):
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            try:
+                output_file: str = self.shared_path(final_path)
+                move_path: Optional[str] = None
+            except ControllerError:
+                move_path = os.path.join(encode_dir, os.path.basename(final_path))
+                output_file = self.shared_path(move_path)
+            combine_obj = self.file_host.request({
+                'version': '1.0.0',
+                'command': 'combine',
+                'inputFiles': part_paths,
+                'outputFile': output_file,
+                'jobId': job.job_id,
+                'streamsFile': streams_file,
+                'keepJob': index < len(part_sets) - 1,
+            })
+            if combine_obj.get('success') is False:
+                raise ControllerError("The combine failed.")
+            if move_path is not None:
+                shutil.move(move_path, final_path)
+        return
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+    File: main.py
+    Description: The headless controller: Run a batch of encodes across the cluster without the GUI, reading the
+        hosts from the GUI's config, and printing progress to stdout as JSON lines.
+
+    Usage: ./main.py --inputDir /mnt/convert/New --secret <secret>
+           ./main.py --follow --secret <secret>
+"""
+import argparse
+import json
+import os
+import sys
+from threading import Lock
+from typing import Final, Any, Optional
+
+sys.path.append('../')
+from ffmpegCli.Ffmpegcli import Ffmpegcli, find_ffmpeg
+from Controller import Controller, ControllerError, Event, load_hosts, load_spec, scan_input_dir
+
+# Consts:
+WORKING_DIR_NAME: Final[str] = '.ClusterEncode'
+CONFIG_FILE_NAME: Final[str] = 'config.json'
+SECRET_ENV: Final[str] = 'CLUSTER_ENCODE_SECRET'
+"""The environment variable to read the shared secret from, when it's not given, or in the config."""
+
+_print_lock: Lock = Lock()
+"""Held while printing an event, events come from every job's threads."""
+
+
+def print_event(event_obj: Event) -> None:
+    """
+    Print an event as a line of JSON. Values JSON can't hold, IE: the timedeltas in split reports, are printed as
+    strings.
+    :param event_obj: Event: The event.
+    :return: None
+    """
+    line: str = json.dumps(event_obj, default=str)
+    with _print_lock:
+        print(line, flush=True)
+    return
+
+
+def parse_rendition(value: str) -> dict[str, Any]:
+    """
+    Parse a '--rendition' argument: 'name:<width>x<height>[:<kbit/s>]', IE: '720p:1280x720:3000'. Renditions are
+    scaled down from the source.
+    :param value: str: The argument.
+    :return: dict[str, Any]: The rendition, see DEFAULT_SETTINGS in Controller.py.
+    """
+    parts: list[str] = value.split(':')
+    try:
+        if len(parts) not in (2, 3):
+            raise ValueError(value)
+        width, height = (int(size) for size in parts[1].lower().split('x'))
+        bit_rate: Optional[int] = int(parts[2]) if len(parts) == 3 else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' isn't name:<width>x<height>[:<kbit/s>]." % value)
+    return {'name': parts[0], 'scaleVideo': {'width': width, 'height': height, 'direction': 'DOWN'},
+            'bitRate': bit_rate}
+
+
+def load_json(file_path: str, name: str, exit_codes: tuple[int, int, int]) -> Any:
+    """
+    Load a JSON file, exiting with an error if it can't be.
+    :param file_path: str: The full path to the file.
+    :param name: str: What the file is, for the error message.
+    :param exit_codes: tuple[int, int, int]: The exit codes if it doesn't exist, can't be read, or isn't JSON.
+    :return: Any: The loaded JSON.
+    """
+    if not os.path.isfile(file_path):
+        print("Failed to locate %s: %s." % (name, file_path), file=sys.stderr)
+        exit(exit_codes[0])
+    try:
+        with open(file_path, 'r') as file_handle:
+            return json.loads(file_handle.read())
+    except OSError as e:
+        print("Failed to open %s for reading: %s[%d]" % (name, e.strerror, e.errno), file=sys.stderr)
+        exit(exit_codes[1])
+    except json.JSONDecodeError as e:
+        print("Failed to load JSON from %s: %s" % (name, e.msg), file=sys.stderr)
+        exit(exit_codes[2])
+
+
+if __name__ == '__main__':
+    description = """
+    ClusterEncodeController:
+    Run a batch of encodes across the cluster, without the GUI. Progress is printed to stdout as JSON lines.
+
+    Exit Codes: 1 -> One or more jobs failed.
+                2 -> Invalid arguments.
+                3 -> Config file doesn't exist.
+                4 -> Failed to open config file for reading.
+                5 -> Failed to load JSON from config file.
+                6 -> Invalid hosts in the config file.
+                7 -> Job spec doesn't exist.
+                8 -> Failed to open job spec for reading.
+                9 -> Failed to load JSON from job spec.
+                10 -> Invalid job spec.
+                11 -> Provided input directory doesn't exist.
+                12 -> Failed to locate ffmpeg.
+                13 -> Failed to reach the file host.
+                14 -> No jobs to run.
+                15 -> The file host isn't watching any folders.
+    """
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--configFile',
+                        help="The full path to the GUI config file to use. Default=$HOME/.ClusterEncode/config.json",
+                        type=str)
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument('--spec',
+                              help="A JSON job spec: A list of jobs, or {'defaults': {...}, 'outputDir': ..., "
+                                   "'jobs': [...]}; Each job has an 'inputFile', and optionally an 'outputFile', "
+                                   "'jobId', and any settings.",
+                              type=str)
+    source_group.add_argument('--inputDir',
+                              help="Encode every media file in this directory, and its sub-directories.",
+                              type=str)
+    source_group.add_argument('--follow',
+                              help="Run the files that arrive in the file host's watch folders, until interrupted; "
+                                   "The file host's 'watchPreset' is the default settings.",
+                              action='store_true',
+                              default=False)
+    parser.add_argument('--sharedDir',
+                        help="The full path to the shared directory, overrides the config. IE: /mnt/convert/",
+                        type=str)
+    parser.add_argument('--outputDir',
+                        help="The full path to the final output directory, overrides the config.",
+                        type=str)
+    parser.add_argument('--secret',
+                        help="The shared secret of hosts the config has none for. Default=$%s" % SECRET_ENV,
+                        type=str,
+                        default=os.environ.get(SECRET_ENV))
+    parser.add_argument('--audioEncoder', help="The audio encoder. Default=aac", type=str)
+    parser.add_argument('--videoEncoder', help="The video encoder. Default=libx265", type=str)
+    parser.add_argument('--chunkSize', help="The chunk length in seconds. Default=30", type=int)
+    parser.add_argument('--wholeFileDuration',
+                        help="Sources this many seconds or shorter are encoded whole on the least loaded host, "
+                             "instead of split across the cluster; 0 to always split. Default=120",
+                        type=int)
+    parser.add_argument('--videoOnlyChunks',
+                        help="Split only the video into chunks; The audio is encoded once on the file host, while the "
+                             "chunks encode, and muxed in with the subtitles and attachments when combining.",
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--videoBitRate',
+                        help="The average video bit rate to target in kbit/s, instead of the encoder's constant "
+                             "quality.",
+                        type=int)
+    parser.add_argument('--twoPass',
+                        help="Encode in two passes across the cluster, with the --videoBitRate budget shared between "
+                             "the chunks by how hard the first pass found each; libx264 and libx265 only.",
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--rendition',
+                        help="Also encode a rendition, name:<width>x<height>[:<kbit/s>], IE: 720p:1280x720:3000, "
+                             "from the same decode of each chunk; Output beside the job's, as <name>.720p.<ext>. "
+                             "Can be repeated.",
+                        type=parse_rendition,
+                        action='append',
+                        dest='renditions')
+    parser.add_argument('--noLocalCopy',
+                        help="Encode straight from the shared directory, instead of a local copy.",
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--parallel',
+                        help="The number of jobs to run at once. Default=2",
+                        type=int,
+                        default=2)
+    parser.add_argument('--skipExisting',
+                        help="Skip jobs whose output already exists, so an interrupted batch can be run again.",
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--verbose',
+                        help="Print every progress report from the daemons, not just the milestones.",
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--fakeFfmpeg',
+                        help="Get the durations with the fake ffmpeg, for runs against daemons using it.",
+                        action='store_true',
+                        default=False)
+    args = parser.parse_args()
+    if args.parallel < 1:
+        parser.error("--parallel must be 1 or more.")  # Exits 2.
+    if args.videoBitRate is not None and args.videoBitRate < 1:
+        parser.error("--videoBitRate must be 1 or more.")  # Exits 2.
+    if args.twoPass and args.videoBitRate is None:
+        parser.error("--twoPass needs a --videoBitRate.")  # Exits 2.
+
+    # Load the GUI config:
+    config_path: str = args.configFile
+    if config_path is None:
+        config_path = os.path.join(os.environ['HOME'], WORKING_DIR_NAME, CONFIG_FILE_NAME)
+    config: dict[str, Any] = load_json(config_path, 'config file', (3, 4, 5))
+    shared_dir: str = args.sharedDir if args.sharedDir is not None else config.get('sharedDir', '')
+    output_dir: str = args.outputDir if args.outputDir is not None else config.get('outputDir', shared_dir)
+    try:
+        hosts = load_hosts(config, args.secret)
+    except ControllerError as e:
+        print("Invalid hosts: %s" % e.message, file=sys.stderr)
+        exit(6)
+
+    # Build the jobs:
+    defaults: dict[str, Any] = {}
+    for key, value in (('audioEncoder', args.audioEncoder), ('videoEncoder', args.videoEncoder),
+                       ('chunkSize', args.chunkSize), ('wholeFileDuration', args.wholeFileDuration),
+                       ('videoBitRate', args.videoBitRate)):
+        if value is not None:
+            defaults[key] = value
+    if args.noLocalCopy:
+        defaults['useLocalCopy'] = False
+    if args.videoOnlyChunks:
+        defaults['videoOnlyChunks'] = True
+    if args.twoPass:
+        defaults['twoPass'] = True
+    if args.renditions is not None:
+        defaults['renditions'] = args.renditions
+    if args.spec is not None:
+        spec_obj = load_json(args.spec, 'job spec', (7, 8, 9))
+        try:
+            jobs = load_spec(spec_obj, output_dir, defaults)
+        except ControllerError as e:
+            print("Invalid job spec: %s" % e.message, file=sys.stderr)
+            exit(10)
+    elif args.inputDir is not None:
+        if not os.path.isdir(args.inputDir):
+            print("Input directory '%s' doesn't exist." % args.inputDir, file=sys.stderr)
+            exit(11)
+        jobs = scan_input_dir(args.inputDir, output_dir, defaults)
+    else:
+        jobs = []
+    if len(jobs) == 0 and not args.follow:
+        print("No jobs to run.", file=sys.stderr)
+        exit(14)
+
+    # Find ffprobe, to get the sources' durations:
+    ffmpeg_path, ffprobe_path = find_ffmpeg(True if args.fakeFfmpeg else None)
+    if ffmpeg_path is None:
+        print("ffmpeg not installed. Please install with 'sudo apt install ffmpeg'.", file=sys.stderr)
+        exit(12)
+
+    controller = Controller(hosts, shared_dir, Ffmpegcli(ffmpeg_path, ffprobe_path), print_event, args.parallel,
+                            args.skipExisting, args.verbose)
+    try:
+        controller.probe_hosts()
+    except ControllerError as e:
+        print("Failed to reach the file host: %s" % e.message, file=sys.stderr)
+        exit(13)
+    if args.follow:
+        if not controller.file_host.watching:
+            print("The file host isn't watching any folders, set its 'watchFolders'.", file=sys.stderr)
+            exit(15)
+        num_failed: int = controller.follow(output_dir, defaults)
+    else:
+        num_failed = controller.run(jobs)
+    exit(1 if num_failed > 0 else 0)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+    File: test_two_pass_shares.py
+    Description: Sharing a two pass job's bit budget between its chunks: Rate control gives each frame bits in
+        proportion to its complexity ** qcomp, so at qcomp 0 chunks of the same length get the same share, and at
+        qcomp 1 shares in proportion to their complexity.
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from Controller import allocate_bit_rates
+from ffmpegCli.Ffmpegcli import Ffmpegcli, PASS_QCOMPRESS
+
+NUM_FRAMES: int = 250
+"""The frames in each chunk's statistics."""
+
+
+class TwoPassSharesTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        # The same length, the second four times as complex, both at q 12 so the bits aren't rescaled:
+        self.pass_logs: list[str] = [self.write_stats('Easy', 10000), self.write_stats('Hard', 40000)]
+        return
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+        return
+
+    def write_stats(self, name: str, texture: int) -> str:
+        pass_log = os.path.join(self.temp_dir.name, 'Stats.' + name)
+        with open(Ffmpegcli.pass_stats_path(pass_log), 'w') as file_handle:
+            file_handle.write('#options: test\n')
+            for frame in range(NUM_FRAMES):
+                file_handle.write('in:%i out:%i type:P q:12.00 tex:%i mv:0 misc:0 ;\n' % (frame, frame, texture))
+        return pass_log
+
+    def shares(self, qcomp: float) -> list[int]:
+        weights = [Ffmpegcli.read_pass_complexity(pass_log, qcomp) for pass_log in self.pass_logs]
+        return allocate_bit_rates(2500, [10.0, 10.0], weights)
+
+    def test_qcomp_0_shares_equally(self) -> None:
+        self.assertEqual(self.shares(0.0), [2500, 2500])
+        return
+
+    def test_qcomp_1_shares_by_complexity(self) -> None:
+        self.assertEqual(self.shares(1.0), [1000, 4000])
+        return
+
+    def test_default_qcomp_favours_the_complex_chunk(self) -> None:
+        easy, hard = self.shares(PASS_QCOMPRESS)
+        self.assertEqual(easy + hard, 5000)
+        self.assertGreater(hard, easy)
+        self.assertLess(hard, 4 * easy)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
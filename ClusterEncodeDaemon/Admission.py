@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+    File: Admission.py
+    Description: Admission control, check the node's free memory, load average, and free disk space before accepting
+        work, so an overcommitted node tells the controller to retry later instead of swapping.
+"""
+import os
+import shutil
+from typing import Optional, Final, Any
+
+MEMINFO_PATH: Final[str] = '/proc/meminfo'
+"""Where the kernel reports the available memory."""
+BUSY_ERROR: Final[int] = 80
+"""The error number sent when the daemon is too busy to accept work."""
+MEMORY_RETRY_AFTER: Final[float] = 30.0
+"""Seconds to tell the client to wait when memory is short; Encodes finishing free memory quickly."""
+LOAD_RETRY_AFTER: Final[float] = 60.0
+"""Seconds to tell the client to wait when the load is high, the 1 minute load average takes about this to fall."""
+DISK_RETRY_AFTER: Final[float] = 120.0
+"""Seconds to tell the client to wait when disk space is short, uploads and cleanup take a while to free space."""
+
+
+def get_available_memory() -> Optional[int]:
+    """
+    Get the memory available for new processes without swapping.
+    :return: Optional[int]: The number of bytes available, or None if it can't be read.
+    """
+    try:
+        with open(MEMINFO_PATH, 'r') as file_handle:
+            for line in file_handle:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_load_percent() -> Optional[float]:
+    """
+    Get the 1 minute load average as a percentage of the CPUs, IE: 100.0 is one runnable process per CPU.
+    :return: Optional[float]: The load percentage, or None if it's not available.
+    """
+    try:
+        load: float = os.getloadavg()[0]
+    except OSError:
+        return None
+    return load * 100.0 / (os.cpu_count() or 1)
+
+
+def get_free_space(path: str) -> Optional[int]:
+    """
+    Get the free space on the file system holding a path.
+    :param path: str: The path.
+    :return: Optional[int]: The number of bytes free, or None if the path can't be checked.
+    """
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return None
+
+
+class AdmissionControl(object):
+    """
+    Decide if the node can take more work.
+    """
+    def __init__(self, min_free_memory: int, max_load_percent: int, min_free_disk: int, paths: list[str]) -> None:
+        """
+        Initialize admission control.
+        :param min_free_memory: int: The min number of bytes of available memory, 0 to not check.
+        :param max_load_percent: int: The max 1 minute load average as a percentage of the CPUs, 0 to not check.
+        :param min_free_disk: int: The min number of bytes free on each of the paths, 0 to not check.
+        :param paths: list[str]: The working directories to check for free space.
+        """
+        self.min_free_memory: int = min_free_memory
+        """The min number of bytes of available memory."""
+        self.max_load_percent: int = max_load_percent
+        """The max load percentage."""
+        self.min_free_disk: int = min_free_disk
+        """The min number of bytes free on each path."""
+        self.paths: list[str] = paths
+        """The working directories to check for free space."""
+        return
+
+    def memory_ok(self) -> bool:
+        """
+        Is there enough memory available to start another encode.
+        :return: bool: True there's enough, or it can't be checked.
+        """
+        if self.min_free_memory <= 0:
+            return True
+        available: Optional[int] = get_available_memory()
+        return available is None or available >= self.min_free_memory
+
+    def check(self) -> Optional[tuple[str, str, float]]:
+        """
+        Check if the node can take more work.
+        :return: Optional[tuple[str, str, float]]: None if it can, otherwise a tuple of the reason: 'memory', 'load',
+        or 'disk'; A message, and the number of seconds to wait before trying again.
+        """
+        if self.min_free_memory > 0:
+            available: Optional[int] = get_available_memory()
+            if available is not None and available < self.min_free_memory:
+                return 'memory', "Only %i MB of memory available." % (available // (1024 * 1024)), MEMORY_RETRY_AFTER
+        if self.max_load_percent > 0:
+            load_percent: Optional[float] = get_load_percent()
+            if load_percent is not None and load_percent > self.max_load_percent:
+                return 'load', "Load is %.0f%% of the CPUs." % load_percent, LOAD_RETRY_AFTER
+        if self.min_free_disk > 0:
+            for path in self.paths:
+                free: Optional[int] = get_free_space(path)
+                if free is not None and free < self.min_free_disk:
+                    return 'disk', "Only %i MB free in '%s'." % (free // (1024 * 1024), path), DISK_RETRY_AFTER
+        return None
+
+    def status(self) -> dict[str, Any]:
+        """
+        Build the node load status dict.
+        :return: dict[str, Any]
+        """
+        return {
+            'memAvailable': get_available_memory(),
+            'loadPercent': get_load_percent(),
+            'diskFree': {path: get_free_space(path) for path in self.paths},
+        }
+
+
+if __name__ == '__main__':
+    exit(0)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+    File: Commands.py
+    Description: The command table. Each command is registered once at startup with its handler, and declarative
+        parameter schemas that are compiled then into flat lookup tables; So dispatch is a dict lookup, and checking
+        a command's parameters is a single pass, however many commands there are. Commands also declare whether they
+        run inline on the connection's thread, or on the bounded worker pool, leaving the connection's thread free
+        to answer status and cancels while they run.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from typing import Optional, Final, Any, Callable
+
+PARAM_MISSING_ERROR: Final[int] = 20
+"""The error number of a missing required parameter."""
+PARAM_TYPE_ERROR: Final[int] = 21
+"""The error number of a parameter of the wrong type."""
+
+ParamSpec = tuple[str, type | tuple[type, ...]]
+"""A parameter's name, and its type, or tuple of types."""
+
+
+class ParamSchema(object):
+    """
+    A compiled set of required, and optional parameters.
+    """
+    __slots__ = ('_required', '_optional')
+
+    def __init__(self, required: tuple[ParamSpec, ...] = (), optional: tuple[ParamSpec, ...] = ()) -> None:
+        """
+        Compile the schema.
+        :param required: tuple[ParamSpec, ...] = (): The required parameters, checked in order.
+        :param optional: tuple[ParamSpec, ...] = (): The optional parameters, missing ones are set to None.
+        """
+        self._required: tuple[tuple[str, frozenset[type], tuple[type, ...], str], ...] = tuple(
+            self._compile(spec) for spec in required)
+        """The required parameters: (name, exact types, types, wrong type message)."""
+        self._optional: tuple[tuple[str, frozenset[type], tuple[type, ...], str], ...] = tuple(
+            self._compile(spec) for spec in optional)
+        """The optional parameters: (name, exact types, types, wrong type message)."""
+        return
+
+    @staticmethod
+    def _compile(spec: ParamSpec) -> tuple[str, frozenset[type], tuple[type, ...], str]:
+        """
+        Compile a parameter: The exact types are a set, checked first, isinstance() is only the fallback for
+        subclasses; And the error message is built once.
+        :param spec: ParamSpec: The parameter's name, and type.
+        :return: tuple[str, frozenset[type], tuple[type, ...], str]: (name, exact types, types, wrong type message).
+        """
+        name, value_type = spec
+        types: tuple[type, ...] = value_type if isinstance(value_type, tuple) else (value_type,)
+        return name, frozenset(types), types, "parameter '%s' must be '%s' type." % (name, str(value_type))
+
+    def validate(self, command_obj: dict[str, Any]) -> Optional[tuple[int, str]]:
+        """
+        Check the parameters of a command, setting missing optional parameters to None.
+        :param command_obj: dict[str, Any]: The command object.
+        :return: Optional[tuple[int, str]]: None the parameters are valid, or the error number and message to send.
+        """
+        for name, exact_types, types, message in self._required:
+            try:
+                value = command_obj[name]
+            except KeyError:
+                return PARAM_MISSING_ERROR, "parameter '%s' doesn't exist." % name
+            if type(value) not in exact_types and not isinstance(value, types):
+                return PARAM_TYPE_ERROR, message
+        for name, exact_types, types, message in self._optional:
+            value = command_obj.get(name)
+            if value is None:
+                command_obj[name] = None
+            elif type(value) not in exact_types and not isinstance(value, types):
+                return PARAM_TYPE_ERROR, message
+        return None
+
+
+class Command(object):
+    """
+    A registered command.
+    """
+    __slots__ = ('name', 'handler', 'schema', 'admission', 'pooled', 'while_busy')
+
+    def __init__(self,
+                 name: str,
+                 handler: Callable[[dict[str, Any]], bool],
+                 schema: ParamSchema,
+                 admission: bool,
+                 pooled: bool,
+                 while_busy: bool,
+                 ) -> None:
+        """
+        Initialize the command.
+        :param name: str: The command name, IE: 'split'.
+        :param handler: Callable[[dict[str, Any]], bool]: Called with the validated command object, returns True to
+        wait for the next command, False the connection has been closed.
+        :param schema: ParamSchema: The parameters.
+        :param admission: bool: True the command starts new work, and is refused while the node is overloaded.
+        :param pooled: bool: True the command runs on the worker pool, False inline on the connection's thread.
+        :param while_busy: bool: True the command is also answered while a pooled command runs on the connection.
+        """
+        self.name: str = name
+        self.handler: Callable[[dict[str, Any]], bool] = handler
+        self.schema: ParamSchema = schema
+        self.admission: bool = admission
+        self.pooled: bool = pooled
+        self.while_busy: bool = while_busy
+        return
+
+
+class CommandRegistry(object):
+    """
+    The commands, by name.
+    """
+    def __init__(self) -> None:
+        """
+        Initialize an empty registry.
+        """
+        self._commands: dict[str, Command] = {}
+        """The commands, by name."""
+        return
+
+    def register(self,
+                 name: str,
+                 handler: Callable[[dict[str, Any]], bool],
+                 required: tuple[ParamSpec, ...] = (),
+                 optional: tuple[ParamSpec, ...] = (),
+                 admission: bool = False,
+                 pooled: bool = False,
+                 while_busy: bool = False,
+                 ) -> None:
+        """
+        Register a command, compiling its schema. Raises ValueError if it's already registered, or a pooled command
+        is also answered while busy.
+        :param name: str: The command name.
+        :param handler: Callable[[dict[str, Any]], bool]: The handler, see Command.
+        :param required: tuple[ParamSpec, ...] = (): The required parameters.
+        :param optional: tuple[ParamSpec, ...] = (): The optional parameters.
+        :param admission: bool = False: True the command is refused while the node is overloaded.
+        :param pooled: bool = False: True the command runs on the worker pool.
+        :param while_busy: bool = False: True the command is answered while a pooled command runs.
+        :return: None
+        """
+        if name in self._commands.keys():
+            raise ValueError("Command '%s' is already registered." % name)
+        if pooled and while_busy:
+            raise ValueError("Command '%s' can't be pooled, and run while busy." % name)
+        self._commands[name] = Command(name, handler, ParamSchema(required, optional), admission, pooled, while_busy)
+        return
+
+    def get(self, name: str) -> Optional[Command]:
+        """
+        Look a command up.
+        :param name: str: The command name.
+        :return: Optional[Command]: The command, or None if there's no such command.
+        """
+        return self._commands.get(name)
+
+    @property
+    def names(self) -> tuple[str, ...]:
+        return tuple(self._commands.keys())
+
+
+class CommandPool(object):
+    """
+    A bounded pool of threads to run long commands on.
+    """
+    def __init__(self, num_workers: int) -> None:
+        """
+        Initialize the pool, its threads are started as they're needed.
+        :param num_workers: int: The max number of commands running at once.
+        """
+        self._num_workers: int = num_workers
+        """The max number of commands running at once."""
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=num_workers,
+                                                                thread_name_prefix='command')
+        """The worker threads."""
+        self._num_running: int = 0
+        """The number of commands running, or about to."""
+        self._lock: Lock = Lock()
+        """Lock for _num_running."""
+        return
+
+    def _finished(self, _future: Future) -> None:
+        with self._lock:
+            self._num_running -= 1
+        return
+
+    def submit(self, function: Callable[..., bool], *args) -> Optional[Future]:
+        """
+        Run a function on a worker, if one is free; Commands are never queued behind others.
+        :param function: Callable[..., bool]: The function.
+        :param args: The arguments to call it with.
+        :return: Optional[Future]: The future of the result, or None if all the workers are busy.
+        """
+        with self._lock:
+            if self._num_running >= self._num_workers:
+                return None
+            self._num_running += 1
+        future: Future = self._executor.submit(function, *args)
+        future.add_done_callback(self._finished)
+        return future
+
+    def status(self) -> dict[str, Any]:
+        """
+        Build the worker pool status dict.
+        :return: dict[str, Any]
+        """
+        with self._lock:
+            return {'workers': self._num_workers, 'running': self._num_running}
+
+
+if __name__ == '__main__':
+    exit(0)
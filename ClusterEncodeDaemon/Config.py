@@ -13,6 +13,27 @@ _CONFIG_KEYS: Final[tuple[tuple[str, type], ...]] = (
     ('numChunks', int), ('isFileHost', bool)
 )
 """Configuration keys and their types."""
+_OPTIONAL_CONFIG_KEYS: Final[tuple[tuple[str, type, Any], ...]] = (
+    ('stagingBudget', int, 4096),
+    ('pinSlots', bool, False),
+    ('encodeNice', int, 0),
+    ('encodeIoPriority', int, 4),
+    ('splitIoPriority', int, 7),
+    ('cgroupPath', str, ''),
+    ('slotCpuPercent', int, 0),
+    ('slotMemoryLimit', int, 0),
+    ('minFreeMemory', int, 512),
+    ('maxLoadPercent', int, 300),
+    ('minFreeDisk', int, 1024),
+    ('sharedQuota', int, 0),
+    ('jobExpiry', int, 24),
+    ('commandWorkers', int, 16),
+    ('watchFolders', list, []),
+    ('watchSettleTime', int, 10),
+    ('watchPollInterval', int, 0),
+    ('watchPreset', dict, {}),
+)
+"""Optional configuration keys, their types, and default values, so older config files still load."""
 
 
 ###################################################################
@@ -101,8 +122,22 @@ class Config(object):
                 raise ConfigError("Key '%s' not found." % key, 7)
             if not isinstance(self._config[key], key_type):
                 raise ConfigError("Key '%s' not proper type '%s'." % (key, str(key_type)), 8)
+        for key, key_type, _default in _OPTIONAL_CONFIG_KEYS:
+            if key in self._config.keys() and not isinstance(self._config[key], key_type):
+                raise ConfigError("Key '%s' not proper type '%s'." % (key, str(key_type)), 8)
         return
 
+    def _get_optional(self, key: str) -> Any:
+        """
+        Get an optional config value, or its default if it's not set.
+        :param key: str: The config key.
+        :return: Any: The value.
+        """
+        for optional_key, _key_type, default in _OPTIONAL_CONFIG_KEYS:
+            if optional_key == key:
+                return self._config.get(key, default)
+        raise KeyError(key)
+
     def save(self) -> None:
         """
         Save the current config to the file.
@@ -226,6 +261,235 @@ class Config(object):
         return
 
 
+    @property
+    def staging_budget(self) -> int:
+        return self._get_optional('stagingBudget')
+
+    @staging_budget.setter
+    def staging_budget(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("staging budget expected type int.")
+        if value < 1:
+            raise ValueError("staging budget must be at least 1 MB.")
+        self._config['stagingBudget'] = value
+        return
+
+    @property
+    def pin_slots(self) -> bool:
+        return self._get_optional('pinSlots')
+
+    @pin_slots.setter
+    def pin_slots(self, value: bool) -> None:
+        if not isinstance(value, bool):
+            raise TypeError("pin slots expected type bool.")
+        self._config['pinSlots'] = value
+        return
+
+    @property
+    def encode_nice(self) -> int:
+        return self._get_optional('encodeNice')
+
+    @encode_nice.setter
+    def encode_nice(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("encode nice expected type int.")
+        if not -20 <= value <= 19:
+            raise ValueError("encode nice must be between -20 and 19.")
+        self._config['encodeNice'] = value
+        return
+
+    @property
+    def encode_io_priority(self) -> int:
+        return self._get_optional('encodeIoPriority')
+
+    @encode_io_priority.setter
+    def encode_io_priority(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("encode io priority expected type int.")
+        if not 0 <= value <= 7:
+            raise ValueError("encode io priority must be between 0 and 7.")
+        self._config['encodeIoPriority'] = value
+        return
+
+    @property
+    def split_io_priority(self) -> int:
+        return self._get_optional('splitIoPriority')
+
+    @split_io_priority.setter
+    def split_io_priority(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("split io priority expected type int.")
+        if not 0 <= value <= 7:
+            raise ValueError("split io priority must be between 0 and 7.")
+        self._config['splitIoPriority'] = value
+        return
+
+    @property
+    def cgroup_path(self) -> str:
+        return self._get_optional('cgroupPath')
+
+    @cgroup_path.setter
+    def cgroup_path(self, value: str) -> None:
+        if not isinstance(value, str):
+            raise TypeError("cgroup path expected type str.")
+        if value != '' and not os.path.isdir(value):
+            raise ValueError("cgroup path must be an existing cgroup directory.")
+        self._config['cgroupPath'] = value
+        return
+
+    @property
+    def slot_cpu_percent(self) -> int:
+        return self._get_optional('slotCpuPercent')
+
+    @slot_cpu_percent.setter
+    def slot_cpu_percent(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("slot cpu percent expected type int.")
+        if value < 0:
+            raise ValueError("slot cpu percent must not be negative.")
+        self._config['slotCpuPercent'] = value
+        return
+
+    @property
+    def slot_memory_limit(self) -> int:
+        return self._get_optional('slotMemoryLimit')
+
+    @slot_memory_limit.setter
+    def slot_memory_limit(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("slot memory limit expected type int.")
+        if value < 0:
+            raise ValueError("slot memory limit must not be negative.")
+        self._config['slotMemoryLimit'] = value
+        return
+
+    @property
+    def min_free_memory(self) -> int:
+        return self._get_optional('minFreeMemory')
+
+    @min_free_memory.setter
+    def min_free_memory(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("min free memory expected type int.")
+        if value < 0:
+            raise ValueError("min free memory must not be negative.")
+        self._config['minFreeMemory'] = value
+        return
+
+    @property
+    def max_load_percent(self) -> int:
+        return self._get_optional('maxLoadPercent')
+
+    @max_load_percent.setter
+    def max_load_percent(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("max load percent expected type int.")
+        if value < 0:
+            raise ValueError("max load percent must not be negative.")
+        self._config['maxLoadPercent'] = value
+        return
+
+    @property
+    def min_free_disk(self) -> int:
+        return self._get_optional('minFreeDisk')
+
+    @min_free_disk.setter
+    def min_free_disk(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("min free disk expected type int.")
+        if value < 0:
+            raise ValueError("min free disk must not be negative.")
+        self._config['minFreeDisk'] = value
+        return
+
+    @property
+    def shared_quota(self) -> int:
+        return self._get_optional('sharedQuota')
+
+    @shared_quota.setter
+    def shared_quota(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("shared quota expected type int.")
+        if value < 0:
+            raise ValueError("shared quota must not be negative.")
+        self._config['sharedQuota'] = value
+        return
+
+    @property
+    def job_expiry(self) -> int:
+        return self._get_optional('jobExpiry')
+
+    @job_expiry.setter
+    def job_expiry(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("job expiry expected type int.")
+        if value < 1:
+            raise ValueError("job expiry must be at least 1 hour.")
+        self._config['jobExpiry'] = value
+        return
+
+    @property
+    def command_workers(self) -> int:
+        return self._get_optional('commandWorkers')
+
+    @command_workers.setter
+    def command_workers(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("command workers expected type int.")
+        if value < 1:
+            raise ValueError("command workers must be at least 1.")
+        self._config['commandWorkers'] = value
+        return
+
+    @property
+    def watch_folders(self) -> list[str]:
+        return self._get_optional('watchFolders')
+
+    @watch_folders.setter
+    def watch_folders(self, value: list[str]) -> None:
+        if not isinstance(value, list) or not all(isinstance(folder, str) for folder in value):
+            raise TypeError("watch folders expected type list[str].")
+        self._config['watchFolders'] = value
+        return
+
+    @property
+    def watch_settle_time(self) -> int:
+        return self._get_optional('watchSettleTime')
+
+    @watch_settle_time.setter
+    def watch_settle_time(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("watch settle time expected type int.")
+        if value < 1:
+            raise ValueError("watch settle time must be at least 1 second.")
+        self._config['watchSettleTime'] = value
+        return
+
+    @property
+    def watch_poll_interval(self) -> int:
+        return self._get_optional('watchPollInterval')
+
+    @watch_poll_interval.setter
+    def watch_poll_interval(self, value: int) -> None:
+        if not isinstance(value, int):
+            raise TypeError("watch poll interval expected type int.")
+        if value < 0:
+            raise ValueError("watch poll interval must not be negative.")
+        self._config['watchPollInterval'] = value
+        return
+
+    @property
+    def watch_preset(self) -> dict[str, Any]:
+        return self._get_optional('watchPreset')
+
+    @watch_preset.setter
+    def watch_preset(self, value: dict[str, Any]) -> None:
+        if not isinstance(value, dict):
+            raise TypeError("watch preset expected type dict.")
+        self._config['watchPreset'] = value
+        return
+
+
 ##########################################################################
 # Config Test:
 if __name__ == '__main__':
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+    File: Profiling.py
+    Description: Profile the running daemon on demand. A sampling profiler takes the stack of every thread at a set
+        interval, so the slot, connection, and supervisor threads are all seen, which cProfile can't do from another
+        thread; And tracemalloc shows where memory grew while the profile ran.
+"""
+import os
+import re
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from threading import Thread, Event, Lock, enumerate as enumerate_threads, get_ident
+from types import FrameType
+from typing import Optional, Final, Any
+
+PROFILE_MAX_DURATION: Final[float] = 600.0
+"""The longest a profile may run for, in seconds."""
+DEFAULT_SAMPLE_INTERVAL: Final[float] = 0.01
+"""The default time between samples, in seconds."""
+MIN_SAMPLE_INTERVAL: Final[float] = 0.001
+"""The shortest time between samples, in seconds; Sampling takes the GIL, so faster slows the daemon down."""
+MAX_SAMPLE_INTERVAL: Final[float] = 1.0
+"""The longest time between samples, in seconds."""
+DEFAULT_TOP: Final[int] = 30
+"""The default number of functions / allocation sites to return."""
+TRACEMALLOC_FRAMES: Final[int] = 8
+"""The number of frames tracemalloc keeps for each allocation, so growth can be traced back to its caller."""
+
+_active_lock: Lock = Lock()
+"""Held while a profile is running, there can only be one at a time."""
+
+
+def _frame_name(frame: FrameType) -> str:
+    """
+    Name a stack frame by its function, IE: 'run (Scheduler.py:487)'.
+    :param frame: FrameType: The frame.
+    :return: str: The name.
+    """
+    code = frame.f_code
+    return '%s (%s:%i)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def _thread_name(name: str) -> str:
+    """
+    Drop the counter from a thread's name, so the threads started for each connection are counted together.
+    :param name: str: The thread name, IE: 'Thread-12 (handle_connection)'.
+    :return: str: The name, IE: 'Thread (handle_connection)'.
+    """
+    return re.sub(r'-\d+', '', name)
+
+
+def _top_growth(differences: list[tracemalloc.StatisticDiff], top: int) -> list[tracemalloc.StatisticDiff]:
+    """
+    Get the allocation sites that grew the most.
+    :param differences: list[tracemalloc.StatisticDiff]: The differences between two snapshots.
+    :param top: int: The number of sites to return.
+    :return: list[tracemalloc.StatisticDiff]: The sites that grew, most first.
+    """
+    grown = [difference for difference in differences if difference.size_diff > 0]
+    grown.sort(key=lambda difference: difference.size_diff, reverse=True)
+    return grown[:top]
+
+
+class SamplingProfiler(Thread):
+    """
+    Sample the stacks of all the other threads.
+    """
+    def __init__(self, interval: float, exclude: tuple[int, ...] = ()) -> None:
+        """
+        Initialize the profiler.
+        :param interval: float: The time between samples, in seconds.
+        :param exclude: tuple[int, ...] = (): Idents of threads not to sample, IE: the one waiting for the profile.
+        """
+        super().__init__(daemon=True)
+        self._interval: float = interval
+        """The time between samples."""
+        self._exclude: tuple[int, ...] = exclude
+        """Idents of threads not to sample, the profiler is added when it starts."""
+        self._stacks: Counter = Counter()
+        """The number of samples of each stack: (thread name, frame names, root first)."""
+        self._num_samples: int = 0
+        """The number of samples taken."""
+        self._stop_event: Event = Event()
+        """Set to stop sampling."""
+        return
+
+    def sample(self) -> None:
+        """
+        Take a sample of each thread's stack.
+        :return: None
+        """
+        names: dict[int, str] = {thread.ident: _thread_name(thread.name) for thread in enumerate_threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident in self._exclude:
+                continue
+            stack: list[str] = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+            self._stacks[(names.get(ident, 'unknown'), tuple(stack))] += 1
+        self._num_samples += 1
+        return
+
+    def run(self) -> None:
+        """
+        Sample until stopped.
+        :return: None
+        """
+        self._exclude += (get_ident(),)
+        while not self._stop_event.wait(self._interval):
+            self.sample()
+        return
+
+    def stop(self) -> None:
+        """
+        Stop sampling, and wait for the thread to finish.
+        :return: None
+        """
+        self._stop_event.set()
+        self.join()
+        return
+
+    @property
+    def num_samples(self) -> int:
+        return self._num_samples
+
+    def collapsed_stacks(self) -> str:
+        """
+        Get the samples as collapsed stacks, one 'thread;frame;frame count' line per stack, root first; The format
+        flamegraph.pl, speedscope, and similar tools read.
+        :return: str: The collapsed stacks, most sampled first.
+        """
+        lines: list[str] = ['%s %i' % (';'.join((thread_name,) + stack), count)
+                            for (thread_name, stack), count in self._stacks.most_common()]
+        return '\n'.join(lines)
+
+    def function_stats(self, top: int) -> list[dict[str, Any]]:
+        """
+        Get the number of samples in each function, like pstats: 'self' the function was running, 'total' it was
+        anywhere on the stack. Threads blocked waiting are sampled too, so waits show up as time in the wait.
+        :param top: int: The number of functions to return.
+        :return: list[dict[str, Any]]: The functions with the most self samples, most first.
+        """
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        for (_thread_name, stack), count in self._stacks.items():
+            if len(stack) == 0:
+                continue
+            self_counts[stack[-1]] += count
+            for frame_name in set(stack):  # Recursion only counts once.
+                total_counts[frame_name] += count
+        num_stacks: int = max(sum(self._stacks.values()), 1)
+        return [{
+            'function': frame_name,
+            'self': self_count,
+            'total': total_counts[frame_name],
+            'selfPercent': self_count * 100.0 / num_stacks,
+            'totalPercent': total_counts[frame_name] * 100.0 / num_stacks,
+        } for frame_name, self_count in self_counts.most_common(top)]
+
+
+class Profile(object):
+    """
+    A profile of the daemon: Stack samples, and optionally memory growth, between start() and stop().
+    """
+    def __init__(self, interval: float, trace_memory: bool, top: int) -> None:
+        """
+        Initialize the profile.
+        :param interval: float: The time between stack samples, in seconds.
+        :param trace_memory: bool: True to trace memory allocations too; It slows every allocation down while it runs.
+        :param top: int: The number of functions / allocation sites to return.
+        """
+        self._interval: float = interval
+        """The time between stack samples."""
+        self._trace_memory: bool = trace_memory
+        """True if memory allocations are traced."""
+        self._top: int = top
+        """The number of functions / allocation sites to return."""
+        self._profiler: Optional[SamplingProfiler] = None
+        """The stack sampler, while running."""
+        self._started_tracemalloc: bool = False
+        """True if tracemalloc was started by this profile, and is stopped when it finishes."""
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        """The memory snapshot at the start."""
+        self._start_time: float = 0.0
+        """When the profile started, on the monotonic clock."""
+        return
+
+    def start(self) -> bool:
+        """
+        Start profiling.
+        :return: bool: True it started, False another profile is already running.
+        """
+        if not _active_lock.acquire(blocking=False):
+            return False
+        if self._trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                self._started_tracemalloc = True
+            self._snapshot = tracemalloc.take_snapshot()
+        self._start_time = time.monotonic()
+        self._profiler = SamplingProfiler(self._interval, (get_ident(),))
+        self._profiler.start()
+        return True
+
+    def _memory_growth(self) -> dict[str, Any]:
+        """
+        Compare the memory now to the start snapshot.
+        :return: dict[str, Any]: The traced memory, and the allocation sites that grew the most.
+        """
+        snapshot = tracemalloc.take_snapshot()
+        # Leave out tracemalloc's, and the profiler's own allocations:
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+                   tracemalloc.Filter(False, __file__, all_frames=True),
+                   tracemalloc.Filter(False, '<frozen importlib._bootstrap>')]
+        differences = snapshot.filter_traces(filters).compare_to(self._snapshot.filter_traces(filters), 'traceback')
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'current': current,
+            'peak': peak,
+            'growth': [{
+                'traceback': ['%s:%i' % (frame.filename, frame.lineno) for frame in difference.traceback],
+                'size': difference.size,
+                'sizeDiff': difference.size_diff,
+                'count': difference.count,
+                'countDiff': difference.count_diff,
+            } for difference in _top_growth(differences, self._top)],
+        }
+
+    def stop(self) -> dict[str, Any]:
+        """
+        Stop profiling.
+        :return: dict[str, Any]: The results: 'duration', 'samples', 'sampleInterval', 'functionStats' (see
+        SamplingProfiler.function_stats()), 'collapsedStacks', and 'memory', None if memory wasn't traced.
+        """
+        self._profiler.stop()
+        results: dict[str, Any] = {
+            'duration': time.monotonic() - self._start_time,
+            'samples': self._profiler.num_samples,
+            'sampleInterval': self._interval,
+            'functionStats': self._profiler.function_stats(self._top),
+            'collapsedStacks': self._profiler.collapsed_stacks(),
+            'memory': None,
+        }
+        if self._trace_memory:
+            results['memory'] = self._memory_growth()
+            self._snapshot = None
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+        self._profiler = None
+        _active_lock.release()
+        return results
+
+
+if __name__ == '__main__':
+    exit(0)
@@ -0,0 +1,1139 @@
+#!/usr/bin/env python3
+"""
+    File: Scheduler.py
+    Description: Schedule chunk encodes on this daemon's encode slots. Each slot prefetches its next chunk into the
+        local working directory while the current chunk encodes, and finished outputs are uploaded to the shared
+        working directory in the background.
+"""
+import os
+import sys
+import time
+from collections import deque
+from datetime import timedelta
+from queue import Queue
+from threading import Thread, Condition, Event, Lock
+from statistics import median
+from typing import Optional, Any, Final
+
+from common import out_info, out_debug, out_warning
+from Staging import StagingBudget, PrefetchThread, UploadThread
+from Admission import AdmissionControl
+from WorkDirs import WorkDirManager
+from Tracing import tracer
+sys.path.append('../')
+from ffmpegCli import Ffmpegcli, ProcessLimits
+
+SPECULATE_CHECK_INTERVAL: Final[float] = 5.0
+"""How often, in seconds, an idle slot looks for a straggler to run a speculative copy of."""
+SPECULATE_MIN_REMAINING: Final[float] = 30.0
+"""Don't speculate on a chunk expected to finish in less than this many seconds."""
+SPECULATE_MARGIN: Final[float] = 1.5
+"""A copy is only started if a fresh encode is expected to finish this many times sooner than the straggler."""
+RESPLIT_MIN_REMAINING: Final[float] = 60.0
+"""Don't re-split a running chunk expected to finish in less than this many seconds."""
+RESPLIT_MIN_LENGTH: Final[timedelta] = timedelta(seconds=30)
+"""The shortest sub-range of the source a re-split will create."""
+RESPLIT_END_TOLERANCE: Final[timedelta] = timedelta(milliseconds=100)
+"""A stopped encode within this of its end time is treated as complete."""
+PRIORITY_WEIGHT_BASE: Final[float] = 2.0
+"""A job's share of the slots is multiplied by this for each step of priority."""
+FINISHED_JOB_HISTORY: Final[int] = 32
+"""The number of finished jobs kept for status."""
+MEMORY_WAIT_INTERVAL: Final[float] = 2.0
+"""How often, in seconds, a slot held back by low memory checks again."""
+
+
+def parse_speed(speed: Optional[str]) -> Optional[float]:
+    """
+    Convert an ffmpeg speed string to a float.
+    :param speed: Optional[str]: The speed, IE: '1.5x'.
+    :return: Optional[float]: The speed as a multiple of real time, or None if unknown.
+    """
+    if speed is None or not speed.endswith('x'):
+        return None
+    try:
+        return float(speed[:-1])
+    except ValueError:
+        return None
+
+
+class Chunk(object):
+    """
+    A single chunk of a job to encode.
+    """
+    def __init__(self,
+                 job: 'Job',
+                 chunk_id: int,
+                 input_path: str,
+                 output_path: str,
+                 start_time: Optional[timedelta] = None,
+                 end_time: Optional[timedelta] = None,
+                 length: Optional[timedelta] = None,
+                 bit_rate: Optional[int] = None,
+                 pass_log: Optional[str] = None,
+                 rendition_paths: Optional[list[str]] = None,
+                 ) -> None:
+        """
+        Initialize the chunk.
+        :param job: Job: The job this chunk belongs to.
+        :param chunk_id: int: The id of the chunk in the job.
+        :param input_path: str: The full path to the input, either a split chunk, or the source if a time range is set.
+        :param output_path: str: The full path to the final output file.
+        :param start_time: Optional[timedelta]: Where to start in the input, None for the start.
+        :param end_time: Optional[timedelta]: Where to stop in the input, None for the end.
+        :param length: Optional[timedelta]: The length of the chunk if known, used to spot stragglers. Calculated from
+        the time range if both ends are set.
+        :param bit_rate: Optional[int]: The video bit rate to target in kbit/s, None for constant quality.
+        :param pass_log: Optional[str]: The full path prefix of the pass statistics, for two pass jobs.
+        :param rendition_paths: Optional[list[str]]: The full paths to the final outputs of the job's renditions.
+        """
+        self.job: Job = job
+        """The job this chunk belongs to."""
+        self.chunk_id: int = chunk_id
+        """The id of the chunk in the job."""
+        self.input_path: str = input_path
+        """The full path to the input."""
+        self.output_path: str = output_path
+        """The full path to the final output."""
+        self.start_time: Optional[timedelta] = start_time
+        """Where to start in the input."""
+        self.end_time: Optional[timedelta] = end_time
+        """Where to stop in the input."""
+        self.length: Optional[timedelta] = length
+        """The length of the chunk."""
+        if start_time is not None and end_time is not None:
+            self.length = end_time - start_time
+        self.bit_rate: Optional[int] = bit_rate
+        """The video bit rate to target."""
+        self.pass_log: Optional[str] = pass_log
+        """The pass statistics path prefix."""
+        self.rendition_paths: list[str] = rendition_paths or []
+        """The final outputs of the job's renditions, one per rendition."""
+        self.state: str = 'pending'
+        """The chunk state: pending, staging, encoding, uploading, finished, failed, or cancelled."""
+        self.slot_num: Optional[int] = None
+        """The slot the chunk is assigned to."""
+        self.current_time: Optional[timedelta] = None
+        """The current encode position."""
+        self.speed: Optional[str] = None
+        """The current encode speed."""
+        self.percent_complete: Optional[float] = None
+        """The percent of the chunk encoded."""
+        self.attempts: list[str] = []
+        """The output paths of the running encodes of this chunk, more than one if a speculative copy is running."""
+        self.speculated: bool = False
+        """True if a speculative copy has been started."""
+        self.won: bool = False
+        """True once an attempt has finished successfully."""
+        self.resplit_parts: int = 0
+        """If > 0, the encode has been stopped to re-split the rest of the chunk into this many parts."""
+        self.was_split: bool = False
+        """True once sub-parts have been split off the chunk; It can't be split again, the new sub-parts' names would
+        clash with the first's, and sort after them."""
+        self.cancelled: bool = False
+        """True once the chunk has been cancelled, it finishes as 'cancelled', and its output is removed."""
+        self.queued_time: float = time.time()
+        """When the chunk was last queued, the start of its 'queued' span."""
+        return
+
+    @property
+    def speed_value(self) -> Optional[float]:
+        return parse_speed(self.speed)
+
+    def estimate_remaining(self) -> Optional[float]:
+        """
+        Estimate the number of seconds until this chunk's encode finishes, from its live progress.
+        :return: Optional[float]: The estimated seconds, or None if the length, position, or speed isn't known.
+        """
+        speed = self.speed_value
+        if self.length is None or self.current_time is None or not speed:
+            return None
+        return max((self.length - self.current_time).total_seconds(), 0.0) / speed
+
+    @property
+    def is_ranged(self) -> bool:
+        """
+        Is this a splitless chunk, encoded straight from the source.
+        :return: bool: True if a time range is set.
+        """
+        return self.start_time is not None or self.end_time is not None
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Build the chunk's status dict.
+        :return: dict[str, Any]
+        """
+        return {
+            'jobId': self.job.job_id,
+            'chunkId': self.chunk_id,
+            'state': self.state,
+            'slot': self.slot_num,
+            'currentTime': self.current_time,
+            'currentSpeed': self.speed,
+            'totalComplete': self.percent_complete,
+        }
+
+
+class Job(object):
+    """
+    A group of chunks encoded with the same settings.
+    """
+    def __init__(self,
+                 job_id: str,
+                 encode_settings: dict[str, Any],
+                 use_local_copy: bool,
+                 priority: int = 0,
+                 owner: str = '',
+                 keep_reports: bool = True,
+                 renditions: Optional[list[tuple[Optional[dict[str, int]], Optional[int]]]] = None,
+                 ) -> None:
+        """
+        Initialize the job.
+        :param job_id: str: The job id.
+        :param encode_settings: dict[str, Any]: The keyword arguments for Ffmpegcli.encode(), IE: audio_encoder,
+        down_mix_audio, boost_volume, video_encoder, and scale_video.
+        :param use_local_copy: bool: True stage the inputs and outputs in the local working directory, False encode
+        from / to the shared working directory directly.
+        :param priority: int = 0: The job's priority, each step up doubles its share of the slots; can be negative.
+        :param owner: str = '': Who submitted the job, slots are shared fairly between owners first, then between
+        each owner's jobs.
+        :param keep_reports: bool = True: True queue reports for a client to send, False drop them, for jobs nobody
+        is waiting on.
+        :param renditions: Optional[list[tuple[Optional[dict[str, int]], Optional[int]]]] = None: The (scale_video,
+        bit_rate) of each extra output encoded from the same decode of a chunk, see EncodeThread.
+        """
+        self.job_id: str = job_id
+        """The job id."""
+        self.encode_settings: dict[str, Any] = encode_settings
+        """The encode keyword arguments."""
+        self.use_local_copy: bool = use_local_copy
+        """Stage the inputs / outputs locally."""
+        self.priority: int = priority
+        """The job's priority."""
+        self.owner: str = owner
+        """Who submitted the job."""
+        self.sequence: int = 0
+        """The order the job was submitted in, set by the scheduler."""
+        self.chunks: list[Chunk] = []
+        """The chunks of this job."""
+        self.pending: deque[Chunk] = deque()
+        """The chunks waiting for a slot."""
+        self.renditions: list[tuple[Optional[dict[str, int]], Optional[int]]] = renditions or []
+        """The extra outputs of each chunk."""
+        self.reports: Optional[Queue] = Queue() if keep_reports else None
+        """Report dicts to send to the client, None if they're dropped."""
+        self.finished: Event = Event()
+        """Set when all the chunks have finished, failed, or been cancelled."""
+        return
+
+    def add_chunk(self,
+                  input_path: str,
+                  output_path: str,
+                  start_time: Optional[timedelta] = None,
+                  end_time: Optional[timedelta] = None,
+                  length: Optional[timedelta] = None,
+                  bit_rate: Optional[int] = None,
+                  pass_log: Optional[str] = None,
+                  rendition_paths: Optional[list[str]] = None,
+                  ) -> Chunk:
+        """
+        Add a chunk to the job.
+        :param input_path: str: The full path to the input.
+        :param output_path: str: The full path to the final output.
+        :param start_time: Optional[timedelta]: Where to start in the input.
+        :param end_time: Optional[timedelta]: Where to stop in the input.
+        :param length: Optional[timedelta]: The length of the chunk, if known.
+        :param bit_rate: Optional[int]: The video bit rate to target in kbit/s.
+        :param pass_log: Optional[str]: The pass statistics path prefix, for two pass jobs.
+        :param rendition_paths: Optional[list[str]]: The full paths to the final outputs of the job's renditions.
+        :return: Chunk: The new chunk.
+        """
+        chunk = Chunk(self, len(self.chunks), input_path, output_path, start_time, end_time, length, bit_rate,
+                      pass_log, rendition_paths)
+        self.chunks.append(chunk)
+        return chunk
+
+    def report(self, status: str, chunk: Chunk, **kwargs) -> None:
+        """
+        Queue a report for the client.
+        :param status: str: The report status.
+        :param chunk: Chunk: The chunk being reported on.
+        :param kwargs: Any extra values to add to the report.
+        :return: None
+        """
+        if self.reports is None:
+            return
+        report_obj: dict[str, Any] = {'version': '1.0.0', 'status': status}
+        report_obj.update(chunk.to_dict())
+        report_obj.update(kwargs)
+        self.reports.put(report_obj)
+        return
+
+    def check_finished(self) -> bool:
+        """
+        Check if all the chunks have finished, failed, or been cancelled. The scheduler sets the finished event, once
+        the job has been removed, see Scheduler._finish_job().
+        :return: bool: True all the chunks are done.
+        """
+        return all(chunk.state in ('finished', 'failed', 'cancelled') for chunk in self.chunks)
+
+    @property
+    def success(self) -> bool:
+        return all(chunk.state == 'finished' for chunk in self.chunks)
+
+    @property
+    def rate_pass(self) -> Optional[int]:
+        return self.encode_settings.get('rate_pass')
+
+    @property
+    def weight(self) -> float:
+        return PRIORITY_WEIGHT_BASE ** self.priority
+
+    def slots_used(self) -> int:
+        """
+        Count the slots this job's chunks are on.
+        :return: int: The number of chunks staging or encoding.
+        """
+        return sum(1 for chunk in self.chunks if chunk.state in ('staging', 'encoding'))
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Build the job's status dict.
+        :return: dict[str, Any]
+        """
+        states: list[str] = [chunk.state for chunk in self.chunks]
+        return {
+            'jobId': self.job_id,
+            'owner': self.owner,
+            'priority': self.priority,
+            'numChunks': len(states),
+            'numPending': states.count('pending'),
+            'numRunning': states.count('staging') + states.count('encoding'),
+            'numUploading': states.count('uploading'),
+            'numFinished': states.count('finished'),
+            'numFailed': states.count('failed'),
+            'numCancelled': states.count('cancelled'),
+            'finished': self.finished.is_set(),
+            'success': self.success,
+        }
+
+    def find_straggler(self) -> Optional[Chunk]:
+        """
+        Find the encoding chunk most worth a speculative copy; one whose estimated remaining time is longer than a
+        fresh encode at the job's median speed would take.
+        :return: Optional[Chunk]: The slowest such chunk, or None.
+        """
+        if self.rate_pass == 1 or len(self.renditions) > 0:  # Copies would write the same statistics, or renditions.
+            return None
+        speeds = [chunk.speed_value for chunk in self.chunks if chunk.speed_value]
+        if len(speeds) == 0:
+            return None
+        median_speed: float = median(speeds)
+        straggler: Optional[Chunk] = None
+        straggler_remaining: float = 0.0
+        for chunk in self.chunks:
+            if chunk.state != 'encoding' or chunk.speculated or chunk.won or chunk.resplit_parts > 0 or chunk.cancelled:
+                continue
+            remaining = chunk.estimate_remaining()
+            if remaining is None or remaining < SPECULATE_MIN_REMAINING:
+                continue
+            fresh = chunk.length.total_seconds() / median_speed
+            if fresh * SPECULATE_MARGIN < remaining and remaining > straggler_remaining:
+                straggler = chunk
+                straggler_remaining = remaining
+        return straggler
+
+    def find_resplit_candidate(self) -> Optional[Chunk]:
+        """
+        Find the encoding ranged chunk with the most time left, if it's worth stopping and re-splitting the rest of
+        its range over the idle slots.
+        :return: Optional[Chunk]: The chunk, or None.
+        """
+        if self.rate_pass is not None or len(self.renditions) > 0:  # Passes / renditions must cut at the same points.
+            return None
+        candidate: Optional[Chunk] = None
+        candidate_remaining: float = 0.0
+        for chunk in self.chunks:
+            if chunk.state != 'encoding' or chunk.end_time is None or chunk.start_time is None:
+                continue
+            if chunk.speculated or chunk.won or chunk.resplit_parts > 0 or chunk.was_split or chunk.cancelled:
+                continue
+            remaining = chunk.estimate_remaining()
+            if remaining is None or remaining < RESPLIT_MIN_REMAINING:
+                continue
+            if chunk.length - chunk.current_time < RESPLIT_MIN_LENGTH * 2:
+                continue
+            if remaining > candidate_remaining:
+                candidate = chunk
+                candidate_remaining = remaining
+        return candidate
+
+
+class SlotThread(Thread):
+    """
+    Thread running a single encode slot.
+    """
+    def __init__(self, scheduler: 'Scheduler', slot_num: int, limits: Optional[ProcessLimits] = None) -> None:
+        """
+        Initialize the slot.
+        :param scheduler: Scheduler: The scheduler to take chunks from.
+        :param slot_num: int: The slot number.
+        :param limits: Optional[ProcessLimits] = None: The CPU / priority / cgroup limits for this slot's encodes.
+        """
+        super().__init__(daemon=True)
+        self._scheduler: Scheduler = scheduler
+        """The scheduler this slot belongs to."""
+        self.slot_num: int = slot_num
+        """The slot number."""
+        self.limits: Optional[ProcessLimits] = limits
+        """The limits this slot's encodes run with, None for the ffmpeg cli's defaults."""
+        self.current_chunk: Optional[Chunk] = None
+        """The chunk currently encoding."""
+        return
+
+    def _stage(self, chunk: Chunk) -> tuple[Chunk, Optional[PrefetchThread]]:
+        """
+        Claim a chunk, and start prefetching its input if the job uses local copies.
+        :param chunk: Chunk: The chunk to stage.
+        :return: tuple[Chunk, Optional[PrefetchThread]]: The chunk, and the prefetch thread, or None if the chunk is
+        encoded from the shared working directory directly.
+        """
+        chunk.slot_num = self.slot_num
+        chunk.state = 'staging'
+        tracer.add('queued', 'queue', chunk.queued_time, None, chunk.job.job_id, chunk.chunk_id, self.slot_num)
+        chunk.job.report('chunk staging', chunk)
+        # Ranged chunks seek the source, copying the whole source locally would defeat the point:
+        if not chunk.job.use_local_copy or chunk.is_ranged:
+            return chunk, None
+        local_path = self._scheduler.local_input_path(chunk)
+        prefetch = PrefetchThread(self._scheduler.budget, chunk.input_path, local_path,
+                                  self._scheduler.copy_io_priority)
+        prefetch.start()
+        return chunk, prefetch
+
+    def _report_progress(self, chunk: Chunk, speculative: bool, report_type: str, *args) -> None:
+        """
+        EncodeThread callback, store the progress and report it.
+        :param chunk: Chunk: The chunk being encoded.
+        :param speculative: bool: True if this is a speculative copy, its progress is reported, but not stored, so
+        the straggler's own progress is still what's compared.
+        :param report_type: str: The report type.
+        :param args: The report values, see EncodeThread.
+        :return: None
+        """
+        if report_type != 'report':
+            return
+        if not speculative:
+            chunk.current_time = args[0]
+            chunk.speed = args[4]
+            chunk.percent_complete = args[5]
+        chunk.job.report('chunk report', chunk, currentFrame=args[1], fps=args[2], bitRate=args[3],
+                         speculative=speculative, attemptTime=args[0], attemptSpeed=args[4])
+        return
+
+    def _encode(self,
+                chunk: Chunk,
+                input_path: str,
+                output_path: str,
+                speculative: bool,
+                rendition_paths: Optional[list[str]] = None,
+                ) -> bool:
+        """
+        Start an encode attempt of a chunk.
+        :param chunk: Chunk: The chunk to encode.
+        :param input_path: str: The input to encode.
+        :param output_path: str: The output for this attempt.
+        :param speculative: bool: True if this is a speculative copy.
+        :param rendition_paths: Optional[list[str]] = None: The outputs of the job's renditions for this attempt.
+        :return: bool: True the encode started, False it failed to start, or the chunk has been cancelled.
+        """
+        if not self._scheduler.attempt_started(chunk, output_path):
+            return False
+        try:
+            started: bool = self._scheduler.ffmpeg_cli.encode(
+                input_path=input_path,
+                output_path=output_path,
+                callback=lambda report_type, *args, _chunk=chunk: self._report_progress(_chunk, speculative,
+                                                                                        report_type, *args),
+                start_time=chunk.start_time,
+                end_time=chunk.end_time,
+                total_time=chunk.length,
+                limits=self.limits,
+                bit_rate=chunk.bit_rate,
+                pass_log=chunk.pass_log,
+                renditions=[(path, scale_video, bit_rate)
+                            for path, (scale_video, bit_rate) in zip(rendition_paths or [], chunk.job.renditions)],
+                **chunk.job.encode_settings
+            )
+        except (ValueError, OSError) as e:  # The encode couldn't be built, IE: an inverted range, fail the attempt.
+            out_warning("Failed to start encoding chunk %i of job '%s': %s" % (chunk.chunk_id, chunk.job.job_id,
+                                                                               str(e)))
+            return False
+        return started
+
+    def _run_speculative(self, chunk: Chunk) -> None:
+        """
+        Run a speculative copy of a straggling chunk. The copy reads the input from the shared working directory,
+        and writes next to the final output; if it finishes first it's renamed into place, and the straggler killed.
+        :param chunk: Chunk: The straggling chunk.
+        :return: None
+        """
+        out_info("Starting speculative copy of chunk %i of job '%s' on slot %i." % (chunk.chunk_id, chunk.job.job_id,
+                                                                                  self.slot_num))
+        chunk.job.report('chunk speculating', chunk, speculativeSlot=self.slot_num)
+        output_path = self._scheduler.speculative_output_path(chunk)
+        self.current_chunk = chunk
+        success: bool = False
+        # A lane of its own, the straggler's encode is still running on the chunk's row:
+        with tracer.span('encode', 'encode', chunk.job.job_id, chunk.chunk_id, self.slot_num, 'speculative',
+                         speculative=True) as span_args:
+            if self._encode(chunk, chunk.input_path, output_path, True):
+                _found, success = self._scheduler.ffmpeg_cli.encode_finish(output_path)
+            span_args['success'] = success
+        self.current_chunk = None
+        result = self._scheduler.attempt_finished(chunk, output_path, success)
+        if result == 'won':
+            try:
+                os.replace(output_path, chunk.output_path)
+            except OSError as e:
+                out_warning("Failed to move speculative output into place: %s" % str(e))
+                self._scheduler.chunk_finished(chunk, False)
+                return
+            self._scheduler.chunk_finished(chunk, True)
+            return
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        if result == 'failed':
+            self._scheduler.chunk_finished(chunk, False)
+        return
+
+    def _upload_finished(self, chunk: Chunk, start: float, success: bool) -> None:
+        """
+        UploadThread callback, trace the upload and finish the chunk.
+        :param chunk: Chunk: The uploaded chunk.
+        :param start: float: When the upload was queued.
+        :param success: bool: True the upload succeeded.
+        :return: None
+        """
+        tracer.add('upload', 'copy', start, None, chunk.job.job_id, chunk.chunk_id, self.slot_num, success=success)
+        self._scheduler.chunk_finished(chunk, success)
+        return
+
+    def _upload(self, chunk: Chunk, uploads: list[tuple[str, str]]) -> None:
+        """
+        Queue a chunk's outputs for upload, the chunk finishes once they all have.
+        :param chunk: Chunk: The chunk.
+        :param uploads: list[tuple[str, str]]: The (local_path, shared_path) of each output.
+        :return: None
+        """
+        start: float = time.time()
+        results: list[bool] = []
+        results_lock: Lock = Lock()
+
+        def uploaded(success: bool) -> None:
+            with results_lock:
+                results.append(success)
+                if len(results) < len(uploads):
+                    return
+            self._upload_finished(chunk, start, all(results))
+            return
+
+        for local_path, shared_path in uploads:
+            self._scheduler.uploader.upload(local_path, shared_path, uploaded)
+        return
+
+    def run(self) -> None:
+        """
+        Encode chunks until the scheduler is stopped.
+        :return: None
+        """
+        next_item: Optional[tuple[Chunk, Optional[PrefetchThread]]] = None
+        while True:
+            # Get the chunk to encode, unless it was already claimed and prefetched:
+            if next_item is None:
+                taken = self._scheduler.next_chunk(block=True)
+                if taken is None:  # Scheduler stopped.
+                    break
+                chunk, speculative = taken
+                if speculative:
+                    self._run_speculative(chunk)
+                    continue
+                self._scheduler.split_pending(chunk)  # Share a long chunk with any other idle slots.
+                next_item = self._stage(chunk)
+            chunk, prefetch = next_item
+            next_item = None
+            self.current_chunk = chunk
+
+            # Wait for the input to be staged:
+            input_path: str = chunk.input_path
+            if prefetch is not None:
+                prefetch.join()
+                tracer.add('copy input', 'copy', prefetch.start_time, prefetch.end_time, chunk.job.job_id,
+                           chunk.chunk_id, self.slot_num, success=prefetch.success, size=prefetch.size)
+                if not prefetch.success:
+                    self.current_chunk = None
+                    self._scheduler.chunk_finished(chunk, False)
+                    continue
+                input_path = prefetch.local_path
+
+            # Start the encode:
+            output_path: str = chunk.output_path
+            rendition_paths: list[str] = chunk.rendition_paths
+            if chunk.job.use_local_copy:
+                output_path = self._scheduler.local_output_path(chunk)
+                rendition_paths = [self._scheduler.local_rendition_path(chunk, index)
+                                   for index in range(len(chunk.rendition_paths))]
+            self._scheduler.wait_for_memory(chunk)
+            chunk.state = 'encoding'
+            chunk.job.report('chunk encoding', chunk)
+            success: bool = False
+            requeued: bool = False
+            encode_start: float = time.time()
+            if self._encode(chunk, input_path, output_path, False, rendition_paths):
+                # Claim and prefetch the next chunk while this one encodes:
+                taken = self._scheduler.next_chunk(block=False)
+                if taken is not None:
+                    next_item = self._stage(taken[0])
+                _found, success = self._scheduler.ffmpeg_cli.encode_finish(output_path)
+                if success and chunk.resplit_parts > 0 and not chunk.cancelled:  # Stopped early, re-split the rest.
+                    requeued = not self._scheduler.resplit(chunk, output_path)
+            tracer.add('encode', 'encode', encode_start, None, chunk.job.job_id, chunk.chunk_id, self.slot_num,
+                       success=success, resplitParts=chunk.resplit_parts)
+
+            # Free the staged input:
+            if prefetch is not None:
+                os.remove(prefetch.local_path)
+                self._scheduler.budget.release(prefetch.size)
+            self.current_chunk = None
+            if requeued:
+                continue
+
+            # Upload the output in the background, or finish the chunk:
+            result = self._scheduler.attempt_finished(chunk, output_path, success)
+            if result == 'won' and chunk.job.use_local_copy and chunk.job.rate_pass != 1:
+                chunk.state = 'uploading'
+                chunk.job.report('chunk uploading', chunk)
+                self._upload(chunk, [(output_path, chunk.output_path)] + list(zip(rendition_paths,
+                                                                                  chunk.rendition_paths)))
+            elif result == 'won':
+                self._scheduler.chunk_finished(chunk, True)
+            else:
+                # Don't remove the final output if a speculative copy already replaced it:
+                if os.path.exists(output_path) and not (chunk.won and output_path == chunk.output_path):
+                    os.remove(output_path)
+                for rendition_path in rendition_paths:
+                    if os.path.exists(rendition_path):
+                        os.remove(rendition_path)
+                if result == 'failed':
+                    self._scheduler.chunk_finished(chunk, False)
+        return
+
+
+class Scheduler(object):
+    """
+    Hand out chunks to the encode slots.
+    """
+    def __init__(self,
+                 ffmpeg_cli: Ffmpegcli,
+                 num_slots: int,
+                 staging_budget: int,
+                 local_input_dir: str,
+                 local_output_dir: str,
+                 slot_limits: Optional[list[ProcessLimits]] = None,
+                 copy_io_priority: Optional[int] = None,
+                 admission: Optional[AdmissionControl] = None,
+                 work_dirs: Optional[WorkDirManager] = None,
+                 ) -> None:
+        """
+        Initialize the scheduler.
+        :param ffmpeg_cli: Ffmpegcli: The ffmpeg cli helper.
+        :param num_slots: int: The number of simultaneous encodes.
+        :param staging_budget: int: The max number of bytes to stage in the local working directory.
+        :param local_input_dir: str: The local working input directory.
+        :param local_output_dir: str: The local working output directory.
+        :param slot_limits: Optional[list[ProcessLimits]] = None: The limits for each slot's encodes, IE: its own
+        CPUs; None for the ffmpeg cli's defaults.
+        :param copy_io_priority: Optional[int] = None: The best-effort I/O priority for prefetches and uploads, 0
+        (highest) to 7 (lowest), None to leave it unchanged.
+        :param admission: Optional[AdmissionControl] = None: If set, slots hold off starting encodes while memory is
+        short.
+        :param work_dirs: Optional[WorkDirManager] = None: If set, the jobs' chunk files are tracked, so they're
+        removed when the job is combined or cancelled.
+        """
+        self.ffmpeg_cli: Ffmpegcli = ffmpeg_cli
+        """The ffmpeg cli helper."""
+        self._admission: Optional[AdmissionControl] = admission
+        """The admission control to check memory with before starting an encode."""
+        self._work_dirs: Optional[WorkDirManager] = work_dirs
+        """The working directory manager to track the jobs' files with."""
+        self.copy_io_priority: Optional[int] = copy_io_priority
+        """The I/O priority for prefetches and uploads."""
+        self.budget: StagingBudget = StagingBudget(staging_budget)
+        """The local staging budget."""
+        self.uploader: UploadThread = UploadThread(self.budget, copy_io_priority)
+        """The background upload thread."""
+        self._local_input_dir: str = local_input_dir
+        """The local working input directory."""
+        self._local_output_dir: str = local_output_dir
+        """The local working output directory."""
+        self._slots: list[SlotThread] = [
+            SlotThread(self, slot_num, slot_limits[slot_num] if slot_limits is not None else None)
+            for slot_num in range(num_slots)
+        ]
+        """The encode slots."""
+        self._jobs: dict[str, Job] = {}
+        """The current jobs, by job id, each with its own pending chunks."""
+        self._finished_jobs: deque[Job] = deque(maxlen=FINISHED_JOB_HISTORY)
+        """The most recently finished jobs, for status."""
+        self._sequence: int = 0
+        """The submission number of the next job."""
+        self._condition: Condition = Condition()
+        """Condition to wait on for pending chunks."""
+        self._running: bool = False
+        """True while the scheduler is running."""
+        self._idle_slots: int = 0
+        """The number of slots waiting for a chunk."""
+        return
+
+    @property
+    def num_slots(self) -> int:
+        return len(self._slots)
+
+    def start(self) -> None:
+        """
+        Start the slot and upload threads.
+        :return: None
+        """
+        self._running = True
+        self.uploader.start()
+        for slot in self._slots:
+            slot.start()
+        return
+
+    def stop(self) -> None:
+        """
+        Stop handing out chunks, the slots exit once their current chunk is finished.
+        :return: None
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self.uploader.stop()
+        return
+
+    def wait_for_memory(self, chunk: Chunk) -> None:
+        """
+        Hold a slot back from starting an encode while memory is short, so the node doesn't swap. Returns early if
+        the chunk is cancelled, or the scheduler is stopped.
+        :param chunk: Chunk: The chunk about to start.
+        :return: None
+        """
+        if self._admission is None or self._admission.memory_ok():
+            return
+        out_warning("Memory is short, holding chunk %i of job '%s'." % (chunk.chunk_id, chunk.job.job_id))
+        with tracer.span('memory wait', 'queue', chunk.job.job_id, chunk.chunk_id, chunk.slot_num):
+            while self._running and not chunk.cancelled and not self._admission.memory_ok():
+                time.sleep(MEMORY_WAIT_INTERVAL)
+        return
+
+    def local_input_path(self, chunk: Chunk) -> str:
+        """
+        The path a chunk's input is staged to.
+        :param chunk: Chunk: The chunk.
+        :return: str: The full path in the local input directory.
+        """
+        return os.path.join(self._local_input_dir, chunk.job.job_id + '.' + os.path.basename(chunk.input_path))
+
+    def local_output_path(self, chunk: Chunk) -> str:
+        """
+        The path a chunk's output is encoded to before upload.
+        :param chunk: Chunk: The chunk.
+        :return: str: The full path in the local output directory.
+        """
+        return os.path.join(self._local_output_dir, chunk.job.job_id + '.' + os.path.basename(chunk.output_path))
+
+    def local_rendition_path(self, chunk: Chunk, index: int) -> str:
+        """
+        The path a chunk's rendition output is encoded to before upload; The renditions' parts share their names.
+        :param chunk: Chunk: The chunk.
+        :param index: int: The rendition's index in the job's renditions.
+        :return: str: The full path in the local output directory.
+        """
+        return os.path.join(self._local_output_dir, '%s.R%i.%s' % (chunk.job.job_id, index,
+                                                                   os.path.basename(chunk.rendition_paths[index])))
+
+    @staticmethod
+    def speculative_output_path(chunk: Chunk) -> str:
+        """
+        The path a speculative copy of a chunk is encoded to, next to the final output.
+        :param chunk: Chunk: The chunk.
+        :return: str: The full path.
+        """
+        output_dir, output_name = os.path.split(chunk.output_path)
+        return os.path.join(output_dir, 'Spec.' + output_name)
+
+    def submit(self, job: Job) -> bool:
+        """
+        Queue a job's chunks for encoding.
+        :param job: Job: The job to queue.
+        :return: bool: True the job was queued, False a job with this id already exists.
+        """
+        with self._condition:
+            if job.job_id in self._jobs.keys():
+                return False
+            job.sequence = self._sequence
+            self._sequence += 1
+            self._jobs[job.job_id] = job
+            queued_time: float = time.time()
+            for chunk in job.chunks:
+                chunk.queued_time = queued_time
+            job.pending.extend(job.chunks)
+            self._condition.notify_all()
+        out_info("Job '%s' from '%s' queued with %i chunks at priority %i." % (job.job_id, job.owner,
+                                                                              len(job.chunks), job.priority))
+        if self._work_dirs is not None:  # Ranged chunks' inputs are the source, which isn't the job's to remove.
+            self._work_dirs.add_files(job.job_id, [chunk.input_path for chunk in job.chunks if not chunk.is_ranged] +
+                                      [chunk.output_path for chunk in job.chunks])
+        if len(job.chunks) == 0:
+            self._finish_job(job)
+        return True
+
+    def _pending_count(self) -> int:
+        """
+        Count the chunks waiting for a slot. Must be called with the condition held.
+        :return: int: The number of pending chunks.
+        """
+        return sum(len(job.pending) for job in self._jobs.values())
+
+    def _pick_job(self) -> Optional[Job]:
+        """
+        Pick the job to take the next chunk from, by weighted fair share. First the owner using the fewest slots for
+        its weight, then that owner's job using the fewest slots for its weight; An owner's weight is that of its
+        highest priority job with pending chunks. Ties go to the higher priority, then to the earlier job. Must be
+        called with the condition held.
+        :return: Optional[Job]: The job, or None if no job has pending chunks.
+        """
+        owners: dict[str, list[Job]] = {}
+        for job in self._jobs.values():
+            if len(job.pending) > 0:
+                owners.setdefault(job.owner, []).append(job)
+        if len(owners) == 0:
+            return None
+        slots_used: dict[Job, int] = {job: job.slots_used() for job in self._jobs.values()}
+
+        def owner_key(owner: str) -> tuple[float, float, int]:
+            weight = max(job.weight for job in owners[owner])
+            used = sum(used for job, used in slots_used.items() if job.owner == owner)
+            return used / weight, -weight, min(job.sequence for job in owners[owner])
+
+        def job_key(job: Job) -> tuple[float, float, int]:
+            return slots_used[job] / job.weight, -job.weight, job.sequence
+
+        return min(owners[min(owners.keys(), key=owner_key)], key=job_key)
+
+    def _take_pending(self) -> Chunk:
+        """
+        Take the next pending chunk, from the job picked by _pick_job(). Must be called with the condition held, and
+        a chunk pending.
+        :return: Chunk: The chunk, marked as staging so it counts towards its job's slots straight away.
+        """
+        chunk = self._pick_job().pending.popleft()
+        chunk.state = 'staging'
+        return chunk
+
+    def next_chunk(self, block: bool = True) -> Optional[tuple[Chunk, bool]]:
+        """
+        Take the next chunk to encode. When blocking and nothing is pending, the slot is idle, so every
+        SPECULATE_CHECK_INTERVAL seconds, long running ranged chunks are stopped and re-split over the idle slots, and
+        other stragglers are returned as speculative copies.
+        :param block: bool: True wait for a chunk, False return None if there isn't one, or another slot is idle.
+        :return: Optional[tuple[Chunk, bool]]: The next chunk, and True if it's a speculative copy of a running
+        chunk; or None if not blocking and there are no chunks, or the scheduler has stopped.
+        """
+        with self._condition:
+            while True:
+                if not self._running:
+                    return None
+                if not block:
+                    # Looking ahead to prefetch; leave the chunk for a slot that's idle now:
+                    if self._pending_count() > 0 and self._idle_slots == 0:
+                        return self._take_pending(), False
+                    return None
+                if self._pending_count() > 0:
+                    return self._take_pending(), False
+                if self._request_resplit():
+                    pass  # The sub-parts are queued once the chunk's encode has stopped.
+                else:
+                    for job in self._jobs.values():
+                        straggler = job.find_straggler()
+                        if straggler is not None:
+                            straggler.speculated = True
+                            return straggler, True
+                self._idle_slots += 1
+                self._condition.wait(SPECULATE_CHECK_INTERVAL)
+                self._idle_slots -= 1
+
+    def _request_resplit(self) -> bool:
+        """
+        Stop the longest running ranged chunk, if any is worth re-splitting, so the rest of its range can be shared
+        with the idle slots. Must be called with the condition held.
+        :return: bool: True a chunk was stopped.
+        """
+        for job in self._jobs.values():
+            chunk = job.find_resplit_candidate()
+            if chunk is None or len(chunk.attempts) == 0:
+                continue
+            # The idle slots, this one, and the slot the chunk is on:
+            chunk.resplit_parts = self._idle_slots + 2
+            out_info("Stopping chunk %i of job '%s' to re-split it in %i parts." % (chunk.chunk_id, job.job_id,
+                                                                                    chunk.resplit_parts))
+            self.ffmpeg_cli.encode_stop(chunk.attempts[0])
+            return True
+        return False
+
+    def _sub_ranges(self,
+                    input_path: str,
+                    start_time: timedelta,
+                    end_time: timedelta,
+                    num_parts: int,
+                    ) -> list[tuple[timedelta, timedelta]]:
+        """
+        Divide a time range into roughly equal parts, cut on keyframes of the source where possible.
+        :param input_path: str: The source file.
+        :param start_time: timedelta: The start of the range.
+        :param end_time: timedelta: The end of the range.
+        :param num_parts: int: The number of parts wanted, fewer are made if they'd be shorter than
+        RESPLIT_MIN_LENGTH.
+        :return: list[tuple[timedelta, timedelta]]: The (start, end) ranges in order.
+        """
+        length: timedelta = end_time - start_time
+        num_parts = max(min(num_parts, int(length / RESPLIT_MIN_LENGTH)), 1)
+        keyframes = self.ffmpeg_cli.get_keyframes(input_path, start_time, end_time) or []
+        cuts: list[timedelta] = [start_time]
+        for part_num in range(1, num_parts):
+            target: timedelta = start_time + (length * part_num) / num_parts
+            cut = min(keyframes, key=lambda keyframe: abs(keyframe - target)) if keyframes else target
+            if cuts[-1] < cut < end_time:
+                cuts.append(cut)
+        cuts.append(end_time)
+        return [(cuts[index], cuts[index + 1]) for index in range(len(cuts) - 1)]
+
+    def _add_sub_chunks(self, chunk: Chunk, ranges: list[tuple[timedelta, timedelta]]) -> list[Chunk]:
+        """
+        Queue sub-parts of a chunk, ahead of the job's other pending chunks, since they're the tail of a running chunk.
+        :param chunk: Chunk: The chunk they're split from.
+        :param ranges: list[tuple[timedelta, timedelta]]: The sub-part ranges.
+        :return: list[Chunk]: The new chunks.
+        """
+        output_dir, output_name = os.path.split(chunk.output_path)
+        with self._condition:
+            chunk.was_split = True
+            sub_chunks: list[Chunk] = []
+            for sub_part, (start_time, end_time) in enumerate(ranges, 1):
+                output_path = os.path.join(output_dir, Ffmpegcli.sub_part_name(output_name, sub_part))
+                sub_chunks.append(chunk.job.add_chunk(chunk.input_path, output_path, start_time, end_time))
+            chunk.job.pending.extendleft(reversed(sub_chunks))
+            self._condition.notify_all()
+        sub_chunk_objs = [{'chunkId': sub_chunk.chunk_id, 'outputFile': sub_chunk.output_path,
+                           'startTime': sub_chunk.start_time, 'endTime': sub_chunk.end_time}
+                          for sub_chunk in sub_chunks]
+        chunk.job.report('chunk resplit', chunk, endTime=chunk.end_time, subChunks=sub_chunk_objs)
+        if self._work_dirs is not None:
+            self._work_dirs.add_files(chunk.job.job_id, [sub_chunk.output_path for sub_chunk in sub_chunks])
+        return sub_chunks
+
+    def split_pending(self, chunk: Chunk) -> None:
+        """
+        Split a ranged chunk just taken from the queue, if there are more idle slots than pending chunks.
+        :param chunk: Chunk: The chunk.
+        :return: None
+        """
+        if chunk.start_time is None or chunk.end_time is None or chunk.job.rate_pass is not None or \
+                len(chunk.job.renditions) > 0 or chunk.was_split:
+            return
+        with self._condition:
+            spare_slots: int = self._idle_slots - self._pending_count()
+        if spare_slots <= 0 or chunk.length < RESPLIT_MIN_LENGTH * 2:
+            return
+        ranges = self._sub_ranges(chunk.input_path, chunk.start_time, chunk.end_time, spare_slots + 1)
+        if len(ranges) < 2:
+            return
+        chunk.end_time = ranges[0][1]
+        chunk.length = chunk.end_time - chunk.start_time
+        self._add_sub_chunks(chunk, ranges[1:])
+        return
+
+    def resplit(self, chunk: Chunk, output_path: str) -> bool:
+        """
+        Queue the rest of a stopped chunk's range as sub-parts, and shorten the chunk to what was encoded.
+        :param chunk: Chunk: The stopped chunk.
+        :param output_path: str: The output of the stopped encode.
+        :return: bool: True the output is good up to the new end time, False where it stopped isn't known, and the
+        chunk has been queued again from the start.
+        """
+        encoded_length = self.ffmpeg_cli.get_duration(output_path)
+        if encoded_length is None:
+            out_warning("Unable to find where chunk %i stopped, re-queueing it." % chunk.chunk_id)
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            with self._condition:
+                if output_path in chunk.attempts:
+                    chunk.attempts.remove(output_path)
+                chunk.resplit_parts = 0
+                chunk.state = 'pending'
+                chunk.queued_time = time.time()
+                chunk.job.pending.appendleft(chunk)
+                self._condition.notify_all()
+            return False
+        resume_time: timedelta = chunk.start_time + encoded_length
+        if resume_time < chunk.end_time - RESPLIT_END_TOLERANCE:
+            ranges = self._sub_ranges(chunk.input_path, resume_time, chunk.end_time, chunk.resplit_parts)
+            chunk.end_time = resume_time
+            chunk.length = encoded_length
+            self._add_sub_chunks(chunk, ranges)
+        return True
+
+    def attempt_started(self, chunk: Chunk, output_path: str) -> bool:
+        """
+        Record an encode attempt of a chunk.
+        :param chunk: Chunk: The chunk.
+        :param output_path: str: The attempt's output path, which identifies the encode.
+        :return: bool: True the attempt can start, False the chunk has been cancelled.
+        """
+        with self._condition:
+            if chunk.cancelled:
+                return False
+            chunk.attempts.append(output_path)
+        return True
+
+    def attempt_finished(self, chunk: Chunk, output_path: str, success: bool) -> str:
+        """
+        Record the end of an encode attempt. The first successful attempt wins, and any others are killed.
+        :param chunk: Chunk: The chunk.
+        :param output_path: str: The attempt's output path.
+        :param success: bool: True the attempt's encode succeeded.
+        :return: str: 'won' this attempt's output should be used; 'lost' another attempt won or is still running,
+        discard this output; 'failed' this was the last attempt, and it failed.
+        """
+        with self._condition:
+            if output_path in chunk.attempts:
+                chunk.attempts.remove(output_path)
+            if chunk.won:
+                return 'lost'
+            if not success:
+                return 'lost' if len(chunk.attempts) > 0 else 'failed'
+            chunk.won = True
+            losers = list(chunk.attempts)
+        for loser_path in losers:
+            out_debug("Killing losing attempt '%s'." % loser_path)
+            self.ffmpeg_cli.encode_terminate(loser_path)
+        return 'won'
+
+    def cancel(self, job_id: str, chunk_id: Optional[int] = None) -> bool:
+        """
+        Cancel a job, or a single chunk of it. Pending chunks are dropped, and running encodes are killed; the slots
+        remove the partial outputs, and take their next chunk.
+        :param job_id: str: The job id.
+        :param chunk_id: Optional[int]: The chunk to cancel, None to cancel all the unfinished chunks of the job.
+        :return: bool: True something was cancelled, False the job / chunk wasn't found, or was already done.
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False
+            chunks = [chunk for chunk in job.chunks if chunk.state not in ('finished', 'failed', 'cancelled')
+                      and not chunk.cancelled and (chunk_id is None or chunk.chunk_id == chunk_id)]
+            not_started: list[Chunk] = []
+            attempts: list[str] = []
+            for chunk in chunks:
+                chunk.cancelled = True
+                if chunk in job.pending:
+                    job.pending.remove(chunk)
+                if len(chunk.attempts) > 0:
+                    attempts.extend(chunk.attempts)
+                elif chunk.state in ('pending', 'staging'):  # Pending, or claimed by a slot, but not encoding yet.
+                    not_started.append(chunk)
+        if len(chunks) == 0:
+            return False
+        out_info("Cancelling %i chunk(s) of job '%s'." % (len(chunks), job_id))
+        for output_path in attempts:
+            self.ffmpeg_cli.encode_terminate(output_path)
+        for chunk in not_started:
+            self.chunk_finished(chunk, False)
+        return True
+
+    def chunk_finished(self, chunk: Chunk, success: bool) -> None:
+        """
+        Mark a chunk as finished, failed, or cancelled. A cancelled chunk's output is removed. Only the first call
+        for a chunk counts, a cancelled chunk can be finished by cancel() before its slot gets to it.
+        :param chunk: Chunk: The chunk.
+        :param success: bool: True the chunk is encoded and in place, False it failed.
+        :return: None
+        """
+        extra: dict[str, Any] = {}
+        if len(chunk.rendition_paths) > 0:
+            extra['renditionFiles'] = chunk.rendition_paths
+        if success and chunk.job.rate_pass == 1 and not chunk.cancelled:
+            # The controller shares the job's bit budget out by each chunk's first pass complexity:
+            extra['passComplexity'] = Ffmpegcli.read_pass_complexity(chunk.pass_log)
+            if extra['passComplexity'] is None:
+                out_warning("Unable to read the first pass statistics of chunk %i." % chunk.chunk_id)
+                success = False
+        with self._condition:
+            if chunk.state in ('finished', 'failed', 'cancelled'):
+                return
+            if chunk.cancelled:
+                chunk.state = 'cancelled'
+            else:
+                chunk.state = 'finished' if success else 'failed'
+        if chunk.cancelled:
+            success = False
+            for output_path in [chunk.output_path] + chunk.rendition_paths:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+        elif not success:
+            out_warning("Chunk %i of job '%s' failed." % (chunk.chunk_id, chunk.job.job_id))
+        chunk.job.report('chunk finished', chunk, success=success, outputFile=chunk.output_path, **extra)
+        if self._work_dirs is not None:
+            self._work_dirs.touch_job(chunk.job.job_id)
+        if chunk.job.check_finished():
+            self._finish_job(chunk.job)
+        return
+
+    def _finish_job(self, job: Job) -> None:
+        """
+        Remove a finished job, then set its finished event: The client may send the next batch under the same job id as
+        soon as it's told, so the id must be free by then.
+        :param job: Job: The job.
+        :return: None
+        """
+        with self._condition:
+            if self._jobs.get(job.job_id) is not job:  # The last chunks finished together, and it's already removed.
+                return
+            self._jobs.pop(job.job_id)
+            self._finished_jobs.append(job)
+        job.finished.set()
+        out_debug("Job '%s' finished." % job.job_id)
+        return
+
+    def status(self) -> dict[str, Any]:
+        """
+        Build the scheduler's status dict.
+        :return: dict[str, Any]
+        """
+        # The slot threads set current_chunk without the lock, so read each once:
+        current_chunks: list[Optional[Chunk]] = [slot.current_chunk for slot in self._slots]
+        with self._condition:
+            return {
+                'slots': [chunk.to_dict() if chunk is not None else None for chunk in current_chunks],
+                'pendingChunks': self._pending_count(),
+                'jobs': [job.to_dict() for job in self._jobs.values()],
+                'finishedJobs': [job.to_dict() for job in self._finished_jobs],
+                'slotLimits': [slot.limits.to_dict() if slot.limits is not None else None for slot in self._slots],
+                'stagingUsed': self.budget.used_bytes,
+                'stagingBudget': self.budget.max_bytes,
+            }
+
+
+if __name__ == '__main__':
+    exit(0)
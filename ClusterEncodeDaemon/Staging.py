@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+    File: Staging.py
+    Description: Local staging of input / output chunks, prefetching inputs from, and uploading outputs to the shared
+        working directory in the background.
+"""
+import os
+import shutil
+import time
+from queue import Queue
+from threading import Thread, Condition
+from typing import Optional, Callable
+
+from common import out_debug, out_error
+from ffmpegCli import set_thread_io_priority
+
+
+class StagingBudget(object):
+    """
+    Limit the number of bytes staged in the local working directory at once.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        """
+        Initialize the budget.
+        :param max_bytes: int: The max number of bytes that can be staged at once.
+        """
+        self._max_bytes: int = max_bytes
+        """The max number of bytes that can be staged."""
+        self._used_bytes: int = 0
+        """The number of bytes currently staged."""
+        self._condition: Condition = Condition()
+        """Condition to wait on for space to be released."""
+        return
+
+    def reserve(self, num_bytes: int) -> None:
+        """
+        Reserve space in the budget, blocking until there is room. A single file larger than the whole budget is
+        allowed once nothing else is staged, so it can't block forever.
+        :param num_bytes: int: The number of bytes to reserve.
+        :return: None
+        """
+        with self._condition:
+            while self._used_bytes > 0 and self._used_bytes + num_bytes > self._max_bytes:
+                self._condition.wait()
+            self._used_bytes += num_bytes
+        return
+
+    def add(self, num_bytes: int) -> None:
+        """
+        Account for bytes already on disk without blocking, IE: a finished output waiting for upload.
+        :param num_bytes: int: The number of bytes to add.
+        :return: None
+        """
+        with self._condition:
+            self._used_bytes += num_bytes
+        return
+
+    def release(self, num_bytes: int) -> None:
+        """
+        Release reserved space.
+        :param num_bytes: int: The number of bytes to release.
+        :return: None
+        """
+        with self._condition:
+            self._used_bytes = max(self._used_bytes - num_bytes, 0)
+            self._condition.notify_all()
+        return
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @property
+    def used_bytes(self) -> int:
+        return self._used_bytes
+
+
+def copy_file(source_path: str, destination_path: str) -> bool:
+    """
+    Copy a file, writing to a temporary name and renaming when complete, so a partial file is never seen under the
+    final name.
+    :param source_path: str: The file to copy.
+    :param destination_path: str: The path to copy to, including file name.
+    :return: bool: True the copy succeeded, False it failed.
+    """
+    temp_path: str = destination_path + '.part'
+    try:
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, destination_path)
+    except OSError as e:
+        out_error("Failed to copy '%s' to '%s': %s" % (source_path, destination_path, str(e)))
+        try:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        except OSError as remove_error:
+            out_error("Failed to remove partial copy '%s': %s" % (temp_path, str(remove_error)))
+        return False
+    return True
+
+
+class PrefetchThread(Thread):
+    """
+    Thread to copy an input chunk from the shared working directory to the local working directory.
+    """
+    def __init__(self,
+                 budget: StagingBudget,
+                 source_path: str,
+                 local_path: str,
+                 io_priority: Optional[int] = None,
+                 ) -> None:
+        """
+        Initialize the prefetch thread.
+        :param budget: StagingBudget: The staging budget to reserve the input size from.
+        :param source_path: str: The full path to the input chunk in the shared working directory.
+        :param local_path: str: The full path to copy the chunk to.
+        :param io_priority: Optional[int] = None: The best-effort I/O priority to copy at, 0 (highest) to 7 (lowest),
+        None to leave it unchanged.
+        """
+        super().__init__(daemon=True)
+        self._budget: StagingBudget = budget
+        """The staging budget."""
+        self._source_path: str = source_path
+        """The path to copy from."""
+        self._local_path: str = local_path
+        """The path to copy to."""
+        self._io_priority: Optional[int] = io_priority
+        """The I/O priority to copy at."""
+        self._size: int = 0
+        """The number of bytes reserved from the budget."""
+        self._success: bool = False
+        """True if the copy succeeded."""
+        self._start_time: float = 0.0
+        """When the thread started, for tracing; Includes any wait for space in the budget."""
+        self._end_time: float = 0.0
+        """When the copy finished."""
+        return
+
+    def run(self) -> None:
+        """
+        Reserve space, and copy the file.
+        :return: None
+        """
+        self._start_time = time.time()
+        if self._io_priority is not None:
+            set_thread_io_priority(self._io_priority)
+        try:
+            self._size = os.path.getsize(self._source_path)
+        except OSError as e:
+            out_error("Failed to stat input chunk '%s': %s" % (self._source_path, str(e)))
+            self._end_time = time.time()
+            return
+        self._budget.reserve(self._size)
+        out_debug("Prefetching '%s'." % self._source_path)
+        self._success = copy_file(self._source_path, self._local_path)
+        if not self._success:
+            self._budget.release(self._size)
+            self._size = 0
+        self._end_time = time.time()
+        return
+
+    @property
+    def local_path(self) -> str:
+        return self._local_path
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def success(self) -> bool:
+        return self._success
+
+    @property
+    def start_time(self) -> float:
+        return self._start_time
+
+    @property
+    def end_time(self) -> float:
+        return self._end_time
+
+
+class UploadThread(Thread):
+    """
+    Thread to copy finished outputs back to the shared working directory in the background.
+    """
+    def __init__(self, budget: StagingBudget, io_priority: Optional[int] = None) -> None:
+        """
+        Initialize the upload thread.
+        :param budget: StagingBudget: The staging budget to release the output sizes to.
+        :param io_priority: Optional[int] = None: The best-effort I/O priority to copy at, 0 (highest) to 7 (lowest),
+        None to leave it unchanged.
+        """
+        super().__init__(daemon=True)
+        self._budget: StagingBudget = budget
+        """The staging budget."""
+        self._io_priority: Optional[int] = io_priority
+        """The I/O priority to copy at."""
+        self._queue: Queue = Queue()
+        """Queue of uploads: (local_path, shared_path, size, callback), or None to stop."""
+        self._pending: int = 0
+        """The number of uploads queued or running."""
+        self._pending_condition: Condition = Condition()
+        """Condition to wait on for the pending uploads to finish."""
+        return
+
+    def upload(self, local_path: str, shared_path: str, callback: Optional[Callable[[bool], None]] = None) -> None:
+        """
+        Queue a finished output for upload. The local file is removed once it's uploaded, or the upload failed, as
+        its size is no longer counted in the staging budget after.
+        :param local_path: str: The full path to the local output.
+        :param shared_path: str: The full path to upload to.
+        :param callback: Optional[Callable[[bool], None]]: Called with True on success, False on failure.
+        :return: None
+        """
+        size: int = os.path.getsize(local_path)
+        self._budget.add(size)
+        with self._pending_condition:
+            self._pending += 1
+        self._queue.put((local_path, shared_path, size, callback))
+        return
+
+    def stop(self) -> None:
+        """
+        Stop the thread once the queued uploads are finished.
+        :return: None
+        """
+        self._queue.put(None)
+        return
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for all the queued uploads to finish.
+        :param timeout: Optional[float]: The number of seconds to wait, None to wait forever.
+        :return: bool: True the uploads are finished, False the timeout expired.
+        """
+        with self._pending_condition:
+            return self._pending_condition.wait_for(lambda: self._pending == 0, timeout)
+
+    def run(self) -> None:
+        """
+        Upload the queued files.
+        :return: None
+        """
+        if self._io_priority is not None:
+            set_thread_io_priority(self._io_priority)
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            local_path, shared_path, size, callback = item
+            out_debug("Uploading '%s'." % local_path)
+            success: bool = copy_file(local_path, shared_path)  # Removes its partial copy if it fails.
+            try:
+                os.remove(local_path)
+            except OSError as e:
+                out_error("Failed to remove local output '%s': %s" % (local_path, str(e)))
+            self._budget.release(size)
+            if callback is not None:
+                callback(success)
+            with self._pending_condition:
+                self._pending -= 1
+                self._pending_condition.notify_all()
+        return
+
+
+if __name__ == '__main__':
+    exit(0)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+    File: Tracing.py
+    Description: Timestamped spans for each stage of a chunk's life: split, copy, queueing, encode, upload, and
+        combine; Tagged with the host and slot, and exported as Chrome trace-event JSON, so a whole cluster job can be
+        viewed as a timeline in chrome://tracing or Perfetto.
+"""
+import socket
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from typing import Optional, Final, Any, Iterator
+
+TRACE_MAX_SPANS: Final[int] = 100000
+"""The max number of spans kept, the oldest are dropped first."""
+DAEMON_TID: Final[int] = 0
+"""The trace thread id of spans that don't belong to a job."""
+
+
+class Span(object):
+    """
+    A single timed stage.
+    """
+    __slots__ = ('name', 'category', 'start', 'end', 'job_id', 'chunk_id', 'slot', 'lane', 'args')
+
+    def __init__(self,
+                 name: str,
+                 category: str,
+                 start: float,
+                 end: float,
+                 job_id: Optional[str],
+                 chunk_id: Optional[int],
+                 slot: Optional[int],
+                 lane: str,
+                 args: dict[str, Any],
+                 ) -> None:
+        """
+        Initialize the span.
+        :param name: str: The stage name, IE: 'encode'.
+        :param category: str: The stage category: 'split', 'copy', 'queue', 'encode', or 'combine'.
+        :param start: float: The wall clock start time, so spans from different hosts line up.
+        :param end: float: The wall clock end time.
+        :param job_id: Optional[str]: The job the span belongs to.
+        :param chunk_id: Optional[int]: The chunk the span belongs to.
+        :param slot: Optional[int]: The encode slot it ran on, None if it's not on a slot.
+        :param lane: str: Separates spans of the same chunk, or job, that run at the same time, IE: 'speculative'.
+        :param args: dict[str, Any]: Extra values to show with the span.
+        """
+        self.name: str = name
+        self.category: str = category
+        self.start: float = start
+        self.end: float = end
+        self.job_id: Optional[str] = job_id
+        self.chunk_id: Optional[int] = chunk_id
+        self.slot: Optional[int] = slot
+        self.lane: str = lane
+        self.args: dict[str, Any] = args
+        return
+
+    @property
+    def track(self) -> tuple[str, int, str]:
+        """The timeline row the span is drawn on: (job_id, chunk_id, lane), a chunk's stages follow each other along
+        its own row."""
+        return self.job_id or '', self.chunk_id if self.chunk_id is not None else -1, self.lane
+
+    @property
+    def track_name(self) -> str:
+        if self.job_id is None:
+            name = 'daemon'
+        elif self.chunk_id is None:
+            name = self.job_id
+        else:
+            name = '%s chunk %i' % (self.job_id, self.chunk_id)
+        return name if self.lane == '' else '%s (%s)' % (name, self.lane)
+
+
+class Tracer(object):
+    """
+    Record spans, and export them as Chrome trace events.
+    """
+    def __init__(self, max_spans: int = TRACE_MAX_SPANS) -> None:
+        """
+        Initialize the tracer.
+        :param max_spans: int = TRACE_MAX_SPANS: The max number of spans to keep.
+        """
+        self.host: str = socket.gethostname()
+        """The host name the spans are tagged with."""
+        self._spans: deque[Span] = deque(maxlen=max_spans)
+        """The recorded spans, oldest first."""
+        self._lock: Lock = Lock()
+        """Lock for _spans."""
+        return
+
+    def add(self,
+            name: str,
+            category: str,
+            start: float,
+            end: Optional[float] = None,
+            job_id: Optional[str] = None,
+            chunk_id: Optional[int] = None,
+            slot: Optional[int] = None,
+            lane: str = '',
+            **args
+            ) -> None:
+        """
+        Record a span that has already happened.
+        :param name: str: The stage name.
+        :param category: str: The stage category.
+        :param start: float: The time.time() it started.
+        :param end: Optional[float] = None: The time.time() it ended, None for now.
+        :param job_id: Optional[str] = None: The job it belongs to.
+        :param chunk_id: Optional[int] = None: The chunk it belongs to.
+        :param slot: Optional[int] = None: The slot it ran on.
+        :param lane: str = '': Separates spans that run at the same time as others of the same chunk, or job.
+        :param args: Extra values to show with the span.
+        :return: None
+        """
+        span = Span(name, category, start, end if end is not None else time.time(), job_id, chunk_id, slot, lane,
+                    args)
+        with self._lock:
+            self._spans.append(span)
+        return
+
+    @contextmanager
+    def span(self,
+             name: str,
+             category: str,
+             job_id: Optional[str] = None,
+             chunk_id: Optional[int] = None,
+             slot: Optional[int] = None,
+             lane: str = '',
+             **args
+             ) -> Iterator[dict[str, Any]]:
+        """
+        Time a block of code as a span. The block can add values to the yielded dict, IE: the result.
+        :param name: str: The stage name.
+        :param category: str: The stage category.
+        :param job_id: Optional[str] = None: The job it belongs to.
+        :param chunk_id: Optional[int] = None: The chunk it belongs to.
+        :param slot: Optional[int] = None: The slot it runs on.
+        :param lane: str = '': Separates spans that run at the same time as others of the same chunk, or job.
+        :param args: Extra values to show with the span.
+        :return: Iterator[dict[str, Any]]: The span's args.
+        """
+        start: float = time.time()
+        try:
+            yield args
+        finally:
+            self.add(name, category, start, None, job_id, chunk_id, slot, lane, **args)
+        return
+
+    def clear(self, job_id: Optional[str] = None) -> None:
+        """
+        Drop recorded spans.
+        :param job_id: Optional[str] = None: Only drop this job's spans, None to drop them all.
+        :return: None
+        """
+        with self._lock:
+            if job_id is None:
+                self._spans.clear()
+            else:
+                kept = [span for span in self._spans if span.job_id != job_id]
+                self._spans.clear()
+                self._spans.extend(kept)
+        return
+
+    def export(self, job_id: Optional[str] = None) -> list[dict[str, Any]]:
+        """
+        Export the spans as Chrome trace events. The host is a process, named after the host, with a row (thread) for
+        each chunk, and one for each job's split / combine; The slot is in each span's args.
+        :param job_id: Optional[str] = None: Only export this job's spans, None for all of them.
+        :return: list[dict[str, Any]]: The trace events.
+        """
+        pid: int = zlib.crc32(self.host.encode()) & 0x7fffffff
+        with self._lock:
+            spans = [span for span in self._spans if job_id is None or span.job_id == job_id]
+        events: list[dict[str, Any]] = [
+            {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': DAEMON_TID, 'args': {'name': self.host}},
+        ]
+        track_names: dict[tuple[str, int, str], str] = {span.track: span.track_name for span in spans}
+        tids: dict[tuple[str, int, str], int] = {}
+        for sort_index, track in enumerate(sorted(track_names.keys())):
+            tid = DAEMON_TID if track_names[track] == 'daemon' else sort_index + 1
+            tids[track] = tid
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                           'args': {'name': track_names[track]}})
+            events.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': pid, 'tid': tid,
+                           'args': {'sort_index': tid}})
+        for span in spans:
+            args: dict[str, Any] = {'host': self.host, 'jobId': span.job_id, 'chunkId': span.chunk_id,
+                                    'slot': span.slot}
+            args.update(span.args)
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': int(span.start * 1000000),
+                'dur': max(int((span.end - span.start) * 1000000), 0),
+                'pid': pid,
+                'tid': tids[span.track],
+                'args': args,
+            })
+        return events
+
+
+tracer: Tracer = Tracer()
+"""The daemon's tracer."""
+
+
+if __name__ == '__main__':
+    exit(0)
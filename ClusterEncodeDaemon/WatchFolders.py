@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+    File: WatchFolders.py
+    Description: Watch folders in the shared working directory for new sources, so jobs start as soon as a file
+        lands, instead of when someone next looks. Changes are seen with inotify, through ctypes, or by scanning the
+        folders when inotify isn't available, or can't see the writes, IE: another machine writing over NFS. A file is
+        only ingested once it's stable: Its size and mtime unchanged for the settle time, and no process here has it
+        open for writing. Ingested files wait in a queue for a controller to take, see the 'ingest' command.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from threading import Thread, Condition, Event
+from typing import Optional, Final, Any, Callable
+
+from common import out_info, out_debug, out_warning
+
+WATCH_EXTENSIONS: Final[tuple[str, ...]] = ('.mkv', '.mp4', '.m4v', '.mov', '.avi', '.ts', '.m2ts', '.mpg', '.mpeg',
+                                            '.webm', '.wmv', '.flv')
+"""The extensions of the files ingested; Partial downloads and copies, IE: '.part', are left alone."""
+FALLBACK_POLL_INTERVAL: Final[float] = 10.0
+"""Seconds between scans when inotify was asked for, but isn't available."""
+MAX_INGEST_WAIT: Final[float] = 300.0
+"""The longest an 'ingest' command may wait for a file, in seconds."""
+# inotify(7) constants:
+IN_MODIFY: Final[int] = 0x00000002
+IN_ATTRIB: Final[int] = 0x00000004
+IN_CLOSE_WRITE: Final[int] = 0x00000008
+IN_MOVED_TO: Final[int] = 0x00000080
+IN_CREATE: Final[int] = 0x00000100
+IN_DELETE_SELF: Final[int] = 0x00000400
+IN_Q_OVERFLOW: Final[int] = 0x00004000
+IN_IGNORED: Final[int] = 0x00008000
+IN_ISDIR: Final[int] = 0x40000000
+IN_NONBLOCK: Final[int] = os.O_NONBLOCK
+IN_CLOEXEC: Final[int] = os.O_CLOEXEC
+WATCH_MASK: Final[int] = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+"""The events watched for."""
+EVENT_HEADER: Final[struct.Struct] = struct.Struct('iIII')
+"""struct inotify_event, without the name: wd, mask, cookie, len."""
+
+
+def open_for_writing(path: str) -> bool:
+    """
+    Check whether any process we can see has a file open for writing, by looking through /proc/<pid>/fd. Processes
+    of other users, and on other machines, can't be seen; The settle time covers those.
+    :param path: str: The full path to the file.
+    :return: bool: True a process has it open for writing.
+    """
+    path = os.path.realpath(path)
+    try:
+        pids: list[str] = [name for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return False
+    for pid in pids:
+        fd_dir: str = os.path.join('/proc', pid, 'fd')
+        try:
+            fds: list[str] = os.listdir(fd_dir)
+        except OSError:  # Gone, or not ours.
+            continue
+        for fd in fds:
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)) != path:
+                    continue
+                with open(os.path.join('/proc', pid, 'fdinfo', fd), 'r') as file_handle:
+                    for line in file_handle:
+                        if line.startswith('flags:'):
+                            if int(line.split()[1], 8) & (os.O_WRONLY | os.O_RDWR):
+                                return True
+                            break
+            except (OSError, ValueError):
+                continue
+    return False
+
+
+class Inotify(object):
+    """
+    A minimal inotify(7) binding, through ctypes. Raises OSError if inotify isn't available.
+    """
+    def __init__(self) -> None:
+        """
+        Create the inotify instance.
+        """
+        libc_name: Optional[str] = ctypes.util.find_library('c')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        """The C library."""
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify isn't available.")
+        self._libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._fd: int = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        """The inotify file descriptor."""
+        if self._fd < 0:
+            errno: int = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._watches: dict[int, str] = {}
+        """The watched directories, by watch descriptor."""
+        return
+
+    def add_watch(self, dir_path: str) -> None:
+        """
+        Watch a directory.
+        :param dir_path: str: The full path to the directory.
+        :return: None
+        """
+        wd: int = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            errno: int = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dir_path)
+        self._watches[wd] = dir_path
+        return
+
+    def read(self, timeout: float) -> list[tuple[str, int]]:
+        """
+        Wait for events.
+        :param timeout: float: Seconds to wait.
+        :return: list[tuple[str, int]]: (full path, mask) of each event; ('', IN_Q_OVERFLOW) if events were lost.
+        """
+        readable, _writable, _errors = select.select((self._fd,), (), (), timeout)
+        if len(readable) == 0:
+            return []
+        try:
+            data: bytes = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events: list[tuple[str, int]] = []
+        offset: int = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name: str = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                events.append(('', IN_Q_OVERFLOW))
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            dir_path: Optional[str] = self._watches.get(wd)
+            if dir_path is not None:
+                events.append((os.path.join(dir_path, name) if name else dir_path, mask))
+        return events
+
+    def close(self) -> None:
+        """
+        Close the inotify instance, and its watches.
+        :return: None
+        """
+        os.close(self._fd)
+        return
+
+
+class IngestQueue(object):
+    """
+    Stable files waiting for a controller to take them.
+    """
+    def __init__(self) -> None:
+        """
+        Initialize an empty queue.
+        """
+        self._files: list[dict[str, Any]] = []
+        """The files waiting, oldest first."""
+        self._num_taken: int = 0
+        """The number of files taken so far."""
+        self._condition: Condition = Condition()
+        """Notified when a file is added."""
+        return
+
+    def put(self, file_obj: dict[str, Any]) -> None:
+        """
+        Add a file.
+        :param file_obj: dict[str, Any]: The file, see FolderWatcher._ingest().
+        :return: None
+        """
+        with self._condition:
+            self._files.append(file_obj)
+            self._condition.notify_all()
+        return
+
+    def take(self, max_files: int, timeout: float) -> list[dict[str, Any]]:
+        """
+        Take the oldest files, waiting for one if there are none.
+        :param max_files: int: The max number of files to take.
+        :param timeout: float: Seconds to wait for a file, 0 to not wait.
+        :return: list[dict[str, Any]]: The files, empty if none arrived in time.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._files) > 0, timeout)
+            files: list[dict[str, Any]] = self._files[:max_files]
+            del self._files[:max_files]
+            self._num_taken += len(files)
+            return files
+
+    def put_back(self, files: list[dict[str, Any]]) -> None:
+        """
+        Return taken files to the front of the queue, IE: the reply couldn't be sent.
+        :param files: list[dict[str, Any]]: The files.
+        :return: None
+        """
+        with self._condition:
+            self._files[:0] = files
+            self._num_taken -= len(files)
+            self._condition.notify_all()
+        return
+
+    def status(self) -> dict[str, Any]:
+        """
+        Build the queue's status dict.
+        :return: dict[str, Any]
+        """
+        with self._condition:
+            return {'numWaiting': len(self._files), 'numTaken': self._num_taken}
+
+
+class FolderWatcher(Thread):
+    """
+    Watch folders, and put their new files in an ingest queue once they're stable.
+    """
+    def __init__(self, folders: list[str], settle_time: float, poll_interval: float, queue: IngestQueue,
+                 to_shared_path: Callable[[str], str]) -> None:
+        """
+        Initialize the watcher.
+        :param folders: list[str]: The full paths to the folders; Their sub-directories are watched too.
+        :param settle_time: float: Seconds a file's size and mtime must be unchanged before it's ingested.
+        :param poll_interval: float: Seconds between scans, 0 to use inotify, scanning only if it isn't available.
+        :param queue: IngestQueue: The queue to put the stable files in.
+        :param to_shared_path: Callable[[str], str]: Converts a full path to a '%shared%/' path.
+        """
+        super().__init__(daemon=True)
+        self._folders: list[str] = [os.path.abspath(folder) for folder in folders]
+        """The watched folders."""
+        self._settle_time: float = settle_time
+        """Seconds a file must be unchanged."""
+        self._poll_interval: float = poll_interval
+        """Seconds between scans, 0 for inotify."""
+        self._queue: IngestQueue = queue
+        """The queue stable files are put in."""
+        self._to_shared_path: Callable[[str], str] = to_shared_path
+        """Converts a full path to a '%shared%/' path."""
+        self._inotify: Optional[Inotify] = None
+        """The inotify instance, None when scanning."""
+        self._candidates: dict[str, tuple[int, float, float]] = {}
+        """Files that changed, and aren't ingested yet: path -> (size, mtime, when last seen changing)."""
+        self._ingested: dict[str, tuple[int, float]] = {}
+        """Ingested files: path -> (size, mtime); A file is ingested again if it's replaced."""
+        self._stop_event: Event = Event()
+        """Set to stop watching."""
+        return
+
+    @property
+    def mode(self) -> str:
+        return 'inotify' if self._inotify is not None else 'polling'
+
+    def start(self) -> None:
+        """
+        Set up inotify if it's wanted, and available, and start watching. Files already in the folders are picked
+        up as if they'd just arrived.
+        :return: None
+        """
+        if self._poll_interval <= 0:
+            try:
+                self._inotify = Inotify()
+                for folder in self._folders:
+                    self._watch_tree(folder)
+            except OSError as e:
+                out_warning("Can't use inotify, scanning watch folders every %i seconds: %s" %
+                            (int(FALLBACK_POLL_INTERVAL), str(e)))
+                if self._inotify is not None:
+                    self._inotify.close()
+                    self._inotify = None
+                self._poll_interval = FALLBACK_POLL_INTERVAL
+        self.scan()
+        out_info("Watching %i folders, by %s." % (len(self._folders), self.mode))
+        super().start()
+        return
+
+    def stop(self) -> None:
+        """
+        Stop watching.
+        :return: None
+        """
+        self._stop_event.set()
+        return
+
+    def _watch_tree(self, dir_path: str) -> None:
+        """
+        Watch a directory, and its sub-directories.
+        :param dir_path: str: The full path to the directory.
+        :return: None
+        """
+        self._inotify.add_watch(dir_path)
+        for sub_dir_path, dir_names, _file_names in os.walk(dir_path):
+            for dir_name in dir_names:
+                self._inotify.add_watch(os.path.join(sub_dir_path, dir_name))
+        return
+
+    def _changed(self, path: str) -> None:
+        """
+        Note a file that may have changed, it's checked until it's stable.
+        :param path: str: The full path to the file.
+        :return: None
+        """
+        if os.path.splitext(path)[1].lower() not in WATCH_EXTENSIONS or os.path.basename(path).startswith('.'):
+            return
+        try:
+            stat_result = os.stat(path)
+        except OSError:  # Removed, or renamed again.
+            self._candidates.pop(path, None)
+            return
+        signature: tuple[int, float] = (stat_result.st_size, stat_result.st_mtime)
+        if self._ingested.get(path) == signature:
+            return
+        previous: Optional[tuple[int, float, float]] = self._candidates.get(path)
+        if previous is None or previous[:2] != signature:
+            self._candidates[path] = signature + (time.monotonic(),)
+        return
+
+    def scan(self) -> None:
+        """
+        Check every file in the folders for changes.
+        :return: None
+        """
+        for folder in self._folders:
+            for dir_path, _dir_names, file_names in os.walk(folder):
+                for file_name in file_names:
+                    self._changed(os.path.join(dir_path, file_name))
+        return
+
+    def _ingest(self, path: str, size: int, mtime: float) -> None:
+        """
+        Put a stable file in the ingest queue.
+        :param path: str: The full path to the file.
+        :param size: int: Its size.
+        :param mtime: float: Its mtime.
+        :return: None
+        """
+        folder: str = next(folder for folder in self._folders if path.startswith(folder + os.sep))
+        self._ingested[path] = (size, mtime)
+        self._queue.put({
+            'inputFile': self._to_shared_path(path),
+            'watchFolder': self._to_shared_path(folder),
+            'relativePath': os.path.relpath(path, folder),
+            'size': size,
+            'arrived': time.time(),
+        })
+        out_info("Ingested '%s'." % path)
+        return
+
+    def check_candidates(self) -> None:
+        """
+        Ingest the candidates that have been stable for the settle time.
+        :return: None
+        """
+        now: float = time.monotonic()
+        for path, (size, mtime, changed_time) in list(self._candidates.items()):
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                del self._candidates[path]
+                continue
+            if (stat_result.st_size, stat_result.st_mtime) != (size, mtime):
+                self._candidates[path] = (stat_result.st_size, stat_result.st_mtime, now)
+                continue
+            if now - changed_time < self._settle_time:
+                continue
+            if open_for_writing(path):
+                out_debug("'%s' is still open for writing." % path)
+                self._candidates[path] = (size, mtime, now)
+                continue
+            del self._candidates[path]
+            self._ingest(path, size, mtime)
+        return
+
+    def run(self) -> None:
+        """
+        Watch until stopped.
+        :return: None
+        """
+        check_interval: float = min(max(self._settle_time / 2, 0.5), 5.0)
+        next_scan: float = time.monotonic() + self._poll_interval
+        while not self._stop_event.is_set():
+            if self._inotify is not None:
+                for path, mask in self._inotify.read(check_interval):
+                    if mask == IN_Q_OVERFLOW:  # Events were lost, look at everything:
+                        self.scan()
+                    elif mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            try:
+                                self._watch_tree(path)
+                            except OSError as e:
+                                out_warning("Failed to watch '%s': %s" % (path, str(e)))
+                            for dir_path, _dir_names, file_names in os.walk(path):
+                                for file_name in file_names:
+                                    self._changed(os.path.join(dir_path, file_name))
+                    else:
+                        self._changed(path)
+            else:
+                self._stop_event.wait(check_interval)
+                if time.monotonic() >= next_scan:
+                    next_scan = time.monotonic() + self._poll_interval
+                    self.scan()
+            self.check_candidates()
+        if self._inotify is not None:
+            self._inotify.close()
+        return
+
+    def status(self) -> dict[str, Any]:
+        """
+        Build the watcher's status dict.
+        :return: dict[str, Any]
+        """
+        status_obj: dict[str, Any] = {
+            'mode': self.mode,
+            'folders': [self._to_shared_path(folder) for folder in self._folders],
+            'numSettling': len(self._candidates),
+        }
+        status_obj.update(self._queue.status())
+        return status_obj
+
+
+if __name__ == '__main__':
+    exit(0)
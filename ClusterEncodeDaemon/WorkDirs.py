@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+    File: WorkDirs.py
+    Description: Lifecycle of the files in the 'Input' / 'Output' working directories. Files are tracked by the job
+        they belong to, and removed once the job is combined or cancelled; A size quota is kept by evicting the oldest
+        files that no live job needs, and leftovers are swept at startup.
+"""
+import json
+import os
+import time
+from threading import Thread, Lock, Event
+from typing import Optional, Final, Any
+
+from common import out_info, out_debug, out_warning, out_error
+
+WORK_SUB_DIRS: Final[tuple[str, ...]] = ('Input', 'Output')
+"""The sub-directories of a working directory that are managed."""
+TEMP_SUFFIXES: Final[tuple[str, ...]] = ('.part', '.concat.txt')
+"""Suffixes of the temporary files left behind if the daemon dies mid copy / combine."""
+SWEEP_INTERVAL: Final[float] = 60.0
+"""How often, in seconds, the quotas are checked, and stale temporary files are removed."""
+EVICT_MIN_AGE: Final[float] = 3600.0
+"""Files modified less than this many seconds ago are never evicted, or swept, they may still be in use."""
+
+
+class WorkDir(object):
+    """
+    A working directory, with its quota.
+    """
+    def __init__(self, path: str, quota: int, scratch: bool) -> None:
+        """
+        Initialize the working directory.
+        :param path: str: The full path to the working directory, holding 'Input' and 'Output'.
+        :param quota: int: The max number of bytes in 'Input' and 'Output', 0 for no quota.
+        :param scratch: bool: True only this daemon writes here, so untracked files are removed at startup.
+        """
+        self.path: str = os.path.abspath(path)
+        """The full path to the working directory."""
+        self.quota: int = quota
+        """The max number of bytes, 0 for no quota."""
+        self.scratch: bool = scratch
+        """True if untracked files are removed at startup."""
+        self.used: int = 0
+        """The number of bytes used at the last sweep."""
+        return
+
+    def list_files(self) -> list[tuple[float, int, str]]:
+        """
+        List the files in 'Input' and 'Output'.
+        :return: list[tuple[float, int, str]]: (mtime, size, path) for each file.
+        """
+        files: list[tuple[float, int, str]] = []
+        for sub_dir in WORK_SUB_DIRS:
+            for dir_path, _dir_names, file_names in os.walk(os.path.join(self.path, sub_dir)):
+                for file_name in file_names:
+                    file_path = os.path.join(dir_path, file_name)
+                    try:
+                        stat_result = os.stat(file_path)
+                    except OSError:  # Removed in the meantime.
+                        continue
+                    files.append((stat_result.st_mtime, stat_result.st_size, file_path))
+        return files
+
+    def contains(self, path: str) -> bool:
+        """
+        Is a path in this directory's 'Input' or 'Output'.
+        :param path: str: The full path.
+        :return: bool: True if it is.
+        """
+        path = os.path.abspath(path)
+        return any(path.startswith(os.path.join(self.path, sub_dir) + os.sep) for sub_dir in WORK_SUB_DIRS)
+
+
+class WorkDirManager(Thread):
+    """
+    Track the working files of each job, and keep the working directories within their quotas.
+    """
+    def __init__(self, manifest_path: str, work_dirs: list[WorkDir], job_expiry: float) -> None:
+        """
+        Initialize the manager.
+        :param manifest_path: str: The full path to the file the tracked files are saved in, so they're still known
+        after a restart; It's loaded straight away.
+        :param work_dirs: list[WorkDir]: The working directories to manage.
+        :param job_expiry: float: The number of seconds after its last use that a job's files can be evicted to keep
+        within a quota. Until then, or until it's released, a job's files are never evicted.
+        """
+        super().__init__(daemon=True)
+        self._manifest_path: str = manifest_path
+        """The full path to the manifest file."""
+        self._work_dirs: list[WorkDir] = work_dirs
+        """The managed working directories."""
+        self._job_expiry: float = job_expiry
+        """Seconds after its last use that a job's files can be evicted."""
+        self._jobs: dict[str, dict[str, Any]] = {}
+        """The tracked jobs, by job id: {'touched': float, 'files': list[str]}."""
+        self._lock: Lock = Lock()
+        """Lock for _jobs."""
+        self._stop_event: Event = Event()
+        """Set to stop the sweep thread."""
+        self._load()
+        return
+
+    def _load(self) -> None:
+        """
+        Load the manifest, dropping files that no longer exist.
+        :return: None
+        """
+        try:
+            with open(self._manifest_path, 'r') as file_handle:
+                jobs: dict[str, dict[str, Any]] = json.load(file_handle)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            out_warning("Failed to load working file manifest, starting empty: %s" % str(e))
+            return
+        with self._lock:
+            for job_id, job in jobs.items():
+                files = [file_path for file_path in job['files'] if os.path.exists(file_path)]
+                if len(files) > 0:
+                    self._jobs[job_id] = {'touched': job['touched'], 'files': files}
+        return
+
+    def _save(self) -> None:
+        """
+        Save the manifest, writing to a temporary name first so a crash can't leave it half written. Must be called
+        with the lock held.
+        :return: None
+        """
+        temp_path: str = self._manifest_path + '.part'
+        try:
+            with open(temp_path, 'w') as file_handle:
+                json.dump(self._jobs, file_handle)
+            os.replace(temp_path, self._manifest_path)
+        except OSError as e:
+            out_error("Failed to save working file manifest: %s" % str(e))
+        return
+
+    def _is_managed(self, path: str) -> bool:
+        """
+        Is a path in one of the managed directories. Anything else, IE: a source file, is never tracked.
+        :param path: str: The full path.
+        :return: bool: True if it's managed.
+        """
+        return any(work_dir.contains(path) for work_dir in self._work_dirs)
+
+    def add_files(self, job_id: str, paths: list[str]) -> None:
+        """
+        Track files as belonging to a job, they don't have to exist yet. Paths outside the managed directories are
+        ignored.
+        :param job_id: str: The job id.
+        :param paths: list[str]: The full paths to the files.
+        :return: None
+        """
+        paths = [os.path.abspath(path) for path in paths if self._is_managed(path)]
+        with self._lock:
+            job = self._jobs.setdefault(job_id, {'touched': 0.0, 'files': []})
+            job['touched'] = time.time()
+            known: set[str] = set(job['files'])
+            job['files'].extend(path for path in paths if path not in known)
+            self._save()
+        return
+
+    def touch_job(self, job_id: str) -> None:
+        """
+        Mark a job as in use, restarting its expiry.
+        :param job_id: str: The job id.
+        :return: None
+        """
+        with self._lock:
+            if job_id in self._jobs.keys():
+                self._jobs[job_id]['touched'] = time.time()
+        return
+
+    def release_job(self, job_id: str, keep: tuple[str, ...] = ()) -> int:
+        """
+        Remove a combined, or cancelled job's files, and stop tracking it.
+        :param job_id: str: The job id.
+        :param keep: tuple[str, ...] = (): Files not to remove, IE: the combined output.
+        :return: int: The number of files removed.
+        """
+        keep_paths: set[str] = {os.path.abspath(path) for path in keep}
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            self._save()
+        if job is None:
+            return 0
+        num_removed: int = 0
+        for file_path in job['files']:
+            if file_path not in keep_paths and self._remove(file_path):
+                num_removed += 1
+        out_info("Released job '%s', removed %i files." % (job_id, num_removed))
+        return num_removed
+
+    @staticmethod
+    def _remove(file_path: str) -> bool:
+        """
+        Remove a file, ignoring it if it's already gone.
+        :param file_path: str: The full path to the file.
+        :return: bool: True it was removed, False it didn't exist, or couldn't be removed.
+        """
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            out_warning("Failed to remove '%s': %s" % (file_path, str(e)))
+            return False
+        return True
+
+    def sweep(self, startup: bool = False) -> None:
+        """
+        Remove stale temporary files, and evict files to keep each directory within its quota. Oldest files are
+        evicted first; Untracked files before those of expired jobs, and live jobs' files are never evicted.
+        :param startup: bool = False: True for the startup sweep; Nothing of this daemon's is running yet, so
+        temporary files in scratch directories are removed whatever their age, and so are untracked files there.
+        :return: None
+        """
+        now: float = time.time()
+        with self._lock:
+            owners: dict[str, str] = {file_path: job_id for job_id, job in self._jobs.items()
+                                      for file_path in job['files']}
+            live_jobs: set[str] = {job_id for job_id, job in self._jobs.items()
+                                   if now - job['touched'] < self._job_expiry}
+        evicted: list[str] = []
+        for work_dir in self._work_dirs:
+            files = work_dir.list_files()
+            remaining: list[tuple[float, int, str]] = []
+            for mtime, size, file_path in files:
+                # Other daemons may be uploading to a shared directory, even at startup:
+                stale: bool = (startup and work_dir.scratch) or now - mtime >= EVICT_MIN_AGE
+                is_temp: bool = file_path.endswith(TEMP_SUFFIXES)
+                orphan: bool = startup and work_dir.scratch and file_path not in owners.keys()
+                if stale and (is_temp or orphan):
+                    out_debug("Sweeping '%s'." % file_path)
+                    self._remove(file_path)
+                else:
+                    remaining.append((mtime, size, file_path))
+            used: int = sum(size for _mtime, size, _file_path in remaining)
+            work_dir.used = used
+            if work_dir.quota <= 0 or used <= work_dir.quota:
+                continue
+            candidates = [(file_path in owners.keys(), mtime, size, file_path)
+                          for mtime, size, file_path in remaining
+                          if owners.get(file_path) not in live_jobs and now - mtime >= EVICT_MIN_AGE]
+            for _tracked, _mtime, size, file_path in sorted(candidates):
+                if used <= work_dir.quota:
+                    break
+                out_info("Evicting '%s' to keep '%s' within its quota." % (file_path, work_dir.path))
+                if self._remove(file_path):
+                    used -= size
+                    evicted.append(file_path)
+            work_dir.used = used
+            if used > work_dir.quota:
+                out_warning("'%s' is over its quota by %i MB, and nothing more can be evicted." %
+                            (work_dir.path, (used - work_dir.quota) // (1024 * 1024)))
+        if len(evicted) > 0:
+            with self._lock:
+                evicted_set: set[str] = set(evicted)
+                for job_id in list(self._jobs.keys()):
+                    self._jobs[job_id]['files'] = [file_path for file_path in self._jobs[job_id]['files']
+                                                   if file_path not in evicted_set]
+                    if len(self._jobs[job_id]['files']) == 0:
+                        del self._jobs[job_id]
+                self._save()
+        return
+
+    def start(self) -> None:
+        """
+        Run the startup sweep, and start the periodic sweeps.
+        :return: None
+        """
+        self.sweep(startup=True)
+        super().start()
+        return
+
+    def stop(self) -> None:
+        """
+        Stop the periodic sweeps.
+        :return: None
+        """
+        self._stop_event.set()
+        return
+
+    def run(self) -> None:
+        """
+        Sweep every SWEEP_INTERVAL seconds until stopped.
+        :return: None
+        """
+        while not self._stop_event.wait(SWEEP_INTERVAL):
+            self.sweep()
+        return
+
+    def status(self) -> dict[str, Any]:
+        """
+        Build the working directory status dict.
+        :return: dict[str, Any]
+        """
+        with self._lock:
+            num_jobs: int = len(self._jobs)
+        return {
+            'trackedJobs': num_jobs,
+            'dirs': [{'path': work_dir.path, 'quota': work_dir.quota, 'used': work_dir.used}
+                     for work_dir in self._work_dirs],
+        }
+
+
+if __name__ == '__main__':
+    exit(0)
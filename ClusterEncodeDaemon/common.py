@@ -2,15 +2,35 @@
 """
     File: common.py
 """
+import atexit
 import logging
 import os
 import sys
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from multiprocessing import AuthenticationError
-from multiprocessing.connection import Connection, Listener
-from typing import Any, Optional
+from multiprocessing.connection import Connection, Listener, Client
+from queue import Queue, Full
+from threading import Lock, Event, local
+from typing import Any, Optional, Final
 from Config import Config, ConfigError
 sys.path.append('../')
 from ffmpegCli import Ffmpegcli
+
+# Logging constants:
+LOG_QUEUE_SIZE: Final[int] = 10000
+"""The max number of log records waiting to be written, more are dropped rather than block the caller."""
+LOG_MAX_BYTES: Final[int] = 10 * 1024 * 1024
+"""The size the log file is rotated at."""
+LOG_BACKUP_COUNT: Final[int] = 5
+"""The number of rotated log files kept."""
+LOG_RATE: Final[float] = 10.0
+"""The number of messages per second each logging call site may write, on average."""
+LOG_BURST: Final[int] = 100
+"""The number of messages a logging call site may write at once, before it's limited to LOG_RATE."""
+LOG_FORMAT: Final[str] = '%(asctime)s %(levelname)s [%(threadName)s] %(message)s'
+"""The log file format."""
+
 # common variables:
 DEBUG: bool = False
 """Should the daemon produce debug output."""
@@ -18,16 +38,179 @@ LOGGER: Optional[logging.Logger] = None
 """The logger to use."""
 IS_DAEMON: bool = False
 """True if this process has forked or not."""
+_log_queue: Queue = Queue(LOG_QUEUE_SIZE)
+"""The queue of log records waiting to be written by the log listener."""
+_log_handlers: list[logging.Handler] = []
+"""The handlers the log listener writes to: the file, then the console handlers."""
+_log_listener: Optional[QueueListener] = None
+"""The log listener thread, None while it's stopped."""
 config: Optional[Config] = None
 """The daemon config."""
 listener: Optional[Listener] = None
 """The listener for the daemon."""
-connection: Optional[Connection] = None
-"""The current connection."""
+connections: dict[Connection, dict[str, Any]] = {}
+"""The open connections, and their info; 'peer': the client address, 'status': what the connection is doing, and
+'sendLock': the lock to serialize sends on it."""
+connections_lock: Lock = Lock()
+"""Lock for connections."""
+_thread_local: local = local()
+"""The connection handled by this thread; each connection is handled on its own thread, and pooled commands on a
+worker adopt it while they run."""
+shutdown_event: Event = Event()
+"""Set when the daemon is shutting down."""
 ffmpeg_cli: Optional[Ffmpegcli] = None
 """The ffmpeg cli helper."""
-status: str = "Idle"
-"""The current status of the daemon."""
+scheduler: Optional['Scheduler'] = None
+"""The encode slot scheduler."""
+admission: Optional['AdmissionControl'] = None
+"""The admission control, checks the node can take more work."""
+work_dirs: Optional['WorkDirManager'] = None
+"""The working directory manager, tracks each job's files, and keeps the quotas."""
+commands: Optional['CommandRegistry'] = None
+"""The command table."""
+command_pool: Optional['CommandPool'] = None
+"""The worker pool long commands run on."""
+watcher: Optional['FolderWatcher'] = None
+"""The watch folder watcher, only on the file host, when there are watch folders."""
+ingest_queue: Optional['IngestQueue'] = None
+"""The files from the watch folders, waiting for a controller to take them with 'ingest'."""
+
+
+##########################################################################
+# Logging:
+class RateLimitFilter(logging.Filter):
+    """
+    Limit how often each logging call site can write, with a token bucket per file / line, so a message logged per
+    progress line can't flood the log. The next message to get through says how many were suppressed. Errors are
+    never limited.
+    """
+    def __init__(self, rate: float, burst: int) -> None:
+        """
+        Initialize the filter.
+        :param rate: float: The number of messages per second allowed on average.
+        :param burst: int: The number of messages allowed at once.
+        """
+        super().__init__()
+        self._rate: float = rate
+        """Messages per second."""
+        self._burst: int = burst
+        """The bucket size."""
+        self._buckets: dict[tuple[str, int], list] = {}
+        """The buckets by (path, line): [tokens: float, last_time: float, suppressed: int]."""
+        self._lock: Lock = Lock()
+        """Lock for _buckets."""
+        return
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """
+        Check a record against its call site's bucket.
+        :param record: logging.LogRecord: The record.
+        :return: bool: True write the record, False drop it.
+        """
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.pathname, record.lineno)
+        now: float = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self._burst), now, 0]
+            bucket[0] = min(float(self._burst), bucket[0] + (now - bucket[1]) * self._rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            suppressed: int = bucket[2]
+            bucket[2] = 0
+        if suppressed > 0:
+            record.msg = "%s (%i similar messages suppressed)" % (record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that drops records when the queue is full, instead of blocking, or raising.
+    """
+    def __init__(self, queue: Queue) -> None:
+        """
+        Initialize the handler.
+        :param queue: Queue: The bounded queue to put records on.
+        """
+        super().__init__(queue)
+        self.dropped: int = 0
+        """The number of records dropped because the queue was full."""
+        return
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """
+        Queue a record, or drop it if the queue is full.
+        :param record: logging.LogRecord: The record.
+        :return: None
+        """
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+        return
+
+
+def setup_logging(log_path: str, log_level: int) -> None:
+    """
+    Setup the logging pipeline: Callers only format, and queue the record; A listener thread writes them to the
+    rotating log file, and the console while not forked, so slow log I/O never holds up a command, or progress.
+    :param log_path: str: The full path to the log file.
+    :param log_level: int: The logging level.
+    :return: None
+    """
+    global LOGGER, _log_handlers
+    file_handler = RotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    out_handler = logging.StreamHandler(sys.stdout)
+    out_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    err_handler = logging.StreamHandler(sys.stderr)
+    err_handler.setLevel(logging.WARNING)
+    for console_handler in (out_handler, err_handler):
+        console_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    _log_handlers = [file_handler, out_handler, err_handler]
+    queue_handler = DroppingQueueHandler(_log_queue)
+    queue_handler.addFilter(RateLimitFilter(LOG_RATE, LOG_BURST))
+    logger = logging.getLogger('CEDaemon')
+    logger.setLevel(log_level)
+    logger.propagate = False
+    logger.addHandler(queue_handler)
+    start_logging()
+    LOGGER = logger
+    atexit.register(stop_logging)
+    return
+
+
+def start_logging() -> None:
+    """
+    Start the log listener thread, writing to the console too unless the daemon has forked.
+    :return: None
+    """
+    global _log_listener
+    if _log_listener is not None or len(_log_handlers) == 0:
+        return
+    handlers = _log_handlers if not IS_DAEMON else _log_handlers[:1]
+    _log_listener = QueueListener(_log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    return
+
+
+def stop_logging() -> None:
+    """
+    Stop the log listener thread, once the queued records are written. It must be stopped before forking, and
+    started again in the child, since threads don't survive a fork.
+    :return: None
+    """
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+    return
 
 
 ##########################################################################
@@ -40,8 +223,8 @@ def out_info(message: str) -> None:
     """
     global LOGGER, IS_DAEMON
     if LOGGER is not None:
-        LOGGER.info(message)
-    if not IS_DAEMON:
+        LOGGER.info(message, stacklevel=2)
+    elif not IS_DAEMON:
         print("INFO:", message, file=sys.stdout)
     return
 
@@ -54,8 +237,8 @@ def out_warning(message: str) -> None:
     """
     global LOGGER, IS_DAEMON
     if LOGGER is not None:
-        LOGGER.warning(message)
-    if not IS_DAEMON:
+        LOGGER.warning(message, stacklevel=2)
+    elif not IS_DAEMON:
         print("WARNING:", message, file=sys.stderr)
     return
 
@@ -68,8 +251,8 @@ def out_error(message: str) -> None:
     """
     global LOGGER, IS_DAEMON
     if LOGGER is not None:
-        LOGGER.error(message)
-    if not IS_DAEMON:
+        LOGGER.error(message, stacklevel=2)
+    elif not IS_DAEMON:
         print("ERROR:", message, file=sys.stderr)
     return
 
@@ -82,69 +265,198 @@ def out_debug(message: str) -> None:
     """
     global LOGGER, DEBUG
     if LOGGER is not None:
-        LOGGER.debug(message)
-    if DEBUG:
+        LOGGER.debug(message, stacklevel=2)
+    elif DEBUG:
         print("DEBUG:", message, file=sys.stdout)
     return
 
 
 #######################################
 # Connection functions:
-def __accept__() -> Connection:
+def __accept__() -> tuple[Connection, str]:
     """
-    Wait for, and set a valid connection.
-    :return: Connection: The connected Connection object.
+    Wait for a valid connection.
+    :return: tuple[Connection, str]: The connected Connection object, and the client's address.
     """
-    global connection, listener
+    global listener
     while True:
         try:
-            connection = listener.accept()
-            return connection
+            new_connection = listener.accept()
         except AuthenticationError:
             continue
         except ConnectionResetError:
             continue
+        peer = listener.last_accepted
+        peer_name: str = '%s:%s' % peer if isinstance(peer, tuple) else str(peer)
+        return new_connection, peer_name
+
+
+def wake_listener() -> None:
+    """
+    Connect to our own listener, so a blocked __accept__() returns, and can check shutdown_event.
+    :return: None
+    """
+    try:
+        Client(listener.address, authkey=config.shared_secret.encode()).close()
+    except OSError:
+        pass
+    return
+
+
+def set_connection(new_connection: Connection, peer: str) -> None:
+    """
+    Make a connection the current thread's connection.
+    :param new_connection: Connection: The connection.
+    :param peer: str: The client's address.
+    :return: None
+    """
+    _thread_local.connection = new_connection
+    with connections_lock:
+        connections[new_connection] = {'peer': peer, 'status': 'idle', 'sendLock': Lock()}
+    return
+
+
+def adopt_connection(connection: Connection, pending: Queue) -> None:
+    """
+    Make a connection the current worker thread's connection, while it runs a pooled command. The connection's own
+    thread keeps reading from it, and passes on the cancels sent meanwhile.
+    :param connection: Connection: The connection.
+    :param pending: Queue: The queue the connection's thread puts cancel commands on.
+    :return: None
+    """
+    _thread_local.connection = connection
+    _thread_local.pending = pending
+    return
+
+
+def release_connection() -> None:
+    """
+    Stop a worker thread using the connection it adopted, without closing it.
+    :return: None
+    """
+    _thread_local.connection = None
+    _thread_local.pending = None
+    return
+
+
+def get_pending() -> Optional[Queue]:
+    """
+    Get the queue of cancels for the current thread's command.
+    :return: Optional[Queue]: The queue, or None if this thread reads its connection itself.
+    """
+    return getattr(_thread_local, 'pending', None)
+
+
+def get_connection() -> Optional[Connection]:
+    """
+    Get the current thread's connection.
+    :return: Optional[Connection]: The connection, or None if it's been closed.
+    """
+    return getattr(_thread_local, 'connection', None)
+
+
+def get_peer() -> Optional[str]:
+    """
+    Get the address of the current thread's client.
+    :return: Optional[str]: The address, IE: '192.168.1.10:50123', or None if the connection's been closed.
+    """
+    with connections_lock:
+        info = connections.get(get_connection())
+        return info['peer'] if info is not None else None
+
+
+def set_status(new_status: str) -> None:
+    """
+    Set what the current thread's connection is doing, shown by 'status'.
+    :param new_status: str: The status, IE: 'splitting'.
+    :return: None
+    """
+    with connections_lock:
+        info = connections.get(get_connection())
+        if info is not None:
+            info['status'] = new_status
+    return
+
+
+def get_status() -> str:
+    """
+    Get the status of the daemon.
+    :return: str: 'idle' if no connection is doing anything, otherwise the statuses of the busy connections,
+    IE: 'encoding, splitting'.
+    """
+    with connections_lock:
+        busy = [info['status'] for info in connections.values() if info['status'] != 'idle']
+    return ', '.join(busy) if len(busy) > 0 else 'idle'
 
 
 def __close__() -> None:
     """
-    Close the connection if it's open.
+    Close the current thread's connection if it's open. On a worker thread the connection is only let go of; Its own
+    thread closes it once the command returns.
     :return: bool: True the connection was closed, False it was not.
     """
-    global connection
-    if connection is not None:
-        connection.close()
-        connection = None
+    current_connection = get_connection()
+    if current_connection is not None and get_pending() is not None:
+        _thread_local.connection = None
+        return True
+    if current_connection is not None:
+        with connections_lock:
+            info = connections.pop(current_connection, None)
+        if info is not None:
+            with info['sendLock']:  # Not while a worker is sending on it.
+                current_connection.close()
+        else:
+            current_connection.close()
+        _thread_local.connection = None
         return True
     return False
 
 
-def __send__(object_to_send: Any) -> bool:
+def __send__(object_to_send: Any, to_connection: Optional[Connection] = None) -> bool:
     """
     Send data over the comms channel.
     :param object_to_send: Any: The data to send.
+    :param to_connection: Optional[Connection]: The connection to send on, None for the current thread's connection.
+    Needed when sending from a thread other than the connection's, IE: streamed output.
     :return: bool: True the data was sent, False is was not.
     """
-    global connection
-    if connection is not None:
-        connection.send(object_to_send)
+    if to_connection is None:
+        to_connection = get_connection()
+    with connections_lock:
+        info = connections.get(to_connection)
+    if info is not None:
+        with info['sendLock']:
+            to_connection.send(object_to_send)
         return True
     return False
 
 
 def __recv__() -> Any:
-    global connection
-    if connection is not None:
-        recv_obj = connection.recv()
+    current_connection = get_connection()
+    if current_connection is not None:
+        recv_obj = current_connection.recv()
         return recv_obj
     return None
 
 
-def send_error(error_no: int, error_msg: str) -> None:
+def __recv_bytes__(max_length: Optional[int] = None) -> Optional[bytes]:
+    """
+    Receive a raw block of bytes, sent with Connection.send_bytes(), used for streamed input.
+    :param max_length: Optional[int]: The max size of the block, if larger OSError is raised.
+    :return: Optional[bytes]: The bytes received, or None if not connected.
+    """
+    current_connection = get_connection()
+    if current_connection is not None:
+        return current_connection.recv_bytes(max_length)
+    return None
+
+
+def send_error(error_no: int, error_msg: str, **details) -> None:
     """
     Send an error response from the daemon to the GUI.
     :param error_no: int: The error number.
     :param error_msg: The error message.
+    :param details: Extra keys for the error dict, IE: retryAfter for a busy error.
     :return: None
     """
     error_obj = {
@@ -152,6 +464,7 @@ def send_error(error_no: int, error_msg: str) -> None:
         'error': {
             'number': error_no,
             'message': error_msg,
+            **details,
         },
     }
     __send__(error_obj)
@@ -176,6 +489,14 @@ def parse_path(path: str) -> str:
     return return_path
 
 
+def to_shared_path(path: str) -> str:
+    """
+    Replace the shared working directory at the start of a path with %shared%, the reverse of parse_path().
+    :param path: str: The full path, in the shared working directory.
+    :return: str: The '%shared%/' path.
+    """
+    return '%shared%/' + os.path.relpath(os.path.realpath(path), os.path.realpath(config.shared_working_dir))
+
 
 
 if __name__ == '__main__':
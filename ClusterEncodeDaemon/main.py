@@ -7,16 +7,29 @@ import ipaddress
 import json
 import logging
 import os
-import shutil
 import sys
+import time
+import uuid
+from concurrent.futures import wait as wait_futures
 from datetime import timedelta
-from typing import Final, Any
-from multiprocessing.connection import Listener
+from queue import Queue, Empty
+from typing import Final, Any, Optional, Callable
+from multiprocessing.connection import Listener, Connection
+from threading import Thread
 from Config import Config, ConfigError
 import common
+from Scheduler import Scheduler, Job
+from Admission import AdmissionControl, BUSY_ERROR
+from WorkDirs import WorkDir, WorkDirManager
+from WatchFolders import FolderWatcher, IngestQueue, MAX_INGEST_WAIT
+from Tracing import tracer
+from Commands import Command, CommandRegistry, CommandPool, ParamSchema
+from Profiling import (Profile, PROFILE_MAX_DURATION, DEFAULT_SAMPLE_INTERVAL, MIN_SAMPLE_INTERVAL, MAX_SAMPLE_INTERVAL,
+                       DEFAULT_TOP)
 from common import out_error, out_info, out_debug, out_warning
 sys.path.append('../')
-from ffmpegCli import Ffmpegcli
+from ffmpegCli import Ffmpegcli, AudioEncoders, VideoEncoders, ProcessLimits, plan_cpu_sets, create_cgroup
+from ffmpegCli.Ffmpegcli import find_ffmpeg, FAKE_FFMPEG_PATH
 
 # Consts:
 __version__: Final[str] = '1.0.0'
@@ -27,68 +40,141 @@ CONFIG_FILENAME: Final[str] = "config.json"
 """The configuration filename."""
 LOG_FILENAME: Final[str] = 'CEDaemon.log'
 """The log file file name."""
-VALID_COMMANDS: Final[tuple[str, ...]] = (
-    'report', 'status', 'split', 'copy_input', 'encode', 'copy_output', 'combine', 'hash', 'shutdown', 'close',
+WORK_FILES_FILENAME: Final[str] = 'workfiles.json'
+"""The file the working files of each job are tracked in."""
+ENCODE_PARAMS: Final[tuple[tuple[str, type | tuple[type, ...]], ...]] = (
+    ('audioEncoder', str), ('downMixAudio', bool), ('boostVolume', int), ('videoEncoder', str),
+    ('scaleVideo', (dict, type(None))),
 )
-"""A list of valid daemon commands."""
+"""The encoder setting parameters shared by the encode commands."""
+STREAM_QUEUE_SIZE: Final[int] = 16
+"""The max number of streamed input blocks to buffer before we stop reading from the connection."""
+STREAM_MAX_BLOCK_SIZE: Final[int] = 4 * 1024 * 1024
+"""The max size in bytes of a single streamed input block."""
+JOB_PARAMS: Final[tuple[tuple[str, type], ...]] = (('jobId', str), ('chunks', list), ('useLocalCopy', bool))
+"""The parameters shared by the encode chunks and submit commands."""
+OPTIONAL_JOB_PARAMS: Final[tuple[tuple[str, type], ...]] = (
+    ('priority', int), ('owner', str), ('ratePass', int), ('bitRate', int), ('renditions', list),
+)
+"""The optional parameters shared by the encode chunks and submit commands. 'bitRate' is the chunks' default video bit
+rate in kbit/s; 'ratePass' 1 or 2 runs that pass of a two pass encode, each chunk then needs a 'passLogFile';
+'renditions' are more outputs from each chunk's decode, each chunk then needs a 'renditionFiles' path for each."""
+RENDITION_SCHEMA: Final[ParamSchema] = ParamSchema((), (('scaleVideo', dict), ('bitRate', int)))
+"""The schema of each rendition in the 'renditions' list of encode chunks and submit."""
+CANCEL_PARAMS: Final[tuple[tuple[str, type], ...]] = (('jobId', str), ('chunkId', int))
+"""The optional parameters of the cancel command."""
+OPTIONAL_JOB_ID_PARAMS: Final[tuple[tuple[str, type], ...]] = (('jobId', str),)
+"""The optional job id of split, encode, and combine; Files they create are tracked under it, and removed once the
+job is combined or cancelled."""
+TRACE_PARAMS: Final[tuple[tuple[str, type], ...]] = (('jobId', str), ('clear', bool))
+"""The optional parameters of the trace command."""
+PROFILE_PARAMS: Final[tuple[tuple[str, type | tuple[type, ...]], ...]] = (
+    ('sampleInterval', (int, float)), ('traceMemory', bool), ('top', int),
+)
+"""The optional parameters of the profile command."""
+INGEST_PARAMS: Final[tuple[tuple[str, type | tuple[type, ...]], ...]] = (('wait', (int, float)), ('max', int))
+"""The optional parameters of the ingest command."""
+DEFAULT_INGEST_MAX: Final[int] = 16
+"""The default max number of files an ingest command takes."""
+SPLIT_PARAMS: Final[tuple[tuple[str, type], ...]] = (
+    ('inputFile', str), ('outputDir', str), ('chunkSize', int), ('length', timedelta),
+)
+"""The parameters of the split command."""
+TIME_RANGE_PARAMS: Final[tuple[tuple[str, type], ...]] = (('startTime', timedelta), ('endTime', timedelta))
+"""The optional time range of an encode; When set the input is the source file, and is seeked directly
+(splitless)."""
+COMBINE_PARAMS: Final[tuple[tuple[str, type], ...]] = (('inputFiles', list), ('outputFile', str))
+"""The parameters of the combine command."""
+CHUNK_SCHEMA: Final[ParamSchema] = ParamSchema((('inputFile', str), ('outputFile', str)),
+                                               TIME_RANGE_PARAMS + (('length', timedelta), ('bitRate', int),
+                                                                    ('passLogFile', str), ('renditionFiles', list)))
+"""The schema of each chunk in the 'chunks' list of encode chunks and submit."""
+WORKERS_RETRY_AFTER: Final[float] = 5.0
+"""Seconds a client is told to wait before retrying, when all the command workers are busy."""
+CANCEL_POLL_INTERVAL: Final[float] = 0.5
+"""How often, in seconds, the connection is checked for a cancel, or the client going away, during long commands."""
+LISTEN_BACKLOG: Final[int] = 128
+"""The number of connections the OS queues while one is being accepted; Listener's default of 1 refuses a burst of
+connects, IE: many clients checking status at once."""
+COMMAND_FINISH_WAIT: Final[float] = 1.0
+"""Seconds to wait for a pooled command to return, when its client sends the next command; The final reply is sent
+just before the worker returns, so a client reusing the connection can beat it."""
 
 
-def validate_command_obj(command_obj: dict[str, Any]) -> bool:
+def validate_command_obj(command_obj: dict[str, Any]) -> Optional[Command]:
     """
-    Validate the basic command structure.
+    Validate the basic command structure, and look the command up.
     :param command_obj: dict[str, Any] the command object.
-    :return: bool: True the command passes the check, false it does not.
+    :return: Optional[Command]: The command, or None if the check failed, and the connection has been closed.
     """
     # Make sure command object is a dict:
     if not isinstance(command_obj, dict):
         common.send_error(1, "Invalid command object type. Not a dict.")
         common.__close__()
-        return False
+        return None
     # Make sure there is a version key:
     if 'version' not in command_obj.keys():
         common.send_error(2, "No version key in command object.")
         common.__close__()
-        return False
+        return None
     # Type check the version key:
     if not isinstance(command_obj['version'], str):
         common.send_error(3, "Version key is of wrong type, not a string.")
         common.__close__()
-        return False
+        return None
     # Make sure the version is 1.0.0:
     if command_obj['version'] != '1.0.0':
         common.send_error(4, "Un supported version.")
         common.__close__()
-        return False
+        return None
     # Make sure there is a command in the command object, if not close the connection and wait for another:
     if 'command' not in command_obj.keys():
         common.send_error(5, "No command key found in command object.")
         common.__close__()
-        return False
+        return None
     # Make sure the command value is of the right type:
     if not isinstance(command_obj['command'], str):
         common.send_error(6, "Invalid command type, not a string.")
         common.__close__()
-        return False
+        return None
     # Make sure the command is a valid command:
-    if command_obj['command'] not in VALID_COMMANDS:
+    command: Optional[Command] = common.commands.get(command_obj['command'])
+    if command is None:
         common.send_error(7, "Command is invalid.")
         common.__close__()
+        return None
+    return command
+
+
+def validate_params(command_obj: dict[str, Any], schema: ParamSchema) -> bool:
+    """
+    Check the parameters of a command against its schema, missing optional parameters are set to None.
+    :param command_obj: dict[str, Any]: The command object.
+    :param schema: ParamSchema: The compiled schema.
+    :return: bool: True the params are valid, False they are not, and the connection has been closed.
+    """
+    error = schema.validate(command_obj)
+    if error is not None:
+        common.send_error(*error)
+        common.__close__()
         return False
     return True
 
 
-def validate_command_params(command_obj: dict[str, Any], params: tuple[tuple[str, type], ...]) -> bool:
-    for param in params:
-        key_name, value_type = param
-        if key_name not in command_obj.keys():
-            common.send_error(20, "parameter '%s' doesn't exist." % key_name)
-            common.__close__()
-            return False
-        if not isinstance(command_obj[key_name], value_type):
-            common.send_error(21, "parameter '%s' must be '%s' type." % (key_name, str(value_type)))
-            common.__close__()
-            return False
-    return True
+def parse_encoders(command_obj: dict[str, Any]) -> Optional[tuple[AudioEncoders, VideoEncoders]]:
+    """
+    Convert the 'audioEncoder' and 'videoEncoder' parameters to their enums, if either is invalid, send an error and
+    close the connection.
+    :param command_obj: dict[str, Any]: The command object, with validated ENCODE_PARAMS.
+    :return: Optional[tuple[AudioEncoders, VideoEncoders]]: The encoders, or None if invalid, and the connection has
+    been closed.
+    """
+    try:
+        return AudioEncoders(command_obj['audioEncoder']), VideoEncoders(command_obj['videoEncoder'])
+    except ValueError:
+        common.send_error(22, "parameter 'audioEncoder' or 'videoEncoder' has an invalid value.")
+        common.__close__()
+        return None
 
 
 def check_file_or_directory_exists(path: str, is_file: bool = True) -> bool:
@@ -123,11 +209,12 @@ def build_report_dict() -> dict[str, Any]:
     """
     response_obj: dict[str, Any] = {
         'version': '1.0.0',
-        'status': common.status,
+        'status': common.get_status(),
         'daemonVersion': __version__,
         'ffmpegVersion': common.ffmpeg_cli.get_version(),
         'numChunks': common.config.num_chunks,
         'isFileHost': common.config.is_file_host,
+        'isWatching': common.watcher is not None,
     }
     return response_obj
 
@@ -139,12 +226,154 @@ def build_status_dict() -> dict[str, Any]:
     """
     response_obj = {
         'version': '1.0.0',
-        'status': common.status,
+        'status': common.get_status(),
     }
-    # TODO: Add encoding / splitting data.
+    if common.scheduler is not None:
+        response_obj['scheduler'] = common.scheduler.status()
+    if common.admission is not None:
+        response_obj['load'] = common.admission.status()
+    if common.work_dirs is not None:
+        response_obj['workDirs'] = common.work_dirs.status()
+    if common.command_pool is not None:
+        response_obj['commands'] = common.command_pool.status()
+    if common.watcher is not None:
+        response_obj['watch'] = common.watcher.status()
+    # TODO: Add splitting data.
     return response_obj
 
 
+def check_admission() -> bool:
+    """
+    Check the node can take more work, sending a busy error with 'reason' and 'retryAfter' if it can't. Unlike other
+    errors, the connection is left open, so the client can retry on it.
+    :return: bool: True the work can be accepted, False a busy error was sent.
+    """
+    if common.admission is None:
+        return True
+    busy = common.admission.check()
+    if busy is None:
+        return True
+    reason, message, retry_after = busy
+    out_warning("Refusing work: %s" % message)
+    common.send_error(BUSY_ERROR, "Daemon is busy: %s" % message, reason=reason, retryAfter=retry_after)
+    return False
+
+
+def client_gone_cancel() -> dict[str, Any]:
+    """
+    Build the cancel command used when the client goes away, it cancels everything the connection started.
+    :return: dict[str, Any]: The cancel command object.
+    """
+    return {'version': '1.0.0', 'command': 'cancel', 'jobId': None, 'chunkId': None}
+
+
+def handle_while_busy(command_obj: Any) -> Optional[dict[str, Any]]:
+    """
+    Handle a command received while a long running command is in progress: A 'cancel' is returned for the running
+    command to act on, commands registered to run while busy, IE: 'status', are answered, and anything else gets
+    error 70. If the command is invalid, the connection is closed, and a cancel of everything returned.
+    :param command_obj: Any: The received command object.
+    :return: Optional[dict[str, Any]]: A validated cancel command object, or None if there's nothing to cancel.
+    """
+    command: Optional[Command] = validate_command_obj(command_obj)
+    if command is None:  # Sent an error and closed the connection.
+        return client_gone_cancel()
+    if command.name != 'cancel' and not command.while_busy:
+        common.send_error(70, "Only 'cancel', and status commands are accepted while a command is running.")
+        return None
+    if not validate_params(command_obj, command.schema):  # Sends an error and closes the connection.
+        return client_gone_cancel()
+    if command.name == 'cancel':
+        return command_obj
+    if not command.handler(command_obj):  # The connection was closed.
+        return client_gone_cancel()
+    return None
+
+
+def check_connection() -> Optional[dict[str, Any]]:
+    """
+    Check for a command sent while a long running command is in progress, see handle_while_busy(). A pooled command
+    gets the cancels its connection's thread passed on, otherwise the connection is read here. If the client has gone
+    away the connection is closed, and a cancel of everything returned.
+    :return: Optional[dict[str, Any]]: A validated cancel command object, or None if there's nothing to cancel.
+    """
+    if common.get_connection() is None:  # Already gone, and cancelled.
+        return None
+    pending: Optional[Queue] = common.get_pending()
+    if pending is not None:
+        try:
+            return pending.get_nowait()
+        except Empty:
+            return None
+    try:
+        if not common.get_connection().poll():
+            return None
+        command_obj = common.__recv__()
+    except (OSError, EOFError):
+        out_warning("Client went away, cancelling the running command.")
+        common.__close__()
+        return client_gone_cancel()
+    return handle_while_busy(command_obj)
+
+
+def send_cancelled(command_obj: dict[str, Any], success: bool) -> None:
+    """
+    Respond to a cancel command.
+    :param command_obj: dict[str, Any]: The validated cancel command.
+    :param success: bool: True something was cancelled, False there was nothing to cancel.
+    :return: None
+    """
+    cancelled_obj = {
+        'version': '1.0.0',
+        'status': 'cancelled',
+        'jobId': command_obj['jobId'],
+        'chunkId': command_obj['chunkId'],
+        'success': success,
+    }
+    common.__send__(cancelled_obj)
+    return
+
+
+def relay_reports(report_queue: Queue,
+                  send_report: Callable,
+                  on_cancel: Optional[Callable[[dict[str, Any]], None]] = None,
+                  block: bool = True,
+                  ) -> Optional[bool]:
+    """
+    Send the reports queued by an ffmpeg callback. The callbacks run on the ffmpeg supervisor thread, so they only
+    queue the reports, and the command thread does the sending. While waiting, the connection is checked for a
+    cancel command, or the client going away.
+    :param report_queue: Queue: The queue of (report_type, *args) tuples.
+    :param send_report: Callable: The function to send a report with, called with (report_type, *args).
+    :param on_cancel: Optional[Callable[[dict[str, Any]], None]] = None: Called with the cancel command object.
+    :param block: bool = True: True wait for the 'finished' report, False only send what's already queued.
+    :return: Optional[bool]: The success value of the 'finished' report, or None if not blocking, and it hasn't
+    arrived yet.
+    """
+    check_time: float = time.monotonic() + CANCEL_POLL_INTERVAL
+    while True:
+        if block and on_cancel is not None and time.monotonic() >= check_time:
+            check_time = time.monotonic() + CANCEL_POLL_INTERVAL
+            cancel_obj = check_connection()
+            if cancel_obj is not None:
+                on_cancel(cancel_obj)
+        try:
+            report = report_queue.get(block=block, timeout=CANCEL_POLL_INTERVAL if block else None)
+        except Empty:
+            if not block:
+                return None
+            continue
+        if report[0] == 'finished':
+            return report[1]
+        try:
+            send_report(*report)
+        except OSError:
+            out_warning("Client went away, cancelling the running command.")
+            common.__close__()
+            if on_cancel is not None:
+                on_cancel(client_gone_cancel())
+
+
 def report_split_progress(report_type: str, *args) -> None:
     response_obj = {
         'version': '1.0.0',
@@ -163,23 +392,57 @@ def report_split_progress(report_type: str, *args) -> None:
     return
 
 
-def do_split(input_path: str, output_path: str, chunk_size: int, length: timedelta) -> bool:
+def trace_split(split_start: float, segment_starts: list[tuple[str, float]], job_id: Optional[str],
+                success: bool) -> None:
+    """
+    Trace a split, and each segment it wrote; A segment runs until the next one is started.
+    :param split_start: float: When the split was started.
+    :param segment_starts: list[tuple[str, float]]: The file path, and start time of each segment.
+    :param job_id: Optional[str]: The job the split is for.
+    :param success: bool: True the split succeeded.
+    :return: None
+    """
+    split_end: float = time.time()
+    for index, (file_path, segment_start) in enumerate(segment_starts):
+        segment_end = segment_starts[index + 1][1] if index + 1 < len(segment_starts) else split_end
+        tracer.add('segment %i' % index, 'split', segment_start, segment_end, job_id,
+                   file=os.path.basename(file_path))
+    tracer.add('split', 'split', split_start, split_end, job_id, success=success, numFiles=len(segment_starts))
+    return
+
+
+def do_split(input_path: str, output_path: str, chunk_size: int, length: timedelta, job_id: Optional[str],
+             video_only: bool = False) -> bool:
     """
     Call ffmpeg split thread
     :param input_path: str: The input file to split.
     :param output_path: str: The output dir for the resulting files.
     :param chunk_size: int: The number of seconds to split by.
     :param length: timedelta: The total length of the input file as a timedelta.
+    :param job_id: Optional[str]: The job to track the chunks under, None to not track them.
+    :param video_only: bool = False: True the chunks only carry the video.
     :return: bool: True the split completed successfully. False it did not.
     """
     # Start the split:
+    report_queue: Queue = Queue()
+    split_start: float = time.time()
+    segment_starts: list[tuple[str, float]] = []  # (file path, time) each segment was started, for tracing.
+
+    def queue_report(report_type: str, *args) -> None:
+        # Timed here, on the supervisor thread, rather than when relayed:
+        if report_type == 'new_file':
+            segment_starts.append((args[0], time.time()))
+        report_queue.put((report_type,) + args)
+        return
+
     success: bool = common.ffmpeg_cli.split(
         input_path=input_path,
         output_path=output_path,
         chunk_size=chunk_size,
-        callback=report_split_progress,
+        callback=queue_report,
         report_delay=0.5,
-        total_time=length
+        total_time=length,
+        video_only=video_only,
     )
 
     if not success:
@@ -187,12 +450,32 @@ def do_split(input_path: str, output_path: str, chunk_size: int, length: timedel
         common.__close__()
         return False
 
+    cancelled: list[bool] = []
+
+    def cancel_split(cancel_obj: dict[str, Any]) -> None:
+        found: bool = cancel_obj['jobId'] is None and common.ffmpeg_cli.split_terminate()
+        if found:
+            cancelled.append(True)
+        send_cancelled(cancel_obj, found)
+        return
+
+    relay_reports(report_queue, report_split_progress, cancel_split)
     success, output_files = common.ffmpeg_cli.split_finish()
+    trace_split(split_start, segment_starts, job_id, success and len(cancelled) == 0)
+
+    if len(cancelled) > 0:  # Remove the partial split, and finish without an error:
+        for output_file in output_files:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+        common.__send__({'version': '1.0.0', 'status': 'split finished', 'success': False, 'outputFiles': ()})
+        return False
 
     if not success:
         common.send_error(41, "Split reports as failed.")
         common.__close__()
         return False
+    if job_id is not None:
+        common.work_dirs.add_files(job_id, list(output_files))
 
     # Send split finished.
     finished_obj = {
@@ -205,86 +488,1042 @@ def do_split(input_path: str, output_path: str, chunk_size: int, length: timedel
     return True
 
 
-def main() -> None:
+def report_encode_progress(report_type: str, *args, to_connection: Optional[Connection] = None) -> None:
     """
-    Main loop.
+    Send an encode progress report to the client.
+    :param report_type: str: The report type, see EncodeThread.
+    :param args: The report values.
+    :param to_connection: Optional[Connection] = None: The connection to send on, None for this thread's connection.
     :return: None
     """
-    running: bool = True
-    while running:
-        # Accept a connection:
-        out_info("Waiting for connection...")
-        common.__accept__()
-        out_info("Accepted connection.")
-        while True:  # Command response loop.
-            # Receive the command:
-            out_info("Waiting for command...")
-            command_obj: dict[str, Any] = common.__recv__()
-            out_info("Command received, verifying...")
-            # Validate command
-            if not validate_command_obj(command_obj):  # Sends an error and closes the connection.
-                out_warning("Invalid command: %s" % str(command_obj))
-                break  # The connection was closed.
-            out_info("Command is valid.")
-            # Act on command:
-            if command_obj['command'] == 'shutdown':  # Shutdown command:
-                out_info("Received shutdown command, shutting down.")
-                common.__close__()
-                running = False
+    response_obj = {
+        'version': '1.0.0',
+    }
+    if report_type == 'report':
+        response_obj['status'] = 'encoding report'
+        response_obj['currentTime'] = args[0]  # Optional[timedelta]
+        response_obj['currentFrame'] = args[1]  # Optional[int]
+        response_obj['fps'] = args[2]  # Optional[float]
+        response_obj['bitRate'] = args[3]  # Optional[str]
+        response_obj['currentSpeed'] = args[4]  # Optional[str]
+        response_obj['totalComplete'] = args[5]  # Optional[float] 0.0 -> 100.0
+    elif report_type == 'data':
+        response_obj['status'] = 'encode stream data'
+        response_obj['data'] = args[0]  # bytes
+    common.__send__(response_obj, to_connection)
+    return
+
+
+def do_encode(input_path: str,
+              output_path: str,
+              audio_encoder: AudioEncoders,
+              down_mix_audio: bool,
+              boost_volume: int,
+              video_encoder: VideoEncoders,
+              scale_video: Optional[dict[str, int]],
+              start_time: Optional[timedelta],
+              end_time: Optional[timedelta],
+              job_id: Optional[str],
+              no_video: bool = False,
+              ) -> bool:
+    """
+    Call the ffmpeg encode thread.
+    :param input_path: str: The input file to encode, either a split chunk, or the source file if a time range is set.
+    :param output_path: str: The output file.
+    :param audio_encoder: AudioEncoders: The audio encoder.
+    :param down_mix_audio: bool: Down mix the audio to stereo.
+    :param boost_volume: int: The percentage to boost the volume.
+    :param video_encoder: VideoEncoders: The video encoder.
+    :param scale_video: Optional[dict[str, int]]: The scale options.
+    :param start_time: Optional[timedelta]: Where to start in the input, None for the start.
+    :param end_time: Optional[timedelta]: Where to stop in the input, None for the end.
+    :param job_id: Optional[str]: The job the encode is for, for tracing.
+    :param no_video: bool = False: True encode every stream but the video, for muxing with video only chunks.
+    :return: bool: True the encode completed successfully. False it did not.
+    """
+    # Start the encode:
+    report_queue: Queue = Queue()
+    encode_start: float = time.time()
+    success: bool = common.ffmpeg_cli.encode(
+        input_path=input_path,
+        output_path=output_path,
+        audio_encoder=audio_encoder,
+        down_mix_audio=down_mix_audio,
+        boost_volume=boost_volume,
+        video_encoder=video_encoder,
+        scale_video=scale_video,
+        callback=lambda *report: report_queue.put(report),
+        report_delay=0.5,
+        start_time=start_time,
+        end_time=end_time,
+        no_video=no_video,
+    )
+
+    if not success:
+        common.send_error(50, "Failed to start encode thread.")
+        common.__close__()
+        return False
+
+    cancelled: list[bool] = []
+
+    def cancel_encode(cancel_obj: dict[str, Any]) -> None:
+        found: bool = cancel_obj['jobId'] is None and common.ffmpeg_cli.encode_terminate(output_path)
+        if found:
+            cancelled.append(True)
+        send_cancelled(cancel_obj, found)
+        return
+
+    relay_reports(report_queue, report_encode_progress, cancel_encode)
+    found, success = common.ffmpeg_cli.encode_finish(output_path)
+    # The controller's chunk id isn't known here, each output gets its own row:
+    tracer.add('encode', 'encode', encode_start, None, job_id, lane=os.path.basename(output_path),
+               success=found and success and len(cancelled) == 0)
+
+    if len(cancelled) > 0:  # Remove the partial output, and finish without an error:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        common.__send__({'version': '1.0.0', 'status': 'encode finished', 'success': False, 'outputFile': output_path})
+        return False
+
+    if not found or not success:
+        common.send_error(51, "Encode reports as failed.")
+        common.__close__()
+        return False
+
+    # Send encode finished:
+    finished_obj = {
+        'version': '1.0.0',
+        'status': 'encode finished',
+        'success': success,
+        'outputFile': output_path,
+    }
+    common.__send__(finished_obj)
+    return True
+
+
+def do_encode_stream(audio_encoder: AudioEncoders,
+                     down_mix_audio: bool,
+                     boost_volume: int,
+                     video_encoder: VideoEncoders,
+                     scale_video: Optional[dict[str, int]],
+                     output_format: str,
+                     ) -> bool:
+    """
+    Encode a chunk streamed over the connection, without writing it to disk. The input blocks are received with
+    recv_bytes() and fed to ffmpeg's stdin through a bounded queue, the output is sent back as 'encode stream data'
+    responses.
+    :param audio_encoder: AudioEncoders: The audio encoder.
+    :param down_mix_audio: bool: Down mix the audio to stereo.
+    :param boost_volume: int: The percentage to boost the volume.
+    :param video_encoder: VideoEncoders: The video encoder.
+    :param scale_video: Optional[dict[str, int]]: The scale options.
+    :param output_format: str: The ffmpeg format for the output, must be streamable, IE: 'matroska'.
+    :return: bool: True the encode completed successfully. False it did not.
+    """
+    input_queue: Queue = Queue(maxsize=STREAM_QUEUE_SIZE)
+    report_queue: Queue = Queue()
+    stream_key: str = 'stream:' + uuid.uuid4().hex  # Identifies the encode, there is no output file.
+    stream_start: float = time.time()
+
+    connection: Optional[Connection] = common.get_connection()
+
+    def queue_report(report_type: str, *args) -> None:
+        # Output data comes from its own thread, so it's sent straight away; The rest come from the supervisor:
+        if report_type == 'data':
+            report_encode_progress(report_type, *args, to_connection=connection)
+        else:
+            report_queue.put((report_type,) + args)
+        return
+
+    success: bool = common.ffmpeg_cli.encode(
+        input_path='pipe:0',
+        output_path=stream_key,
+        audio_encoder=audio_encoder,
+        down_mix_audio=down_mix_audio,
+        boost_volume=boost_volume,
+        video_encoder=video_encoder,
+        scale_video=scale_video,
+        callback=queue_report,
+        report_delay=0.5,
+        input_queue=input_queue,
+        output_format=output_format,
+    )
+    if not success:
+        common.send_error(50, "Failed to start encode thread.")
+        common.__close__()
+        return False
+
+    # Tell the client to start sending, then pass blocks to ffmpeg, blocking when the queue is full:
+    ready_obj = {
+        'version': '1.0.0',
+        'status': 'encode stream ready',
+        'maxBlockSize': STREAM_MAX_BLOCK_SIZE,
+    }
+    common.__send__(ready_obj)
+    finished: Optional[bool] = None
+    try:
+        while True:
+            data: bytes = common.__recv_bytes__(STREAM_MAX_BLOCK_SIZE)
+            if data == b'':  # End of input.
                 break
-            elif command_obj['command'] == 'report':  # Report settings command:
-                out_info("Received report command.")
-                common.status = 'reporting'
-                response_obj = build_report_dict()
-                common.__send__(response_obj)
-                common.status = 'idle'
-                out_info("Report sent.")
-            elif command_obj['command'] == 'status':  # Current status command:
-                out_info("Received status command.")
-                response_obj = build_status_dict()
-                common.__send__(response_obj)
-                out_info("Status sent.")
-            elif command_obj['command'] == 'split':  # Split the video command:
-                out_info("Received split command, verifying params.")
-                # Make sure params exist, and are the right type:
-                params = (('inputFile', str), ('outputDir', str), ('chunkSize', int), ('length', timedelta))
-                if not validate_command_params(command_obj, params):  # Sends an error and closes the connection.
-                    out_warning("Invalid params for split command.")
-                    break  # The connection was closed.
-                out_info("Params validated, verifying values...")
-                # Parse the input file and output directory for shared / local directory:
-                input_file_path = common.parse_path(command_obj['inputFile'])
-                output_dir_path = common.parse_path(command_obj['outputDir'])
-                # Verify the input file exists:
-                if not check_file_or_directory_exists(input_file_path, True):  # Sends error and closes connection
-                    out_warning("Input path doesn't exist.")
-                    out_debug("Input path = %s" % input_file_path)
-                    break  # Connection has been closed.
-                # Verify the output directory exists:
-                if not check_file_or_directory_exists(output_dir_path, False):  # Sens error and closes connection
-                    out_warning("Output directory doesn't exist.")
-                    out_debug("Output dir = %s" % output_dir_path)
-                    break  # Connection has been closed.
-                # Do the split:
-                out_info("Values validated, doing split.")
-                common.status = "splitting"
-                do_split(input_file_path, output_dir_path, command_obj['chunkSize'], command_obj['length'])
-                common.status = "idle"
-                out_info("Split finished.")
-            elif command_obj['command'] == 'copy_input':  # Copy input chunk to local working directory command:
-                pass
-            elif command_obj['command'] == 'encode':  # Encode chunk command:
-                pass
-            elif command_obj['command'] == 'copy_output':  # Copy output chunk.
-                pass
-            elif command_obj['command'] == 'combine':  # Combine the video chunks command:
-                pass
-            elif command_obj['command'] == 'hash':  # Preform a hash on a video chunk:
-                pass
-            elif command_obj['command'] == 'close':  # Close the connection.
+            input_queue.put(data)
+            if finished is None:
+                finished = relay_reports(report_queue, report_encode_progress, block=False)
+    except (OSError, EOFError) as e:
+        out_warning("Error while receiving stream input, cancelling the encode: %s" % str(e))
+        common.ffmpeg_cli.encode_terminate(stream_key)
+        input_queue.put(b'')
+        common.ffmpeg_cli.encode_finish(stream_key)
+        common.__close__()
+        return False
+    input_queue.put(b'')
+    if finished is None:
+        relay_reports(report_queue, report_encode_progress)
+
+    found, success = common.ffmpeg_cli.encode_finish(stream_key)
+    tracer.add('encode stream', 'encode', stream_start, None, lane=stream_key, success=found and success)
+    if not found or not success:
+        common.send_error(51, "Encode reports as failed.")
+        common.__close__()
+        return False
+
+    finished_obj = {
+        'version': '1.0.0',
+        'status': 'encode finished',
+        'success': success,
+    }
+    common.__send__(finished_obj)
+    return True
+
+
+def parse_renditions(command_obj: dict[str, Any],
+                     video_encoder: VideoEncoders,
+                     ) -> Optional[list[tuple[Optional[dict[str, int]], Optional[int]]]]:
+    """
+    Validate the 'renditions' parameter of an 'encode_chunks' or 'submit' command.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :param video_encoder: VideoEncoders: The video encoder.
+    :return: Optional[list[tuple[Optional[dict[str, int]], Optional[int]]]]: The (scale_video, bit_rate) of each
+    rendition, empty for none; Or None if they're invalid, and the connection has been closed.
+    """
+    if command_obj['renditions'] is None:
+        return []
+    if video_encoder == VideoEncoders.COPY or command_obj['ratePass'] is not None:
+        common.send_error(22, "parameter 'renditions' needs a 'videoEncoder' other than copy, and no 'ratePass'.")
+        common.__close__()
+        return None
+    renditions: list[tuple[Optional[dict[str, int]], Optional[int]]] = []
+    for rendition_obj in command_obj['renditions']:
+        if not isinstance(rendition_obj, dict):
+            common.send_error(21, "parameter 'renditions' must be a list of dicts.")
+            common.__close__()
+            return None
+        if not validate_params(rendition_obj, RENDITION_SCHEMA):  # Sends an error and closes the connection.
+            return None
+        if rendition_obj['bitRate'] is not None and rendition_obj['bitRate'] < 1:
+            common.send_error(22, "parameter 'bitRate' must be at least 1.")
+            common.__close__()
+            return None
+        renditions.append((rendition_obj['scaleVideo'], rendition_obj['bitRate']))
+    return renditions
+
+
+def build_job(command_obj: dict[str, Any],
+              audio_encoder: AudioEncoders,
+              video_encoder: VideoEncoders,
+              keep_reports: bool,
+              ) -> Optional[Job]:
+    """
+    Build a job from an 'encode_chunks' or 'submit' command, validating the chunk list.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :param audio_encoder: AudioEncoders: The audio encoder.
+    :param video_encoder: VideoEncoders: The video encoder.
+    :param keep_reports: bool: True queue the job's reports to send to this connection, False drop them.
+    :return: Optional[Job]: The job, or None if a chunk was invalid, and the connection has been closed.
+    """
+    encode_settings: dict[str, Any] = {
+        'audio_encoder': audio_encoder,
+        'down_mix_audio': command_obj['downMixAudio'],
+        'boost_volume': command_obj['boostVolume'],
+        'video_encoder': video_encoder,
+        'scale_video': command_obj['scaleVideo'],
+        'rate_pass': command_obj['ratePass'],
+    }
+    if command_obj['ratePass'] is not None:
+        if command_obj['ratePass'] not in (1, 2):
+            common.send_error(22, "parameter 'ratePass' must be 1 or 2.")
+            common.__close__()
+            return None
+        if video_encoder not in (VideoEncoders.X264, VideoEncoders.X265):
+            common.send_error(22, "parameter 'ratePass' needs 'videoEncoder' libx264 or libx265.")
+            common.__close__()
+            return None
+    # The owner defaults to the client's host, so each machine submitting gets a fair share:
+    owner: Optional[str] = command_obj['owner']
+    if owner is None:
+        owner = (common.get_peer() or '').rsplit(':', 1)[0]
+    priority: int = command_obj['priority'] if command_obj['priority'] is not None else 0
+    renditions = parse_renditions(command_obj, video_encoder)
+    if renditions is None:  # Sent an error and closed the connection.
+        return None
+    job = Job(command_obj['jobId'], encode_settings, command_obj['useLocalCopy'], priority, owner, keep_reports,
+              renditions)
+    for chunk_obj in command_obj['chunks']:
+        if not isinstance(chunk_obj, dict):
+            common.send_error(21, "parameter 'chunks' must be a list of dicts.")
+            common.__close__()
+            return None
+        if not validate_params(chunk_obj, CHUNK_SCHEMA):  # Sends an error and closes the connection.
+            return None
+        if chunk_obj['startTime'] is not None and chunk_obj['endTime'] is not None and \
+                chunk_obj['endTime'] <= chunk_obj['startTime']:
+            common.send_error(52, "Invalid time range, 'endTime' must be after 'startTime'.")
+            common.__close__()
+            return None
+        input_file_path = common.parse_path(chunk_obj['inputFile'])
+        output_file_path = common.parse_path(chunk_obj['outputFile'])
+        if not check_file_or_directory_exists(input_file_path, True):  # Sends error and closes connection
+            return None
+        if not check_file_or_directory_exists(os.path.dirname(output_file_path), False):  # Sends error and closes.
+            return None
+        bit_rate: Optional[int] = chunk_obj['bitRate'] if chunk_obj['bitRate'] is not None else command_obj['bitRate']
+        if bit_rate is not None and bit_rate < 1:
+            common.send_error(22, "parameter 'bitRate' must be at least 1.")
+            common.__close__()
+            return None
+        pass_log_path: Optional[str] = None
+        if command_obj['ratePass'] is not None:
+            if bit_rate is None or chunk_obj['passLogFile'] is None:
+                common.send_error(20, "parameter 'bitRate' and 'passLogFile' are required with 'ratePass'.")
+                common.__close__()
+                return None
+            pass_log_path = common.parse_path(chunk_obj['passLogFile'])
+            if not check_file_or_directory_exists(os.path.dirname(pass_log_path), False):  # Sends error and closes.
+                return None
+        rendition_paths: list[str] = []
+        if len(renditions) > 0:
+            rendition_files = chunk_obj['renditionFiles']
+            if rendition_files is None or len(rendition_files) != len(renditions) or \
+                    not all(isinstance(rendition_file, str) for rendition_file in rendition_files):
+                common.send_error(21, "parameter 'renditionFiles' must be a list of a str for each rendition.")
                 common.__close__()
+                return None
+            for rendition_file in rendition_files:
+                rendition_paths.append(common.parse_path(rendition_file))
+                if not check_file_or_directory_exists(os.path.dirname(rendition_paths[-1]), False):  # Sends error.
+                    return None
+        job.add_chunk(input_file_path, output_file_path, chunk_obj['startTime'], chunk_obj['endTime'],
+                      chunk_obj['length'], bit_rate, pass_log_path, rendition_paths)
+    return job
+
+
+def do_encode_chunks(job: Job) -> bool:
+    """
+    Queue a job on the scheduler, and send its reports until it's finished.
+    :param job: Job: The job to run.
+    :return: bool: True all the chunks were encoded, False one or more failed, or were cancelled.
+    """
+    if not common.scheduler.submit(job):
+        common.send_error(53, "A job with id '%s' already exists." % job.job_id)
+        common.__close__()
+        return False
+    check_time: float = time.monotonic() + CANCEL_POLL_INTERVAL
+    while not job.finished.is_set() or not job.reports.empty():
+        if time.monotonic() >= check_time:
+            check_time = time.monotonic() + CANCEL_POLL_INTERVAL
+            cancel_obj = check_connection()
+            if cancel_obj is not None:
+                job_id: str = cancel_obj['jobId'] if cancel_obj['jobId'] is not None else job.job_id
+                found: bool = common.scheduler.cancel(job_id, cancel_obj['chunkId'])
+                if cancel_obj['chunkId'] is None:  # The whole job is cancelled, remove its files:
+                    found = common.work_dirs.release_job(job_id) > 0 or found
+                send_cancelled(cancel_obj, found)
+        try:
+            report_obj = job.reports.get(timeout=CANCEL_POLL_INTERVAL)
+        except Empty:
+            continue
+        try:
+            common.__send__(report_obj)
+        except OSError:
+            out_warning("Client went away, cancelling job '%s'." % job.job_id)
+            common.__close__()
+            common.scheduler.cancel(job.job_id)
+    finished_obj = {
+        'version': '1.0.0',
+        'status': 'encode chunks finished',
+        'jobId': job.job_id,
+        'success': job.success,
+        'outputFiles': tuple(chunk.output_path for chunk in job.chunks if chunk.state == 'finished'),
+    }
+    common.__send__(finished_obj)
+    return job.success
+
+
+def do_submit(job: Job) -> bool:
+    """
+    Queue a job on the scheduler, and reply straight away. Nobody waits on the job's reports, its progress shows in
+    'status', and it isn't cancelled when this connection closes.
+    :param job: Job: The job to queue.
+    :return: bool: True the job was queued, False a job with this id already exists, and the connection has been
+    closed.
+    """
+    if not common.scheduler.submit(job):
+        common.send_error(53, "A job with id '%s' already exists." % job.job_id)
+        common.__close__()
+        return False
+    submitted_obj = {
+        'version': '1.0.0',
+        'status': 'job submitted',
+        'jobId': job.job_id,
+        'numChunks': len(job.chunks),
+        'priority': job.priority,
+        'owner': job.owner,
+    }
+    common.__send__(submitted_obj)
+    return True
+
+
+def do_combine(input_files: list[str], output_path: str, job_id: Optional[str],
+               streams_file: Optional[str] = None) -> bool:
+    """
+    Combine the encoded parts into the output file.
+    :param input_files: list[str]: The full paths to the parts, in any order; they're sorted by part number.
+    :param output_path: str: The full path to the output file.
+    :param job_id: Optional[str]: The job the parts belong to, for tracing.
+    :param streams_file: Optional[str] = None: The full path to the other streams to mux in with video only parts.
+    :return: bool: True the parts were combined, False they were not.
+    """
+    with tracer.span('combine', 'combine', job_id, numParts=len(input_files)) as span_args:
+        success: bool = common.ffmpeg_cli.combine(input_files, output_path, streams_file)
+        span_args['success'] = success
+    if not success:
+        common.send_error(60, "Combine reports as failed.")
+        common.__close__()
+        return False
+    finished_obj = {
+        'version': '1.0.0',
+        'status': 'combine finished',
+        'success': success,
+        'outputFile': output_path,
+    }
+    common.__send__(finished_obj)
+    return True
+
+
+def do_profile(duration: float, sample_interval: float, trace_memory: bool, top: int) -> bool:
+    """
+    Profile the daemon for a while, and send the results. The connection is checked for a cancel while it runs, which
+    stops it early, and still sends the results.
+    :param duration: float: The number of seconds to profile for.
+    :param sample_interval: float: The time between stack samples, in seconds.
+    :param trace_memory: bool: True to trace memory allocations too.
+    :param top: int: The number of functions / allocation sites to send.
+    :return: bool: True the profile ran, False another profile is already running, and the connection has been closed.
+    """
+    profile = Profile(sample_interval, trace_memory, top)
+    if not profile.start():
+        common.send_error(90, "A profile is already running.")
+        common.__close__()
+        return False
+    out_info("Profiling for %.1f seconds." % duration)
+    end_time: float = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        time.sleep(min(CANCEL_POLL_INTERVAL, max(end_time - time.monotonic(), 0.0)))
+        cancel_obj = check_connection()
+        if cancel_obj is not None:
+            send_cancelled(cancel_obj, cancel_obj['jobId'] is None)
+            if cancel_obj['jobId'] is None:
+                break
+    results: dict[str, Any] = profile.stop()
+    finished_obj = {
+        'version': '1.0.0',
+        'status': 'profile finished',
+    }
+    finished_obj.update(results)
+    common.__send__(finished_obj)
+    return True
+
+
+def do_ingest(wait: float, max_files: int) -> bool:
+    """
+    Take the files waiting in the ingest queue, waiting for one to arrive if there are none, and send them. The
+    connection is checked for a cancel while waiting, which stops the wait early. If the reply can't be sent, the
+    files are put back for the next controller.
+    :param wait: float: The max number of seconds to wait for a file, 0 to not wait.
+    :param max_files: int: The max number of files to take.
+    :return: bool: True wait for the next command, False the connection has been closed.
+    """
+    end_time: float = time.monotonic() + wait
+    while True:
+        files: list[dict[str, Any]] = common.ingest_queue.take(
+            max_files, min(CANCEL_POLL_INTERVAL, max(end_time - time.monotonic(), 0.0)))
+        if len(files) > 0 or time.monotonic() >= end_time:
+            break
+        cancel_obj = check_connection()
+        if common.get_connection() is None:  # The client went away.
+            return False
+        if cancel_obj is not None:
+            send_cancelled(cancel_obj, cancel_obj['jobId'] is None)
+            if cancel_obj['jobId'] is None:
                 break
+    ingest_obj = {
+        'version': '1.0.0',
+        'status': 'ingest',
+        'files': files,
+        'preset': common.config.watch_preset,
+    }
+    try:
+        sent: bool = common.__send__(ingest_obj)
+    except (OSError, ValueError):
+        sent = False
+    if not sent:
+        if len(files) > 0:
+            out_warning("Failed to send %i ingested files, putting them back." % len(files))
+            common.ingest_queue.put_back(files)
+        common.__close__()
+        return False
+    return True
+
+
+def handle_shutdown(_command_obj: dict[str, Any]) -> bool:
+    """
+    Shutdown command: Stop the daemon.
+    :param _command_obj: dict[str, Any]: The command object.
+    :return: bool: False, the connection has been closed.
+    """
+    out_info("Received shutdown command, shutting down.")
+    common.__close__()
+    common.shutdown_event.set()
+    common.wake_listener()
+    return False
+
+
+def handle_report(_command_obj: dict[str, Any]) -> bool:
+    """
+    Report settings command.
+    :param _command_obj: dict[str, Any]: The command object.
+    :return: bool: True, wait for the next command.
+    """
+    out_info("Received report command.")
+    response_obj = build_report_dict()
+    common.__send__(response_obj)
+    out_info("Report sent.")
+    return True
+
+
+def handle_status(_command_obj: dict[str, Any]) -> bool:
+    """
+    Current status command.
+    :param _command_obj: dict[str, Any]: The command object.
+    :return: bool: True, wait for the next command.
+    """
+    out_info("Received status command.")
+    response_obj = build_status_dict()
+    common.__send__(response_obj)
+    out_info("Status sent.")
+    return True
+
+
+def handle_not_implemented(command_obj: dict[str, Any]) -> bool:
+    """
+    A command that's reserved, but does nothing yet: 'copy_input', 'copy_output', and 'hash'.
+    :param command_obj: dict[str, Any]: The command object.
+    :return: bool: True, wait for the next command.
+    """
+    out_debug("Received %s command, which does nothing yet." % command_obj['command'])
+    return True
+
+
+def handle_split(command_obj: dict[str, Any]) -> bool:
+    """
+    Split the video command.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :return: bool: True wait for the next command, False the connection has been closed.
+    """
+    out_info("Received split command, verifying values...")
+    # Parse the input file and output directory for shared / local directory:
+    input_file_path = common.parse_path(command_obj['inputFile'])
+    output_dir_path = common.parse_path(command_obj['outputDir'])
+    # Verify the input file exists:
+    if not check_file_or_directory_exists(input_file_path, True):  # Sends error and closes connection
+        out_warning("Input path doesn't exist.")
+        out_debug("Input path = %s" % input_file_path)
+        return False
+    # Verify the output directory exists:
+    if not check_file_or_directory_exists(output_dir_path, False):  # Sends error and closes connection
+        out_warning("Output directory doesn't exist.")
+        out_debug("Output dir = %s" % output_dir_path)
+        return False
+    # Do the split:
+    out_info("Values validated, doing split.")
+    common.set_status('splitting')
+    do_split(input_file_path, output_dir_path, command_obj['chunkSize'], command_obj['length'], command_obj['jobId'],
+             command_obj['videoOnly'] is True)
+    common.set_status('idle')
+    out_info("Split finished.")
+    return common.get_connection() is not None
+
+
+def handle_encode(command_obj: dict[str, Any]) -> bool:
+    """
+    Encode chunk command.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :return: bool: True wait for the next command, False the connection has been closed.
+    """
+    out_info("Received encode command, verifying values...")
+    encoders = parse_encoders(command_obj)
+    if encoders is None:  # Sends an error and closes the connection.
+        out_warning("Invalid encoder for encode command.")
+        return False
+    audio_encoder, video_encoder = encoders
+    start_time: Optional[timedelta] = command_obj['startTime']
+    end_time: Optional[timedelta] = command_obj['endTime']
+    if start_time is not None and end_time is not None and end_time <= start_time:
+        common.send_error(52, "Invalid time range, 'endTime' must be after 'startTime'.")
+        common.__close__()
+        out_warning("Invalid time range for encode command.")
+        return False
+    input_file_path = common.parse_path(command_obj['inputFile'])
+    output_file_path = common.parse_path(command_obj['outputFile'])
+    # Verify the input file exists:
+    if not check_file_or_directory_exists(input_file_path, True):  # Sends error and closes connection
+        out_warning("Input path doesn't exist.")
+        out_debug("Input path = %s" % input_file_path)
+        return False
+    # Verify the output directory exists:
+    output_dir_path = os.path.dirname(output_file_path)
+    if not check_file_or_directory_exists(output_dir_path, False):  # Sends error and closes connection
+        out_warning("Output directory doesn't exist.")
+        out_debug("Output dir = %s" % output_dir_path)
+        return False
+    if command_obj['jobId'] is not None:
+        common.work_dirs.add_files(command_obj['jobId'], [output_file_path])
+    # Do the encode:
+    out_info("Values validated, doing encode.")
+    common.set_status('encoding')
+    do_encode(input_file_path, output_file_path, audio_encoder, command_obj['downMixAudio'],
+              command_obj['boostVolume'], video_encoder, command_obj['scaleVideo'], start_time, end_time,
+              command_obj['jobId'], command_obj['noVideo'] is True)
+    common.set_status('idle')
+    out_info("Encode finished.")
+    return common.get_connection() is not None
+
+
+def handle_encode_stream(command_obj: dict[str, Any]) -> bool:
+    """
+    Encode a chunk streamed over the connection. It reads the connection itself, so it runs inline.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :return: bool: True wait for the next command, False the connection has been closed.
+    """
+    out_info("Received encode stream command.")
+    encoders = parse_encoders(command_obj)
+    if encoders is None:  # Sends an error and closes the connection.
+        out_warning("Invalid encoder for encode stream command.")
+        return False
+    audio_encoder, video_encoder = encoders
+    out_info("Params validated, doing stream encode.")
+    common.set_status('encoding')
+    success = do_encode_stream(audio_encoder, command_obj['downMixAudio'], command_obj['boostVolume'],
+                               video_encoder, command_obj['scaleVideo'], command_obj['outputFormat'])
+    common.set_status('idle')
+    out_info("Stream encode finished.")
+    return success
+
+
+def parse_job(command_obj: dict[str, Any], keep_reports: bool) -> Optional[Job]:
+    """
+    Build the job of an encode chunks, or submit command.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :param keep_reports: bool: True queue the job's reports to send to this connection, False drop them.
+    :return: Optional[Job]: The job, or None if it's invalid, and the connection has been closed.
+    """
+    if common.scheduler.num_slots == 0:  # IE: a file host with 'numChunks' 0, the job would never run.
+        common.send_error(54, "This daemon has no encode slots.")
+        common.__close__()
+        out_warning("Refused %s command, there are no encode slots." % command_obj['command'])
+        return None
+    encoders = parse_encoders(command_obj)
+    if encoders is None:  # Sends an error and closes the connection.
+        out_warning("Invalid encoder for %s command." % command_obj['command'])
+        return None
+    job = build_job(command_obj, *encoders, keep_reports=keep_reports)
+    if job is None:  # Sends an error and closes the connection.
+        out_warning("Invalid chunk for %s command." % command_obj['command'])
+    return job
+
+
+def handle_encode_chunks(command_obj: dict[str, Any]) -> bool:
+    """
+    Encode a list of chunks on the encode slots, waiting for the job, and sending its reports.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :return: bool: True wait for the next command, False the connection has been closed.
+    """
+    out_info("Received encode_chunks command, verifying values...")
+    job = parse_job(command_obj, keep_reports=True)
+    if job is None:  # Sent an error and closed the connection.
+        return False
+    out_info("Values validated, encoding %i chunks." % len(job.chunks))
+    common.set_status('encoding')
+    do_encode_chunks(job)
+    common.set_status('idle')
+    out_info("Encode chunks finished.")
+    return common.get_connection() is not None
+
+
+def handle_submit(command_obj: dict[str, Any]) -> bool:
+    """
+    Queue a list of chunks on the encode slots, and reply straight away.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :return: bool: True wait for the next command, False the connection has been closed.
+    """
+    out_info("Received submit command, verifying values...")
+    job = parse_job(command_obj, keep_reports=False)
+    if job is None:  # Sent an error and closed the connection.
+        return False
+    out_info("Values validated, queueing %i chunks." % len(job.chunks))
+    return do_submit(job)
+
+
+def handle_combine(command_obj: dict[str, Any]) -> bool:
+    """
+    Combine the video chunks command.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :return: bool: True wait for the next command, False the connection has been closed.
+    """
+    out_info("Received combine command, verifying values...")
+    input_file_paths: list[str] = []
+    for input_file in command_obj['inputFiles']:
+        if not isinstance(input_file, str):
+            common.send_error(21, "parameter 'inputFiles' must be a list of str.")
+            common.__close__()
+            out_warning("Invalid input file for combine command.")
+            return False
+        input_file_path = common.parse_path(input_file)
+        if not check_file_or_directory_exists(input_file_path, True):  # Sends error and closes.
+            out_warning("Invalid input file for combine command.")
+            out_debug("Input path = %s" % input_file_path)
+            return False
+        input_file_paths.append(input_file_path)
+    output_file_path = common.parse_path(command_obj['outputFile'])
+    if not check_file_or_directory_exists(os.path.dirname(output_file_path), False):  # Sends error.
+        out_warning("Output directory doesn't exist.")
+        out_debug("Output dir = %s" % os.path.dirname(output_file_path))
+        return False
+    streams_file_path: Optional[str] = None
+    if command_obj['streamsFile'] is not None:
+        streams_file_path = common.parse_path(command_obj['streamsFile'])
+        if not check_file_or_directory_exists(streams_file_path, True):  # Sends error and closes.
+            out_warning("Streams file doesn't exist.")
+            out_debug("Streams path = %s" % streams_file_path)
+            return False
+    out_info("Values validated, doing combine.")
+    common.set_status('combining')
+    combined: bool = do_combine(input_file_paths, output_file_path, command_obj['jobId'], streams_file_path)
+    if combined and command_obj['jobId'] is not None:
+        # The job is done, remove its chunks and parts, including any parts it didn't know about; Unless more of its
+        # renditions are still to be combined:
+        common.work_dirs.add_files(command_obj['jobId'], input_file_paths)
+        if streams_file_path is not None:
+            common.work_dirs.add_files(command_obj['jobId'], [streams_file_path])
+        if command_obj['keepJob'] is not True:
+            common.work_dirs.release_job(command_obj['jobId'], keep=(output_file_path,))
+    common.set_status('idle')
+    out_info("Combine finished.")
+    return combined
+
+
+def handle_cancel(command_obj: dict[str, Any]) -> bool:
+    """
+    Cancel a job, nothing else is running on this connection.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :return: bool: True, wait for the next command.
+    """
+    out_info("Received cancel command.")
+    found = False
+    if command_obj['jobId'] is not None:
+        found = common.scheduler.cancel(command_obj['jobId'], command_obj['chunkId'])
+        if command_obj['chunkId'] is None:  # The whole job is cancelled, remove its files:
+            found = common.work_dirs.release_job(command_obj['jobId']) > 0 or found
+    send_cancelled(command_obj, found)
+    out_info("Cancel finished.")
+    return True
 
+
+def handle_trace(command_obj: dict[str, Any]) -> bool:
+    """
+    Export the recorded spans.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :return: bool: True, wait for the next command.
+    """
+    out_info("Received trace command.")
+    response_obj = {
+        'version': '1.0.0',
+        'status': 'trace',
+        'host': tracer.host,
+        'time': time.time(),
+        'traceEvents': tracer.export(command_obj['jobId']),
+    }
+    if command_obj['clear']:
+        tracer.clear(command_obj['jobId'])
+    common.__send__(response_obj)
+    out_info("Trace sent.")
+    return True
+
+
+def handle_profile(command_obj: dict[str, Any]) -> bool:
+    """
+    Profile the running daemon.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :return: bool: True wait for the next command, False the connection has been closed.
+    """
+    out_info("Received profile command, verifying values...")
+    sample_interval: float = command_obj['sampleInterval'] or DEFAULT_SAMPLE_INTERVAL
+    top: int = command_obj['top'] if command_obj['top'] is not None else DEFAULT_TOP
+    if not 0 < command_obj['duration'] <= PROFILE_MAX_DURATION:
+        common.send_error(22, "parameter 'duration' must be > 0 and <= %i." % PROFILE_MAX_DURATION)
+        common.__close__()
+        return False
+    if not MIN_SAMPLE_INTERVAL <= sample_interval <= MAX_SAMPLE_INTERVAL:
+        common.send_error(22, "parameter 'sampleInterval' must be between %s and %s." %
+                          (MIN_SAMPLE_INTERVAL, MAX_SAMPLE_INTERVAL))
+        common.__close__()
+        return False
+    if top < 1:
+        common.send_error(22, "parameter 'top' must be at least 1.")
+        common.__close__()
+        return False
+    common.set_status('profiling')
+    success = do_profile(command_obj['duration'], sample_interval, command_obj['traceMemory'] is True, top)
+    common.set_status('idle')
+    out_info("Profile finished.")
+    return success
+
+
+def handle_ingest(command_obj: dict[str, Any]) -> bool:
+    """
+    Hand the files that have arrived in the watch folders to a controller.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :return: bool: True wait for the next command, False the connection has been closed.
+    """
+    out_info("Received ingest command, verifying values...")
+    if common.ingest_queue is None:
+        common.send_error(100, "Not watching any folders.")
+        common.__close__()
+        return False
+    wait: float = command_obj['wait'] if command_obj['wait'] is not None else 0.0
+    max_files: int = command_obj['max'] if command_obj['max'] is not None else DEFAULT_INGEST_MAX
+    if not 0 <= wait <= MAX_INGEST_WAIT:
+        common.send_error(22, "parameter 'wait' must be >= 0 and <= %i." % MAX_INGEST_WAIT)
+        common.__close__()
+        return False
+    if max_files < 1:
+        common.send_error(22, "parameter 'max' must be at least 1.")
+        common.__close__()
+        return False
+    success = do_ingest(wait, max_files)
+    out_info("Ingest finished.")
+    return success
+
+
+def handle_close(_command_obj: dict[str, Any]) -> bool:
+    """
+    Close the connection.
+    :param _command_obj: dict[str, Any]: The command object.
+    :return: bool: False, the connection has been closed.
+    """
+    common.__close__()
+    return False
+
+
+def build_command_registry() -> CommandRegistry:
+    """
+    Build the command table, compiling each command's parameter schema. Commands that run for long are pooled, so
+    their connection's thread stays free to pass on cancels, and answer the commands that run while busy.
+    :return: CommandRegistry: The commands.
+    """
+    registry = CommandRegistry()
+    registry.register('report', handle_report, while_busy=True)
+    registry.register('status', handle_status, while_busy=True)
+    registry.register('split', handle_split, SPLIT_PARAMS, OPTIONAL_JOB_ID_PARAMS + (('videoOnly', bool),),
+                      admission=True, pooled=True)
+    registry.register('copy_input', handle_not_implemented)
+    registry.register('encode', handle_encode, (('inputFile', str), ('outputFile', str)) + ENCODE_PARAMS,
+                      TIME_RANGE_PARAMS + OPTIONAL_JOB_ID_PARAMS + (('noVideo', bool),), admission=True, pooled=True)
+    # Stream encodes read their input from the connection, so they can't leave it to a worker:
+    registry.register('encode_stream', handle_encode_stream, ENCODE_PARAMS + (('outputFormat', str),),
+                      admission=True)
+    registry.register('encode_chunks', handle_encode_chunks, JOB_PARAMS + ENCODE_PARAMS, OPTIONAL_JOB_PARAMS,
+                      admission=True, pooled=True)
+    registry.register('copy_output', handle_not_implemented)
+    registry.register('combine', handle_combine, COMBINE_PARAMS,
+                      OPTIONAL_JOB_ID_PARAMS + (('streamsFile', str), ('keepJob', bool)),
+                      admission=True,
+                      pooled=True)
+    registry.register('hash', handle_not_implemented)
+    registry.register('submit', handle_submit, JOB_PARAMS + ENCODE_PARAMS, OPTIONAL_JOB_PARAMS, admission=True)
+    registry.register('cancel', handle_cancel, optional=CANCEL_PARAMS)
+    registry.register('trace', handle_trace, optional=TRACE_PARAMS, while_busy=True)
+    registry.register('profile', handle_profile, (('duration', (int, float)),), PROFILE_PARAMS, pooled=True)
+    # Pooled, as it waits for files to arrive:
+    registry.register('ingest', handle_ingest, optional=INGEST_PARAMS, pooled=True)
+    registry.register('shutdown', handle_shutdown)
+    registry.register('close', handle_close)
+    return registry
+
+
+def run_on_worker(command: Command, command_obj: dict[str, Any], connection: Connection, pending: Queue) -> bool:
+    """
+    Run a pooled command on a worker thread, as the connection's.
+    :param command: Command: The command.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :param connection: Connection: The connection the command came on.
+    :param pending: Queue: The queue the connection's thread puts cancels on.
+    :return: bool: True wait for the next command, False the connection should be closed.
+    """
+    common.adopt_connection(connection, pending)
+    try:
+        return command.handler(command_obj) and common.get_connection() is not None
+    finally:
+        common.release_connection()
+
+
+def run_pooled(command: Command, command_obj: dict[str, Any], connection: Connection
+               ) -> tuple[bool, Optional[dict[str, Any]]]:
+    """
+    Run a command on the worker pool, and read the connection while it runs; Cancels are passed on to it, and the
+    commands that run while busy are answered. If all the workers are busy, the client gets a busy error to retry
+    after.
+    :param command: Command: The command.
+    :param command_obj: dict[str, Any]: The command object, with validated params.
+    :param connection: Connection: The connection the command came on.
+    :return: tuple[bool, Optional[dict[str, Any]]]: True wait for the next command, False the connection has been
+    closed, or should be; And the next command, if it arrived as the command finished, to run next.
+    """
+    pending: Queue = Queue()
+    future = common.command_pool.submit(run_on_worker, command, command_obj, connection, pending)
+    if future is None:
+        out_warning("Refusing %s command, all the command workers are busy." % command.name)
+        common.send_error(BUSY_ERROR, "Daemon is busy: all the command workers are busy.", reason='workers',
+                          retryAfter=WORKERS_RETRY_AFTER)
+        return True, None
+    next_obj: Optional[dict[str, Any]] = None
+    while not future.done():
+        try:
+            if not connection.poll(CANCEL_POLL_INTERVAL):
+                continue
+            busy_obj = common.__recv__()
+        except (OSError, EOFError):
+            out_warning("Client went away, cancelling the running command.")
+            pending.put(client_gone_cancel())
+            break
+        busy_command: Optional[Command] = common.commands.get(busy_obj.get('command')) \
+            if isinstance(busy_obj, dict) else None
+        if busy_command is not None and busy_command.name != 'cancel' and not busy_command.while_busy:
+            # Sent after the final reply, before the worker returned? Then it's the next command:
+            if len(wait_futures((future,), COMMAND_FINISH_WAIT).done) > 0:
+                next_obj = busy_obj
+                break
+        cancel_obj = handle_while_busy(busy_obj)
+        if cancel_obj is not None:
+            pending.put(cancel_obj)
+        if common.get_connection() is None:  # Closed, the cancel of everything has been passed on.
+            break
+    try:
+        keep_open: bool = future.result()
+    except Exception as e:
+        out_error("The %s command failed: %s" % (command.name, repr(e)))
+        keep_open = False
+    return keep_open and common.get_connection() is not None, next_obj
+
+
+def handle_connection(connection: Connection, peer: str) -> None:
+    """
+    Command response loop for one connection, run on its own thread. Commands are looked up in the command table,
+    and run inline, or on the worker pool.
+    :param connection: Connection: The accepted connection.
+    :param peer: str: The client's address.
+    :return: None
+    """
+    common.set_connection(connection, peer)
+    next_obj: Optional[dict[str, Any]] = None
+    while True:  # Command response loop.
+        # Receive the command, unless it arrived as the last one finished:
+        if next_obj is not None:
+            command_obj, next_obj = next_obj, None
+        else:
+            out_info("Waiting for command...")
+            try:
+                command_obj: dict[str, Any] = common.__recv__()
+            except (OSError, EOFError):
+                out_info("Client at %s went away." % peer)
+                break
+        out_info("Command received, verifying...")
+        # Validate command
+        command: Optional[Command] = validate_command_obj(command_obj)
+        if command is None:  # Sent an error and closed the connection.
+            out_warning("Invalid command: %s" % str(command_obj))
+            break
+        out_info("Command is valid.")
+        # Refuse new work while the node is overloaded, the client retries after the given time:
+        if command.admission and not check_admission():
+            continue
+        if not validate_params(command_obj, command.schema):  # Sends an error and closes the connection.
+            out_warning("Invalid params for %s command." % command.name)
+            break
+        # Act on command:
+        if command.pooled:
+            keep_open, next_obj = run_pooled(command, command_obj, connection)
+        else:
+            keep_open = command.handler(command_obj)
+        if not keep_open:
+            break
+
+    common.__close__()
+    out_info("Connection from %s closed." % peer)
+    return
+
+
+def build_slot_limits(num_slots: int) -> list[ProcessLimits]:
+    """
+    Build the limits for each encode slot from the config: Its own CPUs if pinning, on a single NUMA node, the encode
+    nice / I/O priority, and its own cgroup if a cgroup path and CPU / memory limits are set.
+    :param num_slots: int: The number of encode slots.
+    :return: list[ProcessLimits]: The limits, one per slot.
+    """
+    if common.config.pin_slots:
+        cpu_plan: list[tuple[Optional[int], Optional[list[int]]]] = plan_cpu_sets(num_slots)
+    else:
+        cpu_plan = [(None, None)] * num_slots
+    use_cgroups: bool = (common.config.cgroup_path != '' and
+                         (common.config.slot_cpu_percent > 0 or common.config.slot_memory_limit > 0))
+    slot_limits: list[ProcessLimits] = []
+    for slot_num, (numa_node, cpus) in enumerate(cpu_plan):
+        cgroup_path: Optional[str] = None
+        if use_cgroups:
+            cgroup_path = create_cgroup(common.config.cgroup_path, 'slot%i' % slot_num,
+                                        common.config.slot_cpu_percent, common.config.slot_memory_limit * 1024 * 1024)
+        limits = ProcessLimits(cpus=cpus, numa_node=numa_node, nice=common.config.encode_nice,
+                               io_priority=common.config.encode_io_priority, cgroup_path=cgroup_path)
+        out_debug("Slot %i limits: %s" % (slot_num, str(limits.to_dict())))
+        slot_limits.append(limits)
+    return slot_limits
+
+
+def main() -> None:
+    """
+    Main loop, accept connections, and handle each on its own thread, so several clients can submit work, check
+    status, or cancel at once.
+    :return: None
+    """
+    while not common.shutdown_event.is_set():
+        # Accept a connection:
+        out_info("Waiting for connection...")
+        connection, peer = common.__accept__()
+        if common.shutdown_event.is_set():
+            connection.close()
+            break
+        out_info("Accepted connection from %s." % peer)
+        Thread(target=handle_connection, args=(connection, peer), daemon=True).start()
     return
 
 
@@ -317,6 +1556,12 @@ if __name__ == '__main__':
 
 
         23 = Error while trying to fork process.
+        24 = Staging budget must be an integer, and at least 1 MB. (Invalid config.)
+        25 = Invalid process limit option. (Invalid config.)
+        26 = Invalid admission control option. (Invalid config.)
+        27 = Invalid working directory quota option. (Invalid config.)
+        28 = Command workers must be an integer, and at least 1. (Invalid config.)
+        29 = Invalid watch folder option. (Invalid config.)
     """
     # Command line arguments:
     parser = argparse.ArgumentParser(description=description,
@@ -330,6 +1575,11 @@ if __name__ == '__main__':
                         action='store_false',
                         dest='doFork',
                         default=True)
+    parser.add_argument('--fakeFfmpeg',
+                        help="Use the fake ffmpeg stand-in, for load testing without real media. The speed and "
+                             "failure rate are set with the FAKE_FFMPEG_* environment variables, see FakeFfmpeg.py.",
+                        action='store_true',
+                        default=False)
     parser.add_argument('--configFile',
                         help="The full path to the config file.",
                         type=str)
@@ -355,6 +1605,69 @@ if __name__ == '__main__':
                         help='This daemon instance hosts the files. IE: Is the NFS server.',
                         action='store_true',
                         default=None)
+    parser.add_argument('--stagingBudget',
+                        help="The max number of MB of chunks to stage in the local working directory.",
+                        type=int)
+    parser.add_argument('--pinSlots',
+                        help="Pin each encode slot to its own CPUs, on a single NUMA node.",
+                        action=argparse.BooleanOptionalAction,
+                        default=None)
+    parser.add_argument('--encodeNice',
+                        help="The niceness to add to encodes, -20 to 19.",
+                        type=int)
+    parser.add_argument('--encodeIoPriority',
+                        help="The best-effort I/O priority of encodes, 0 (highest) to 7 (lowest).",
+                        type=int)
+    parser.add_argument('--splitIoPriority',
+                        help="The best-effort I/O priority of splits, combines, and chunk copies, 0 (highest) to 7 "
+                             "(lowest).",
+                        type=int)
+    parser.add_argument('--cgroupPath',
+                        help="A delegated cgroup v2 directory to create a group per encode slot in, '' for none.",
+                        type=str)
+    parser.add_argument('--slotCpuPercent',
+                        help="The CPU limit of each encode slot's cgroup, as a percent of one CPU, 0 for no limit.",
+                        type=int)
+    parser.add_argument('--slotMemoryLimit',
+                        help="The memory limit in MB of each encode slot's cgroup, 0 for no limit.",
+                        type=int)
+    parser.add_argument('--minFreeMemory',
+                        help="Refuse work while less than this many MB of memory is available, 0 to not check.",
+                        type=int)
+    parser.add_argument('--maxLoadPercent',
+                        help="Refuse work while the 1 minute load average is over this percent of the CPUs, 0 to not "
+                             "check.",
+                        type=int)
+    parser.add_argument('--minFreeDisk',
+                        help="Refuse work while less than this many MB are free in the working directories, 0 to not "
+                             "check.",
+                        type=int)
+    parser.add_argument('--sharedQuota',
+                        help="The max number of MB in the shared working directory's Input / Output, on the file host; "
+                             "the oldest files no job needs are evicted. 0 for no quota.",
+                        type=int)
+    parser.add_argument('--jobExpiry',
+                        help="Hours after its last use that a job's working files can be evicted to keep within the "
+                             "quota.",
+                        type=int)
+    parser.add_argument('--commandWorkers',
+                        help="The max number of long commands, IE: split, encode, and combine, running at once; More "
+                             "are refused as busy.",
+                        type=int)
+    parser.add_argument('--watchFolder',
+                        help="A folder in the shared working directory, relative to it, to watch for new sources on "
+                             "the file host; A controller takes them with 'ingest'. Can be given more than once, "
+                             "replacing the config's.",
+                        action='append',
+                        dest='watchFolders')
+    parser.add_argument('--watchSettleTime',
+                        help="Seconds a watched file's size must be unchanged, and not open for writing, before it's "
+                             "ingested.",
+                        type=int)
+    parser.add_argument('--watchPollInterval',
+                        help="Seconds between scans of the watch folders, 0 to use inotify, scanning only if it isn't "
+                             "available; Scan when other machines write to the folders over NFS.",
+                        type=int)
     parser.add_argument('--saveConfig',
                         help="Save the options to the config file and exit.",
                         action='store_true',
@@ -386,8 +1699,7 @@ if __name__ == '__main__':
     if common.DEBUG:
         log_level = logging.DEBUG
     log_path = os.path.join(working_dir_path, LOG_FILENAME)
-    logging.basicConfig(filename=log_path, level=log_level)
-    common.LOGGER = logging.getLogger(__name__)
+    common.setup_logging(log_path, log_level)
     out_debug("Logging started.")
 
     # Set the default config file path, and select the config file path to use:
@@ -482,6 +1794,63 @@ if __name__ == '__main__':
             out_error(e.args[0])
             exit(13)
 
+    if _args.stagingBudget is not None:  # Local staging budget:
+        try:
+            common.config.staging_budget = _args.stagingBudget
+        except (TypeError, ValueError) as e:
+            out_error(e.args[0])
+            exit(24)
+
+    # Process limits:
+    for _arg_value, _attribute in ((_args.pinSlots, 'pin_slots'), (_args.encodeNice, 'encode_nice'),
+                                   (_args.encodeIoPriority, 'encode_io_priority'),
+                                   (_args.splitIoPriority, 'split_io_priority'), (_args.cgroupPath, 'cgroup_path'),
+                                   (_args.slotCpuPercent, 'slot_cpu_percent'),
+                                   (_args.slotMemoryLimit, 'slot_memory_limit')):
+        if _arg_value is not None:
+            try:
+                setattr(common.config, _attribute, _arg_value)
+            except (TypeError, ValueError) as e:
+                out_error(e.args[0])
+                exit(25)
+
+    # Admission control:
+    for _arg_value, _attribute in ((_args.minFreeMemory, 'min_free_memory'), (_args.maxLoadPercent, 'max_load_percent'),
+                                   (_args.minFreeDisk, 'min_free_disk')):
+        if _arg_value is not None:
+            try:
+                setattr(common.config, _attribute, _arg_value)
+            except (TypeError, ValueError) as e:
+                out_error(e.args[0])
+                exit(26)
+
+    # Working directory quota:
+    for _arg_value, _attribute in ((_args.sharedQuota, 'shared_quota'), (_args.jobExpiry, 'job_expiry')):
+        if _arg_value is not None:
+            try:
+                setattr(common.config, _attribute, _arg_value)
+            except (TypeError, ValueError) as e:
+                out_error(e.args[0])
+                exit(27)
+
+    # Command workers:
+    if _args.commandWorkers is not None:
+        try:
+            common.config.command_workers = _args.commandWorkers
+        except (TypeError, ValueError) as e:
+            out_error(e.args[0])
+            exit(28)
+
+    # Watch folders:
+    for _arg_value, _attribute in ((_args.watchFolders, 'watch_folders'), (_args.watchSettleTime, 'watch_settle_time'),
+                                   (_args.watchPollInterval, 'watch_poll_interval')):
+        if _arg_value is not None:
+            try:
+                setattr(common.config, _attribute, _arg_value)
+            except (TypeError, ValueError) as e:
+                out_error(e.args[0])
+                exit(29)
+
     # If --saveConfig is selected, save config and exit:
     if _args.saveConfig is True:
         out_info("Saving config, and exiting.")
@@ -495,11 +1864,17 @@ if __name__ == '__main__':
 
     # Find ffmpeg, and setup cli object:
     out_info("Locating ffmpeg.")
-    ffmpeg_path = shutil.which('ffmpeg')
+    ffmpeg_path, ffprobe_path = find_ffmpeg(True if _args.fakeFfmpeg else None)
     if ffmpeg_path is None:
         out_error("Unable to find ffmpeg.")
         exit(15)
-    common.ffmpeg_cli = Ffmpegcli(ffmpeg_path)
+    if ffmpeg_path == FAKE_FFMPEG_PATH:
+        out_warning("Using the fake ffmpeg, nothing will really be encoded.")
+    common.ffmpeg_cli = Ffmpegcli(ffmpeg_path, ffprobe_path)
+    # Splits, combines, and copies run at a lower I/O priority than encodes, so they don't starve them:
+    common.ffmpeg_cli.split_limits = ProcessLimits(io_priority=common.config.split_io_priority)
+    common.ffmpeg_cli.encode_limits = ProcessLimits(nice=common.config.encode_nice,
+                                                    io_priority=common.config.encode_io_priority)
 
     # Setup local working directory:
     out_info("Checking local working directory...")
@@ -547,30 +1922,96 @@ if __name__ == '__main__':
                 out_error("Failed to create shared output directory: %s[%d]" % (e.strerror, e.errno))
                 exit(19)
 
+    # If file host, find or create the watch folders; They can't be in Input / Output, which are swept:
+    _watch_paths: list[str] = []
+    if common.config.is_file_host:
+        for _folder in common.config.watch_folders:
+            _watch_path: str = os.path.realpath(os.path.join(common.config.shared_working_dir, _folder))
+            _relative_path: str = os.path.relpath(_watch_path, os.path.realpath(common.config.shared_working_dir))
+            if _relative_path == '.' or _relative_path.startswith('..') or \
+                    _relative_path.split(os.sep)[0] in ('Input', 'Output'):
+                out_error("Watch folder '%s' must be in the shared working directory, outside Input, and Output." %
+                          _folder)
+                exit(29)
+            try:
+                os.makedirs(_watch_path, exist_ok=True)
+            except OSError as e:
+                out_error("Failed to create watch folder '%s': %s[%d]" % (_folder, e.strerror, e.errno))
+                exit(29)
+            _watch_paths.append(_watch_path)
+
     # Create listener
     out_info("Connecting to socket.")
     passwd: bytes = common.config.shared_secret.encode()
     try:
-        common.listener = Listener((common.config.host, common.config.port), authkey=passwd)
+        common.listener = Listener((common.config.host, common.config.port), backlog=LISTEN_BACKLOG, authkey=passwd)
     except OSError as e:
         out_error("Failed to bind to socket: %s[%d]." % (e.strerror, e.errno))
         exit(20)
     out_info("Connected.")
+    # Tag spans with the port too, so several daemons on one machine show as separate processes in a trace:
+    tracer.host = '%s:%i' % (tracer.host, common.config.port)
 
     # Fork if requested:
     if _args.doFork is True:
         out_info("Detaching from terminal")
+        common.stop_logging()  # The log thread doesn't survive the fork.
         try:
             pid = os.fork()
             if pid == 0:  # Child process:
                 os.setsid()  # Set new session
                 os.chdir(working_dir_path)  # Make sure the working dir is set.
+                common.IS_DAEMON = True
+                common.start_logging()
             else:  # Parent process:
                 os._exit(0)  # Exit parent.
         except OSError as e:
+            common.start_logging()
             out_error("Got error while trying to fork: %s[%d]" % (e.strerror, e.errno))
             exit(23)
 
+    # Check the node's load before accepting work:
+    common.admission = AdmissionControl(
+        min_free_memory=common.config.min_free_memory * 1024 * 1024,
+        max_load_percent=common.config.max_load_percent,
+        min_free_disk=common.config.min_free_disk * 1024 * 1024,
+        paths=[common.config.local_working_dir, common.config.shared_working_dir],
+    )
+
+    # Track the working files, and sweep leftovers; The shared directory is only managed by the file host:
+    _work_dirs: list[WorkDir] = [WorkDir(common.config.local_working_dir, 0, True)]
+    if common.config.is_file_host:
+        _work_dirs.append(WorkDir(common.config.shared_working_dir, common.config.shared_quota * 1024 * 1024, False))
+    common.work_dirs = WorkDirManager(os.path.join(working_dir_path, WORK_FILES_FILENAME), _work_dirs,
+                                      common.config.job_expiry * 3600.0)
+    common.work_dirs.start()
+
+    # Start the encode slots, this must be after forking:
+    out_info("Starting %i encode slots." % common.config.num_chunks)
+    common.scheduler = Scheduler(
+        ffmpeg_cli=common.ffmpeg_cli,
+        num_slots=common.config.num_chunks,
+        staging_budget=common.config.staging_budget * 1024 * 1024,
+        local_input_dir=local_input_path,
+        local_output_dir=local_output_path,
+        slot_limits=build_slot_limits(common.config.num_chunks),
+        copy_io_priority=common.config.split_io_priority,
+        admission=common.admission,
+        work_dirs=common.work_dirs,
+    )
+    common.scheduler.start()
+
+    # Watch for new sources, after forking, as the watcher is a thread:
+    if len(_watch_paths) > 0:
+        common.ingest_queue = IngestQueue()
+        common.watcher = FolderWatcher(_watch_paths, common.config.watch_settle_time,
+                                       common.config.watch_poll_interval, common.ingest_queue, common.to_shared_path)
+        common.watcher.start()
+
+    # Compile the command table, and start the pool long commands run on:
+    common.commands = build_command_registry()
+    common.command_pool = CommandPool(common.config.command_workers)
+
     # Run main:
     try:
         main()
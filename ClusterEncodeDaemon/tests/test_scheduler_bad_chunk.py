@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+    File: test_scheduler_bad_chunk.py
+    Description: A chunk whose encode can't be built, IE: an inverted range, must fail that chunk, and leave its slot
+        running for the next one, instead of killing the slot thread with the chunk stuck 'encoding'. And a finished
+        job's id must be free once it's reported finished, as the controller sends its next batch under the same id.
+"""
+import os
+import sys
+import tempfile
+import unittest
+from datetime import timedelta
+from threading import Event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Scheduler import Scheduler, Job
+from ffmpegCli import Ffmpegcli, AudioEncoders, VideoEncoders
+from ffmpegCli.Ffmpegcli import FAKE_FFMPEG_PATH
+from ffmpegCli.FakeFfmpeg import make_fake_media
+
+JOB_TIMEOUT: float = 30.0
+"""Seconds to wait for a job to finish."""
+
+
+class BadChunkTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.input_path: str = os.path.join(self.temp_dir.name, 'source.mkv')
+        make_fake_media(self.input_path, 20.0)
+        self.scheduler = Scheduler(Ffmpegcli(FAKE_FFMPEG_PATH, FAKE_FFMPEG_PATH), 1, 0, self.temp_dir.name,
+                                   self.temp_dir.name)
+        self.scheduler.start()
+        return
+
+    def tearDown(self) -> None:
+        self.scheduler.stop()
+        self.temp_dir.cleanup()
+        return
+
+    def make_job(self, job_id: str, start_time: timedelta, end_time: timedelta) -> Job:
+        job = Job(job_id, {'audio_encoder': AudioEncoders.COPY, 'down_mix_audio': False, 'boost_volume': 0,
+                           'video_encoder': VideoEncoders.X264, 'scale_video': None}, False)
+        job.add_chunk(self.input_path, os.path.join(self.temp_dir.name, job_id + '.mkv'), start_time, end_time)
+        return job
+
+    def test_inverted_range_fails_the_chunk_not_the_slot(self) -> None:
+        bad_job = self.make_job('bad', timedelta(seconds=10), timedelta(seconds=5))
+        self.assertTrue(self.scheduler.submit(bad_job))
+        self.assertTrue(bad_job.finished.wait(JOB_TIMEOUT))
+        self.assertEqual(bad_job.chunks[0].state, 'failed')
+
+        # The slot is still there to encode the next job:
+        good_job = self.make_job('good', timedelta(seconds=0), timedelta(seconds=1))
+        self.assertTrue(self.scheduler.submit(good_job))
+        self.assertTrue(good_job.finished.wait(JOB_TIMEOUT))
+        self.assertTrue(good_job.success)
+        return
+
+    def test_job_id_is_free_once_finished(self) -> None:
+        next_job = self.make_job('batches', timedelta(seconds=1), timedelta(seconds=2))
+        resubmitted: list[bool] = []
+
+        class _SubmitOnFinished(Event):
+            """Submits the next batch the moment the job is reported finished, as the controller may."""
+            def set(event) -> None:
+                resubmitted.append(self.scheduler.submit(next_job))
+                super().set()
+                return
+
+        job = self.make_job('batches', timedelta(seconds=0), timedelta(seconds=1))
+        job.finished = _SubmitOnFinished()
+        self.assertTrue(self.scheduler.submit(job))
+        self.assertTrue(job.finished.wait(JOB_TIMEOUT))
+        self.assertEqual(resubmitted, [True])
+        self.assertTrue(next_job.finished.wait(JOB_TIMEOUT))
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+    File: test_scheduler_resplit.py
+    Description: Splitting ranged chunks into sub-parts: Every part's name must be unique, and the names must sort in
+        the order of the source, as combine orders the parts by name.
+"""
+import os
+import sys
+import tempfile
+import unittest
+from datetime import timedelta
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Scheduler import Scheduler, Job
+from ffmpegCli import Ffmpegcli
+
+
+class _FakeCli(object):
+    """
+    The parts of Ffmpegcli the re-split uses: No keyframes, so ranges are cut evenly, and a fixed encoded length.
+    """
+    def __init__(self, encoded_length: timedelta) -> None:
+        self.encoded_length: timedelta = encoded_length
+        return
+
+    def get_keyframes(self, *_args) -> Optional[list[timedelta]]:
+        return None
+
+    def get_duration(self, _path: str) -> Optional[timedelta]:
+        return self.encoded_length
+
+
+class ResplitTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cli = _FakeCli(timedelta(seconds=10))
+        self.scheduler = Scheduler(self.cli, 2, 0, self.temp_dir.name, self.temp_dir.name)
+        self.job = Job('job', {}, False)
+        self.output_dir: str = os.path.join(self.temp_dir.name, 'Output')
+        return
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+        return
+
+    def assert_parts_in_order(self) -> None:
+        names = [os.path.basename(chunk.output_path) for chunk in self.job.chunks]
+        self.assertEqual(len(names), len(set(names)), "Duplicate part names: %s" % names)
+        by_name = sorted(self.job.chunks,
+                         key=lambda chunk: Ffmpegcli.part_sort_key(os.path.basename(chunk.output_path)))
+        self.assertEqual([chunk.start_time for chunk in by_name], sorted(chunk.start_time for chunk in self.job.chunks))
+        for previous, chunk in zip(by_name, by_name[1:]):
+            self.assertEqual(previous.end_time, chunk.start_time)
+        return
+
+    def test_split_chunk_is_not_split_again(self) -> None:
+        chunk = self.job.add_chunk('source.mkv', os.path.join(self.output_dir, 'Part.0.source.mkv'),
+                                   timedelta(seconds=0), timedelta(seconds=300))
+        self.scheduler._idle_slots = 3
+        self.scheduler.split_pending(chunk)
+        self.assertEqual(len(self.job.chunks), 4)
+        self.assertTrue(chunk.was_split)
+
+        # Split off while queued, then running long enough to be worth re-splitting:
+        chunk.state = 'encoding'
+        chunk.current_time = timedelta(seconds=0)
+        chunk.speed = '0.5x'
+        self.assertIsNone(self.job.find_resplit_candidate())
+        self.scheduler.split_pending(chunk)
+        self.assertEqual(len(self.job.chunks), 4)
+
+        # A sub-part can still be re-split, its tail sorts between it and the next sub-part:
+        sub_chunk = self.job.chunks[1]
+        sub_chunk.state = 'encoding'
+        sub_chunk.current_time = timedelta(seconds=0)
+        sub_chunk.speed = '0.5x'
+        sub_chunk.job.pending.clear()
+        self.assertIs(self.job.find_resplit_candidate(), sub_chunk)
+        sub_chunk.resplit_parts = 2
+        self.assertTrue(self.scheduler.resplit(sub_chunk, sub_chunk.output_path))
+        self.assertEqual(len(self.job.chunks), 6)
+        self.assert_parts_in_order()
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+    File: test_staging_upload.py
+    Description: Uploading local outputs: The local file is removed whether the upload succeeds or fails, as its size
+        is released from the staging budget either way, and a failed upload leaves no partial copy.
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Staging import StagingBudget, UploadThread
+
+UPLOAD_TIMEOUT: float = 10.0
+"""Seconds to wait for the uploads to finish."""
+
+
+class UploadTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.budget = StagingBudget(0)
+        self.uploader = UploadThread(self.budget)
+        self.uploader.start()
+        self.results: list[bool] = []
+        return
+
+    def tearDown(self) -> None:
+        self.uploader.stop()
+        self.uploader.join(UPLOAD_TIMEOUT)
+        self.temp_dir.cleanup()
+        return
+
+    def upload(self, shared_path: str) -> str:
+        local_path = os.path.join(self.temp_dir.name, 'Part.0.mkv')
+        with open(local_path, 'wb') as file_handle:
+            file_handle.write(b'\0' * 4096)
+        self.uploader.upload(local_path, shared_path, self.results.append)
+        self.assertTrue(self.uploader.wait_idle(UPLOAD_TIMEOUT))
+        return local_path
+
+    def test_uploaded_output_is_removed(self) -> None:
+        shared_path = os.path.join(self.temp_dir.name, 'Shared.mkv')
+        local_path = self.upload(shared_path)
+        self.assertEqual(self.results, [True])
+        self.assertFalse(os.path.exists(local_path))
+        self.assertEqual(os.path.getsize(shared_path), 4096)
+        self.assertEqual(self.budget.used_bytes, 0)
+        return
+
+    def test_failed_upload_removes_the_local_output(self) -> None:
+        shared_path = os.path.join(self.temp_dir.name, 'Missing', 'Shared.mkv')
+        local_path = self.upload(shared_path)
+        self.assertEqual(self.results, [False])
+        self.assertFalse(os.path.exists(local_path))
+        self.assertFalse(os.path.exists(shared_path + '.part'))
+        self.assertEqual(self.budget.used_bytes, 0)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@
 import ipaddress
 import sys
 import json
+import time
 from typing import Any, Final, Optional
 from gi.repository import Gtk
 from multiprocessing.connection import Client, Connection
@@ -16,6 +17,12 @@ from ffmpegCli.Ffmpegcli import Ffmpegcli
 
 # Constants:
 __version__: Final[str] = '1.0.0'
+BUSY_ERROR: Final[int] = 80
+"""The error number a daemon replies with when it's too busy to accept work."""
+BUSY_MAX_RETRIES: Final[int] = 10
+"""The number of times to retry a command a daemon was too busy for."""
+BUSY_DEFAULT_RETRY_AFTER: Final[float] = 30.0
+"""Seconds to wait before retrying a busy daemon that didn't say how long to wait."""
 
 
 # Common variables:
@@ -257,26 +264,60 @@ def get_host_status(host_name: str) -> Optional[dict[str, Any]]:
     response_obj: dict[str, Any] = connection.recv()
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+def send_command(connection: Connection, command_obj: dict[str, Any],
+                 max_retries: int = BUSY_MAX_RETRIES) -> dict[str, Any]:
+    """
+    Send a command and receive the first response. If the daemon replies that it's busy (error 80), wait the
+    'retryAfter' it gives, and send the command again, up to max_retries times.
+    :param connection: Connection: The connection to the daemon.
+    :param command_obj: dict[str, Any]: The command object.
+    :param max_retries: int = BUSY_MAX_RETRIES: The number of times to retry a busy daemon.
+    :return: dict[str, Any]: The first response that isn't a busy error, or the last busy error if the retries ran
+    out.
+    """
+    retries: int = 0
+    while True:
+        connection.send(command_obj)
+        response_obj: dict[str, Any] = connection.recv()
+        if response_obj.get('status') != 'error' or response_obj['error']['number'] != BUSY_ERROR:
+            return response_obj
+        if retries >= max_retries:
+            return response_obj
+        retries += 1
+        time.sleep(response_obj['error'].get('retryAfter', BUSY_DEFAULT_RETRY_AFTER))
+
+
+def export_trace(file_path: str, job_id: Optional[str] = None, clear: bool = False) -> int:
+    """
+    Collect the traced spans from each connected daemon, and save them as a single Chrome trace-event JSON file. Each
+    daemon's events are shifted by its clock's offset from ours, estimated from the time it reports against the
+    midpoint of the round trip.
+    :param file_path: str: The full path to the file to save.
+    :param job_id: Optional[str] = None: Only export this job's spans, None for all of them.
+    :param clear: bool = False: True to drop the exported spans on the daemons.
+    :return: int: The number of daemons the trace was collected from.
+    """
+    command_obj: dict[str, Any] = {
+        'version': '1.0.0',
+        'command': 'trace',
+        'jobId': job_id,
+        'clear': clear,
+    }
+    trace_events: list[dict[str, Any]] = []
+    num_hosts: int = 0
+    for _host_name, connection in open_connections:
+        if connection.closed:
+            continue
+        sent_time: float = time.time()
+        response_obj: dict[str, Any] = send_command(connection, command_obj)
+        if response_obj.get('status') != 'trace':
+            continue
+        offset_us: int = int((response_obj['time'] - (sent_time + time.time()) / 2) * 1000000)
+        for event in response_obj['traceEvents']:
+            if 'ts' in event.keys():
+                event['ts'] -= offset_us
+            trace_events.append(event)
+        num_hosts += 1
+    with open(file_path, 'w') as file_handle:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, file_handle)
+    return num_hosts
@@ -5,7 +5,6 @@
 import argparse
 import json
 import os
-import shutil
 import sys
 from typing import Final, Optional
 
@@ -16,7 +15,7 @@ from gi.repository import Gtk
 
 # Include my libs:
 sys.path.append('../')
-from ffmpegCli.Ffmpegcli import Ffmpegcli
+from ffmpegCli.Ffmpegcli import Ffmpegcli, find_ffmpeg
 import common
 from SignalHandlers import SignalHandlers
 
@@ -138,11 +137,11 @@ if __name__ == '__main__':
         common.save_config()  # Exit's 10 on failure.
 
     # Find ffmpeg path, and set common ffmpeg instance:
-    ffmpeg_path: str = shutil.which('ffmpeg')
+    ffmpeg_path, ffprobe_path = find_ffmpeg()
     if ffmpeg_path is None:
         print("ffmpeg not installed. Please install with 'sudo apt install ffmpeg'.")
         exit(11)
-    common.ffpmeg_cli = Ffmpegcli(ffmpeg_path)
+    common.ffpmeg_cli = Ffmpegcli(ffmpeg_path, ffprobe_path)
 
     # Connect GUI signals:
     common.builder.connect_signals(SignalHandlers())
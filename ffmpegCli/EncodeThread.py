@@ -2,12 +2,21 @@
 """
     File: EncodeThread.py
 """
-import os.path
+import io
+import os
+import signal
 from datetime import timedelta
-from threading import Thread
+from queue import Queue
 import subprocess
 from enum import Enum
-from typing import Optional, Callable
+from typing import Optional, Callable, Final, IO
+
+try:
+    from Supervisor import Supervisor, SupervisedProcess
+    from ProcessLimits import ProcessLimits
+except ModuleNotFoundError:
+    from .Supervisor import Supervisor, SupervisedProcess
+    from .ProcessLimits import ProcessLimits
 
 
 class AudioEncoders(Enum):
@@ -34,9 +43,15 @@ class VideoEncoders(Enum):
     """Encode video with X265."""
 
 
-class EncodeThread(Thread):
+STREAM_READ_SIZE: Final[int] = 1024 * 1024
+"""The number of bytes to read from ffmpeg's stdout at a time when streaming the output."""
+PASS_STATS_SUFFIX: Final[str] = '-0.log'
+"""Appended to the pass log prefix for the statistics file, as ffmpeg names it for the first output stream."""
+
+
+class EncodeThread(SupervisedProcess):
     """
-    Thread to watch a single ffmpeg encode process.
+    A single ffmpeg encode process. It runs on the supervisor, but keeps the start() / join() interface of a thread.
     """
     def __init__(self,
                  ffmpeg_path: str,
@@ -48,12 +63,25 @@ class EncodeThread(Thread):
                  video_encoder: VideoEncoders,
                  scale_video: Optional[dict[str, int]],
                  callback: Callable,
+                 report_delay: float = 0.5,
+                 start_time: Optional[timedelta] = None,
+                 end_time: Optional[timedelta] = None,
+                 total_time: Optional[timedelta] = None,
+                 input_queue: Optional[Queue] = None,
+                 output_format: Optional[str] = None,
+                 supervisor: Optional[Supervisor] = None,
+                 limits: Optional[ProcessLimits] = None,
+                 no_video: bool = False,
+                 bit_rate: Optional[int] = None,
+                 rate_pass: Optional[int] = None,
+                 pass_log: Optional[str] = None,
+                 renditions: Optional[list[tuple[str, Optional[dict[str, int]], Optional[int]]]] = None,
                  ) -> None:
         """
         Initialize the encoder thread.
         :param ffmpeg_path: str: The full path to ffmpeg.
         :param input_path: str: The full path to the video to encode.
-        :param output_path: str: The full path to the directory to output in.
+        :param output_path: str: The full path to the output file.
         :param audio_encoder: AudioEncoders: One of the enum of the audio encoders. NOTE: If this is COPY, then the
         down_mix_audio parameter is ignored.
         :param down_mix_audio: bool: True down mix the audio to stereo, False keep the original channels.
@@ -64,9 +92,47 @@ class EncodeThread(Thread):
         the keys 'width', 'height', and 'direction'; Width and height values an int for the number of pixels; And
         'direction' is either 'UP' or 'DOWN'.
         IE: {'width': 640, 'width': 480}
-        :param callback: Callable: The callback to call with the status.
+        :param callback: Callable: The callback to call with the status. The callback signature should be:
+        (report_type: str, *args). If 'report_type' == 'report', then *args is: [current_time: timedelta,
+        current_frame: Optional[int], fps: Optional[float], bit_rate: Optional[str], speed: Optional[str],
+        percent_complete: Optional[float]]; Otherwise, if 'report_type' == 'data', then *args is: [data: bytes], a block
+        of the encoded output, only sent when output_format is set, from a separate thread; Once ffmpeg has exited,
+        'report_type' == 'finished', and *args is: [success: bool].
+        :param report_delay: float = 0.5: The amount of time in seconds to wait between reporting.
+        :param start_time: Optional[timedelta] = None: Where in the input to start encoding. If set, ffmpeg seeks the
+        input directly (input side seek), so the encode starts from the keyframe at or before this point, and only
+        the frames from this point on are output. None starts at the beginning of the input.
+        :param end_time: Optional[timedelta] = None: Where in the input to stop encoding. None encodes to the end of
+        the input.
+        :param total_time: Optional[timedelta] = None: The length of the input. If start_time / end_time are given,
+        this is calculated from them when possible. If not known, percent complete won't be calculated.
+        :param input_queue: Optional[Queue] = None: If set, the input is read from this queue instead of input_path,
+        and fed to ffmpeg's stdin. The queue items are bytes, and an empty bytes object marks the end of the input. The
+        queue should be bounded, so a slow encode blocks the producer instead of buffering the whole input in memory.
+        The input must be in a streamable format, IE: mkv or mpegts, not mp4 with the index at the end.
+        :param output_format: Optional[str] = None: If set, the output is written to ffmpeg's stdout in this format,
+        IE: 'matroska', and passed to the callback as 'data' reports; output_path then only identifies the encode.
+        :param supervisor: Optional[Supervisor] = None: The supervisor to run ffmpeg on, None for the shared one.
+        :param limits: Optional[ProcessLimits] = None: The CPU / priority / cgroup limits to start ffmpeg with.
+        :param no_video: bool = False: True output every stream but the video: All the audio, encoded, and the rest,
+        IE: subtitles, attachments, and attached pictures, copied; For muxing with video only chunks when combining.
+        The down mix only applies to the first audio stream, the others may not be 5.1. video_encoder and scale_video
+        are ignored.
+        :param bit_rate: Optional[int] = None: The video bit rate to target in kbit/s, None for the encoder's default
+        constant quality.
+        :param rate_pass: Optional[int] = None: 1 or 2 to run that pass of a two pass encode, None for one pass. The
+        first pass only writes the rate control statistics to pass_log, it skips the audio and muxes to ffmpeg's
+        null format, so output_path only identifies the encode. The second uses them to spend bit_rate where the video
+        needs it. Only libx264 and libx265 can.
+        :param pass_log: Optional[str] = None: The path prefix of the pass statistics files, required for rate_pass;
+        See Ffmpegcli.pass_stats_path().
+        :param renditions: Optional[list[tuple[str, Optional[dict[str, int]], Optional[int]]]] = None: More outputs
+        of the same encode, IE: the rungs of an adaptive bit rate ladder, as (output_path, scale_video, bit_rate)
+        tuples. The input is decoded once, and its video split to an encoder per output; Each output gets all the
+        audio, encoded. output_path, scale_video, and bit_rate are the first output. Not with no_video, output_format,
+        or rate_pass.
         """
-        super().__init__(daemon=True)
+        super().__init__(report_delay, supervisor, limits)
         self._ffmpeg_path: str = ffmpeg_path
         self._input_path: str = input_path
         self._output_path: str = output_path
@@ -75,53 +141,286 @@ class EncodeThread(Thread):
         self._boost_volume: int = boost_volume
         self._video_encoder: VideoEncoders = video_encoder
         self._scale_video: Optional[dict[str, int]] = scale_video
+        self._input_queue: Optional[Queue] = input_queue
+        self._output_format: Optional[str] = output_format
+        self._no_video: bool = no_video
+        self._bit_rate_target: Optional[int] = bit_rate
+        self._rate_pass: Optional[int] = rate_pass
+        self._pass_log: Optional[str] = pass_log
+        if rate_pass is not None:
+            if rate_pass not in (1, 2):
+                raise ValueError("rate_pass must be 1 or 2.")
+            if video_encoder not in (VideoEncoders.X264, VideoEncoders.X265) or no_video:
+                raise ValueError("Only libx264 and libx265 can encode in two passes.")
+            if pass_log is None or bit_rate is None:
+                raise ValueError("rate_pass needs pass_log and bit_rate.")
+        self._renditions: list[tuple[str, Optional[dict[str, int]], Optional[int]]] = renditions or []
+        if len(self._renditions) > 0:
+            if video_encoder == VideoEncoders.COPY or no_video or output_format is not None or rate_pass is not None:
+                raise ValueError("renditions need a video encoder, and a single pass to an output file.")
+        self._callback: Callable = callback
+        self._start_time: Optional[timedelta] = start_time
+        self._end_time: Optional[timedelta] = end_time
+        if start_time is not None and end_time is not None and end_time <= start_time:
+            raise ValueError("end_time must be after start_time.")
+        # Calculate the length of the range we're encoding:
+        self._total_time: Optional[timedelta] = total_time
+        if end_time is not None:
+            self._total_time = end_time - (start_time or timedelta(seconds=0))
+        elif start_time is not None and total_time is not None:
+            self._total_time = total_time - start_time
         # Properties:
         self._current_frame: Optional[int] = None  # Will be None if video_encoder = copy
         self._fps: Optional[float] = None  # Will be None if video_encoder = copy
         self._bit_rate: Optional[str] = None  # Will be None until encoding starts.
         self._current_time: Optional[timedelta] = None  # Will be None until encoding starts.
         self._speed: Optional[str] = None  # Will be None until encoding starts.
+        self._percent_complete: Optional[float] = None  # Will be None if the total time is unknown.
+        self._terminated: bool = False  # True if terminate() was called.
+        self._stopped: bool = False  # True if stop() was called.
         return
 
-    def run(self) -> None:
+    def stop(self) -> None:
         """
-        Start the encoding process.
+        Stop the encode early, but gracefully; ffmpeg finishes writing the output up to the current position, and the
+        encode reports as successful. Use get_duration() on the output to find where it stopped.
         :return: None
         """
-        # ffmpeg -i job-id_1.mp4 -c:v copy -c:a copy job-id_1_done.mkv
-        command_line = [self._ffmpeg_path, '-y', '-hide_banner', '-progress', '-', '-i', self._input_path,]
-        # Add video encoding options:
-        command_line.extend(['-c:v', self._video_encoder.value,])
-        if self._video_encoder != VideoEncoders.COPY:
-            if self._scale_video is not None:
-                scale_filter: str
-                if self._scale_video['direction'] == 'UP':
-                    scale_filter = ':flags=lanczos'
-                elif self._scale_video['direction'] == 'DOWN':
-                    scale_filter = ':flags=bicubic'
-                else:
-                    raise RuntimeError("Invalid scale direction.")
-                scale_size = "scale=%ix%i" % (self._scale_video['width'], self._scale_video['height'])
-                video_filter = scale_size + scale_filter
-                command_line.extend(['-vf', video_filter])
-
-        # Add audio encoding options.
+        self._stopped = True
+        if self._process is not None and self._process.poll() is None:
+            self._process.send_signal(signal.SIGINT)
+        return
+
+    def terminate(self) -> None:
+        """
+        Stop the encode, killing ffmpeg if it's running. The encode then reports as failed.
+        :return: None
+        """
+        self._terminated = True
+        self.kill()
+        return
+
+    def _build_input_options(self) -> list[str]:
+        """
+        Build the input options, seeking the input directly if a time range is set.
+        :return: list[str]: The input part of the command line.
+        """
+        input_options: list[str] = []
+        # Input side seeking; ffmpeg seeks to the keyframe at or before start_time instead of decoding everything
+        # up to it. Using -t rather than -to keeps the end correct, since timestamps are reset by the seek.
+        if self._start_time is not None:
+            input_options.extend(['-ss', str(self._start_time.total_seconds())])
+        if self._end_time is not None:
+            duration = self._end_time - (self._start_time or timedelta(seconds=0))
+            input_options.extend(['-t', str(duration.total_seconds())])
+        if self._input_queue is not None:
+            input_options.extend(['-i', 'pipe:0'])
+        else:
+            input_options.extend(['-i', self._input_path])
+        return input_options
+
+    def _feed_input(self, stdin: io.BufferedWriter) -> None:
+        """
+        Write the blocks from the input queue to ffmpeg's stdin until the end of input marker.
+        :param stdin: io.BufferedWriter: ffmpeg's stdin.
+        :return: None
+        """
+        broken: bool = False
+        while True:
+            data: bytes = self._input_queue.get()
+            if data == b'':
+                break
+            if broken:  # Keep draining so the producer doesn't block forever.
+                continue
+            try:
+                stdin.write(data)
+            except (BrokenPipeError, ValueError):  # ffmpeg exited early.
+                broken = True
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+        return
+
+    def _read_output(self, stdout: io.BufferedReader) -> None:
+        """
+        Read the encoded output from ffmpeg's stdout, and pass it to the callback.
+        :param stdout: io.BufferedReader: ffmpeg's stdout.
+        :return: None
+        """
+        while True:
+            data: bytes = stdout.read1(STREAM_READ_SIZE)
+            if data == b'':  # EOF
+                break
+            self._callback('data', data)
+        return
+
+    def handle_progress(self, key: str, value: str) -> None:
+        """
+        Handle a line of ffmpeg's -progress output, and update the properties.
+        :param key: str: The progress key.
+        :param value: str: The progress value.
+        :return: None
+        """
+        if value == 'N/A':
+            return
+        if key == 'frame':
+            self._current_frame = int(value)
+        elif key == 'fps':
+            self._fps = float(value)
+        elif key == 'bitrate':
+            self._bit_rate = value
+        elif key == 'out_time_us':
+            self._current_time = timedelta(microseconds=int(value))
+            if self._total_time:
+                self._percent_complete = min((self._current_time / self._total_time) * 100.0, 100.0)
+        elif key == 'speed':
+            self._speed = value
+        return
+
+    def handle_report(self) -> None:
+        """
+        Report the progress.
+        :return: None
+        """
+        self._callback('report', self._current_time, self._current_frame, self._fps, self._bit_rate, self._speed,
+                       self._percent_complete)
+        return
+
+    def handle_finished(self) -> None:
+        """
+        Report the encode is finished.
+        :return: None
+        """
+        self._callback('finished', self.success)
+        return
+
+    @staticmethod
+    def _scale_filter(scale_video: dict[str, int]) -> str:
+        """
+        Build the scale filter of the scale options.
+        :param scale_video: dict[str, int]: The scale options, see __init__().
+        :return: str: The filter, IE: 'scale=1280x720:flags=bicubic'.
+        """
+        scale_filter: str
+        if scale_video['direction'] == 'UP':
+            scale_filter = ':flags=lanczos'
+        elif scale_video['direction'] == 'DOWN':
+            scale_filter = ':flags=bicubic'
+        else:
+            raise RuntimeError("Invalid scale direction.")
+        scale_size = "scale=%ix%i" % (scale_video['width'], scale_video['height'])
+        return scale_size + scale_filter
+
+    def _build_audio_options(self) -> list[str]:
+        """
+        Build the audio encoding options of an output. Outputs mapping all the audio only down mix the first stream,
+        the others may not be 5.1.
+        :return: list[str]: The audio part of the output's options.
+        """
         # "pan=stereo|c0=c2+0.30*c0+0.30*c4|c1=c2+0.30*c1+0.30*c5"
-        command_line.extend(['-c:a', self._audio_encoder.value])
+        audio_options: list[str] = ['-c:a', self._audio_encoder.value]
         if self._audio_encoder != AudioEncoders.COPY:
             if self._boost_volume:
                 volume = 256 + int(256 * (self._boost_volume / 100))
-                command_line.extend(['-vol', str(volume)])
+                audio_options.extend(['-vol', str(volume)])
             if self._down_mix_audio:
-                command_line.extend(['-af', "pan=stereo|c0=c2+0.30*c0+0.30*c4|c1=c2+0.30*c1+0.30*c5"])
+                all_audio: bool = self._no_video or len(self._renditions) > 0
+                audio_options.extend(['-filter:a:0' if all_audio else '-af',
+                                      "pan=stereo|c0=c2+0.30*c0+0.30*c4|c1=c2+0.30*c1+0.30*c5"])
+        return audio_options
 
-        # Add the output file path:
-        command_line.append(self._output_path)
+    def _build_rendition_options(self) -> list[str]:
+        """
+        Build the filtergraph and outputs of a multi rendition encode: The decoded video is split once, each branch
+        scaled for its output, and encoded there.
+        IE: -filter_complex '[0:v:0]split=2[v0][v1];[v1]scale=1280x720:flags=bicubic[r1]' -map '[v0]' ... out0
+            -map '[r1]' ... out1
+        :return: list[str]: The filtergraph, and every output's options and path.
+        """
+        outputs = [(self._output_path, self._scale_video, self._bit_rate_target)] + self._renditions
+        graph: list[str] = ['[0:v:0]split=%i%s' % (len(outputs), ''.join('[v%i]' % index
+                                                                          for index in range(len(outputs))))]
+        output_options: list[str] = []
+        for index, (output_path, scale_video, bit_rate) in enumerate(outputs):
+            label: str = '[v%i]' % index
+            if scale_video is not None:
+                graph.append('%s%s[r%i]' % (label, self._scale_filter(scale_video), index))
+                label = '[r%i]' % index
+            output_options.extend(['-map', label, '-map', '0:a?', '-c:v', self._video_encoder.value])
+            if bit_rate is not None:
+                output_options.extend(['-b:v', '%ik' % bit_rate])
+            output_options.extend(self._build_audio_options())
+            output_options.append(output_path)
+        return ['-filter_complex', ';'.join(graph)] + output_options
 
-        process = subprocess.Popen(command_line, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        while process.poll() is None:
-            line = process.stdout.readline()
+    def start_process(self) -> list[IO[bytes]]:
+        """
+        Start the encoding process.
+        :return: list[IO[bytes]]: The pipe with ffmpeg's progress output.
+        """
+        # ffmpeg -i job-id_1.mp4 -c:v copy -c:a copy job-id_1_done.mkv
+        command_line = [self._ffmpeg_path, '-y', '-hide_banner']
+        if self._output_format is not None:  # stdout carries the output, so send progress to stderr.
+            command_line.extend(['-progress', 'pipe:2', '-nostats', '-loglevel', 'error'])
+        else:  # stderr is read with the progress, so leave out the stats line, IE: 'frame=  10 fps=...'.
+            command_line.extend(['-progress', '-', '-nostats'])
+        if self._input_queue is None:
+            command_line.append('-nostdin')
+        command_line.extend(self._build_input_options())
+        if len(self._renditions) > 0:
+            command_line.extend(self._build_rendition_options())
+        else:
+            # Add video encoding options, or copy everything that isn't video:
+            if self._no_video:
+                command_line.extend(['-map', '0', '-map', '-0:V', '-c', 'copy'])
+            else:
+                command_line.extend(['-c:v', self._video_encoder.value])
+            if not self._no_video and self._video_encoder != VideoEncoders.COPY:
+                if self._scale_video is not None:
+                    command_line.extend(['-vf', self._scale_filter(self._scale_video)])
+                if self._bit_rate_target is not None:
+                    command_line.extend(['-b:v', '%ik' % self._bit_rate_target])
+                if self._rate_pass is not None:
+                    # ffmpeg only passes -pass / -passlogfile on to x264, x265 takes them as its own params:
+                    if self._video_encoder == VideoEncoders.X265:
+                        command_line.extend(['-x265-params', 'pass=%i:stats=%s' % (self._rate_pass,
+                                                                                   self._pass_log + PASS_STATS_SUFFIX)])
+                    else:
+                        command_line.extend(['-pass', str(self._rate_pass), '-passlogfile', self._pass_log])
+            # Add audio encoding options, the first pass only needs the video:
+            if self._rate_pass == 1:
+                command_line.append('-an')
+            else:
+                command_line.extend(self._build_audio_options())
+
+            # Add the output file path, the first pass only needs its statistics:
+            if self._output_format is not None:
+                command_line.extend(['-f', self._output_format, 'pipe:1'])
+            elif self._rate_pass == 1:
+                command_line.extend(['-f', 'null', os.devnull])
+            else:
+                command_line.append(self._output_path)
 
+        # Start ffmpeg, when streaming, stdin / stdout are binary data and the progress is read from stderr. The
+        # stream pipes block on the connection, so they get helper threads instead of running on the supervisor:
+        if self._input_queue is not None or self._output_format is not None:
+            stdin = subprocess.PIPE if self._input_queue is not None else subprocess.DEVNULL
+            stdout = subprocess.PIPE if self._output_format is not None else subprocess.DEVNULL
+            self.popen(command_line, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE)
+            progress_pipe = self._process.stderr
+            if self._input_queue is not None:
+                self.start_helper(self._feed_input, self._process.stdin)
+            if self._output_format is not None:
+                self.start_helper(self._read_output, self._process.stdout)
+        else:
+            self.popen(command_line, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            progress_pipe = self._process.stdout
+        if self._terminated:  # terminate() was called before ffmpeg started.
+            self.kill()
+        elif self._stopped:  # stop() was called before ffmpeg started.
+            self._process.send_signal(signal.SIGINT)
+        return [progress_pipe]
 
     @property
     def current_frame(self) -> Optional[int]:
@@ -156,8 +455,49 @@ class EncodeThread(Thread):
         :return: Optional[timedelta]: The current timestamp as a timedelta object.
         """
         return self._current_time
-        # self._current_time: Optional[timedelta] = None  # Will be None until encoding starts.
-        # self._speed: Optional[str] = None  # Will be None until encoding starts.
+
+    @property
+    def speed(self) -> Optional[str]:
+        """
+        The current speed of the encode.
+        :return: Optional[str]: The current speed, IE: '1.5x', or None if encoding has not started.
+        """
+        return self._speed
+
+    @property
+    def percent_complete(self) -> Optional[float]:
+        """
+        The total percentage complete.
+        :return: Optional[float]: 0.0 -> 100.0, or None if the total time isn't known.
+        """
+        return self._percent_complete
+
+    @property
+    def output_path(self) -> str:
+        """
+        The output file path.
+        :return: str: The full path to the output file.
+        """
+        return self._output_path
+
+    @property
+    def success(self) -> bool:
+        """
+        Did the encode finish successfully.
+        :return: bool: True ffmpeg exited with 0, False it's still running or failed.
+        """
+        if self._terminated:
+            return False
+        # ffmpeg exits with 255 after finishing the output when interrupted:
+        return self._return_code == 0 or (self._stopped and self._return_code == 255)
+
+    @property
+    def stopped(self) -> bool:
+        """
+        Was the encode stopped early with stop().
+        :return: bool: True if stop() was called.
+        """
+        return self._stopped
 
 if __name__ == '__main__':
     exit(0)
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""
+    File: FakeFfmpeg.py
+    Description: A stand-in for ffmpeg / ffprobe, for load testing the daemon without real media, or a real ffmpeg.
+        It takes the command lines ffmpegCli builds, and behaves like ffmpeg on the outside: '-progress' output, the
+        segment muxer's "Opening '...' for writing" lines, SIGINT finishing the output early, and output files; But
+        it only sleeps, at a configurable speed, and fails at a configurable rate. Media files are fake too: a line of
+        JSON with the duration, padded to a realistic size, see make_fake_media(). Any other input is treated as
+        FAKE_FFMPEG_DURATION seconds long. It's ffprobe when called with '-show_entries'.
+
+    Settings, from the environment, so they reach every process the daemon starts:
+        FAKE_FFMPEG_SPEED: Seconds of media processed per second, default 50.
+        FAKE_FFMPEG_COPY_FACTOR: How many times faster a stream copy, IE: a split, runs than an encode, default 20.
+        FAKE_FFMPEG_SPEED_JITTER: Each process runs at a random speed within this fraction of it, default 0.1.
+        FAKE_FFMPEG_FAIL_RATE: The chance, 0 - 1, a split / encode fails part way through, default 0.
+        FAKE_FFMPEG_STARTUP: Seconds to wait before starting, like ffmpeg probing its input, default 0.05.
+        FAKE_FFMPEG_PROGRESS_PERIOD: Seconds between '-progress' blocks, default 0.5 like ffmpeg.
+        FAKE_FFMPEG_DURATION: The duration in seconds of inputs that aren't fake media, default 600.
+        FAKE_FFMPEG_BYTES_PER_SECOND: Output bytes per second of media, default 4096.
+        FAKE_FFMPEG_SEED: Seed the random numbers, for repeatable runs.
+
+    Make a source to split / encode with: FakeFfmpeg.py --make-media <path> <duration>
+"""
+import json
+import math
+import os
+import random
+import signal
+import sys
+import time
+from typing import Optional, Final, Any, IO, Callable
+
+FAKE_MEDIA_KEY: Final[str] = 'fakeMedia'
+"""The key in the JSON header that marks a fake media file."""
+FRAME_RATE: Final[float] = 24.0
+"""The frame rate of fake media."""
+DEFAULT_KEYFRAME_INTERVAL: Final[float] = 2.0
+"""Seconds between keyframes in fake media."""
+FLAG_OPTIONS: Final[frozenset[str]] = frozenset((
+    '-y', '-n', '-hide_banner', '-nostdin', '-nostats', '-an', '-vn', '-sn', '-dn', '-shortest', '-version',
+    '-encoders',
+))
+"""Options that don't take a value, every other option does."""
+ENCODERS_LIST: Final[str] = """Encoders:
+ V..... = Video
+ A..... = Audio
+ S..... = Subtitle
+ .F.... = Frame-level multithreading
+ ..S... = Slice-level multithreading
+ ...X.. = Codec is experimental
+ ....B. = Supports draw_horiz_band
+ .....D = Supports direct rendering method 1
+ ------
+ V....D libx264              libx264 H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10 (codec h264)
+ V....D libx265              libx265 H.265 / HEVC (codec hevc)
+ V....D libsvtav1            SVT-AV1(Scalable Video Technology for AV1) encoder (codec av1)
+ A....D aac                  AAC (Advanced Audio Coding)
+ A....D libmp3lame           libmp3lame MP3 (MPEG audio layer 3) (codec mp3)
+ A....D libopus              libopus Opus (codec opus)
+"""
+"""What '-encoders' prints."""
+
+
+def _env_float(name: str, default: float) -> float:
+    """
+    Read a number setting from the environment.
+    :param name: str: The variable name.
+    :param default: float: The value if it's not set, or not a number.
+    :return: float: The value.
+    """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def make_fake_media(path: str, duration: float, keyframe_interval: float = DEFAULT_KEYFRAME_INTERVAL,
+                    bytes_per_second: Optional[int] = None, **extra) -> None:
+    """
+    Write a fake media file.
+    :param path: str: The full path to write.
+    :param duration: float: The duration in seconds.
+    :param keyframe_interval: float = DEFAULT_KEYFRAME_INTERVAL: Seconds between keyframes.
+    :param bytes_per_second: Optional[int] = None: Bytes per second of media to pad the file to, None for
+    FAKE_FFMPEG_BYTES_PER_SECOND.
+    :param extra: Values to add to the header, IE: what it was encoded from.
+    :return: None
+    """
+    with open(path, 'wb') as file_handle:
+        _write_media(file_handle, duration, keyframe_interval, bytes_per_second, **extra)
+    return
+
+
+def _write_media(file_handle: IO[bytes], duration: float, keyframe_interval: float,
+                 bytes_per_second: Optional[int] = None, **extra) -> None:
+    """
+    Write fake media to an open file.
+    :param file_handle: IO[bytes]: The file, or stdout.
+    :param duration: float: The duration in seconds.
+    :param keyframe_interval: float: Seconds between keyframes.
+    :param bytes_per_second: Optional[int] = None: Bytes per second of media, None for FAKE_FFMPEG_BYTES_PER_SECOND.
+    :param extra: Values to add to the header.
+    :return: None
+    """
+    if bytes_per_second is None:
+        bytes_per_second = int(_env_float('FAKE_FFMPEG_BYTES_PER_SECOND', 4096))
+    header: dict[str, Any] = {FAKE_MEDIA_KEY: 1, 'duration': max(duration, 0.0), 'keyframeInterval': keyframe_interval}
+    header.update(extra)
+    file_handle.write(json.dumps(header).encode() + b'\n')
+    padding: int = int(duration * bytes_per_second)
+    block: bytes = b'\0' * 65536
+    while padding > 0:
+        file_handle.write(block[:padding])
+        padding -= len(block)
+    return
+
+
+def _parse_header(first_line: bytes) -> Optional[dict[str, Any]]:
+    """
+    Parse the header of a fake media file.
+    :param first_line: bytes: The first line of the file.
+    :return: Optional[dict[str, Any]]: The header, or None if it's not fake media.
+    """
+    try:
+        header = json.loads(first_line)
+    except ValueError:
+        return None
+    if not isinstance(header, dict) or FAKE_MEDIA_KEY not in header.keys():
+        return None
+    return header
+
+
+def read_media(path: str) -> tuple[float, float]:
+    """
+    Get the duration, and keyframe interval of an input.
+    :param path: str: The full path to the input.
+    :return: tuple[float, float]: (duration, keyframe_interval) in seconds; FAKE_FFMPEG_DURATION if it's not fake
+    media.
+    :raises OSError: If the input can't be read.
+    """
+    with open(path, 'rb') as file_handle:
+        header = _parse_header(file_handle.readline(4096))
+    if header is None:
+        return _env_float('FAKE_FFMPEG_DURATION', 600.0), DEFAULT_KEYFRAME_INTERVAL
+    return float(header['duration']), float(header.get('keyframeInterval', DEFAULT_KEYFRAME_INTERVAL))
+
+
+def parse_command_line(args: list[str]) -> tuple[list[tuple[str, dict[str, str]]], list[tuple[str, dict[str, str]]],
+                                                 dict[str, str]]:
+    """
+    Split an ffmpeg command line into its inputs and outputs, each with the options given before it.
+    :param args: list[str]: The arguments, without the program name.
+    :return: tuple[list[...], list[...], dict[str, str]]: The inputs, and the outputs as (path, options) tuples, and
+    the global options, IE: '-progress'.
+    """
+    inputs: list[tuple[str, dict[str, str]]] = []
+    outputs: list[tuple[str, dict[str, str]]] = []
+    global_options: dict[str, str] = {}
+    options: dict[str, str] = {}
+    index: int = 0
+    while index < len(args):
+        arg = args[index]
+        if arg == '-i':
+            inputs.append((args[index + 1], options))
+            options = {}
+            index += 2
+        elif arg in FLAG_OPTIONS:
+            options[arg] = ''
+            index += 1
+        elif arg.startswith('-') and arg != '-' and index + 1 < len(args):
+            if arg in ('-progress', '-loglevel', '-v'):
+                global_options[arg] = args[index + 1]
+            else:
+                options[arg] = args[index + 1]
+            index += 2
+        else:
+            outputs.append((arg, options))
+            options = {}
+            index += 1
+    return inputs, outputs, global_options
+
+
+def _format_time(seconds: float) -> str:
+    """
+    Format a time like ffmpeg's progress 'out_time'.
+    :param seconds: float: The time.
+    :return: str: IE: '00:01:02.500000'.
+    """
+    hours, remainder = divmod(max(seconds, 0.0), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return '%02i:%02i:%09.6f' % (hours, minutes, seconds)
+
+
+class FakeProcess(object):
+    """
+    A fake ffmpeg run: Advance through the media in real time at the fake speed, writing progress and log lines.
+    """
+    def __init__(self, global_options: dict[str, str], copy: bool = False) -> None:
+        """
+        Initialize the run.
+        :param global_options: dict[str, str]: The global options, from parse_command_line().
+        :param copy: bool = False: True the streams are copied, not encoded, so it runs FAKE_FFMPEG_COPY_FACTOR times
+        faster.
+        """
+        rate: float = _env_float('FAKE_FFMPEG_SPEED', 50.0)
+        if copy:
+            rate *= max(_env_float('FAKE_FFMPEG_COPY_FACTOR', 20.0), 0.001)
+        jitter: float = _env_float('FAKE_FFMPEG_SPEED_JITTER', 0.1)
+        self.speed: float = max(rate * random.uniform(1.0 - jitter, 1.0 + jitter), 0.001)
+        """Seconds of media processed per second."""
+        self.period: float = max(_env_float('FAKE_FFMPEG_PROGRESS_PERIOD', 0.5), 0.01)
+        """Seconds between progress blocks."""
+        progress_target: Optional[str] = global_options.get('-progress')
+        self.progress: Optional[IO[str]] = None
+        """Where to write progress blocks, None if not asked for."""
+        if progress_target in ('-', 'pipe:1', 'pipe:'):
+            self.progress = sys.stdout
+        elif progress_target == 'pipe:2':
+            self.progress = sys.stderr
+        self.quiet: bool = global_options.get('-loglevel', global_options.get('-v', '')) in ('error', 'quiet', 'fatal')
+        """True if only errors are logged."""
+        self.interrupted: bool = False
+        """True once SIGINT is received, the output is then finished up to the current position."""
+        signal.signal(signal.SIGINT, self._on_interrupt)
+        return
+
+    def _on_interrupt(self, _signal_number: int, _frame: Any) -> None:
+        self.interrupted = True
+        return
+
+    def log(self, message: str) -> None:
+        """
+        Write a log line to stderr, like ffmpeg does.
+        :param message: str: The line.
+        :return: None
+        """
+        if not self.quiet:
+            sys.stderr.write(message + '\n')
+            sys.stderr.flush()
+        return
+
+    def write_progress(self, media_time: float, finished: bool) -> None:
+        """
+        Write a '-progress' block.
+        :param media_time: float: The current output time in seconds.
+        :param finished: bool: True for the final block.
+        :return: None
+        """
+        if self.progress is None:
+            return
+        out_time_us: int = int(media_time * 1000000)
+        lines = [
+            'frame=%i' % int(media_time * FRAME_RATE),
+            'fps=%.2f' % (FRAME_RATE * self.speed),
+            'stream_0_0_q=28.0',
+            'bitrate=%.1fkbits/s' % 2500.0,
+            'total_size=%i' % int(media_time * 2500 * 1000 / 8),
+            'out_time_us=%i' % out_time_us,
+            'out_time_ms=%i' % out_time_us,
+            'out_time=%s' % _format_time(media_time),
+            'dup_frames=0',
+            'drop_frames=0',
+            'speed=%.3gx' % self.speed,
+            'progress=%s' % ('end' if finished else 'continue'),
+        ]
+        self.progress.write('\n'.join(lines) + '\n')
+        self.progress.flush()
+        return
+
+    def run(self,
+            duration: float,
+            boundaries: tuple[float, ...] = (),
+            on_boundary: Optional[Callable[[int], None]] = None,
+            ) -> tuple[float, bool]:
+        """
+        Advance through the media, sleeping to keep to the fake speed.
+        :param duration: float: The seconds of media to process.
+        :param boundaries: tuple[float, ...] = (): Media times to call on_boundary at, IE: segment starts.
+        :param on_boundary: Optional[Callable[[int], None]] = None: Called with the index of each boundary as it's
+        passed.
+        :return: tuple[float, bool]: The media time reached, and True if it failed part way.
+        """
+        time.sleep(max(_env_float('FAKE_FFMPEG_STARTUP', 0.05), 0.0))
+        fail_at: Optional[float] = None
+        if random.random() < _env_float('FAKE_FFMPEG_FAIL_RATE', 0.0):
+            fail_at = random.uniform(0.0, duration)
+        start: float = time.monotonic()
+        next_boundary: int = 0
+        media_time: float = 0.0
+        while True:
+            media_time = min((time.monotonic() - start) * self.speed, duration)
+            while next_boundary < len(boundaries) and boundaries[next_boundary] <= media_time:
+                if on_boundary is not None:
+                    on_boundary(next_boundary)
+                next_boundary += 1
+            if fail_at is not None and media_time >= fail_at:
+                self.log('Error while decoding stream #0:0: Invalid data found when processing input')
+                return fail_at, True
+            if media_time >= duration or self.interrupted:
+                break
+            self.write_progress(media_time, False)
+            time.sleep(min(self.period, (duration - media_time) / self.speed + 0.001))
+        self.write_progress(media_time, True)
+        return media_time, False
+
+
+def probe(args: list[str]) -> int:
+    """
+    Act as ffprobe: Print the duration, or the keyframes, of a fake media file.
+    :param args: list[str]: The arguments, without the program name.
+    :return: int: The exit code.
+    """
+    path: str = args[-1]
+    try:
+        duration, keyframe_interval = read_media(path)
+    except OSError as e:
+        sys.stderr.write("%s: %s\n" % (path, e.strerror))
+        return 1
+    entries: str = args[args.index('-show_entries') + 1]
+    if entries.startswith('format=duration'):
+        print('%.6f' % duration)
+    elif entries.startswith('packet='):
+        start, end = 0.0, duration
+        if '-read_intervals' in args:
+            interval_start, interval_end = args[args.index('-read_intervals') + 1].split('%')
+            start = float(interval_start) if interval_start != '' else 0.0
+            end = min(float(interval_end), duration) if interval_end != '' else duration
+        # Reading starts from the keyframe before the interval, like ffprobe:
+        keyframe: float = math.floor(start / keyframe_interval) * keyframe_interval
+        while keyframe < end:
+            print('%.6f,K__' % keyframe)
+            keyframe += keyframe_interval
+    return 0
+
+
+def split(media_time_limit: float, keyframe_interval: float, segment_time: float, output_pattern: str,
+          process: FakeProcess) -> int:
+    """
+    Act as the segment muxer: Cut at the first keyframe after each segment_time, writing a segment file for each.
+    :param media_time_limit: float: The duration of the input.
+    :param keyframe_interval: float: Seconds between keyframes.
+    :param segment_time: float: The target segment length.
+    :param output_pattern: str: The output path, with a '%d' for the segment number.
+    :param process: FakeProcess: The run.
+    :return: int: The exit code.
+    """
+    starts: list[float] = [0.0]
+    while True:
+        cut = math.ceil((starts[-1] + segment_time) / keyframe_interval) * keyframe_interval
+        if cut >= media_time_limit:
+            break
+        starts.append(cut)
+    opened: list[str] = []
+
+    def open_segment(index: int) -> None:
+        path = output_pattern.replace('%d', str(index))
+        opened.append(path)
+        process.log("[segment @ 0x%x] Opening '%s' for writing" % (id(process), path))
+        return
+
+    reached, failed = process.run(media_time_limit, tuple(starts), open_segment)
+    # Write each segment opened, the last one only up to where the run stopped:
+    for index, path in enumerate(opened):
+        end = starts[index + 1] if index + 1 < len(starts) else media_time_limit
+        try:
+            make_fake_media(path, min(end, reached) - starts[index], keyframe_interval)
+        except OSError as e:
+            sys.stderr.write("%s: %s\n" % (path, e.strerror))
+            return 1
+    if failed:
+        return 1
+    return 255 if process.interrupted else 0
+
+
+def write_pass_stats(output_options: dict[str, str], length: float, seed: str) -> None:
+    """
+    Write a first pass's statistics file, when the output is one, with a line per frame like x264 / x265's. Each
+    source range gets its own steady complexity, so the second pass's bit rates differ between chunks.
+    :param output_options: dict[str, str]: The output's options.
+    :param length: float: The seconds of media encoded.
+    :param seed: str: Seeds the range's complexity, IE: the input path and start time.
+    :return: None
+    """
+    stats_path: Optional[str] = None
+    if output_options.get('-pass') == '1' and '-passlogfile' in output_options.keys():
+        stats_path = output_options['-passlogfile'] + '-0.log'
+    elif '-x265-params' in output_options.keys():
+        params = dict(param.split('=', 1) for param in output_options['-x265-params'].split(':') if '=' in param)
+        if params.get('pass') == '1' and 'stats' in params.keys():
+            stats_path = params['stats']
+    if stats_path is None:
+        return
+    complexity: random.Random = random.Random(seed)
+    texture: float = complexity.uniform(5000.0, 60000.0)
+    with open(stats_path, 'w') as file_handle:
+        file_handle.write('#options: fake\n')
+        for frame in range(int(length * FRAME_RATE)):
+            file_handle.write('in:%i out:%i type:%s q:%.2f tex:%i mv:%i misc:%i ;\n' % (
+                frame, frame, 'I' if frame % int(DEFAULT_KEYFRAME_INTERVAL * FRAME_RATE) == 0 else 'P', 24.0,
+                texture * complexity.uniform(0.8, 1.2), texture / 10, 200))
+    return
+
+
+def main(argv: list[str]) -> int:
+    """
+    Run as ffmpeg, or ffprobe.
+    :param argv: list[str]: The command line.
+    :return: int: The exit code.
+    """
+    args: list[str] = argv[1:]
+    if 'FAKE_FFMPEG_SEED' in os.environ.keys():
+        random.seed(os.environ['FAKE_FFMPEG_SEED'] + ' '.join(args))
+    if len(args) == 3 and args[0] == '--make-media':
+        make_fake_media(args[1], float(args[2]))
+        return 0
+    if '-show_entries' in args:
+        return probe(args)
+    if '-version' in args:
+        print('ffmpeg version 6.0-fake Copyright (c) 2000-2023 the FFmpeg developers (fake stand-in)')
+        return 0
+    if '-encoders' in args:
+        sys.stdout.write(ENCODERS_LIST)
+        return 0
+    inputs, outputs, global_options = parse_command_line(args)
+    if len(inputs) == 0 or len(outputs) == 0:
+        sys.stderr.write('At least one input and one output file must be specified\n')
+        return 1
+    input_path, input_options = inputs[0]
+
+    # Concat demuxer, IE: combine; It's a copy, so just sum the parts:
+    if input_options.get('-f') == 'concat':
+        total: float = 0.0
+        try:
+            with open(input_path, 'r') as file_handle:
+                for line in file_handle:
+                    if line.startswith('file '):
+                        part_path = line[5:].strip()[1:-1].replace("'\\''", "'")
+                        total += read_media(part_path)[0]
+        except OSError as e:
+            sys.stderr.write("%s: %s\n" % (input_path, e.strerror))
+            return 1
+        try:
+            for output_path, _output_options in outputs:
+                make_fake_media(output_path, total)
+        except OSError as e:
+            sys.stderr.write("%s\n" % str(e))
+            return 1
+        return 0
+
+    # Read the input, from stdin when streaming:
+    keyframe_interval: float = DEFAULT_KEYFRAME_INTERVAL
+    if input_path in ('pipe:0', 'pipe:', '-'):
+        header = _parse_header(sys.stdin.buffer.readline())
+        while sys.stdin.buffer.read(65536) != b'':
+            pass
+        duration: float = float(header['duration']) if header is not None else _env_float('FAKE_FFMPEG_DURATION',
+                                                                                          600.0)
+    else:
+        try:
+            duration, keyframe_interval = read_media(input_path)
+        except OSError as e:
+            sys.stderr.write("%s: %s\n" % (input_path, e.strerror))
+            return 1
+    start: float = float(input_options.get('-ss', 0.0))
+    length: float = max(duration - start, 0.0)
+    if '-t' in input_options.keys():
+        length = min(float(input_options['-t']), length)
+
+    first_output_path, first_output_options = outputs[0]
+    # The video is most of an encode's work, so copying it, or leaving it out, runs at copy speed:
+    process = FakeProcess(global_options, first_output_options.get('-c') == 'copy' or
+                          first_output_options.get('-c:v') == 'copy' or first_output_options.get('-map') == '-0:V')
+    if first_output_options.get('-f') == 'segment':
+        return split(length, keyframe_interval, float(first_output_options.get('-segment_time', 2.0)),
+                     first_output_path, process)
+
+    reached, failed = process.run(length)
+    if failed:
+        return 1
+    try:
+        write_pass_stats(first_output_options, reached, '%s %f' % (input_path, start))
+    except OSError as e:
+        sys.stderr.write("%s\n" % str(e))
+        return 1
+    for output_path, output_options in outputs:
+        if output_options.get('-f') == 'null':  # IE: A first pass, only its statistics are kept.
+            continue
+        if output_path in ('pipe:1', 'pipe:', '-'):
+            _write_media(sys.stdout.buffer, reached, keyframe_interval, source=os.path.basename(input_path))
+            sys.stdout.buffer.flush()
+            continue
+        try:
+            make_fake_media(output_path, reached, keyframe_interval, source=os.path.basename(input_path))
+        except OSError as e:
+            sys.stderr.write("%s: %s\n" % (output_path, e.strerror))
+            return 1
+    # ffmpeg exits with 255 after finishing the output when interrupted:
+    return 255 if process.interrupted else 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
@@ -8,12 +8,51 @@ import sys
 import shutil
 import subprocess
 from datetime import timedelta
-from typing import Optional
+from queue import Queue
+from threading import Lock
+from typing import Optional, Final
 
 try:
+    from Supervisor import Supervisor
+    from ProcessLimits import ProcessLimits
     from SplitThread import SplitThread
+    from EncodeThread import EncodeThread, AudioEncoders, VideoEncoders, PASS_STATS_SUFFIX
 except ModuleNotFoundError:
+    from .Supervisor import Supervisor
+    from .ProcessLimits import ProcessLimits
     from .SplitThread import SplitThread
+    from .EncodeThread import EncodeThread, AudioEncoders, VideoEncoders, PASS_STATS_SUFFIX
+
+
+FAKE_FFMPEG_PATH: Final[str] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'FakeFfmpeg.py')
+"""The fake ffmpeg / ffprobe stand-in for load testing, see FakeFfmpeg.py."""
+FAKE_FFMPEG_ENV: Final[str] = 'CLUSTER_ENCODE_FAKE_FFMPEG'
+"""Set this environment variable to '1' to use the fake ffmpeg wherever find_ffmpeg() is used."""
+PASS_QCOMPRESS: Final[float] = 0.6
+"""x264 / x265's default qcomp: Rate control gives each frame bits in proportion to its complexity ** qcomp, so 0 gives
+every frame the same bits, constant bit rate, and 1 bits in proportion to complexity, constant quantizer. Used to weigh
+the chunks' first pass statistics the way the second pass spends them."""
+
+
+def find_ffmpeg(fake: Optional[bool] = None) -> tuple[Optional[str], Optional[str]]:
+    """
+    Find ffmpeg, and ffprobe; Or the fake stand-in for both, for load testing without real media.
+    :param fake: Optional[bool] = None: True use the fake, False the real ffmpeg, None the fake only if the
+    FAKE_FFMPEG_ENV environment variable is '1'.
+    :return: tuple[Optional[str], Optional[str]]: The full paths to ffmpeg and ffprobe, None if not found.
+    """
+    if fake is None:
+        fake = os.environ.get(FAKE_FFMPEG_ENV) == '1'
+    if fake:
+        return FAKE_FFMPEG_PATH, FAKE_FFMPEG_PATH
+    ffmpeg_path: Optional[str] = shutil.which('ffmpeg')
+    if ffmpeg_path is None:
+        return None, None
+    # Prefer the ffprobe installed alongside this ffmpeg:
+    ffprobe_path: Optional[str] = os.path.join(os.path.dirname(ffmpeg_path), 'ffprobe')
+    if not os.path.isfile(ffprobe_path):
+        ffprobe_path = shutil.which('ffprobe')
+    return ffmpeg_path, ffprobe_path
 
 
 class Ffmpegcli(object):
@@ -21,13 +60,28 @@ class Ffmpegcli(object):
     class to store ffmpeg functions / threads / actions etc.
     """
 
-    def __init__(self, ffmpeg_path: str) -> None:
+    def __init__(self, ffmpeg_path: str, ffprobe_path: Optional[str] = None) -> None:
         self._ffmpeg_path = ffmpeg_path
         """The full path to ffmpeg."""
-        self.current_threads: Optional[list[SplitThread]] = []
-        """The current threads running."""
+        if ffprobe_path is None:
+            # Prefer the ffprobe installed alongside this ffmpeg:
+            ffprobe_path = os.path.join(os.path.dirname(ffmpeg_path), 'ffprobe')
+            if not os.path.isfile(ffprobe_path):
+                ffprobe_path = shutil.which('ffprobe')
+        self._ffprobe_path: Optional[str] = ffprobe_path
+        """The full path to ffprobe, None if not found."""
+        self.current_threads: Optional[list[SplitThread | EncodeThread]] = []
+        """The current split / encode processes running."""
+        self._supervisor: Supervisor = Supervisor()
+        """The supervisor that runs the split / encode processes, and reads their progress on one thread."""
         self.status: str = 'idle'
         """The current status of ffmpeg operations."""
+        self._lock: Lock = Lock()
+        """Lock for current_threads, splits / encodes can be started and finished from several threads."""
+        self.split_limits: Optional[ProcessLimits] = None
+        """The limits to run splits / combines with, IE: a lower I/O priority than the encodes."""
+        self.encode_limits: Optional[ProcessLimits] = None
+        """The limits to run encodes with, unless encode() is given its own."""
         return
 
     def get_version(self) -> Optional[str]:
@@ -92,13 +146,70 @@ class Ffmpegcli(object):
                     video_encoders.append((encoder, description))
         return video_encoders
 
+    def get_keyframes(self,
+                      input_path: str,
+                      start_time: Optional[timedelta] = None,
+                      end_time: Optional[timedelta] = None,
+                      ) -> Optional[list[timedelta]]:
+        """
+        Get the video keyframe times of a file, reading only the packet headers, not decoding.
+        :param input_path: str: The full path to the video.
+        :param start_time: Optional[timedelta] = None: Only return keyframes from here, None for the start.
+        :param end_time: Optional[timedelta] = None: Only return keyframes before here, None for the end.
+        :return: Optional[list[timedelta]]: The keyframe times in order, or None on error running ffprobe.
+        """
+        if self._ffprobe_path is None:
+            return None
+        command_line: list[str] = [self._ffprobe_path, '-v', 'error', '-select_streams', 'v:0',
+                                   '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0']
+        if start_time is not None or end_time is not None:
+            interval_start = '' if start_time is None else str(start_time.total_seconds())
+            interval_end = '' if end_time is None else str(end_time.total_seconds())
+            command_line.extend(['-read_intervals', interval_start + '%' + interval_end])
+        command_line.append(input_path)
+        try:
+            lines: list[str] = subprocess.check_output(command_line, text=True).splitlines()
+        except (subprocess.CalledProcessError, OSError):
+            return None
+        keyframes: list[timedelta] = []
+        for line in lines:
+            values = line.split(',')
+            if len(values) < 2 or 'K' not in values[1] or values[0] in ('', 'N/A'):
+                continue
+            keyframe = timedelta(seconds=float(values[0]))
+            if start_time is not None and keyframe < start_time:
+                continue
+            if end_time is not None and keyframe >= end_time:
+                continue
+            keyframes.append(keyframe)
+        keyframes.sort()
+        return keyframes
+
+    def get_duration(self, input_path: str) -> Optional[timedelta]:
+        """
+        Get the duration of a file.
+        :param input_path: str: The full path to the file.
+        :return: Optional[timedelta]: The duration, or None on error running ffprobe.
+        """
+        if self._ffprobe_path is None:
+            return None
+        command_line: list[str] = [self._ffprobe_path, '-v', 'error', '-show_entries', 'format=duration',
+                                   '-of', 'csv=p=0', input_path]
+        try:
+            output: str = subprocess.check_output(command_line, text=True).strip()
+            return timedelta(seconds=float(output))
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            return None
+
     def split(self,
               input_path: str,
               output_path: str,
               chunk_size: int,
               callback: callable,
               report_delay: float = 0.5,
-              total_time: Optional[timedelta] = None
+              total_time: Optional[timedelta] = None,
+              limits: Optional[ProcessLimits] = None,
+              video_only: bool = False,
               ) -> bool:
         """
         Start the split thread running.
@@ -109,25 +220,32 @@ class Ffmpegcli(object):
         callback signature should be: (report_type: str, *args). If 'report_type' == 'report', then *args is:
         [current_time: timedelta, current_speed: str, percent_segment_complete: float,
         percent_complete: Optional[float]]; Otherwise, if 'report_type' == 'new_file', then *args is:
-        [new_file_path: str, current_num_files: int].
+        [new_file_path: str, current_num_files: int]; Once the split is finished, 'report_type' == 'finished', and *args
+        is: [success: bool]. The callback is called from the supervisor thread, so it must not block.
         :param report_delay: float = 0.5: The amount of time in seconds to wait between reporting.
         :param total_time: Optional[timedelta] = None: The length of the input video.
+        :param limits: Optional[ProcessLimits] = None: The limits to run ffmpeg with, None for split_limits.
+        :param video_only: bool = False: True the chunks only carry the video, see SplitThread.
         :return: bool: True the thread started, False, the thread didn't start.
         """
-        for thread in self.current_threads:
-            if isinstance(thread, SplitThread):
-                print("Split thread already running.")
-                return False
-        split_thread = SplitThread(
-            ffmpeg_path=self._ffmpeg_path,
-            input_path=input_path,
-            output_path=output_path,
-            chunk_size=chunk_size,
-            callback=callback,
-            report_delay=report_delay,
-            total_time=total_time,
-        )
-        self.current_threads.append(split_thread)
+        with self._lock:
+            for thread in self.current_threads:
+                if isinstance(thread, SplitThread):
+                    print("Split thread already running.")
+                    return False
+            split_thread = SplitThread(
+                ffmpeg_path=self._ffmpeg_path,
+                input_path=input_path,
+                output_path=output_path,
+                chunk_size=chunk_size,
+                callback=callback,
+                report_delay=report_delay,
+                total_time=total_time,
+                supervisor=self._supervisor,
+                limits=limits if limits is not None else self.split_limits,
+                video_only=video_only,
+            )
+            self.current_threads.append(split_thread)
         split_thread.start()
         return True
 
@@ -135,16 +253,291 @@ class Ffmpegcli(object):
         """
         Blocks until split is finished, returning the results.
         :return: tuple[bool, tuple[str, ...]]: Returns a tuple where the first element is a bool, which is True on
-        split success, and False if the split wasn't started; The second element of the tuple is a tuple of strings,
-        each element being the full path to a created file, or an empty tuple if the split wasn't started.
+        split success, and False if the split failed, or wasn't started; The second element of the tuple is a tuple of
+        strings, each element being the full path to a created file, or an empty tuple if the split wasn't started.
+        """
+        split_thread: Optional[SplitThread] = None
+        with self._lock:
+            for thread in self.current_threads:
+                if isinstance(thread, SplitThread):
+                    split_thread = thread
+                    break
+        if split_thread is None:
+            return False, ()
+        split_thread.join()
+        with self._lock:
+            self.current_threads.remove(split_thread)
+        return split_thread.success, split_thread.output_files
+
+    def split_terminate(self) -> bool:
+        """
+        Kill a running split, split_finish() must still be called to collect it.
+        :return: bool: True the split was found and terminated, False it wasn't running.
+        """
+        with self._lock:
+            for thread in self.current_threads:
+                if isinstance(thread, SplitThread):
+                    thread.terminate()
+                    return True
+        return False
+
+    def encode(self,
+               input_path: str,
+               output_path: str,
+               audio_encoder: AudioEncoders,
+               down_mix_audio: bool,
+               boost_volume: int,
+               video_encoder: VideoEncoders,
+               scale_video: Optional[dict[str, int]],
+               callback: callable,
+               report_delay: float = 0.5,
+               start_time: Optional[timedelta] = None,
+               end_time: Optional[timedelta] = None,
+               total_time: Optional[timedelta] = None,
+               input_queue: Optional[Queue] = None,
+               output_format: Optional[str] = None,
+               limits: Optional[ProcessLimits] = None,
+               no_video: bool = False,
+               bit_rate: Optional[int] = None,
+               rate_pass: Optional[int] = None,
+               pass_log: Optional[str] = None,
+               renditions: Optional[list[tuple[str, Optional[dict[str, int]], Optional[int]]]] = None,
+               ) -> bool:
+        """
+        Start an encode thread running.
+        :param input_path: str: The full path to the video to encode.
+        :param output_path: str: The full path to the output file.
+        :param audio_encoder: AudioEncoders: The audio encoder to use.
+        :param down_mix_audio: bool: True down mix the audio to stereo.
+        :param boost_volume: int: The percentage to boost the volume by.
+        :param video_encoder: VideoEncoders: The video encoder to use.
+        :param scale_video: Optional[dict[str, int]]: The scale options, see EncodeThread.
+        :param callback: Callable: The callback to call with reports, see EncodeThread. It's called from the
+        supervisor thread, except for stream 'data' reports, so it must not block.
+        :param report_delay: float = 0.5: The amount of time in seconds to wait between reporting.
+        :param start_time: Optional[timedelta] = None: Where to start encoding in the input, None for the start.
+        :param end_time: Optional[timedelta] = None: Where to stop encoding in the input, None for the end.
+        :param total_time: Optional[timedelta] = None: The length of the input video.
+        :param input_queue: Optional[Queue] = None: A bounded queue of input blocks to feed to ffmpeg's stdin instead
+        of reading input_path, see EncodeThread.
+        :param output_format: Optional[str] = None: Stream the output from ffmpeg's stdout in this format to the
+        callback instead of writing output_path, which then only identifies the encode. See EncodeThread.
+        :param limits: Optional[ProcessLimits] = None: The limits to run ffmpeg with, IE: an encode slot's CPUs; None
+        for encode_limits.
+        :param no_video: bool = False: True output every stream but the video, see EncodeThread.
+        :param bit_rate: Optional[int] = None: The video bit rate to target in kbit/s, None for constant quality.
+        :param rate_pass: Optional[int] = None: 1 or 2 to run that pass of a two pass encode, see EncodeThread.
+        :param pass_log: Optional[str] = None: The pass statistics path prefix, see pass_stats_path().
+        :param renditions: Optional[list[tuple[str, Optional[dict[str, int]], Optional[int]]]] = None: More outputs
+        from the one decode, as (output_path, scale_video, bit_rate), see EncodeThread.
+        :return: bool: True the thread started, False an encode to this output path is already running.
+        """
+        with self._lock:
+            for thread in self.current_threads:
+                if isinstance(thread, EncodeThread) and thread.output_path == output_path:
+                    print("Encode thread for '%s' already running." % output_path)
+                    return False
+            encode_thread = EncodeThread(
+                ffmpeg_path=self._ffmpeg_path,
+                input_path=input_path,
+                output_path=output_path,
+                audio_encoder=audio_encoder,
+                down_mix_audio=down_mix_audio,
+                boost_volume=boost_volume,
+                video_encoder=video_encoder,
+                scale_video=scale_video,
+                callback=callback,
+                report_delay=report_delay,
+                start_time=start_time,
+                end_time=end_time,
+                total_time=total_time,
+                input_queue=input_queue,
+                output_format=output_format,
+                supervisor=self._supervisor,
+                limits=limits if limits is not None else self.encode_limits,
+                no_video=no_video,
+                bit_rate=bit_rate,
+                rate_pass=rate_pass,
+                pass_log=pass_log,
+                renditions=renditions,
+            )
+            self.current_threads.append(encode_thread)
+        encode_thread.start()
+        return True
+
+    def encode_finish(self, output_path: str) -> tuple[bool, bool]:
+        """
+        Blocks until the encode to the given output path is finished.
+        :param output_path: str: The output path the encode was started with.
+        :return: tuple[bool, bool]: The first element is True if the encode was found, and False if it wasn't
+        started; The second element is True if ffmpeg finished successfully, False if not.
+        """
+        encode_thread: Optional[EncodeThread] = None
+        with self._lock:
+            for thread in self.current_threads:
+                if isinstance(thread, EncodeThread) and thread.output_path == output_path:
+                    encode_thread = thread
+                    break
+        if encode_thread is None:
+            return False, False
+        encode_thread.join()
+        with self._lock:
+            self.current_threads.remove(encode_thread)
+        return True, encode_thread.success
+
+    def encode_terminate(self, output_path: str) -> bool:
+        """
+        Kill a running encode, encode_finish() must still be called to collect it.
+        :param output_path: str: The output path the encode was started with.
+        :return: bool: True the encode was found and terminated, False it wasn't found.
+        """
+        with self._lock:
+            for thread in self.current_threads:
+                if isinstance(thread, EncodeThread) and thread.output_path == output_path:
+                    thread.terminate()
+                    return True
+        return False
+
+    def encode_stop(self, output_path: str) -> bool:
+        """
+        Gracefully stop a running encode early, the output is finished up to the current position. encode_finish()
+        must still be called to collect it.
+        :param output_path: str: The output path the encode was started with.
+        :return: bool: True the encode was found and stopped, False it wasn't found.
+        """
+        with self._lock:
+            for thread in self.current_threads:
+                if isinstance(thread, EncodeThread) and thread.output_path == output_path:
+                    thread.stop()
+                    return True
+        return False
+
+    def combine(self, input_files: list[str], output_path: str, streams_file: Optional[str] = None) -> bool:
+        """
+        Join encoded parts into one file with the concat demuxer, without re-encoding. The parts are put in order
+        with part_sort_key(), so re-split sub-parts land right after the part they were split from.
+        :param input_files: list[str]: The full paths to the parts, in any order.
+        :param output_path: str: The full path to the output file.
+        :param streams_file: Optional[str] = None: The full path to a file with the other streams, IE: the audio, to
+        mux in with video only parts; None if the parts carry every stream.
+        :return: bool: True the parts were combined, False ffmpeg failed.
+        """
+        list_path: str = output_path + '.concat.txt'
+        sorted_files = sorted(input_files, key=lambda file_path: self.part_sort_key(os.path.basename(file_path)))
+        try:
+            with open(list_path, 'w') as file_handle:
+                for file_path in sorted_files:
+                    file_handle.write("file '%s'\n" % file_path.replace("'", "'\\''"))
+        except OSError:
+            return False
+        command_line: list[str] = [self._ffmpeg_path, '-y', '-hide_banner', '-nostdin', '-f', 'concat', '-safe', '0',
+                                   '-i', list_path]
+        if streams_file is not None:
+            command_line.extend(['-i', streams_file, '-map', '0', '-map', '1'])
+        else:
+            command_line.extend(['-map', '0'])
+        command_line.extend(['-c', 'copy', output_path])
+        if self.split_limits is not None:  # A combine is a copy, like a split.
+            command_line = self.split_limits.wrap(command_line)
+        try:
+            return_code = subprocess.run(command_line, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+        except OSError:
+            return_code = -1
+        finally:
+            os.remove(list_path)
+        return return_code == 0
+
+    @staticmethod
+    def part_sort_key(file_name: str) -> tuple[int, ...]:
+        """
+        Get the sort key of a part file name. Parts are named 'Part.<n>.<name>', and a part re-split mid-job gets
+        sub-parts named 'Part.<n>-<m>.<name>', which sort after part n, and before part n + 1.
+        :param file_name: str: The part's file name, without directory.
+        :return: tuple[int, ...]: The sort key, IE: (3,) for 'Part.3.x.mkv', or (3, 1) for 'Part.3-1.x.mkv'.
+        """
+        if not file_name.startswith('Part.'):
+            return ()
+        number = file_name.split('.')[1]
+        try:
+            return tuple(int(value) for value in number.split('-'))
+        except ValueError:
+            return ()
+
+    @staticmethod
+    def sub_part_name(file_name: str, sub_part: int) -> str:
+        """
+        Get the file name of a sub-part of a part, see part_sort_key().
+        :param file_name: str: The part's file name, IE: 'Part.3.x.mkv'.
+        :param sub_part: int: The sub-part number, starting at 1.
+        :return: str: The sub-part's file name, IE: 'Part.3-1.x.mkv'.
+        """
+        if not file_name.startswith('Part.'):
+            return 'Part.0-%i.%s' % (sub_part, file_name)
+        _part, number, name = file_name.split('.', 2)
+        return 'Part.%s-%i.%s' % (number, sub_part, name)
+
+    @staticmethod
+    def pass_stats_path(pass_log: str) -> str:
+        """
+        Get the path of the statistics file a first pass writes.
+        :param pass_log: str: The pass log path prefix the encode was given.
+        :return: str: The statistics file's path. x264 also writes a '.mbtree' file beside it, x265 a '.cutree'.
+        """
+        return pass_log + PASS_STATS_SUFFIX
+
+    @staticmethod
+    def read_pass_complexity(pass_log: str, qcomp: float = PASS_QCOMPRESS) -> Optional[float]:
+        """
+        Read a first pass's statistics, and measure how many bits the encoded range needs compared to others: Each
+        frame's complexity is its texture, motion vector, and misc bits, at the quantizer they were coded with
+        scaled to a common one; Then raised to qcomp, as the second pass spends bits, and summed. Giving each chunk of a
+        job its share of the bit budget by this weight spends the bits as one two pass encode of the whole source
+        would. Both x264 and x265 write one 'key:value' line per frame, with 'q', 'tex', 'mv', and 'misc'.
+        :param pass_log: str: The pass log path prefix the first pass was given.
+        :param qcomp: float: The second pass's qcomp, see PASS_QCOMPRESS.
+        :return: Optional[float]: The weight, None if the statistics are missing or unreadable.
+        """
+        weight: float = 0.0
+        num_frames: int = 0
+        try:
+            with open(Ffmpegcli.pass_stats_path(pass_log), 'r') as file_handle:
+                for line in file_handle:
+                    if line.startswith('#'):  # The options header.
+                        continue
+                    values: dict[str, str] = dict(token.split(':', 1) for token in line.split() if ':' in token)
+                    try:
+                        q_scale: float = 0.85 * 2.0 ** ((float(values['q']) - 12.0) / 6.0)
+                        bits: float = float(values['tex']) + float(values['mv']) + float(values['misc'])
+                    except (KeyError, ValueError):
+                        continue
+                    weight += (bits * q_scale) ** qcomp
+                    num_frames += 1
+        except OSError:
+            return None
+        if num_frames == 0:
+            return None
+        return weight
+
+    @staticmethod
+    def get_chunk_ranges(total_time: timedelta, chunk_size: int) -> tuple[tuple[timedelta, timedelta], ...]:
+        """
+        Calculate the time ranges to encode in splitless mode, where each worker seeks the source directly instead
+        of reading a split chunk.
+        :param total_time: timedelta: The length of the input video.
+        :param chunk_size: int: The number of seconds per chunk.
+        :return: tuple[tuple[timedelta, timedelta], ...]: A tuple of (start_time, end_time) tuples, in order. The
+        last range ends at total_time.
         """
-        for thread in self.current_threads:
-            if isinstance(thread, SplitThread):
-                thread.join()
-                self.current_threads.remove(thread)
-                output_file_list = thread.output_files
-                return True, output_file_list
-        return False, ()
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1 second.")
+        chunk_length = timedelta(seconds=chunk_size)
+        ranges: list[tuple[timedelta, timedelta]] = []
+        start_time = timedelta(seconds=0)
+        while start_time < total_time:
+            end_time = min(start_time + chunk_length, total_time)
+            ranges.append((start_time, end_time))
+            start_time = end_time
+        return tuple(ranges)
 
 
 if __name__ == '__main__':
@@ -156,12 +549,12 @@ if __name__ == '__main__':
 
     _input = args.input
     _output = args.output
-    _ffmpeg_path = shutil.which('ffmpeg')
+    _ffmpeg_path, _ffprobe_path = find_ffmpeg()
     if _ffmpeg_path is None:
         print("ffmpeg not found.")
         exit(1)
 
-    _ffmpeg_cli = Ffmpegcli(_ffmpeg_path)
+    _ffmpeg_cli = Ffmpegcli(_ffmpeg_path, _ffprobe_path)
     print(_ffmpeg_cli.get_version())
 
     # Test split:
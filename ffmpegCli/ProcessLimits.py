@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+    File: ProcessLimits.py
+    Description: CPU / NUMA pinning, nice / ionice levels, and cgroup v2 limits for the ffmpeg processes, so encode
+        slots don't fight over the same cores, and splits / copies don't starve the encodes of disk bandwidth.
+"""
+import ctypes
+import os
+import platform
+import shutil
+from threading import Lock
+from typing import Optional, Final
+
+NUMA_NODE_PATH: Final[str] = '/sys/devices/system/node'
+"""Where the kernel lists the NUMA nodes, and their CPUs."""
+CGROUP_CPU_PERIOD: Final[int] = 100000
+"""The cgroup cpu.max period in microseconds."""
+IOPRIO_CLASS_BEST_EFFORT: Final[int] = 2
+"""The best-effort I/O scheduling class, levels 0 (highest) to 7 (lowest)."""
+IOPRIO_CLASS_SHIFT: Final[int] = 13
+"""The I/O priority class is stored above this bit."""
+IOPRIO_WHO_PROCESS: Final[int] = 1
+"""ioprio_set() target type for a single process / thread."""
+IOPRIO_SET_SYSCALLS: Final[dict[str, int]] = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+}
+"""The ioprio_set() syscall number by machine, there's no wrapper for it in libc, or in the os module."""
+
+_tools: dict[str, Optional[str]] = {}
+"""The paths to the wrapper tools, None if the tool isn't installed."""
+_tools_lock: Lock = Lock()
+"""Lock for _tools."""
+
+
+def _find_tool(name: str) -> Optional[str]:
+    """
+    Find a wrapper tool, warning once if it's missing.
+    :param name: str: The tool name.
+    :return: Optional[str]: The full path to the tool, or None if it's not installed.
+    """
+    with _tools_lock:
+        if name not in _tools.keys():
+            _tools[name] = shutil.which(name)
+            if _tools[name] is None:
+                print("'%s' not found, ignoring the limits it would set." % name)
+        return _tools[name]
+
+
+def parse_cpu_list(cpu_list: str) -> list[int]:
+    """
+    Parse a kernel CPU list, IE: '0-3,8,10-11'.
+    :param cpu_list: str: The CPU list.
+    :return: list[int]: The CPU numbers.
+    """
+    cpus: list[int] = []
+    for part in cpu_list.strip().split(','):
+        if part == '':
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpu_list(cpus: list[int]) -> str:
+    """
+    Format CPU numbers as a CPU list for taskset / numactl, the reverse of parse_cpu_list().
+    :param cpus: list[int]: The CPU numbers.
+    :return: str: The CPU list.
+    """
+    ranges: list[str] = []
+    sorted_cpus = sorted(set(cpus))
+    index: int = 0
+    while index < len(sorted_cpus):
+        last: int = index
+        while last + 1 < len(sorted_cpus) and sorted_cpus[last + 1] == sorted_cpus[last] + 1:
+            last += 1
+        if last == index:
+            ranges.append(str(sorted_cpus[index]))
+        else:
+            ranges.append('%i-%i' % (sorted_cpus[index], sorted_cpus[last]))
+        index = last + 1
+    return ','.join(ranges)
+
+
+def get_numa_nodes() -> dict[int, list[int]]:
+    """
+    Get the NUMA nodes and their CPUs.
+    :return: dict[int, list[int]]: The CPUs by node number, empty if the topology isn't available.
+    """
+    nodes: dict[int, list[int]] = {}
+    try:
+        entries = os.listdir(NUMA_NODE_PATH)
+    except OSError:
+        return nodes
+    for entry in entries:
+        if not entry.startswith('node') or not entry[4:].isdigit():
+            continue
+        try:
+            with open(os.path.join(NUMA_NODE_PATH, entry, 'cpulist'), 'r') as file_handle:
+                nodes[int(entry[4:])] = parse_cpu_list(file_handle.read())
+        except (OSError, ValueError):
+            continue
+    return nodes
+
+
+def plan_cpu_sets(num_slots: int) -> list[tuple[Optional[int], list[int]]]:
+    """
+    Divide the CPUs this process may run on between the slots. Slots are spread round-robin over the NUMA nodes,
+    and each slot gets its share of its node's CPUs, so it never spans nodes. If there are more slots than CPUs on a
+    node, the slots share CPUs.
+    :param num_slots: int: The number of slots.
+    :return: list[tuple[Optional[int], list[int]]]: (numa_node, cpus) for each slot; The node is None if the
+    topology isn't available.
+    """
+    allowed: set[int] = os.sched_getaffinity(0)
+    nodes: dict[Optional[int], list[int]] = {}
+    for node, cpus in get_numa_nodes().items():
+        node_cpus = [cpu for cpu in cpus if cpu in allowed]
+        if len(node_cpus) > 0:
+            nodes[node] = node_cpus
+    if len(nodes) == 0:
+        nodes[None] = sorted(allowed)
+    node_order: list[Optional[int]] = sorted(nodes.keys(), key=lambda node: -1 if node is None else node)
+    slots_by_node: dict[Optional[int], list[int]] = {node: [] for node in node_order}
+    for slot_num in range(num_slots):
+        slots_by_node[node_order[slot_num % len(node_order)]].append(slot_num)
+    plan: list[tuple[Optional[int], list[int]]] = [(None, [])] * num_slots
+    for node, slot_nums in slots_by_node.items():
+        cpus = nodes[node]
+        for index, slot_num in enumerate(slot_nums):
+            first: int = index * len(cpus) // len(slot_nums)
+            last: int = (index + 1) * len(cpus) // len(slot_nums)
+            plan[slot_num] = (node, cpus[first:max(last, first + 1)])
+    return plan
+
+
+def create_cgroup(base_path: str, name: str, cpu_percent: int = 0, memory_limit: int = 0) -> Optional[str]:
+    """
+    Create a cgroup v2 group with CPU / memory limits. The base must be a cgroup delegated to this user that the
+    daemon itself isn't in, since cgroup v2 doesn't allow processes in a group that has controllers enabled for its
+    children.
+    :param base_path: str: The full path to the parent cgroup, IE: '/sys/fs/cgroup/cluster-encode'.
+    :param name: str: The name of the group to create.
+    :param cpu_percent: int = 0: The CPU limit as a percentage of one CPU, IE: 400 for four CPUs; 0 for no limit.
+    :param memory_limit: int = 0: The memory limit in bytes, 0 for no limit.
+    :return: Optional[str]: The full path to the group, or None if it couldn't be created.
+    """
+    controllers: list[str] = []
+    if cpu_percent > 0:
+        controllers.append('+cpu')
+    if memory_limit > 0:
+        controllers.append('+memory')
+    path: str = os.path.join(base_path, name)
+    try:
+        if len(controllers) > 0:
+            with open(os.path.join(base_path, 'cgroup.subtree_control'), 'w') as file_handle:
+                file_handle.write(' '.join(controllers))
+        os.makedirs(path, exist_ok=True)
+        if cpu_percent > 0:
+            with open(os.path.join(path, 'cpu.max'), 'w') as file_handle:
+                file_handle.write('%i %i' % (cpu_percent * CGROUP_CPU_PERIOD // 100, CGROUP_CPU_PERIOD))
+        if memory_limit > 0:
+            with open(os.path.join(path, 'memory.max'), 'w') as file_handle:
+                file_handle.write(str(memory_limit))
+    except OSError as e:
+        print("Failed to create cgroup '%s': %s" % (path, str(e)))
+        return None
+    return path
+
+
+def set_thread_io_priority(level: int) -> bool:
+    """
+    Set the best-effort I/O priority of the calling thread, IE: for a copy thread. Linux only.
+    :param level: int: The priority level, 0 (highest) to 7 (lowest).
+    :return: bool: True the priority was set, False it's not supported here, or failed.
+    """
+    syscall_number: Optional[int] = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall_number is None:
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return False
+    # Target 0 is the calling thread:
+    priority: int = (IOPRIO_CLASS_BEST_EFFORT << IOPRIO_CLASS_SHIFT) | level
+    return libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, priority) == 0
+
+
+class ProcessLimits(object):
+    """
+    Limits to start an ffmpeg process with. The CPU set, nice, and I/O priority are set by running ffmpeg through
+    numactl / taskset, nice, and ionice, so they're in place before ffmpeg starts any threads; Each of those exec()s
+    the next, so the pid is still ffmpeg's. The cgroup is joined right after the process starts.
+    """
+    def __init__(self,
+                 cpus: Optional[list[int]] = None,
+                 numa_node: Optional[int] = None,
+                 nice: int = 0,
+                 io_priority: Optional[int] = None,
+                 cgroup_path: Optional[str] = None,
+                 ) -> None:
+        """
+        Initialize the limits.
+        :param cpus: Optional[list[int]] = None: The CPUs to run on, None for any.
+        :param numa_node: Optional[int] = None: The NUMA node to prefer memory from, None for the default policy.
+        Needs numactl, without it only the CPUs are pinned, and memory is still allocated locally to them by default.
+        :param nice: int = 0: The niceness to add, 0 to leave it unchanged.
+        :param io_priority: Optional[int] = None: The best-effort I/O priority, 0 (highest) to 7 (lowest), None to
+        leave it unchanged.
+        :param cgroup_path: Optional[str] = None: The full path to the cgroup v2 group to run in, see create_cgroup().
+        """
+        if io_priority is not None and not 0 <= io_priority <= 7:
+            raise ValueError("io_priority must be between 0 and 7.")
+        self.cpus: Optional[list[int]] = cpus
+        """The CPUs to run on."""
+        self.numa_node: Optional[int] = numa_node
+        """The NUMA node to prefer memory from."""
+        self.nice: int = nice
+        """The niceness to add."""
+        self.io_priority: Optional[int] = io_priority
+        """The best-effort I/O priority."""
+        self.cgroup_path: Optional[str] = cgroup_path
+        """The cgroup to run in."""
+        return
+
+    def wrap(self, command_line: list[str]) -> list[str]:
+        """
+        Prefix a command line with the tools that set the limits.
+        :param command_line: list[str]: The command line.
+        :return: list[str]: The wrapped command line.
+        """
+        prefix: list[str] = []
+        numactl_path: Optional[str] = _find_tool('numactl') if self.numa_node is not None else None
+        if numactl_path is not None:
+            prefix += [numactl_path, '--preferred=%i' % self.numa_node]
+            if self.cpus is not None:
+                prefix.append('--physcpubind=%s' % format_cpu_list(self.cpus))
+            else:
+                prefix.append('--cpunodebind=%i' % self.numa_node)
+        elif self.cpus is not None:
+            taskset_path: Optional[str] = _find_tool('taskset')
+            if taskset_path is not None:
+                prefix += [taskset_path, '--cpu-list', format_cpu_list(self.cpus)]
+        if self.nice != 0:
+            nice_path: Optional[str] = _find_tool('nice')
+            if nice_path is not None:
+                prefix += [nice_path, '-n', str(self.nice)]
+        if self.io_priority is not None:
+            ionice_path: Optional[str] = _find_tool('ionice')
+            if ionice_path is not None:
+                # -t: Run the command even if the priority can't be set.
+                prefix += [ionice_path, '-t', '-c', str(IOPRIO_CLASS_BEST_EFFORT), '-n', str(self.io_priority)]
+        return prefix + command_line
+
+    def apply(self, pid: int) -> None:
+        """
+        Apply the limits that can only be set once the process is running, IE: move it into the cgroup. Anything it
+        starts afterwards is in the cgroup too.
+        :param pid: int: The process id.
+        :return: None
+        """
+        if self.cgroup_path is None:
+            return
+        try:
+            with open(os.path.join(self.cgroup_path, 'cgroup.procs'), 'w') as file_handle:
+                file_handle.write(str(pid))
+        except OSError as e:
+            print("Failed to move process %i into cgroup '%s': %s" % (pid, self.cgroup_path, str(e)))
+        return
+
+    def to_dict(self) -> dict[str, object]:
+        """
+        Get the limits as a dict, for status.
+        :return: dict[str, object]: The limits.
+        """
+        return {
+            'cpus': format_cpu_list(self.cpus) if self.cpus is not None else None,
+            'numaNode': self.numa_node,
+            'nice': self.nice,
+            'ioPriority': self.io_priority,
+            'cgroup': self.cgroup_path,
+        }
@@ -4,14 +4,20 @@
 """
 import os
 import subprocess
-from datetime import timedelta, datetime
-from threading import Thread
-from typing import Callable, Optional
+from datetime import timedelta
+from typing import Callable, Optional, IO
 
+try:
+    from Supervisor import Supervisor, SupervisedProcess
+    from ProcessLimits import ProcessLimits
+except ModuleNotFoundError:
+    from .Supervisor import Supervisor, SupervisedProcess
+    from .ProcessLimits import ProcessLimits
 
-class SplitThread(Thread):
+
+class SplitThread(SupervisedProcess):
     """
-    Thread to run the ffmpeg split operation.
+    The ffmpeg split operation. It runs on the supervisor, but keeps the start() / join() interface of a thread.
     """
     def __init__(self,
                  ffmpeg_path: str,
@@ -20,7 +26,10 @@ class SplitThread(Thread):
                  chunk_size: int,
                  callback: Callable,
                  report_delay: float,
-                 total_time: Optional[timedelta] = None
+                 total_time: Optional[timedelta] = None,
+                 supervisor: Optional[Supervisor] = None,
+                 limits: Optional[ProcessLimits] = None,
+                 video_only: bool = False,
                  ) -> None:
         """
         Initialize the split thread.
@@ -28,12 +37,17 @@ class SplitThread(Thread):
         :param input_path: str: The full path to the input file, including filename.
         :param output_path: str: The full path ot the output directory, excluding filename.
         :param chunk_size: int: The number of seconds to split by.
-        :param callback: Callable: The callback to use when new files are created.
+        :param callback: Callable: The callback to use when new files are created, for reports, and once when the
+        split is finished with ('finished', success: bool).
         :param report_delay: float: Number of seconds to wait before reporting stats as a float.
         :param total_time: Optional[timedelta]: The total time of the input file. Optional. If not provided, then
         percent complete won't be calculated.
+        :param supervisor: Optional[Supervisor] = None: The supervisor to run ffmpeg on, None for the shared one.
+        :param limits: Optional[ProcessLimits] = None: The CPU / priority / cgroup limits to start ffmpeg with.
+        :param video_only: bool = False: True the chunks only carry the video, not attached pictures, audio,
+        subtitles, or attachments; Those are encoded once, see EncodeThread's no_video.
         """
-        super().__init__(daemon=True)
+        super().__init__(report_delay, supervisor, limits)
         self._ffmpeg_path: str = ffmpeg_path
         """The full path to ffmpeg."""
         self._input_path: str = input_path
@@ -53,12 +67,10 @@ class SplitThread(Thread):
         """The time that the current segment stops."""
         self._callback: Optional[Callable] = callback
         """The callback to call on report / new_file events."""
-        self._report_delay: float = report_delay
-        """The number of seconds to wait between reports as a float."""
         self._total_time: Optional[timedelta] = total_time
         """The length of the input video as a timedelta"""
-        self._start_time: Optional[datetime] = None
-        """The time the split was started used to calculate elapsed time."""
+        self._video_only: bool = video_only
+        """True the chunks only carry the video."""
 
         # Properties:
         self._output_files: list[str] = []
@@ -71,55 +83,98 @@ class SplitThread(Thread):
         """The total percentage completed."""
         self._percent_segment_complete: float = 0.0
         """The approx percent complete of the current segment."""
+        self._terminated: bool = False
+        """True if terminate() was called."""
         return
 
-    def run(self):
+    def start_process(self) -> list[IO[bytes]]:
         """
-        Start the split operation, calling the call back every file, and report period.
-        :return: None
+        Start the split operation.
+        :return: list[IO[bytes]]: ffmpeg's output, with the progress and the segment messages.
         """
         # ffmpeg -i movie.mp4 -c copy -map 0 -segment_time 120 -f segment job-id_%d.mp4
         command_line = [self._ffmpeg_path, '-y', '-hide_banner', '-progress', '-', '-nostdin', '-i', self._input_path,
-                        '-c', 'copy', '-map', '0', '-segment_time', str(self._chunk_size), '-f', 'segment',
-                        self._output_path]
-        process = subprocess.Popen(command_line, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        if process.returncode is not None:
-            raise RuntimeError("Failed to start ffmpeg")
-        self._start_time = datetime.now()
-        delta_delay = timedelta(seconds=self._report_delay)
-        report_time = self._start_time + delta_delay
+                        '-c', 'copy', '-map', '0:V' if self._video_only else '0',
+                        '-segment_time', str(self._chunk_size), '-f', 'segment', self._output_path]
         self._segment_start = timedelta(seconds=0)
-        while process.poll() is None:
-            line = process.stdout.readline()
-            if line.startswith('out_time_us'):  # Current time:
-                # Get and set the current position of the file:
-                micros: int = int(line.split('=')[-1])
-                self._current_time = timedelta(microseconds=micros)
-                # Calculate the approx segment percent complete:
-                if self._segment_start is not None:
-                    segment_time: timedelta = self._current_time - self._segment_start
-                    self._percent_segment_complete = (segment_time / self._segment_length) * 100.0
-                    self._percent_segment_complete = min(self._percent_segment_complete, 100.0)
-                # Calculate total percent complete if we have the info:
-                if self._total_time is not None:
-                    self._percent_complete = (self._current_time / self._total_time) * 100.0
-            elif line.startswith('speed'):  # Speed:
-                self._current_speed = line.split('=')[-1].strip()
-            elif line.startswith('[segment') and line.find("Opening") > -1:
-                # Collect and store the new file path:
-                file_path = line.split("'")[1]
-                self._output_files.append(file_path)
-                # Set the segment times:
-                self._segment_start = self._current_time
-                self._percent_segment_complete = 0.0
-                # Call the callback with the new file info:
-                self._callback('new_file', file_path, len(self._output_files))
-            if datetime.now() > report_time:
-                report_time = datetime.now() + delta_delay
-                self._callback('report', self._current_time, self._current_speed, self._percent_segment_complete,
-                               self._percent_complete)
+        self.popen(command_line, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if self._terminated:  # terminate() was called before ffmpeg started.
+            self.kill()
+        return [self._process.stdout]
+
+    def terminate(self) -> None:
+        """
+        Stop the split, killing ffmpeg if it's running. The split then reports as failed.
+        :return: None
+        """
+        self._terminated = True
+        self.kill()
+        return
+
+    def handle_progress(self, key: str, value: str) -> None:
+        """
+        Update the current time and speed.
+        :param key: str: The progress key.
+        :param value: str: The progress value.
+        :return: None
+        """
+        if key == 'out_time_us' and value != 'N/A':  # Current time:
+            # Get and set the current position of the file:
+            self._current_time = timedelta(microseconds=int(value))
+            # Calculate the approx segment percent complete:
+            if self._segment_start is not None:
+                segment_time: timedelta = self._current_time - self._segment_start
+                self._percent_segment_complete = (segment_time / self._segment_length) * 100.0
+                self._percent_segment_complete = min(self._percent_segment_complete, 100.0)
+            # Calculate total percent complete if we have the info:
+            if self._total_time is not None:
+                self._percent_complete = (self._current_time / self._total_time) * 100.0
+        elif key == 'speed':  # Speed:
+            self._current_speed = value
+        return
+
+    def handle_line(self, line: str) -> None:
+        """
+        Collect the new files as the segment muxer opens them.
+        :param line: str: The output line.
+        :return: None
+        """
+        if line.startswith('[segment') and line.find("Opening") > -1:
+            # Collect and store the new file path:
+            file_path = line.split("'")[1]
+            self._output_files.append(file_path)
+            # Set the segment times:
+            self._segment_start = self._current_time
+            self._percent_segment_complete = 0.0
+            # Call the callback with the new file info:
+            self._callback('new_file', file_path, len(self._output_files))
+        return
+
+    def handle_report(self) -> None:
+        """
+        Report the progress.
+        :return: None
+        """
+        self._callback('report', self._current_time, self._current_speed, self._percent_segment_complete,
+                       self._percent_complete)
         return
 
+    def handle_finished(self) -> None:
+        """
+        Report the split is finished.
+        :return: None
+        """
+        self._callback('finished', self.success)
+        return
+
+    @property
+    def success(self) -> bool:
+        """
+        Did the split finish successfully.
+        :return: bool: True ffmpeg exited with 0, False it's still running, failed, or was terminated.
+        """
+        return self._return_code == 0 and not self._terminated
+
     @property
     def output_files(self) -> tuple[str, ...]:
         return tuple(self._output_files)
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+    File: Supervisor.py
+    Description: A single thread that owns the ffmpeg child processes, and multiplexes their progress pipes with
+        selectors, instead of a thread blocking on readline() per process.
+"""
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import time
+import traceback
+from threading import Thread, Lock, Event
+from typing import Optional, Callable, Final, IO
+
+try:
+    from ProcessLimits import ProcessLimits
+except ModuleNotFoundError:
+    from .ProcessLimits import ProcessLimits
+
+READ_SIZE: Final[int] = 64 * 1024
+"""The max number of bytes to read from a progress pipe at a time."""
+EXIT_POLL_INTERVAL: Final[float] = 0.05
+"""The number of seconds between checks for processes that closed their pipes, but haven't exited yet."""
+
+
+class ProgressParser(object):
+    """
+    Incremental parser for ffmpeg's output. Bytes are fed as they're read, and split into lines on '\\n' or '\\r',
+    since the stats line is redrawn with '\\r'. A partial line is kept until the rest of it arrives.
+    """
+    def __init__(self) -> None:
+        """
+        Initialize the parser.
+        """
+        self._buffer: bytes = b''
+        """The partial line left over from the last feed."""
+        return
+
+    def feed(self, data: bytes) -> list[tuple[Optional[str], str]]:
+        """
+        Parse a block of output.
+        :param data: bytes: The bytes read from the pipe.
+        :return: list[tuple[Optional[str], str]]: A list of (key, value) tuples for the -progress 'key=value' lines,
+        and (None, line) tuples for any other line, in order.
+        """
+        lines = (self._buffer + data).replace(b'\r', b'\n').split(b'\n')
+        self._buffer = lines.pop()
+        return [self.parse_line(line) for line in lines if line]
+
+    def flush(self) -> list[tuple[Optional[str], str]]:
+        """
+        Parse the partial line left at EOF.
+        :return: list[tuple[Optional[str], str]]: The parsed line, if there was one, see feed().
+        """
+        line, self._buffer = self._buffer, b''
+        if not line:
+            return []
+        return [self.parse_line(line)]
+
+    @staticmethod
+    def parse_line(line: bytes) -> tuple[Optional[str], str]:
+        """
+        Parse a single line.
+        :param line: bytes: The line, without the line ending.
+        :return: tuple[Optional[str], str]: (key, value) for a -progress line, IE: ('speed', '1.5x'), or
+        (None, line) for any other line. The stats line, IE: 'frame=  10 fps=...', is not a progress line.
+        """
+        key, separator, value = line.partition(b'=')
+        if separator and key and b' ' not in key and b'=' not in value:
+            return key.decode('utf-8', 'replace'), value.strip().decode('utf-8', 'replace')
+        return None, line.decode('utf-8', 'replace')
+
+
+class SupervisedProcess(object):
+    """
+    Base class for an ffmpeg process run by the supervisor. Subclasses start the process, and handle the parsed
+    output; The handlers are called from the supervisor thread, so they must not block.
+    """
+    def __init__(self,
+                 report_delay: float,
+                 supervisor: Optional['Supervisor'] = None,
+                 limits: Optional[ProcessLimits] = None,
+                 ) -> None:
+        """
+        Initialize the process.
+        :param report_delay: float: The number of seconds to wait between reports.
+        :param supervisor: Optional[Supervisor] = None: The supervisor to run on, None uses the shared supervisor.
+        :param limits: Optional[ProcessLimits] = None: The CPU / priority / cgroup limits to start ffmpeg with.
+        """
+        self._supervisor: Supervisor = supervisor if supervisor is not None else get_supervisor()
+        """The supervisor running this process."""
+        self._limits: Optional[ProcessLimits] = limits
+        """The limits to start ffmpeg with, None for no limits."""
+        self._report_delay: float = report_delay
+        """The number of seconds to wait between reports."""
+        self._report_time: float = 0.0
+        """The monotonic time of the next report."""
+        self._process: Optional[subprocess.Popen] = None
+        """The ffmpeg process, None until it's started."""
+        self._return_code: Optional[int] = None
+        """ffmpeg's return code, None until it exits, or if it failed to start."""
+        self._started: bool = False
+        """True once start() has been called."""
+        self._finished: Event = Event()
+        """Set once ffmpeg has exited, and all its pipes and helper threads are done."""
+        self._pending: int = 0
+        """The number of things to wait for before finishing: the process, its open pipes, and helper threads."""
+        self._pending_lock: Lock = Lock()
+        """Lock for _pending."""
+        return
+
+    def start(self) -> None:
+        """
+        Start ffmpeg on the supervisor.
+        :return: None
+        """
+        self._started = True
+        self._report_time = time.monotonic() + self._report_delay
+        self._supervisor.spawn(self)
+        return
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        """
+        Block until ffmpeg has exited, and the output has been handled.
+        :param timeout: Optional[float] = None: The number of seconds to wait, None to wait forever.
+        :return: None
+        """
+        self._finished.wait(timeout)
+        return
+
+    def is_alive(self) -> bool:
+        """
+        Is the process started, and not yet finished.
+        :return: bool: True if running.
+        """
+        return self._started and not self._finished.is_set()
+
+    def start_process(self) -> list[IO[bytes]]:
+        """
+        Start the ffmpeg process, called by the supervisor.
+        :return: list[IO[bytes]]: The pipes for the supervisor to read and parse.
+        """
+        raise NotImplementedError
+
+    def handle_progress(self, key: str, value: str) -> None:
+        """
+        Handle a -progress 'key=value' line.
+        :param key: str: The key, IE: 'out_time_us'.
+        :param value: str: The value.
+        :return: None
+        """
+        return
+
+    def handle_line(self, line: str) -> None:
+        """
+        Handle any other line of output.
+        :param line: str: The line.
+        :return: None
+        """
+        return
+
+    def handle_report(self) -> None:
+        """
+        Send a progress report, called at most once every report_delay seconds.
+        :return: None
+        """
+        return
+
+    def handle_finished(self) -> None:
+        """
+        Called once ffmpeg has exited, and all the output has been handled.
+        :return: None
+        """
+        return
+
+    def handle_output(self, events: list[tuple[Optional[str], str]]) -> None:
+        """
+        Handle a block of parsed output, then report if it's time to.
+        :param events: list[tuple[Optional[str], str]]: The parsed lines, see ProgressParser.feed().
+        :return: None
+        """
+        for key, value in events:
+            if key is None:
+                self.handle_line(value)
+            else:
+                self.handle_progress(key, value)
+        now = time.monotonic()
+        if now >= self._report_time:
+            self._report_time = now + self._report_delay
+            self.handle_report()
+        return
+
+    def start_helper(self, target: Callable, *args) -> None:
+        """
+        Run a blocking helper, IE: feeding stdin, on its own thread. The process doesn't finish until it returns.
+        :param target: Callable: The function to run.
+        :param args: The arguments to pass to it.
+        :return: None
+        """
+        def run_helper() -> None:
+            try:
+                target(*args)
+            finally:
+                self.release()
+            return
+
+        self.acquire(1)
+        Thread(target=run_helper, daemon=True).start()
+        return
+
+    def acquire(self, count: int) -> None:
+        """
+        Add things to wait for before finishing.
+        :param count: int: The number of things.
+        :return: None
+        """
+        with self._pending_lock:
+            self._pending += count
+        return
+
+    def release(self) -> None:
+        """
+        Mark one thing to wait for as done, and finish if it was the last one.
+        :return: None
+        """
+        with self._pending_lock:
+            self._pending -= 1
+            if self._pending > 0:
+                return
+        try:
+            self.handle_finished()
+        finally:
+            self._finished.set()
+        return
+
+    def exited(self, return_code: int) -> None:
+        """
+        Called by the supervisor when ffmpeg has exited.
+        :param return_code: int: ffmpeg's return code.
+        :return: None
+        """
+        self._return_code = return_code
+        self.release()
+        return
+
+    def popen(self, command_line: list[str], **kwargs) -> subprocess.Popen:
+        """
+        Start ffmpeg in its own process group, so kill() reaches anything it starts, and a Ctrl-C meant for the
+        daemon doesn't reach it. The limits, if any, are applied.
+        :param command_line: list[str]: The command line.
+        :param kwargs: The other subprocess.Popen() arguments.
+        :return: subprocess.Popen: The process.
+        """
+        if self._limits is not None:
+            command_line = self._limits.wrap(command_line)
+        self._process = subprocess.Popen(command_line, start_new_session=True, **kwargs)
+        if self._limits is not None:
+            self._limits.apply(self._process.pid)
+        return self._process
+
+    def kill(self) -> None:
+        """
+        Terminate ffmpeg's process group if it's running.
+        :return: None
+        """
+        if self._process is not None and self._process.poll() is None:
+            try:
+                os.killpg(self._process.pid, signal.SIGTERM)
+            except ProcessLookupError:  # Exited in the meantime.
+                pass
+        return
+
+    @property
+    def process(self) -> Optional[subprocess.Popen]:
+        return self._process
+
+    @property
+    def return_code(self) -> Optional[int]:
+        return self._return_code
+
+
+class Supervisor(Thread):
+    """
+    Thread to own ffmpeg child processes; it reads all their progress pipes with one selector, parses the output,
+    and reaps the processes when they exit.
+    """
+    def __init__(self) -> None:
+        """
+        Initialize the supervisor, it's started on the first spawn().
+        """
+        super().__init__(daemon=True, name='ffmpeg supervisor')
+        self._selector: selectors.BaseSelector = selectors.DefaultSelector()
+        """The selector for the progress pipes."""
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        self._selector.register(self._wake_read, selectors.EVENT_READ, None)
+        self._lock: Lock = Lock()
+        """Lock for the new process list, and starting the thread."""
+        self._new: list[tuple[SupervisedProcess, list[IO[bytes]]]] = []
+        """Processes started, but not registered with the selector yet."""
+        self._open_pipes: dict[SupervisedProcess, int] = {}
+        """The number of open pipes per process."""
+        self._exiting: list[SupervisedProcess] = []
+        """Processes with all their pipes closed, waiting to exit."""
+        return
+
+    def spawn(self, supervised: SupervisedProcess) -> bool:
+        """
+        Start a process, and supervise it. Called from any thread.
+        :param supervised: SupervisedProcess: The process to start.
+        :return: bool: True the process started, False it failed; The process is finished either way.
+        """
+        with self._lock:
+            if not self.is_alive():
+                self.start()
+        supervised.acquire(1)  # The process itself, released when it's reaped.
+        try:
+            pipes = supervised.start_process()
+        except (OSError, ValueError, RuntimeError) as e:
+            print("Failed to start ffmpeg: %s" % str(e), file=sys.stderr)
+            supervised.release()
+            return False
+        supervised.acquire(len(pipes))
+        with self._lock:
+            self._new.append((supervised, pipes))
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:  # Already woken.
+            pass
+        return True
+
+    def _register_new(self) -> None:
+        """
+        Register the pipes of newly started processes.
+        :return: None
+        """
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            new, self._new = self._new, []
+        for supervised, pipes in new:
+            self._open_pipes[supervised] = len(pipes)
+            if not pipes:
+                self._exiting.append(supervised)
+            for pipe in pipes:
+                self._selector.register(pipe, selectors.EVENT_READ, (supervised, ProgressParser()))
+        return
+
+    def _read_pipe(self, key: selectors.SelectorKey) -> None:
+        """
+        Read and parse what's available from a progress pipe, closing it at EOF.
+        :param key: selectors.SelectorKey: The selector key of the pipe.
+        :return: None
+        """
+        supervised, parser = key.data
+        try:
+            data: bytes = os.read(key.fd, READ_SIZE)
+        except OSError:
+            data = b''
+        try:
+            if data:
+                supervised.handle_output(parser.feed(data))
+            else:
+                supervised.handle_output(parser.flush())
+        except Exception:  # A broken handler must not stop the other processes.
+            traceback.print_exc()
+            supervised.kill()
+        if data:
+            return
+        self._selector.unregister(key.fileobj)
+        key.fileobj.close()
+        supervised.release()
+        self._open_pipes[supervised] -= 1
+        if self._open_pipes[supervised] == 0:
+            self._exiting.append(supervised)
+        return
+
+    def _reap(self) -> None:
+        """
+        Collect the return codes of processes that have exited.
+        :return: None
+        """
+        for supervised in tuple(self._exiting):
+            return_code = supervised.process.poll()
+            if return_code is None:
+                continue
+            self._exiting.remove(supervised)
+            del self._open_pipes[supervised]
+            try:
+                supervised.exited(return_code)
+            except Exception:
+                traceback.print_exc()
+        return
+
+    def run(self) -> None:
+        """
+        Wait for output from any process, and handle it.
+        :return: None
+        """
+        while True:
+            timeout: Optional[float] = EXIT_POLL_INTERVAL if self._exiting else None
+            for key, _events in self._selector.select(timeout):
+                if key.data is None:
+                    self._register_new()
+                else:
+                    self._read_pipe(key)
+            if self._exiting:
+                self._reap()
+
+
+_shared_supervisor: Optional[Supervisor] = None
+"""The supervisor used when none is given."""
+_shared_lock: Lock = Lock()
+"""Lock for creating the shared supervisor."""
+
+
+def get_supervisor() -> Supervisor:
+    """
+    Get the shared supervisor, creating it if needed.
+    :return: Supervisor: The shared supervisor.
+    """
+    global _shared_supervisor
+    with _shared_lock:
+        if _shared_supervisor is None:
+            _shared_supervisor = Supervisor()
+        return _shared_supervisor
+
+
+if __name__ == '__main__':
+    exit(0)
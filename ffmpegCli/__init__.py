@@ -2,4 +2,6 @@
 from typing import Final
 
 from ffmpegCli.Ffmpegcli import Ffmpegcli
+from ffmpegCli.EncodeThread import AudioEncoders, VideoEncoders
+from ffmpegCli.ProcessLimits import ProcessLimits, plan_cpu_sets, create_cgroup, set_thread_io_priority
 __version__: Final[str] = '1.0.0'
\ No newline at end of file